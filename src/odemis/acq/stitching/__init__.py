@@ -15,10 +15,10 @@ Odemis is distributed in the hope that it will be useful, but WITHOUT ANY WARRAN
 You should have received a copy of the GNU General Public License along with Odemis. If not, see http://www.gnu.org/licenses/.
 '''
 from odemis.acq.stitching._constants import REGISTER_GLOBAL_SHIFT, REGISTER_SHIFT, \
-    REGISTER_IDENTITY, WEAVER_MEAN, WEAVER_COLLAGE, WEAVER_COLLAGE_REVERSE
+    REGISTER_IDENTITY, REGISTER_PYRAMID, WEAVER_MEAN, WEAVER_COLLAGE, WEAVER_COLLAGE_REVERSE
 from odemis.acq.stitching._tiledacq import (acquireTiledArea, acquireOverview, estimateOverviewTime,
                                             estimateTiledAcquisitionTime, estimateTiledAcquisitionMemory,
                                             FocusingMethod, get_tiled_areas, get_zstack_levels)
 from odemis.acq.stitching._registrar import *
 from odemis.acq.stitching._weaver import *
-from odemis.acq.stitching._simple import register, weave
+from odemis.acq.stitching._simple import register, weave, weave_into, StitchingPipeline
@@ -21,6 +21,7 @@ Odemis. If not, see http://www.gnu.org/licenses/.
 REGISTER_IDENTITY = 0
 REGISTER_SHIFT = 1
 REGISTER_GLOBAL_SHIFT = 2
+REGISTER_PYRAMID = 3
 WEAVER_MEAN = 0
 WEAVER_COLLAGE = 1
 WEAVER_COLLAGE_REVERSE = 2
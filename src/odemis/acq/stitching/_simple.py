@@ -14,11 +14,14 @@ Odemis is distributed in the hope that it will be useful, but WITHOUT ANY WARRAN
 
 You should have received a copy of the GNU General Public License along with Odemis. If not, see http://www.gnu.org/licenses/.
 '''
+from concurrent.futures import ThreadPoolExecutor
 import copy
+import logging
 from odemis import model
 from odemis.acq.stitching._constants import REGISTER_GLOBAL_SHIFT, REGISTER_SHIFT, \
-    REGISTER_IDENTITY, WEAVER_MEAN, WEAVER_COLLAGE, WEAVER_COLLAGE_REVERSE
-from odemis.acq.stitching._registrar import ShiftRegistrar, IdentityRegistrar, GlobalShiftRegistrar
+    REGISTER_IDENTITY, REGISTER_PYRAMID, WEAVER_MEAN, WEAVER_COLLAGE, WEAVER_COLLAGE_REVERSE
+from odemis.acq.stitching._registrar import ShiftRegistrar, IdentityRegistrar, GlobalShiftRegistrar, \
+    PyramidShiftRegistrar
 from odemis.acq.stitching._weaver import MeanWeaver, CollageWeaver, CollageWeaverReverse
 
 
@@ -27,37 +30,67 @@ def register(tiles, method=REGISTER_GLOBAL_SHIFT):
     tiles (list of DataArray of shape YX or tuples of DataArrays): The tiles to compute the registration.
     If it's tuples, the first tile of each tuple is the “main tile”, and the following ones are
     dependent tiles.
-    method (REGISTER_*): REGISTER_SHIFT → ShiftRegistrar, REGISTER_IDENTITY → IdentityRegistrar
+    method (REGISTER_*): REGISTER_SHIFT → ShiftRegistrar, REGISTER_IDENTITY → IdentityRegistrar,
+      REGISTER_GLOBAL_SHIFT → GlobalShiftRegistrar, REGISTER_PYRAMID → PyramidShiftRegistrar
     returns:
         tiles (list of DataArray of shape YX or tuples of DataArrays): The tiles as passed, but with updated
         MD_POS metadata
     """
 
-    if method == REGISTER_SHIFT:
-        registrar = ShiftRegistrar()
-    elif method == REGISTER_IDENTITY:
-        registrar = IdentityRegistrar()
-    elif method == REGISTER_GLOBAL_SHIFT:
-        registrar = GlobalShiftRegistrar()
-    else:
-        raise ValueError("Invalid registrar %s" % (method,))
+    registrar = _create_registrar(method)
 
     # Register tiles
-    updatedTiles = []
     for ts in tiles:
-        # Separate tile and dependent_tiles
-        if isinstance(ts, tuple):
-            tile = ts[0]
-            dep_tiles = ts[1:]
-        else:
-            tile = ts
-            dep_tiles = None
+        tile, dep_tiles = _split_tiles(ts)
         registrar.addTile(tile, dep_tiles)
 
     # Compute the positions
     positions, dep_positions = registrar.getPositions()
 
+    return _update_positions(tiles, positions, dep_positions)
+
+
+def _create_registrar(method):
+    """
+    method (REGISTER_*): the registration method
+    return (Registrar): a new registrar for the given method
+    raise ValueError: if the method is unknown
+    """
+    if method == REGISTER_SHIFT:
+        return ShiftRegistrar()
+    elif method == REGISTER_IDENTITY:
+        return IdentityRegistrar()
+    elif method == REGISTER_GLOBAL_SHIFT:
+        return GlobalShiftRegistrar()
+    elif method == REGISTER_PYRAMID:
+        return PyramidShiftRegistrar()
+    else:
+        raise ValueError("Invalid registrar %s" % (method,))
+
+
+def _split_tiles(ts):
+    """
+    Separate the main tile and the dependent tiles
+    ts (DataArray or tuple of DataArrays): the tile(s) at one position
+    return (DataArray, tuple of DataArrays or None): main tile, dependent tiles
+    """
+    if isinstance(ts, tuple):
+        return ts[0], ts[1:]
+    else:
+        return ts, None
+
+
+def _update_positions(tiles, positions, dep_positions):
+    """
+    Create DataArrays with the same data as the tiles, but with the MD_POS updated
+    tiles (list of DataArray of shape YX or tuples of DataArrays): the tiles, as
+      passed to the registrar
+    positions (list of tuples): the position of each main tile
+    dep_positions (list of tuples of tuples): the position of each dependent tile
+    return (list of DataArray of shape YX or tuples of DataArrays): the updated tiles
+    """
     # Update positions, by creating DataArrays with the same data, but different MD_POS
+    updatedTiles = []
     for i, ts in enumerate(tiles):
         # Return tuple of positions if dependent tiles are present
         if isinstance(ts, tuple):
@@ -95,14 +128,7 @@ def weave(tiles, method=WEAVER_MEAN, adjust_brightness=False):
         image (DataArray of shape Y'X'): A large image containing all the tiles
     """
 
-    if method == WEAVER_MEAN:
-        weaver = MeanWeaver(adjust_brightness)
-    elif method == WEAVER_COLLAGE:
-        weaver = CollageWeaver(adjust_brightness)
-    elif method == WEAVER_COLLAGE_REVERSE:
-        weaver = CollageWeaverReverse(adjust_brightness)
-    else:
-        raise ValueError("Invalid weaver %s" % (method,))
+    weaver = _create_weaver(method, adjust_brightness)
 
     for t in tiles:
         if isinstance(t, model.DataArrayShadow):
@@ -111,3 +137,146 @@ def weave(tiles, method=WEAVER_MEAN, adjust_brightness=False):
     stitched_image = weaver.getFullImage()
 
     return stitched_image
+
+
+def weave_into(tiles, writer, method=WEAVER_MEAN, adjust_brightness=False):
+    """
+    Same as weave(), but the large image is directly written into a file, block
+    by block, so that it never needs to be entirely in memory.
+    tiles (list of DataArray or DataArrayShadow of shape YX): The tiles to draw.
+      To keep the memory usage low, they should be memory-mapped (eg, opened
+      from uncompressed TIFF files).
+    writer (AcquisitionWriter): writer of the file (eg, from dataio.hdf5 or dataio.zarr)
+    method (WEAVER_*): WEAVER_MEAN → MeanWeaver, WEAVER_COLLAGE → CollageWeaver
+    return:
+        image (StreamedImage of shape Y'X'): The image in the file, containing all the tiles
+    """
+    weaver = _create_weaver(method, adjust_brightness)
+
+    for t in tiles:
+        if isinstance(t, model.DataArrayShadow):
+            t = t.getData()
+        weaver.addTile(t)
+    return weaver.weaveInto(writer)
+
+
+def _create_weaver(method, adjust_brightness=False):
+    """
+    method (WEAVER_*): the weaving method
+    adjust_brightness (bool): True if brightness correction should be applied
+    return (Weaver): a new weaver for the given method
+    raise ValueError: if the method is unknown
+    """
+    if method == WEAVER_MEAN:
+        return MeanWeaver(adjust_brightness)
+    elif method == WEAVER_COLLAGE:
+        return CollageWeaver(adjust_brightness)
+    elif method == WEAVER_COLLAGE_REVERSE:
+        return CollageWeaverReverse(adjust_brightness)
+    else:
+        raise ValueError("Invalid weaver %s" % (method,))
+
+
+class StitchingPipeline(object):
+    """
+    Stitches tiles while they are being acquired: each tile is passed to the
+    registrar, in a separate thread, as soon as it's added. So when the last
+    tile is added, only the global position optimisation and the weaving are
+    left to do.
+    The tiles must be added in the same order as they were acquired, as each
+    tile is registered against the previously added ones.
+    """
+
+    def __init__(self, registrar=REGISTER_GLOBAL_SHIFT, weaver=WEAVER_MEAN, adjust_brightness=False):
+        """
+        registrar (REGISTER_*): the registration method
+        weaver (WEAVER_*): the weaving method
+        adjust_brightness (bool): True if brightness correction should be applied
+        raise ValueError: if the registration or weaving method is unknown
+        """
+        self._reg_method = registrar
+        self._registrar = _create_registrar(registrar)
+        _create_weaver(weaver)  # Just to check the method is valid
+        self._weaver = weaver
+        self._adjust_brt = adjust_brightness
+
+        self._tiles = []  # DataArrays or tuples of DataArrays, as added
+        self._futures = []
+        # If the registrar failed, the exception which was raised
+        self._reg_error = None
+        # Only one worker, as the registrar handles the tiles one at a time
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def addTile(self, ts):
+        """
+        Add a tile, and start registering it in the background
+        ts (DataArray of shape YX or tuple of DataArrays): the tile. If it's a
+          tuple, the first tile is the “main tile”, and the following ones are
+          dependent tiles.
+        """
+        self._tiles.append(ts)
+        self._futures.append(self._executor.submit(self._registerTile, ts))
+
+    def _registerTile(self, ts):
+        if self._reg_error is not None:
+            return  # Anyway, the registration will be done again with the identity registrar
+
+        tile, dep_tiles = _split_tiles(ts)
+        try:
+            self._registrar.addTile(tile, dep_tiles)
+        except ValueError as ex:
+            self._reg_error = ex
+
+    def getRegisteredTiles(self):
+        """
+        Wait for all the tiles to be registered, and compute their positions.
+        If the registration fails, the tiles are placed based on their original
+        MD_POS (ie, with the identity registrar).
+        return (list of DataArray of shape YX or tuples of DataArrays): the tiles
+          as added, but with updated MD_POS metadata
+        raise ValueError: if no tile was added
+        """
+        if not self._tiles:
+            raise ValueError("No tile to register")
+
+        for f in self._futures:
+            f.result()
+        self._executor.shutdown()
+
+        if self._reg_error is None:
+            try:
+                positions, dep_positions = self._registrar.getPositions()
+                return _update_positions(self._tiles, positions, dep_positions)
+            except ValueError as ex:
+                self._reg_error = ex
+
+        logging.warning("Registration with %s failed %s. Retrying with identity registrar.",
+                        self._reg_method, self._reg_error)
+        return register(self._tiles, method=REGISTER_IDENTITY)
+
+    def getFullImages(self):
+        """
+        Register all the tiles and weave them. Each stream is woven in a separate
+        thread.
+        return (list of DataArrays of shape Y'X'): a large image for each stream
+          (ie, each element of the tuples, or just one image if the tiles are not
+          tuples)
+        raise ValueError: if no tile was added
+        """
+        das_registered = self.getRegisteredTiles()
+        if isinstance(das_registered[0], tuple):
+            streams = [[das[s] for das in das_registered] for s in range(len(das_registered[0]))]
+        else:
+            streams = [das_registered]
+
+        with ThreadPoolExecutor(max_workers=len(streams)) as executor:
+            futures = [executor.submit(weave, tiles, self._weaver, self._adjust_brt)
+                       for tiles in streams]
+            return [f.result() for f in futures]
+
+    def cancel(self):
+        """
+        Stop registering the tiles which are still waiting. Safe to call
+        several times, and after the images were computed.
+        """
+        self._executor.shutdown(wait=False, cancel_futures=True)
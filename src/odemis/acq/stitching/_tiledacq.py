@@ -37,8 +37,8 @@ from odemis.acq import acqmng
 from odemis.acq.align.autofocus import AutoFocus, MTD_EXHAUSTIVE
 from odemis.util.focus import MeasureOpticalFocus
 from odemis.acq.align.roi_autofocus import autofocus_in_roi, estimate_autofocus_in_roi_time
-from odemis.acq.stitching._constants import WEAVER_MEAN, REGISTER_IDENTITY, REGISTER_GLOBAL_SHIFT
-from odemis.acq.stitching._simple import register, weave
+from odemis.acq.stitching._constants import WEAVER_MEAN, REGISTER_GLOBAL_SHIFT
+from odemis.acq.stitching._simple import StitchingPipeline
 from odemis.acq.stream import Stream, EMStream, ARStream, \
     SpectrumStream, FluoStream, MultipleDetectorStream, util, executeAsyncTask, \
     CLStream
@@ -636,9 +636,11 @@ class TiledAcquisitionTask(object):
             das.append(da)
         return das
 
-    def _acquireTiles(self):
+    def _acquireTiles(self, stitcher=None):
         """
          Acquire needed tiles by moving the stage to the tile position then calling acqmng.acquire
+        :param stitcher: (StitchingPipeline or None) if provided, each tile is passed to it, as
+          soon as it's acquired, so that it's registered while the next tiles are acquired.
         :return: (list of list of DataArrays): list of acquired data for each stream on each tile
         """
         da_list = []  # for each position, a list of DataArrays
@@ -672,7 +674,10 @@ class TiledAcquisitionTask(object):
                 self._save_tiles(ix, iy, das)
 
             # Sort tiles (largest sem on first position)
-            da_list.append(self._sortDAs(das, self._streams))
+            das = self._sortDAs(das, self._streams)
+            da_list.append(das)
+            if stitcher and das:
+                stitcher.addTile(das)
 
             i += 1
         return da_list
@@ -836,34 +841,22 @@ class TiledAcquisitionTask(object):
 
         return das
 
-    def _stitchTiles(self, da_list):
+    def _stitchTiles(self, da_list, stitcher=None):
         """
         Stitch the acquired tiles to create a complete view of the required total area
+        :param stitcher: (StitchingPipeline or None) the pipeline to which all the tiles of
+          da_list have already been added. If None, the tiles are registered now.
         :return: (list of DataArrays): a stitched data for each stream acquisition
         """
-        st_data = []
         logging.info("Computing big image out of %d images", len(da_list))
-
-        # TODO: Do this registration step in a separate thread while acquiring
-        try:
-            das_registered = register(da_list, method=self._registrar)
-        except ValueError as exp:
-            logging.warning("Registration with %s failed %s. Retrying with identity registrar.", self._registrar, exp)
-            das_registered = register(da_list, method=REGISTER_IDENTITY)
+        if stitcher is None:
+            stitcher = StitchingPipeline(self._registrar, self._weaver)
+            for das in da_list:
+                stitcher.addTile(das)
 
         logging.info("Using weaving method %s.", self._weaver)
         # Weave every stream
-        if isinstance(das_registered[0], tuple):
-            for s in range(len(das_registered[0])):
-                streams = []
-                for da in das_registered:
-                    streams.append(da[s])
-                da = weave(streams, self._weaver)
-                st_data.append(da)
-        else:
-            da = weave(das_registered, self._weaver)
-            st_data.append(da)
-        return st_data
+        return stitcher.getFullImages()
 
     def run(self):
         """
@@ -878,9 +871,11 @@ class TiledAcquisitionTask(object):
             return
         self._future._task_state = RUNNING
         st_data = []
+        # The tiles are registered while the acquisition continues
+        stitcher = StitchingPipeline(self._registrar, self._weaver)
         try:
             # Acquire the needed tiles
-            da_list = self._acquireTiles()
+            da_list = self._acquireTiles(stitcher)
 
             if not da_list or not da_list[0]:
                 logging.warning("No stream acquired that can be used for stitching.")
@@ -888,7 +883,7 @@ class TiledAcquisitionTask(object):
                 logging.info("Acquisition completed, now stitching...")
                 # Stitch the acquired tiles
                 self._future.set_progress(end=self.estimateTime(0) + time.time())
-                st_data = self._stitchTiles(da_list)
+                st_data = self._stitchTiles(da_list, stitcher)
 
             if self._future._task_state == CANCELLED:
                 raise CancelledError()
@@ -900,6 +895,7 @@ class TiledAcquisitionTask(object):
             self._future.running_subf.cancel()
             raise
         finally:
+            stitcher.cancel()
             logging.info("Tiled acquisition ended")
             with self._future._task_lock:
                 self._future._task_state = FINISHED
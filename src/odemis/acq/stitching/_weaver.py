@@ -16,10 +16,13 @@ You should have received a copy of the GNU General Public License along with Ode
 """
 
 from abc import ABCMeta
+import itertools
 import logging
-import copy
+import math
 import numpy
 from abc import abstractmethod
+from scipy.sparse import csr_matrix
+from scipy.sparse.linalg import lsqr
 from odemis import model, util
 from odemis.util import img
 
@@ -32,6 +35,11 @@ from odemis.util import img
 # directly copy the image already transformed.
 # TODO: handle higher dimensions by just copying them as-is
 
+# Size of the blocks in which the global image is computed, when it's directly
+# written into a file (see Weaver.weaveInto()). Only the tiles overlapping a
+# block are accessed when computing it.
+BLOCK_SIZE = 2048  # px
+
 class Weaver(metaclass=ABCMeta):
     """
     Abstract class representing a weaver.
@@ -41,13 +49,15 @@ class Weaver(metaclass=ABCMeta):
     def __init__(self, adjust_brightness=False):
         """
         adjust_brightness (bool): True if brightness correction should be applied (useful in case of
-        tiles with strong bleaching/depletion effects)
+        tiles with strong bleaching/depletion effects). The brightness of the tiles is adjusted
+        so that it matches in the regions where they overlap.
         """
         self.tiles = []
         self.adjust_brt = adjust_brightness
         self.tbbx_px = None  # the bounding boxes of each tile in pixel coordinates
         self.gbbx_px = None  # the global bounding box of the weaved image in pixel coordinates
         self.gbbx_phy = None  # the global bounding box of the weaved image in physical coordinates
+        self._brt_corr = None  # (list of (float, float)) gain and offset of each tile, if adjust_brt
 
     def addTile(self, tile):
         """
@@ -70,6 +80,54 @@ class Weaver(metaclass=ABCMeta):
         Assembles the tiles into a large image.
         return (2D DataArray): same dtype as the tiles, with shape corresponding to the bounding box of the tiles.
         """
+        rotation, center_of_rot = self._align_tiles()
+        im = self.weave_tiles()
+        md = self.get_final_metadata(self.tiles[0].metadata.copy())
+        weaved_image = img.rotate_img_metadata(model.DataArray(im, md), rotation, center_of_rot)
+
+        return weaved_image
+
+    def weaveInto(self, writer, block_size=BLOCK_SIZE):
+        """
+        Assembles the tiles into a large image, which is directly written into a file.
+        The image is computed block by block, so that the whole image never needs
+        to be in memory. The result is the same as with getFullImage().
+        If the tiles are memory-mapped (eg, uncompressed TIFF files), only the
+        tiles overlapping the current block are read.
+        writer (AcquisitionWriter): writer of the file, with a create_image() method
+          (eg, from dataio.hdf5 or dataio.zarr)
+        block_size (int): size of the side of the blocks, in px
+        return (StreamedImage): the image as written in the file. It still needs
+          to be finalised (or the writer closed).
+        """
+        rotation, center_of_rot = self._align_tiles()
+        md = self.get_final_metadata(self.tiles[0].metadata.copy())
+        # Only the metadata is rotated, so no need to pass the actual image
+        md = img.rotate_img_metadata(model.DataArray(numpy.empty((0, 0)), md),
+                                     rotation, center_of_rot).metadata
+
+        shape = self.gbbx_px[-1], self.gbbx_px[-2]
+        logging.debug("Generating global image of size %dx%d px, by blocks of %d px",
+                      shape[1], shape[0], block_size)
+        out = writer.create_image(shape, self.tiles[0].dtype, md)
+        background = self._get_background()
+        for top in range(0, shape[0], block_size):
+            for left in range(0, shape[1], block_size):
+                bshape = min(block_size, shape[0] - top), min(block_size, shape[1] - left)
+                im = self._weave_block((left, top), bshape, background)
+                out.write(im, (top, left))
+
+        return out
+
+    def _align_tiles(self):
+        """
+        Rotate all tiles by the inverse of the rotation of the first tile, such that each tile is
+        aligned with the horizontal axis, and compute their bounding boxes (and the brightness
+        correction, if requested).
+        :returns: (float, (float, float)) the rotation and center of rotation, to be applied to
+        the final image.
+        :updates self.tiles, self.tbbx_px, self.gbbx_px, self.gbbx_phy, self._brt_corr:
+        """
         # NOTE on rotation:
         # Total image rotation is the sum of the "standard" rotation, relative to the sample coordinates, and the scan rotation.
         # The scan rotation is not used when displaying the images, because it causes images to be displayed 'upside down' from
@@ -86,18 +144,64 @@ class Weaver(metaclass=ABCMeta):
         self.tiles = tiles
 
         self.tbbx_px, self.gbbx_px, self.gbbx_phy = self.get_bounding_boxes(self.tiles)
-        im = self.weave_tiles()
-        md = self.get_final_metadata(self.tiles[0].metadata.copy())
-        weaved_image = img.rotate_img_metadata(model.DataArray(im, md), rotation, center_of_rot)
-
-        return weaved_image
+        if self.adjust_brt:
+            self._brt_corr = self._compute_brightness_correction()
+        return rotation, center_of_rot
 
-    @abstractmethod
     def weave_tiles(self):
         """
         Weave the tiles into a single image.
         return (2D DataArray): The weaved image.
         """
+        logging.debug("Generating global image of size %dx%d px",
+                      self.gbbx_px[-2], self.gbbx_px[-1])
+        return self._weave_block((0, 0), (self.gbbx_px[-1], self.gbbx_px[-2]), self._get_background())
+
+    def _get_background(self):
+        """
+        return (number): the value of the parts of the global image not covered by any tile,
+          which is the minimum value of all the tiles.
+        """
+        # Look at the tiles one at a time, to not have to copy all of them into a single array
+        return numpy.amin([numpy.amin(t) for t in self.tiles])
+
+    def _weave_block(self, lt, shape, background):
+        """
+        Compute a block of the global image.
+        lt (int, int): position of the top-left corner of the block in the global image, in px
+        shape (int, int): YX shape of the block
+        background (number): value of the pixels not covered by any tile
+        return (2D ndarray): the block of the global image
+        """
+        im = numpy.full(shape, background, dtype=self.tiles[0].dtype)
+
+        # Find the part of each tile overlapping the block
+        tiles = []
+        for i, (b, t) in enumerate(zip(self.tbbx_px, self.tiles)):
+            l, r = max(b[0], lt[0]), min(b[0] + t.shape[1], lt[0] + shape[1])
+            u, d = max(b[1], lt[1]), min(b[1] + t.shape[0], lt[1] + shape[0])
+            if l >= r or u >= d:
+                continue
+            if self._brt_corr is not None:
+                t = self._adjust_brightness(t, *self._brt_corr[i])
+            bslc = slice(u - lt[1], d - lt[1]), slice(l - lt[0], r - lt[0])
+            tslc = slice(u - b[1], d - b[1]), slice(l - b[0], r - b[0])
+            tiles.append((bslc, tslc, t))
+
+        self._paste_tiles(im, tiles)
+        return im
+
+    @abstractmethod
+    def _paste_tiles(self, im, tiles):
+        """
+        Paste the tiles into (a block of) the global image.
+        im (2D ndarray): the block of the global image, initially filled with the background.
+          It's updated in place.
+        tiles (list of (slices, slices, DataArray)): for each tile overlapping the block, in the
+          order they were added: the YX slices of the block covered by the tile, the YX slices
+          of the corresponding part of the tile, and the (whole) tile, with its brightness
+          already adjusted.
+        """
         pass
 
     @staticmethod
@@ -172,32 +276,102 @@ class Weaver(metaclass=ABCMeta):
         md[model.MD_DIMS] = "YX"
         return md
 
-    def _adjust_brightness(self, tile, tiles):
+    def _compute_brightness_correction(self):
         """
-        Adjusts the brightness of a tile, so its mean corresponds to the mean of a list of tiles.
+        Computes a gain and an offset for each tile, so that the overlapping regions of
+        neighbouring tiles have the same brightness. This compensates for bleaching/deposition
+        effects, which cause some tiles to be darker or brighter than their neighbours.
+        The statistics (mean and standard deviation) of each overlap region are computed once,
+        and a global least-squares solution is found for all the tiles:
+        * gains, such that the standard deviations are equal: log(g_i) - log(g_j) = log(std_j / std_i)
+        * offsets, such that the means are equal: o_i - o_j = g_j * mean_j - g_i * mean_i
+        The solution has the smallest corrections, so the average brightness is kept.
+        Must be called after the bounding boxes are computed.
+        :returns: (list of (float, float)): gain and offset for each tile
+        """
+        gain_eqs = []  # i, j, weight, value
+        overlaps = []  # i, j, weight, mean_i, mean_j
+        for i, j, (l, t, r, b) in self._find_overlaps():
+            bi, bj = self.tbbx_px[i], self.tbbx_px[j]
+            roi_i = numpy.asarray(self.tiles[i])[t - bi[1]:b - bi[1], l - bi[0]:r - bi[0]]
+            roi_j = numpy.asarray(self.tiles[j])[t - bj[1]:b - bj[1], l - bj[0]:r - bj[0]]
+            # The larger the overlap, the more reliable the statistics
+            w = math.sqrt(roi_i.size)
+            std_i, std_j = float(numpy.std(roi_i)), float(numpy.std(roi_j))
+            if std_i > 0 and std_j > 0:  # No gain can be deduced from a flat region
+                gain_eqs.append((i, j, w, math.log(std_j / std_i)))
+            overlaps.append((i, j, w, float(numpy.mean(roi_i)), float(numpy.mean(roi_j))))
+
+        gains = numpy.exp(self._solve_differences(len(self.tiles), gain_eqs))
+        offset_eqs = [(i, j, w, gains[j] * m_j - gains[i] * m_i) for i, j, w, m_i, m_j in overlaps]
+        offsets = self._solve_differences(len(self.tiles), offset_eqs)
+        return list(zip(gains, offsets))
+
+    def _find_overlaps(self):
+        """
+        Finds all the pairs of tiles which overlap, based on their bounding boxes.
+        :returns: (list of (int, int, (int, int, int, int))): for each pair of overlapping tiles,
+        their indices (in order) and the ltrb bounding box of the overlap in pixels.
+        """
+        # To avoid comparing every tile with every other tile, the tiles are grouped in cells
+        # as large as the largest tile: overlapping tiles are always in neighbouring cells.
+        cw = max(b[2] - b[0] for b in self.tbbx_px)
+        ch = max(b[3] - b[1] for b in self.tbbx_px)
+        cells = {}
+        for i, b in enumerate(self.tbbx_px):
+            cells.setdefault((b[0] // cw, b[1] // ch), []).append(i)
+
+        overlaps = []
+        for i, bi in enumerate(self.tbbx_px):
+            cx, cy = bi[0] // cw, bi[1] // ch
+            for dx, dy in itertools.product((-1, 0, 1), repeat=2):
+                for j in cells.get((cx + dx, cy + dy), ()):
+                    if j <= i:
+                        continue
+                    bj = self.tbbx_px[j]
+                    ovl = (max(bi[0], bj[0]), max(bi[1], bj[1]), min(bi[2], bj[2]), min(bi[3], bj[3]))
+                    if ovl[0] < ovl[2] and ovl[1] < ovl[3]:
+                        overlaps.append((i, j, ovl))
+        return overlaps
+
+    @staticmethod
+    def _solve_differences(n, eqs):
+        """
+        Finds the least-squares solution of a set of equations of the type x_i - x_j = v.
+        As the equations only constrain the differences, the solution with the minimum norm is
+        returned, which is centred on 0 for each group of connected tiles (and 0 for the tiles
+        without any equation).
+        :param n: (int) number of values
+        :param eqs: (list of (int, int, float, float)): for each equation, i, j, the weight and v
+        :returns: (ndarray of n floats) the values
+        """
+        if not eqs:
+            return numpy.zeros(n)
+        rows = numpy.repeat(numpy.arange(len(eqs)), 2)
+        cols = numpy.array([(i, j) for i, j, _, _ in eqs]).ravel()
+        data = numpy.array([(w, -w) for _, _, w, _ in eqs]).ravel()
+        a = csr_matrix((data, (rows, cols)), shape=(len(eqs), n))
+        b = numpy.array([w * v for _, _, w, v in eqs])
+        # Starting from 0, lsqr converges to the minimum norm solution
+        return lsqr(a, b, atol=1e-12, btol=1e-12)[0]
+
+    @staticmethod
+    def _adjust_brightness(tile, gain, offset):
+        """
+        Adjusts the brightness of a tile.
         :param tile (DataArray): tile to adjust
-        :param tiles (2D DataArray): input tiles
-        :returns (2D DataArray): tiles with adjusted brightness
-        """
-        # This is a very simple algorithm. In reality, not every tile should have the same brightness. A better
-        # way to handle it would be to do local brightness adjustments, e.g. by comparing the overlapping
-        # regions.
-        # In general, even this simple calculation helps to improve the quality of the overall image
-        # if there are a lot of bleaching/deposition effects, which cause a small number of tiles to have
-        # a very different (typically higher) brightness than the others.
-        tile = copy.deepcopy(tile)  # don't change the input tile
-        im_brt = numpy.mean(tiles)
-        tile_brt = numpy.mean(tile)
-        diff = im_brt - tile_brt
+        :param gain (float): factor to apply to the tile
+        :param offset (float): value to add to the tile, after the gain
+        :returns (2D ndarray): tile with adjusted brightness, of the same dtype
+        """
+        if gain == 1 and offset == 0:
+            return tile
+        adjusted = numpy.asarray(tile) * gain + offset
         # To avoid overflows, we need to clip the results to the dtype range.
         if numpy.issubdtype(tile.dtype, numpy.integer):
-            maxval = numpy.iinfo(tile.dtype).max
-        elif numpy.issubdtype(tile.dtype, float):
-            maxval = numpy.finfo(tile.dtype).max
-        else:
-            maxval = numpy.inf
-        tile = tile + numpy.minimum(maxval - tile, diff)  # clip to maxval
-        return tile
+            info = numpy.iinfo(tile.dtype)
+            adjusted = numpy.clip(numpy.round(adjusted), info.min, info.max)
+        return adjusted.astype(tile.dtype, copy=False)
 
 
 class CollageWeaver(Weaver):
@@ -213,24 +387,13 @@ class CollageWeaver(Weaver):
       the bounding box.
     """
 
-    def weave_tiles(self):
+    def _paste_tiles(self, im, tiles):
         """
         Weave tiles by pasting the tiles where their center position is.
-        return (2D DataArray): The weaved image.
         """
-        # Paste each tile
-        logging.debug("Generating global image of size %dx%d px",
-                      self.gbbx_px[-2], self.gbbx_px[-1])
-
-        # Create a background of the image using the minimum value of self.tiles
-        im = numpy.ones((self.gbbx_px[-1], self.gbbx_px[-2]), dtype=self.tiles[0].dtype) * numpy.amin(self.tiles)
-
-        for b, t in zip(self.tbbx_px, self.tiles):
-            if self.adjust_brt:
-                t = self._adjust_brightness(t, self.tiles)
-            im[b[1]:b[1] + t.shape[0], b[0]:b[0] + t.shape[1]] = t
+        for bslc, tslc, t in tiles:
+            im[bslc] = t[tslc]
             # TODO: border
-        return im
 
 
 class CollageWeaverReverse(Weaver):
@@ -241,34 +404,24 @@ class CollageWeaverReverse(Weaver):
     with the last tile and pastes the older tiles in reverse order of acquisition.
     """
 
-    def weave_tiles(self):
+    def _paste_tiles(self, im, tiles):
         """
         Weave tiles by filling parts of the global image that are still empty with the new tile.
-        return (2D DataArray): The weaved image.
         """
-        # Paste each tile
-        logging.debug("Generating global image of size %dx%d px",
-                      self.gbbx_px[-2], self.gbbx_px[-1])
-        # Create a background of the image using the minimum value of self.tiles
-        im = numpy.ones((self.gbbx_px[-1], self.gbbx_px[-2]), dtype=self.tiles[0].dtype) * numpy.amin(self.tiles)
-
-        # The mask is multiplied with the tile, thereby creating a tile with a gradient
-        mask = numpy.zeros((self.gbbx_px[-1], self.gbbx_px[-2]), dtype=bool)
+        # The mask indicates the parts of the image which already contain a tile
+        mask = numpy.zeros(im.shape, dtype=bool)
 
-        for b, t in zip(self.tbbx_px, self.tiles):
+        for bslc, tslc, t in tiles:
             # Part of image overlapping with tile
-            roi = im[b[1]:b[1] + t.shape[0], b[0]:b[0] + t.shape[1]]
-            moi = mask[b[1]:b[1] + t.shape[0], b[0]:b[0] + t.shape[1]]
-
-            if self.adjust_brt:
-                t = self._adjust_brightness(t, self.tiles)
+            roi = im[bslc]
+            moi = mask[bslc]
+            t = t[tslc]
 
             # Insert image at positions that are still empty
             roi[~moi] = t[~moi]
 
             # Update mask
-            mask[b[1]:b[1] + t.shape[0], b[0]:b[0] + t.shape[1]] = True
-        return im
+            mask[bslc] = True
 
 
 class MeanWeaver(Weaver):
@@ -277,10 +430,9 @@ class MeanWeaver(Weaver):
     average of the pixel of each tile.
     """
 
-    def weave_tiles(self):
+    def _paste_tiles(self, im, tiles):
         """
         Weave tiles by using a smooth gradient.
-        return (2D DataArray): The weaved image.
         """
         #  The part of the tile that does not overlap
         # with any previous tiles is inserted into the part of the
@@ -299,22 +451,16 @@ class MeanWeaver(Weaver):
         # the ovv image are added, so the resulting image contains a gradient in the overlapping regions
         # between all the tiles that have been inserted before and the newly inserted tile.
 
-        # Paste each tile
-        logging.debug("Generating global image of size %dx%d px",
-                      self.gbbx_px[-2], self.gbbx_px[-1])
-        # Create a background of the image using the minimum value of self.tiles
-        im = numpy.ones((self.gbbx_px[-1], self.gbbx_px[-2]), dtype=self.tiles[0].dtype) * numpy.amin(self.tiles)
-
         # The mask is multiplied with the tile, thereby creating a tile with a gradient
-        mask = numpy.zeros((self.gbbx_px[-1], self.gbbx_px[-2]), dtype=bool)
+        mask = numpy.zeros(im.shape, dtype=bool)
 
-        for b, t in zip(self.tbbx_px, self.tiles):
+        for bslc, tslc, t in tiles:
             # Part of image overlapping with tile
-            roi = im[b[1]:b[1] + t.shape[0], b[0]:b[0] + t.shape[1]]
-            moi = mask[b[1]:b[1] + t.shape[0], b[0]:b[0] + t.shape[1]]
+            roi = im[bslc]
+            moi = mask[bslc]
 
-            if self.adjust_brt:
-                self._adjust_brightness(t, self.tiles)
+            tfull_shape = t.shape
+            t = t[tslc]
             # Insert image at positions that are still empty
             roi[~moi] = t[~moi]
 
@@ -322,13 +468,13 @@ class MeanWeaver(Weaver):
             # distance to the center of the tile
 
             # Create weight matrix with decreasing values from its center that
-            # has the same size as the tile.
-            sz = numpy.array(roi.shape)
+            # has the same size as the tile (and only keep the part in the block).
+            sz = numpy.array(tfull_shape)
             hh, hw = sz / 2  # half-height, half-width
             x = numpy.linspace(-hw, hw, sz[1])
             y = numpy.linspace(-hh, hh, sz[0])
             xx, yy = numpy.meshgrid((x / hw) ** 6, (y / hh) ** 6)
-            w = numpy.maximum(xx, yy)
+            w = numpy.maximum(xx, yy)[tslc]
             # Hardcoding a weight function is quite arbitrary and might result in
             # suboptimal solutions in some cases.
             # Alternatively, different weights might be used. One option would be to select
@@ -342,5 +488,4 @@ class MeanWeaver(Weaver):
             roi[moi] = (t * (1 - w))[moi] + (roi * w)[moi]
 
             # Update mask
-            mask[b[1]:b[1] + t.shape[0], b[0]:b[0] + t.shape[1]] = True
-        return im
+            mask[bslc] = True
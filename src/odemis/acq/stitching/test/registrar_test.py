@@ -26,6 +26,7 @@ import logging
 import os
 import random
 import re
+import time
 import unittest
 import warnings
 
@@ -33,7 +34,8 @@ import numpy
 
 import odemis
 from odemis import model
-from odemis.acq.stitching import IdentityRegistrar, ShiftRegistrar, GlobalShiftRegistrar
+from odemis.acq.stitching import IdentityRegistrar, ShiftRegistrar, GlobalShiftRegistrar, \
+    PyramidShiftRegistrar, REGISTER_GLOBAL_SHIFT, REGISTER_PYRAMID, register
 from odemis.acq.stitching.test.stitching_test import decompose_image
 from odemis.dataio import find_fittest_converter
 from odemis.util import testing
@@ -759,6 +761,33 @@ class TestGlobalShiftRegistrar(unittest.TestCase):
                                             "%s x %s tiles, %s ovlp, %s method." % (num, num, o, a)
                                             )
 
+    def test_parallel(self):
+        """
+        Check the shifts computed in parallel are identical to the serial computation,
+        and report the speed-up depending on the number of threads.
+        """
+        conv = find_fittest_converter(IMGS[0])
+        data = ensure2DImage(conv.read_data(IMGS[0])[0])
+        tiles, _ = decompose_image(data, 0.2, 8, "horizontalZigzag")
+
+        ncpus = os.cpu_count() or 1
+        workers = sorted({1, 2, 4, ncpus})
+        exp_pos = None
+        dur_serial = None
+        for n in workers:
+            registrar = GlobalShiftRegistrar(max_workers=n)
+            tstart = time.time()
+            for tile in tiles:
+                registrar.addTile(tile)
+            pos = registrar.getPositions()[0]
+            dur = time.time() - tstart
+
+            if exp_pos is None:
+                exp_pos, dur_serial = pos, dur
+            logging.info("Registered %d tiles with %d threads in %g s (x%.2f)",
+                         len(tiles), n, dur, dur_serial / dur)
+            numpy.testing.assert_array_equal(pos, exp_pos)
+
     def test_shift_real_manual(self):
         """ Test case not generated by decompose.py file and manually cropped """
 
@@ -912,5 +941,66 @@ class TestGlobalShiftRegistrar(unittest.TestCase):
                     self.assertAlmostEqual(dep_tile[1], p[1] + r2 * px_size[1])
 
 
+class TestPyramidShiftRegistrar(unittest.TestCase):
+    """
+    Tests PyramidShiftRegistrar on real images (simulated with decompose_image function)
+    with known positions
+    """
+
+    def setUp(self):
+        random.seed(1)
+
+    def test_shift_real(self):
+        """ Test on decomposed image with known shift """
+        numTiles = [2, 3]
+        overlap = [0.3, 0.2]
+
+        for img, num, o in itertools.product(IMGS, numTiles, overlap):
+            _, img_name = os.path.split(img)
+            conv = find_fittest_converter(img)
+            data = ensure2DImage(conv.read_data(img)[0])
+
+            [tiles, real_pos] = decompose_image(data, o, num, "horizontalZigzag")
+            px_size = tiles[0].metadata[model.MD_PIXEL_SIZE]
+            # Small minimum size, to be sure the tiles are downsampled
+            registrar = PyramidShiftRegistrar(min_size=32)
+            for tile in tiles:
+                registrar.addTile(tile)
+
+            # Compare positions to real positions, allow 5 px offset
+            registered_pos = registrar.getPositions()[0]
+            diff = numpy.absolute(numpy.subtract(registered_pos, real_pos))
+            allowed_px_offset = numpy.repeat(numpy.multiply(px_size, 5), len(diff))
+            numpy.testing.assert_array_less(diff.flatten(),
+                                            allowed_px_offset.flatten(),
+                                            "Position %s pxs off for image '%s', " % (
+                                                max(diff.flatten()) / px_size[0], img_name) +
+                                            "%s x %s tiles, %s ovlp." % (num, num, o)
+                                            )
+
+    def test_compare_global_shift(self):
+        """
+        Compare the accuracy and speed with the full resolution registration
+        """
+        for img in IMGS:
+            _, img_name = os.path.split(img)
+            conv = find_fittest_converter(img)
+            data = ensure2DImage(conv.read_data(img)[0])
+            [tiles, real_pos] = decompose_image(data, 0.2, 3, "horizontalZigzag")
+            px_size = tiles[0].metadata[model.MD_PIXEL_SIZE]
+
+            errors = {}
+            for method in (REGISTER_GLOBAL_SHIFT, REGISTER_PYRAMID):
+                tstart = time.time()
+                upd_tiles = register(tiles, method=method)
+                dur = time.time() - tstart
+                pos = [t.metadata[model.MD_POS] for t in upd_tiles]
+                errors[method] = numpy.max(numpy.abs(numpy.subtract(pos, real_pos))) / px_size[0]
+                logging.info("Registration %s of %s took %g s, max error = %g px",
+                             method, img_name, dur, errors[method])
+
+            self.assertLess(errors[REGISTER_PYRAMID], 5)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -21,9 +21,11 @@ Odemis. If not, see http://www.gnu.org/licenses/.
 '''
 
 import copy
+import logging
 import os
 import random
 import re
+import time
 import unittest
 import warnings
 
@@ -31,8 +33,9 @@ import numpy
 
 import odemis
 from odemis import model
-from odemis.acq.stitching import (REGISTER_IDENTITY, REGISTER_SHIFT,
-                                  WEAVER_COLLAGE, WEAVER_MEAN, register, weave)
+from odemis.acq.stitching import (REGISTER_IDENTITY, REGISTER_SHIFT, REGISTER_GLOBAL_SHIFT,
+                                  WEAVER_COLLAGE, WEAVER_MEAN, register, weave,
+                                  StitchingPipeline)
 from odemis.dataio import find_fittest_converter
 from odemis.util.img import ensure2DImage
 
@@ -251,6 +254,81 @@ class TestWeave(unittest.TestCase):
                     numpy.testing.assert_allclose(w, img[:sz, :sz], rtol=1)
 
 
+class TestStitchingPipeline(unittest.TestCase):
+
+    def test_same_result(self):
+        """
+        Check the pipeline gives the same result as register() + weave()
+        """
+        img = ensure2DImage(find_fittest_converter(IMGS[1]).read_data(IMGS[1])[0])
+        tiles, _ = decompose_image(img, 0.2, 3, "horizontalZigzag")
+        all_tiles = [(t, t) for t in tiles]
+
+        exp_tiles = register(all_tiles, method=REGISTER_GLOBAL_SHIFT)
+        exp_im = weave([t[0] for t in exp_tiles], WEAVER_MEAN)
+
+        stitcher = StitchingPipeline(REGISTER_GLOBAL_SHIFT, WEAVER_MEAN)
+        for t in all_tiles:
+            stitcher.addTile(t)
+        ims = stitcher.getFullImages()
+
+        self.assertEqual(len(ims), 2)
+        numpy.testing.assert_array_equal(ims[0], exp_im)
+        numpy.testing.assert_array_equal(ims[1], exp_im)
+        self.assertEqual(ims[0].metadata[model.MD_POS], exp_im.metadata[model.MD_POS])
+
+    def test_identity_fallback(self):
+        """
+        Check that if the registration fails, the tiles are still stitched
+        """
+        img = ensure2DImage(find_fittest_converter(IMGS[1]).read_data(IMGS[1])[0])
+        tiles, _ = decompose_image(img, 0.2, 2, "horizontalZigzag", False)
+        # Two tiles at the same position => the global registrar cannot handle it
+        tiles.append(tiles[-1])
+
+        stitcher = StitchingPipeline(REGISTER_GLOBAL_SHIFT, WEAVER_MEAN)
+        for t in tiles:
+            stitcher.addTile(t)
+        upd_tiles = stitcher.getRegisteredTiles()
+        self.assertEqual(len(upd_tiles), len(tiles))
+        for t, ut in zip(tiles, upd_tiles):
+            numpy.testing.assert_allclose(ut.metadata[model.MD_POS], t.metadata[model.MD_POS])
+
+    def test_latency(self):
+        """
+        Simulate an acquisition, and compare the time between the end of the
+        acquisition of the last tile and the availability of the mosaic, with
+        and without pipeline.
+        """
+        img = ensure2DImage(find_fittest_converter(IMGS[0]).read_data(IMGS[0])[0])
+        tiles, _ = decompose_image(img, 0.2, 5, "horizontalZigzag")
+        acq_time = 0.1  # s, simulated stage move + camera exposure per tile
+
+        def acquire_tiles(stitcher=None):
+            for t in tiles:
+                time.sleep(acq_time)
+                if stitcher:
+                    stitcher.addTile(t)
+
+        # Sequential: stitch everything after the acquisition
+        acquire_tiles()
+        tstart = time.time()
+        exp_im = weave(register(tiles, method=REGISTER_GLOBAL_SHIFT), WEAVER_MEAN)
+        lat_seq = time.time() - tstart
+
+        # Pipelined
+        stitcher = StitchingPipeline(REGISTER_GLOBAL_SHIFT, WEAVER_MEAN)
+        acquire_tiles(stitcher)
+        tstart = time.time()
+        ims = stitcher.getFullImages()
+        lat_pipe = time.time() - tstart
+
+        logging.info("Mosaic of %d tiles ready %g s after the last tile sequentially, "
+                     "and %g s with the pipeline", len(tiles), lat_seq, lat_pipe)
+        numpy.testing.assert_array_equal(ims[0], exp_im)
+        self.assertLess(lat_pipe, lat_seq * 1.1)
+
+
 def decompose_image(img, overlap=0.1, numTiles=5, method="horizontalLines", shift=True):
     """
     Decomposes image into tiles for testing. The tiles overlap and their center positions are subject to random noise.
@@ -25,7 +25,9 @@ import math
 import os
 import random
 import re
+import shutil
 import time
+import tracemalloc
 import unittest
 import warnings
 
@@ -36,7 +38,7 @@ from odemis import model
 from odemis.acq.stitching import CollageWeaver, MeanWeaver, CollageWeaverReverse, WEAVER_MEAN, WEAVER_COLLAGE_REVERSE, \
     WEAVER_COLLAGE
 from odemis.acq.stitching.test.stitching_test import decompose_image
-from odemis.dataio import find_fittest_converter
+from odemis.dataio import find_fittest_converter, zarr
 from odemis.util.img import ensure2DImage
 
 logging.getLogger().setLevel(logging.DEBUG)
@@ -409,5 +411,152 @@ class TestCollageWeaverReverse(WeaverBaseTest, unittest.TestCase):
         numpy.testing.assert_equal(o, 256 * numpy.ones((80, 30)))
 
 
+class TestBrightnessCorrection(unittest.TestCase):
+    """
+    Tests the brightness correction of the weavers
+    """
+
+    def _decompose_bleached(self, num):
+        """
+        Create tiles from a real image, with a different gain and offset for each tile
+        return (list of DataArrays, ndarray): the tiles, the original image
+        """
+        conv = find_fittest_converter(IMGS[1])
+        data = ensure2DImage(conv.read_data(IMGS[1])[0]).astype(numpy.float64)
+        tiles, _ = decompose_image(data, 0.2, num, "horizontalZigzag", False)
+        rng = numpy.random.default_rng(1)
+        btiles = []
+        for t in tiles:
+            gain, offset = rng.uniform(0.7, 1.3), rng.uniform(-20, 20)
+            btiles.append(model.DataArray(t * gain + offset, t.metadata))
+        return tiles, btiles
+
+    def test_bleached_tiles(self):
+        """
+        The corrected tiles should have the same brightness in the overlapping regions
+        """
+        tiles, btiles = self._decompose_bleached(4)
+
+        weaver = CollageWeaver()
+        for t in tiles:
+            weaver.addTile(t)
+        exp_im = weaver.getFullImage()
+
+        errors = {}
+        for adjust in (False, True):
+            weaver = CollageWeaver(adjust_brightness=adjust)
+            for t in btiles:
+                weaver.addTile(t)
+            im = weaver.getFullImage()
+            self.assertEqual(im.shape, exp_im.shape)
+
+            # The absolute brightness is unknown => compare after normalisation
+            norm_im = (im - im.mean()) / im.std()
+            norm_exp = (exp_im - exp_im.mean()) / exp_im.std()
+            errors[adjust] = numpy.mean(numpy.abs(norm_im - norm_exp))
+
+        logging.info("Mean error without correction: %g, with correction: %g", errors[False], errors[True])
+        self.assertLess(errors[True], errors[False] / 2)
+
+    def test_speed(self):
+        """
+        The brightness correction should not make the weaving much slower
+        """
+        _, btiles = self._decompose_bleached(10)
+
+        durations = {}
+        for adjust in (False, True):
+            weaver = CollageWeaver(adjust_brightness=adjust)
+            for t in btiles:
+                weaver.addTile(t)
+            tstart = time.time()
+            weaver.getFullImage()
+            durations[adjust] = time.time() - tstart
+
+        logging.info("Weaved %d tiles in %g s without brightness correction, %g s with it",
+                     len(btiles), durations[False], durations[True])
+        self.assertLess(durations[True], durations[False] * 3 + 1)
+
+
+class TestWeaveInto(unittest.TestCase):
+    """
+    Tests weaving directly into a file, block by block
+    """
+
+    FILENAME = "test-weave" + zarr.EXTENSIONS[0]
+
+    def tearDown(self):
+        shutil.rmtree(self.FILENAME, ignore_errors=True)
+
+    def test_same_as_full_image(self):
+        """
+        The image written by blocks should be identical to the one computed at once
+        """
+        conv = find_fittest_converter(IMGS[1])
+        data = ensure2DImage(conv.read_data(IMGS[1])[0])
+        tiles, _ = decompose_image(data, 0.3, 3, "horizontalZigzag")
+
+        for weaver_cls in (CollageWeaver, CollageWeaverReverse, MeanWeaver):
+            weaver = weaver_cls()
+            for t in tiles:
+                weaver.addTile(t)
+            exp_im = weaver.getFullImage()
+
+            weaver = weaver_cls()
+            for t in tiles:
+                weaver.addTile(t)
+            # Small blocks, so that the tiles span over several blocks
+            with zarr.AcquisitionWriter(self.FILENAME) as writer:
+                weaver.weaveInto(writer, block_size=100)
+
+            im = zarr.read_data(self.FILENAME)[0]
+            numpy.testing.assert_array_equal(im, exp_im)
+            self.assertEqual(im.dtype, exp_im.dtype)
+            numpy.testing.assert_allclose(im.metadata[model.MD_POS], exp_im.metadata[model.MD_POS])
+            shutil.rmtree(self.FILENAME)
+
+    def test_memory(self):
+        """
+        Compare the peak memory usage of the weaving in memory and into a file,
+        depending on the size of the mosaic.
+        """
+        tile_shape = (1024, 1024)
+        overlap = 0.2
+        px_size = 1e-6
+        step = int(tile_shape[0] * (1 - overlap))
+
+        for n in (4, 8):
+            tiles = []
+            for i in range(n):
+                for j in range(n):
+                    md = {model.MD_PIXEL_SIZE: (px_size, px_size),
+                          model.MD_POS: (j * step * px_size, -i * step * px_size)}
+                    tiles.append(model.DataArray(numpy.random.randint(0, 4096, tile_shape, dtype=numpy.uint16), md))
+            mosaic_size = step * (n - 1) + tile_shape[0]
+
+            weaver = MeanWeaver()
+            for t in tiles:
+                weaver.addTile(t)
+            tracemalloc.start()
+            weaver.getFullImage()
+            _, peak_mem = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            weaver = MeanWeaver()
+            for t in tiles:
+                weaver.addTile(t)
+            tracemalloc.start()
+            with zarr.AcquisitionWriter(self.FILENAME, compressed=False) as writer:
+                weaver.weaveInto(writer)
+            _, peak_file = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            shutil.rmtree(self.FILENAME)
+
+            logging.info("Mosaic of %d px²: peak memory %d MB in memory, %d MB into a file",
+                         mosaic_size, peak_mem / 2 ** 20, peak_file / 2 ** 20)
+            if n >= 8:
+                self.assertLess(peak_file, peak_mem)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -105,6 +105,10 @@ class Stream(object):
     # Minimum overhead time in seconds when acquiring an image
     SETUP_OVERHEAD = 0.1
 
+    # Maximum error accepted on the histogram used for the auto B/C, to only
+    # look at a subset of the data. 0 => the whole data is used.
+    HISTOGRAM_MAX_ERROR = 0
+
     def __init__(self, name, detector, dataflow, emitter, focuser=None, opm=None,
                  hwdetvas=None, hwemtvas=None, detvas=None, emtvas=None, axis_map={},
                  raw=None, acq_type=None):
@@ -251,6 +255,7 @@ class Stream(object):
         self.histogram = model.VigilantAttribute(numpy.empty(0), readonly=True)
         self.histogram._full_hist = numpy.ndarray(0) # for finding the outliers
         self.histogram._edges = None
+        self.histogram._max_error = 0  # error accepted when computing _full_hist
 
         # Tuple of (int, str) or (None, None): loglevel and message
         self.status = model.VigilantAttribute((None, None), readonly=True)
@@ -1165,7 +1170,11 @@ class Stream(object):
 
     def _onOutliers(self, outliers):
         if self.auto_bc.value:
-            self._recomputeIntensityRange()
+            if outliers == 0 and self.histogram._max_error:
+                # The extreme values might not be in the subsampled histogram
+                self._updateHistogram()
+            else:
+                self._recomputeIntensityRange()
 
     def _recomputeIntensityRange(self):
         if len(self.histogram._full_hist) == 0:  # No histogram yet
@@ -1244,14 +1253,22 @@ class Stream(object):
         # Depth can change at each image (depends on hardware settings)
         self._updateDRange(data)
 
+        # Only the exact histogram contains the extreme values, which are
+        # needed if no outliers are discarded.
+        if self.auto_bc_outliers.value > 0:
+            max_error = self.HISTOGRAM_MAX_ERROR
+        else:
+            max_error = 0
+
         # Initially, _drange might be None, in which case it will be guessed
-        hist, edges = img.histogram(data, irange=self._drange)
+        hist, edges = self._computeHistogram(data, max_error)
         if hist.size > 256:
             chist = img.compactHistogram(hist, 256)
         else:
             chist = hist
         self.histogram._full_hist = hist
         self.histogram._edges = edges
+        self.histogram._max_error = max_error
         # First update the value, before the intensityRange subscribers are called...
         self.histogram._value = chist
 
@@ -1261,6 +1278,14 @@ class Stream(object):
         # Notify last, so intensityRange is correct when subscribers get the new histogram
         self.histogram.notify(chist)
 
+    def _computeHistogram(self, data, max_error):
+        """
+        data (DataArray): the raw data
+        max_error (0<=float<1): maximum error accepted, see img.histogram()
+        return hist, edges: see img.histogram()
+        """
+        return img.histogram(data, irange=self._drange, max_error=max_error)
+
     def _onNewData(self, dataflow, data):
         # Commented out to prevent log flooding
         # if model.MD_ACQ_DATE in data.metadata:
@@ -175,7 +175,8 @@ class RepetitionStream(LiveStream):
         """
         if hasattr(self, "integrationTime"):
             if self._img_intor is None:
-                self._img_intor = img.ImageIntegrator(self.integrationCounts.value)
+                self._img_intor = img.ImageIntegrator(self.integrationCounts.value,
+                                                      hist_max_error=self.HISTOGRAM_MAX_ERROR)
 
             # Reset in case the integrationCounts change while playing the stream
             if self._img_intor.steps != self.integrationCounts.value:
@@ -187,7 +188,8 @@ class RepetitionStream(LiveStream):
                 self.raw = [self._img_intor.append(data)]
             except Exception as ex:
                 logging.warning("Failed to integrate image (of shape %s): %s", data.shape, ex)
-                self._img_intor = img.ImageIntegrator(self.integrationCounts.value)
+                self._img_intor = img.ImageIntegrator(self.integrationCounts.value,
+                                                      hist_max_error=self.HISTOGRAM_MAX_ERROR)
                 self.raw = [self._img_intor.append(data)]
         else:
             self.raw = [data]
@@ -195,6 +197,20 @@ class RepetitionStream(LiveStream):
         self._shouldUpdateHistogram()
         self._shouldUpdateImage()
 
+    # Overrides method of Stream
+    def _computeHistogram(self, data, max_error):
+        # If the data is the latest integrated image, the integrator already
+        # has the values needed for the histogram.
+        intor = getattr(self, "_img_intor", None)
+        if (intor is not None and max_error and intor.hist_max_error == max_error
+            and self.raw and data is self.raw[0]):
+            try:
+                return intor.getHistogram(self._drange)
+            except ValueError:
+                pass  # No image yet => compute it normally
+
+        return super(RepetitionStream, self)._computeHistogram(data, max_error)
+
     # Overrides method of Stream
     def _updateImage(self):
         """
@@ -42,6 +42,9 @@ class LiveStream(Stream):
     Abstract class for any stream that can do continuous acquisition.
     """
 
+    # The histogram is recomputed several times per second, on possibly large images
+    HISTOGRAM_MAX_ERROR = img.HISTOGRAM_LIVE_MAX_ERROR
+
     def __init__(self, name, detector, dataflow, emitter, forcemd=None, **kwargs):
         """
         forcemd (None or dict of MD_* -> value): force the metadata of the
@@ -36,8 +36,9 @@ try:
 except ImportError:
     pass  # The projection using this module should never be instantiated then.
 
-from odemis import model
+from odemis import model, util
 from odemis.util import img, angleres
+from odemis.util.conversion import get_tile_md_pos
 from scipy import ndimage
 from odemis.model import MD_PIXEL_SIZE, MD_POL_EPHI, MD_POL_EX, MD_POL_EY, MD_POL_EZ, MD_POL_ETHETA, MD_POL_DS0, \
     MD_POL_S0, MD_POL_DOP, MD_POL_DOLP, MD_POL_UP
@@ -182,24 +183,29 @@ class RGBProjection(DataProjection):
 
         self._shouldUpdateImage()
 
-    def _project2RGB(self, data, tint=(255, 255, 255)):
+    def _project2RGB(self, data, tint=(255, 255, 255), out=None):
         """
         Project a 2D DataArray into a RGB representation
         data (DataArray): 2D DataArray
         tint ((int, int, int)): colouration of the image, in RGB.
+        out (None or numpy.ndarray of uint8): array of shape YX3 where to write
+          the RGB image, to avoid allocating a new one. It must not be in use
+          anymore (eg, not in .image).
         return (DataArray): 3D DataArray
         """
         # TODO replace by local irange
         irange = self.stream._getDisplayIRange()
-        rgbim = img.DataArray2RGB(data, irange, tint)
-        rgbim.flags.writeable = False
+        rgbim = img.DataArray2RGB(data, irange, tint, out=out)
         # Commented to prevent log flooding
         # if model.MD_ACQ_DATE in data.metadata:
         #     logging.debug("Computed RGB projection %g s after acquisition",
         #                    time.time() - data.metadata[model.MD_ACQ_DATE])
         md = self._find_metadata(data.metadata)
         md[model.MD_DIMS] = "YXC"  # RGB format
-        return model.DataArray(rgbim, md)
+        rgbim = model.DataArray(rgbim, md)
+        # Only the view is read-only, so that the out array can be reused
+        rgbim.flags.writeable = False
+        return rgbim
 
     def projectAsRaw(self):
         """ Project a raw image without converting to RGB
@@ -812,6 +818,13 @@ class RGBSpatialProjection(RGBProjection):
     That is the recommended way to create a RGBSpatialProjection.
     """
 
+    # Maximum memory used to keep the tiles of pyramidal images, so that panning
+    # and zooming back to a previous area doesn't need to read/project them again.
+    PROJ_TILES_CACHE_SIZE = 256 * 2 ** 20  # bytes
+    RAW_TILES_CACHE_SIZE = 256 * 2 ** 20  # bytes
+    # Number of tiles of pyramidal images read concurrently
+    TILE_LOADER_WORKERS = 8
+
     def __new__(cls, stream):
 
         if isinstance(stream, StaticSpectrumStream):
@@ -847,10 +860,12 @@ class RGBSpatialProjection(RGBProjection):
             self.rect = model.TupleContinuous(full_rect, rect_range)
             self.mpp.subscribe(self._onMpp)
             self.rect.subscribe(self._onRect)
-            # initialize the projected tiles cache
-            self._projectedTilesCache = {}
-            # initialize the raw tiles cache
-            self._rawTilesCache = {}
+            # Caches of the most recently used tiles, (x, y, z) -> DataArray
+            self._projectedTilesCache = util.LRUCache(self.PROJ_TILES_CACHE_SIZE)
+            self._rawTilesCache = util.LRUCache(self.RAW_TILES_CACHE_SIZE)
+            # Reads the raw tiles in parallel. Whenever a tile needed is read, the image is updated.
+            self._tileLoader = img.TileLoader(raw, self._rawTilesCache, self.TILE_LOADER_WORKERS,
+                                              callback=self._onTileLoaded)
             # When True, the projected tiles cache should be invalidated
             self._projectedTilesInvalid = True
 
@@ -859,6 +874,12 @@ class RGBSpatialProjection(RGBProjection):
     def _onMpp(self, mpp):
         self._shouldUpdateImage()
 
+    def _onTileLoaded(self, x, y, z):
+        # Called from the tile loader threads. Note: it doesn't check whether
+        # the tile is still visible, as recomputing the image is cheap when all
+        # the tiles are cached.
+        self._shouldUpdateImage()
+
     def _onRect(self, rect):
         self._shouldUpdateImage()
 
@@ -978,45 +999,112 @@ class RGBSpatialProjection(RGBProjection):
             int(round(rect[1] / (-ps[1]) + img_shape[1] / 2)) - 1,
         )
 
-    def _getTile(self, x, y, z, prev_raw_cache, prev_proj_cache):
+    def _getTile(self, x, y, z, wait=True):
         """
         Get a tile from a DataArrayShadow. Uses cache.
-        The cache for projected tiles and the cache for raw tiles has always the same tiles
         x (int): X coordinate of the tile
         y (int): Y coordinate of the tile
         z (int): zoom level where the tile is
-        prev_raw_cache (dictionary): raw tiles cache from the
-            last execution of _updateImage
-        prev_proj_cache (dictionary): projected tiles cache from the
-            last execution of _updateImage
+        wait (bool): if False, and the tile is not yet available, a temporary
+          version of the tile is returned, based on the lower resolution tile
+          (if it is available).
         return (DataArray, DataArray): raw tile and projected tile
         """
-        # the key of the tile on the cache
-        tile_key = "%d-%d-%d" % (x, y, z)
+        tile_key = (x, y, z)
 
-        # if the raw tile has been already cached, read it from the cache
-        if tile_key in prev_raw_cache:
-            raw_tile = prev_raw_cache[tile_key]
-        elif tile_key in self._rawTilesCache:
-            raw_tile = self._rawTilesCache[tile_key]
-        else:
+        raw_tile = self._rawTilesCache.get(tile_key)
+        if raw_tile is None:
+            if not wait:
+                raw_tile = self._getLowResTile(x, y, z)
+                if raw_tile is not None:
+                    # Temporary tile => not cached
+                    return raw_tile, self._projectTile(raw_tile)
             # The tile was not cached, so it must be read from the file
-            raw_tile = self.stream.raw[0].getTile(x, y, z)
+            raw_tile = self._tileLoader.get(x, y, z)
 
-        # if the projected tile has been already cached, read it from the cache
-        if tile_key in prev_proj_cache:
-            proj_tile = prev_proj_cache[tile_key]
-        elif tile_key in self._projectedTilesCache:
-            proj_tile = self._projectedTilesCache[tile_key]
-        else:
+        proj_tile = self._projectedTilesCache.get(tile_key)
+        if proj_tile is None:
             # The tile was not cached, so it must be projected again
             proj_tile = self._projectTile(raw_tile)
+            self._projectedTilesCache[tile_key] = proj_tile
 
-        # cache raw and projected tiles
-        self._rawTilesCache[tile_key] = raw_tile
-        self._projectedTilesCache[tile_key] = proj_tile
         return raw_tile, proj_tile
 
+    def _getLowResTile(self, x, y, z):
+        """
+        Create a temporary version of a tile, by enlarging the corresponding part
+        of the tile at the next zoom level (ie, at lower resolution), if it's
+        already in the cache.
+        x (int): X coordinate of the tile
+        y (int): Y coordinate of the tile
+        z (int): zoom level where the tile is
+        return (DataArray or None): the raw tile, or None if the lower resolution
+          tile is not available.
+        """
+        das = self.stream.raw[0]
+        if z >= das.maxzoom:
+            return None
+        ltile = self._rawTilesCache.get((x // 2, y // 2, z + 1))
+        if ltile is None:
+            return None
+
+        dims = das.metadata.get(model.MD_DIMS, "CTZYX"[-das.ndim::])
+        xi, yi = dims.index("X"), dims.index("Y")
+        tw, th = das.tile_shape
+        # Expected shape of the tile (which is smaller on the border of the image)
+        width = min(tw, das.shape[xi] // 2 ** z - x * tw)
+        height = min(th, das.shape[yi] // 2 ** z - y * th)
+
+        # Pick the part of the lower resolution tile, and enlarge it twice
+        part = [slice(None)] * ltile.ndim
+        part[xi] = slice((x % 2) * tw // 2, (x % 2) * tw // 2 + (width + 1) // 2)
+        part[yi] = slice((y % 2) * th // 2, (y % 2) * th // 2 + (height + 1) // 2)
+        tile = ltile[tuple(part)]
+        tile = numpy.repeat(numpy.repeat(tile, 2, axis=xi), 2, axis=yi)
+        if tile.shape[xi] < width or tile.shape[yi] < height:
+            return None  # Rounding issue on the border => just wait for the real tile
+        crop = [slice(None)] * tile.ndim
+        crop[xi] = slice(0, width)
+        crop[yi] = slice(0, height)
+        tile = model.DataArray(tile[tuple(crop)], ltile.metadata.copy())
+
+        pxs = das.metadata.get(model.MD_PIXEL_SIZE, (1, 1))
+        tile.metadata[model.MD_PIXEL_SIZE] = tuple(ps * 2 ** z for ps in pxs[:2]) + tuple(pxs[2:])
+        tile.metadata[model.MD_POS] = get_tile_md_pos((x, y), das.tile_shape, tile, das)
+        return tile
+
+    def _getVisibleTiles(self, z, rect):
+        """
+        Compute the tiles to read for the given area, and schedule their reading
+        z (int): zoom level
+        rect (int, int, int, int): the first and last tiles (x1, y1, x2, y2)
+          visible
+        """
+        das = self.stream.raw[0]
+        if self._tileLoader.das is not das:  # The raw data has been changed
+            self._tileLoader = img.TileLoader(das, self._rawTilesCache, self.TILE_LOADER_WORKERS,
+                                              callback=self._onTileLoaded)
+        dims = das.metadata.get(model.MD_DIMS, "CTZYX"[-das.ndim::])
+
+        def in_image(x, y, z):
+            if not (0 <= z <= das.maxzoom):
+                return False
+            # Number of tiles at this zoom level
+            ntx = -(-(das.shape[dims.index("X")] // 2 ** z) // das.tile_shape[0])
+            nty = -(-(das.shape[dims.index("Y")] // 2 ** z) // das.tile_shape[1])
+            return 0 <= x < ntx and 0 <= y < nty
+
+        x1, y1, x2, y2 = rect
+        visible = [(x, y, z) for x in range(x1, x2 + 1) for y in range(y1, y2 + 1)]
+        # Prefetch the lower resolution tiles first, as they are fast to read
+        # and can be shown while waiting for the visible tiles, then the ring
+        # of tiles around the visible area, to be ready when panning.
+        prefetch = [(x, y, z + 1) for x in range(x1 // 2, x2 // 2 + 1)
+                                  for y in range(y1 // 2, y2 // 2 + 1)]
+        prefetch += [(x, y, z) for x in range(x1 - 1, x2 + 2) for y in range(y1 - 1, y2 + 2)
+                     if not (x1 <= x <= x2 and y1 <= y <= y2)]
+        self._tileLoader.request(visible, [k for k in prefetch if in_image(*k)])
+
     def _projectTile(self, tile):
         """
         Project the tile
@@ -1052,9 +1140,12 @@ class RGBSpatialProjection(RGBProjection):
 
         return self._projectXY2RGB(tile, tint)
 
-    def _getTilesFromSelectedArea(self):
+    def _getTilesFromSelectedArea(self, wait=True):
         """
         Get the tiles inside the region defined by .rect and .mpp
+        wait (bool): if False, the tiles not yet read are replaced by an
+          enlarged version of the lower resolution tile (when available), and
+          the image will be updated again as soon as the tiles are read.
         return (DataArray, DataArray): Raw tiles and projected tiles
         """
 
@@ -1065,9 +1156,6 @@ class RGBSpatialProjection(RGBProjection):
 
         das = self.stream.raw[0]
 
-        # store the previous cache to use in this execution
-        prev_raw_cache = self._rawTilesCache
-        prev_proj_cache = self._projectedTilesCache
         # Execute at least once. If mpp and rect changed in
         # the last execution of the loops, execute again
         need_recompute = True
@@ -1078,13 +1166,8 @@ class RGBSpatialProjection(RGBProjection):
             rect = [l / (2 ** z) for l in rect]
             rect = [int(math.floor(l / das.tile_shape[0])) for l in rect]
             x1, y1, x2, y2 = rect
-            # the 4 lines below avoids that lots of old tiles
-            # stays in instance caches
-            prev_raw_cache.update(self._rawTilesCache)
-            prev_proj_cache.update(self._projectedTilesCache)
-            # empty current caches
-            self._rawTilesCache = {}
-            self._projectedTilesCache = {}
+            # Read all the tiles needed concurrently
+            self._getVisibleTiles(z, rect)
 
             raw_tiles = []
             projected_tiles = []
@@ -1097,8 +1180,7 @@ class RGBSpatialProjection(RGBProjection):
                     for y in range(y1, y2 + 1):
                         # the projected tiles cache is invalid
                         if self._projectedTilesInvalid:
-                            self._projectedTilesCache = {}
-                            prev_proj_cache = {}
+                            self._projectedTilesCache.clear()
                             self._projectedTilesInvalid = False
                             raise NeedRecomputeException()
 
@@ -1109,8 +1191,7 @@ class RGBSpatialProjection(RGBProjection):
                             # but using the cache from the last execution
                             raise NeedRecomputeException()
 
-                        raw_tile, proj_tile = \
-                            self._getTile(x, y, z, prev_raw_cache, prev_proj_cache)
+                        raw_tile, proj_tile = self._getTile(x, y, z, wait)
                         rt_column.append(raw_tile)
                         pt_column.append(proj_tile)
 
@@ -1134,7 +1215,7 @@ class RGBSpatialProjection(RGBProjection):
         try:
             if isinstance(raw[0], model.DataArrayShadow):
                 # DataArrayShadow => need to get each tile individually
-                self._raw, projected_tiles = self._getTilesFromSelectedArea()
+                self._raw, projected_tiles = self._getTilesFromSelectedArea(wait=False)
                 self.image.value = projected_tiles
             else:
                 self.image.value = self._projectTile(raw[0])
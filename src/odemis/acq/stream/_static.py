@@ -123,6 +123,8 @@ class RGBStream(StaticStream):
         raw (DataArray, DataArrayShadow or list of DataArray): The data to display.
         """
         raw = self._clean_raw(raw)
+        # Large images are displayed via a pyramid, to only project the visible part
+        raw[0] = img.toPyramid(raw[0])
         super(RGBStream, self).__init__(name, raw, *args, **kwargs)
 
     def _init_projection_vas(self):
@@ -219,6 +221,9 @@ class Static2DStream(StaticStream):
         # Copy back the metadata
         raw[0].metadata = metadata
 
+        # Large images are displayed via a pyramid, to only project the visible part
+        raw[0] = img.toPyramid(raw[0])
+
         super(Static2DStream, self).__init__(name, raw, *args, **kwargs)
 
         # Colouration of the image
@@ -1064,6 +1064,52 @@ class SEMCCDMDStream(MultipleDetectorStream):
 
         self._hw_settings_orig = {}  # str -> value, original HW settings
 
+        # None or AcquisitionWriter where the CCD data is directly written
+        self._writer = None
+
+    def setWriter(self, writer):
+        """
+        Write the CCD data to a file as soon as it's received, instead of
+        keeping the whole data in memory during the acquisition. This allows
+        to acquire data larger than the memory. Only the streams which have
+        a large CCD data (ie, spectrum cubes) support it, the other ones ignore
+        the writer.
+        In such case, the CCD data is not part of the .raw returned by the
+        acquisition. The caller is in charge of adding the rest of the data to
+        the writer, and closing it.
+        writer (None or dataio.hdf5.AcquisitionWriter): opened writer used for
+          the next acquisitions. None to keep the data in memory.
+        """
+        self._writer = writer
+
+    def _createCCDData(self, shape, dtype, md):
+        """
+        Allocate the container for the CCD data of the whole acquisition
+        shape (tuple of int): shape of the final data
+        dtype (numpy.dtype): type of the data
+        md (dict): metadata of the final data
+        return (DataArray or StreamedImage): container initialised with 0's
+        """
+        if self._writer is None:
+            return model.DataArray(numpy.zeros(shape, dtype=dtype), md)
+        else:
+            logging.debug("Writing CCD data of shape %s directly to file", shape)
+            return self._writer.create_image(shape, dtype, md)
+
+    def _assembleFinalData(self, n, data):
+        """
+        :param n: (int) number of the current stream which is assembled into ._raw
+        :param data: all acquired data of the stream
+        If the CCD data was written to a file, it's finalised there, instead
+        of being added to ._raw.
+        """
+        if n == self._ccd_idx and self._writer is not None:
+            for d in data:
+                d.finalize()
+            return
+
+        super()._assembleFinalData(n, data)
+
     def _supports_hw_sync(self):
         """
         :returns (bool): True if hardware synchronised acquisition is supported.
@@ -2604,8 +2650,8 @@ class SEMSpectrumMDStream(SEMCCDMDStream):
                        MD_DESCRIPTION: self._streams[n].name.value})
 
             # Shape of spectrum data = C11YX
-            da = numpy.zeros(shape=(spec_shape[1], 1, 1, rep[1], rep[0]), dtype=raw_data.dtype)
-            self._live_data[n].append(model.DataArray(da, md))
+            da = self._createCCDData((spec_shape[1], 1, 1, rep[1], rep[0]), raw_data.dtype, md)
+            self._live_data[n].append(da)
 
         self._live_data[n][pol_idx][:, 0, 0, px_idx[0], px_idx[1]] = raw_data.reshape(spec_shape[1])
 
@@ -2919,8 +2965,8 @@ class SEMAngularSpectrumMDStream(SEMCCDMDStream):
                               len(md[MD_THETA_LIST]), angle_res)
 
             # Shape of spectrum data = CA1YX
-            da = numpy.zeros(shape=(spec_res, angle_res, 1, rep[1], rep[0]), dtype=raw_data.dtype)
-            self._live_data[n].append(model.DataArray(da, md))
+            da = self._createCCDData((spec_res, angle_res, 1, rep[1], rep[0]), raw_data.dtype, md)
+            self._live_data[n].append(da)
 
         # Detector image has a shape of (angle, lambda)
         raw_data = raw_data.T  # transpose to (lambda, angle)
@@ -2941,6 +2987,9 @@ class SEMAngularSpectrumMDStream(SEMCCDMDStream):
             for d in data:
                 d.metadata[model.MD_DESCRIPTION] += " " + d.metadata[model.MD_POL_MODE]
 
+        if self._writer is not None:
+            return super()._assembleFinalData(n, data)
+
         self._raw.extend(data)
 
 
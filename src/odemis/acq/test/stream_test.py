@@ -5510,6 +5510,59 @@ class StaticStreamsTestCase(unittest.TestCase):
         self.assertEqual(len(pj.image.value), 2)
         self.assertEqual(len(pj.image.value[0]), 1)
 
+    def test_tiled_stream_memory(self):
+        """
+        Test a large image in memory is displayed via a pyramid
+        """
+        POS = (5.0, 7.0)
+        size = (8192, 4096)  # X, Y
+        md = {
+            model.MD_DIMS: 'YX',
+            model.MD_POS: POS,
+            model.MD_PIXEL_SIZE: (1e-6, 1e-6),
+        }
+        arr = numpy.zeros(size[::-1], dtype=numpy.uint16)
+        arr[::2, ::2] = 1000
+        data = model.DataArray(arr, metadata=md)
+
+        tstart = time.time()
+        ss = stream.StaticSEMStream("test", data)
+        self.assertIsInstance(ss.raw[0], img.DataArrayShadowPyramidalMemory)
+        pj = stream.RGBSpatialProjection(ss)
+        logging.info("Stream and projection created in %g s", time.time() - tstart)
+        self.assertEqual(pj.mpp.range, (1e-6, 1e-6 * 2 ** 5))
+
+        # full image, at the lowest resolution
+        pj.mpp.value = 1e-6 * 2 ** 5
+        pj.rect.value = (POS[0] - 0.004096, POS[1] - 0.002048, POS[0] + 0.004096, POS[1] + 0.002048)
+        time.sleep(0.5)
+        self.assertEqual(len(pj.image.value), 1)
+        self.assertEqual(len(pj.image.value[0]), 1)
+        self.assertEqual(pj.image.value[0][0].shape, (128, 256, 3))
+        # Each pixel is the average of 32x32 pixels
+        numpy.testing.assert_array_equal(pj.raw[0][0], 250)
+
+        # Zoom in, on a small area, at full resolution
+        pj.mpp.value = 1e-6
+        pj.rect.value = (POS[0] - 300e-6, POS[1] - 200e-6, POS[0] + 300e-6, POS[1] + 200e-6)
+        time.sleep(0.5)
+        self.assertEqual(len(pj.image.value), 4)
+        self.assertEqual(len(pj.image.value[0]), 2)
+        self.assertEqual(pj.image.value[0][0].shape, (256, 256, 3))
+        numpy.testing.assert_array_equal(pj.raw[0][0][::2, ::2], 1000)
+
+        # Tint change => the tiles are projected again (from the cache of raw tiles)
+        ss.tint.value = (255, 0, 0)
+        time.sleep(0.5)
+        self.assertEqual(pj.image.value[0][0][0, 0].tolist(), [255, 0, 0])
+
+        # Reading back the whole data is still possible
+        numpy.testing.assert_array_equal(ss.raw[0].getData(), arr)
+
+        # Small images are kept as-is
+        ss = stream.StaticSEMStream("test", data[:1024, :1024])
+        self.assertIsInstance(ss.raw[0], model.DataArray)
+
     def test_rgb_tiled_stream(self):
         POS = (5.0, 7.0)
         size = (2000, 1000, 3)
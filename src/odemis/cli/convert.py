@@ -32,16 +32,19 @@ from odemis.util import spectrum
 from odemis.util import dataio as io
 import os
 import sys
+import time
 
 from odemis.acq.stitching import WEAVER_MEAN, WEAVER_COLLAGE, WEAVER_COLLAGE_REVERSE, \
-                                REGISTER_SHIFT, REGISTER_IDENTITY, REGISTER_GLOBAL_SHIFT
+                                REGISTER_SHIFT, REGISTER_IDENTITY, REGISTER_GLOBAL_SHIFT, REGISTER_PYRAMID
 
 logging.getLogger().setLevel(logging.INFO) # use DEBUG for more messages
 
 
-def open_acq(fn):
+def open_acq(fn, shadow=False):
     """
     Read the content of an acquisition file
+    shadow (bool): if True, and the format supports it, the data is returned
+      as DataArrayShadows, which are only read when needed.
     return (list of DataArray, list of DataArray):
         list of the data in the file
         thumbnail (if available, might be empty)
@@ -55,6 +58,15 @@ def open_acq(fn):
     if not hasattr(fmt_mng, "read_data"):
         raise NotImplementedError("No support for importing format %s" % fmt_mng.FORMAT)
 
+    if shadow and hasattr(fmt_mng, "open_data"):
+        try:
+            acd = fmt_mng.open_data(fn)
+        except Exception:
+            raise ValueError("Failed to open the file '%s' as %s" % (fn, fmt_mng.FORMAT))
+        data = list(acd.content)
+        # The thumbnails are small, no need to keep them on the disk
+        return data, [t.getData() for t in acd.thumbnails]
+
     try:
         data = fmt_mng.read_data(fn)
     except Exception:
@@ -121,17 +133,53 @@ def save_acq(fn, data, thumbs, pyramid=False):
             raise ValueError("Format %s doesn't support pyramidal export" %
                              (exporter.FORMAT,))
 
+    if not getattr(exporter, "CAN_SAVE_SHADOW", False):
+        # The exporter needs the whole data in memory
+        data = [d.getData() if isinstance(d, model.DataArrayShadow) else d for d in data]
+
     exporter.export(fn, data, thumb, **kwargs)
 
 
-def da_sub(daa, dab):
+def read_part(d, key):
     """
-    subtract 2 DataArrays as cleverly as possible:
-      * keep the metadata of the first DA in the result
-      * ensures the result has the right type so that no underflows happen
-    returns (DataArray): the result of daa - dab
+    Read part of the data, without reading the rest, if possible
+    d (DataArray or DataArrayShadow): the data
+    key (tuple of int or slice): the part to read
+    return (DataArray): the part of the data
     """
-    rt = numpy.result_type(daa, dab) # dtype of result of daa-dab
+    if isinstance(d, numpy.ndarray):
+        return d[key]
+    if not key:
+        return d.getData()
+    try:
+        part = d[key]
+    except TypeError:  # This DataArrayShadow doesn't support partial reading
+        return d.getData()[key]
+    if isinstance(part, model.DataArrayShadow):
+        part = part.getData()
+    return part
+
+
+def iter_planes(d):
+    """
+    Read the data, one plane (ie, image along the last 2 dimensions) at a time
+    d (DataArray or DataArrayShadow): the data
+    yield (DataArray): each plane
+    """
+    for i in numpy.ndindex(*d.shape[:-2]):
+        yield read_part(d, i)
+
+
+def sub_dtype(daa, dab, minval=None):
+    """
+    Find the type of the result of daa - dab, so that no underflow happens
+    daa (DataArray or DataArrayShadow)
+    dab (DataArray or DataArrayShadow)
+    minval (None or int): the minimum value of daa - dab (if known)
+    return (None or numpy.dtype): the dtype of the result (None if numpy
+      can decide by itself)
+    """
+    rt = numpy.result_type(daa.dtype, dab.dtype) # dtype of result of daa-dab
 
     dt = None # default is to let numpy decide
     if rt.kind == "f":
@@ -141,40 +189,124 @@ def da_sub(daa, dab):
         # underflow can happen (especially if unsigned)
 
         # find the worse case value (could be improved, but would be longer)
-        worse_val = int(daa.min()) - int(dab.max())
-        dt = numpy.result_type(rt, numpy.min_scalar_type(worse_val))
+        if minval is None:
+            minval = int(daa.min()) - int(dab.max())
+        dt = numpy.result_type(rt, numpy.min_scalar_type(minval))
     else:
         # subtracting such a data is suspicious, but try anyway
         logging.warning("Subtraction on data of type %s unsupported", rt.name)
 
+    return dt
+
+
+def da_sub(daa, dab):
+    """
+    subtract 2 DataArrays as cleverly as possible:
+      * keep the metadata of the first DA in the result
+      * ensures the result has the right type so that no underflows happen
+    returns (DataArray): the result of daa - dab
+    """
+    dt = sub_dtype(daa, dab)
     res = numpy.subtract(daa, dab, dtype=dt) # metadata is copied from daa
     logging.debug("type = %s, %s", res.dtype.name, daa.dtype.name)
     return res
 
 
+class DataArrayShadowSub(model.DataArrayShadow):
+    """
+    Subtraction of two data, computed plane by plane, only when the data is
+    read. This allows to subtract data which doesn't fit in memory.
+    The result is the same as da_sub().
+    """
+
+    def __init__(self, daa, dab):
+        """
+        daa (DataArray or DataArrayShadow): the data to subtract from. The
+          metadata is copied from it.
+        dab (DataArray or DataArrayShadow): the data to subtract. It must have
+          the same shape as daa, or be broadcastable to it, along the
+          dimensions of the planes.
+        """
+        shape = numpy.broadcast_shapes(daa.shape, dab.shape)
+        if shape != daa.shape:
+            raise ValueError("Cannot subtract data of shape %s from data of shape %s" %
+                             (dab.shape, daa.shape))
+        self._daa = daa
+        self._dab = dab
+
+        minval = None
+        if numpy.result_type(daa.dtype, dab.dtype).kind in "iub":
+            # Find the extreme values, reading one plane at a time
+            mina = min(int(p.min()) for p in iter_planes(daa))
+            maxb = max(int(p.max()) for p in iter_planes(dab))
+            minval = mina - maxb
+        dt = sub_dtype(daa, dab, minval)
+        if dt is None:
+            dt = numpy.result_type(daa.dtype, dab.dtype)
+        model.DataArrayShadow.__init__(self, daa.shape, dt, daa.metadata.copy())
+
+    def __getitem__(self, key):
+        """
+        Fetches only part of the data, reading only this part in both data.
+        key (int, or tuple of int): index along the first dimensions
+        return DataArray: the part of the result
+        """
+        if not isinstance(key, tuple):
+            key = (key,)
+        if not all(isinstance(k, int) for k in key):
+            return self.getData()[key]
+
+        # dab is broadcast along the dimensions it doesn't have, or which are of length 1
+        ndiff = self.ndim - self._dab.ndim
+        bkey = tuple(0 if self._dab.shape[d - ndiff] == 1 else k
+                     for d, k in enumerate(key) if d >= ndiff)
+        a = read_part(self._daa, key)
+        b = read_part(self._dab, bkey)
+        # Use the metadata of the plane (which might be specific to it), but
+        # with only the dimensions left
+        md = getattr(a, "metadata", self.metadata).copy()
+        dims = md.get(model.MD_DIMS)
+        if dims is not None and len(dims) > a.ndim:
+            md[model.MD_DIMS] = dims[-a.ndim:] if a.ndim else ""
+        return model.DataArray(numpy.subtract(a, b, dtype=self.dtype), md)
+
+    def getData(self):
+        """
+        Fetches the whole data (at full resolution) of image.
+        return DataArray: the data, with its metadata
+        """
+        a = read_part(self._daa, ())
+        b = read_part(self._dab, ())
+        return model.DataArray(numpy.subtract(a, b, dtype=self.dtype), self.metadata.copy())
+
+
 def minus(data_a, data_b):
     """
     computes data_a - data_b.
-    data_a (list of DataArrays of length N)
-    data_b (list of DataArrays of length 1 or N): if length is 1, all the arrays
-     in data_a are subtracted from this array, otherwise, each array is subtracted
-     1 to 1.
-    returns (list of DataArrays of length N)
+    data_a (list of DataArrays or DataArrayShadows of length N)
+    data_b (list of DataArrays or DataArrayShadows of length 1 or N): if length
+     is 1, all the arrays in data_a are subtracted from this array, otherwise,
+     each array is subtracted 1 to 1.
+    returns (list of DataArrays or DataArrayShadows of length N): if any of the
+      data is a DataArrayShadow, the result is a DataArrayShadow, which is
+      computed plane by plane, only when reading it.
     """
-    ret = []
     if len(data_b) == 1:
         # subtract the same data from all the data_a
-        b = data_b[0]
-        for a in data_a:
-            r = da_sub(a, b)
-            ret.append(r)
+        pairs = [(a, data_b[0]) for a in data_a]
     elif len(data_b) == len(data_a):
-        for a, b in zip(data_a, data_b):
-            r = da_sub(a, b)
-            ret.append(r)
+        pairs = zip(data_a, data_b)
     else:
         raise ValueError("Cannot subtract %d images from %d images" %
                          (len(data_b), len(data_a)))
+
+    ret = []
+    for a, b in pairs:
+        if isinstance(a, model.DataArrayShadow) or isinstance(b, model.DataArrayShadow):
+            r = DataArrayShadowSub(a, b)
+        else:
+            r = da_sub(a, b)
+        ret.append(r)
     return ret
 
 
@@ -216,8 +348,9 @@ def main(args):
             help="name of registrar to be used during stitching. Options: 'identity': IdentityRegistrar "
             "(place tiles at original position), 'shift': ShiftRegistrar (use cross-correlation "
             "algorithm to correct for suboptimal stage movement), 'global_shift': GlobalShiftRegistrar "
-            "(uses cross-correlation algorithm with global optimization)",
-            choices=("identity", "shift", "global_shift"), default="global_shift")
+            "(uses cross-correlation algorithm with global optimization), 'pyramid': PyramidShiftRegistrar "
+            "(same as global_shift, but faster on large tiles, by first matching downsampled tiles)",
+            choices=("identity", "shift", "global_shift", "pyramid"), default="global_shift")
 
     # TODO: --export (spatial) image that defaults to a HFW corresponding to the
     # smallest image, and can be overridden by --hfw xxx (in µm).
@@ -245,7 +378,8 @@ def main(args):
         raise ValueError("--input, --tiles, --effcomp cannot be provided simultaneously.")
 
     if infn:
-        data, thumbs = open_acq(infn)
+        # Only read the data while writing it, so that large files can be converted
+        data, thumbs = open_acq(infn, shadow=True)
         logging.info("File contains %d %s (and %d %s)",
                      len(data), ngettext("image", "images", len(data)),
                      len(thumbs), ngettext("thumbnail", "thumbnails", len(thumbs)))
@@ -259,7 +393,8 @@ def main(args):
                 raise ValueError(f"No file matching filename {file_pattern}")
 
         registration_method = {"identity": REGISTER_IDENTITY, "shift": REGISTER_SHIFT,
-                               "global_shift": REGISTER_GLOBAL_SHIFT}[options.registrar]
+                               "global_shift": REGISTER_GLOBAL_SHIFT,
+                               "pyramid": REGISTER_PYRAMID}[options.registrar]
         weaving_method = {"collage": WEAVER_COLLAGE, "mean": WEAVER_MEAN,
                   "collage_reverse": WEAVER_COLLAGE_REVERSE}[options.weaver]
         data = io.open_files_and_stitch(tifns, registration_method, weaving_method)
@@ -276,12 +411,16 @@ def main(args):
             logging.info("Dropping thumbnail due to subtraction")
             thumbs = []
         for fn in options.minus:
-            sdata, _ = open_acq(fn)
+            sdata, _ = open_acq(fn, shadow=True)
             data = minus(data, sdata)
 
+    tstart = time.time()
     save_acq(outfn, data, thumbs, options.pyramid)
+    dur = time.time() - tstart
 
-    logging.info("Successfully generated file %s", outfn)
+    size = sum(numpy.prod(d.shape) * numpy.dtype(d.dtype).itemsize for d in data) / 2 ** 20
+    logging.info("Successfully generated file %s, with %.1f MB of data in %.1f s (%.1f MB/s)",
+                 outfn, size, dur, size / max(dur, 1e-6))
 
 
 if __name__ == '__main__':
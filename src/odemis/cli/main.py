@@ -175,14 +175,24 @@ def print_component_graph(graph, pretty=True, level=0):
         print_component_graph(subg, pretty, level + 1)
 
 
-def build_graph_children(comps):
+def build_graph_children(comps, descs=None):
     """
     Constructs a graph based on the children hierarchy, so each component is a
     node, and the children are sub-nodes of their parent. Precisely, it builds a
     tree, or several trees if there is more than one root component.
     comps (set of Component): All the components
+    descs (None or dict str -> dict): description of the components, as returned
+      by model.describeComponents(), used to avoid reading .children of each component.
     return (dict {Component -> dict {Component -> dict...}}): parent -> children, recursive
     """
+    descs = descs or {}
+    comp_children = {}
+    for comp in comps:
+        try:
+            comp_children[comp] = set(descs[comp.name]["vas"]["children"]["value"])
+        except KeyError:
+            comp_children[comp] = set(comp.children.value)
+
     # Start from the leaves, which have no children, and merge all the leaves
     # into their parent, once the parent has all its children in the graph.
     # Note: the children must have a single parent, otherwise, it'll not work
@@ -191,7 +201,7 @@ def build_graph_children(comps):
     while lefts:
         prev_lefts = lefts.copy()
         for comp in prev_lefts:
-            children = set(comp.children.value)
+            children = comp_children[comp]
             if not (children - set(graph.keys())):
                 graph[comp] = {k: v for k, v in graph.items() if k in children}
                 for child in children:
@@ -221,7 +231,7 @@ def list_components(pretty=True):
 
     print_component(microscope, pretty)
     if pretty:
-        graph = build_graph_children(subcomps)
+        graph = build_graph_children(subcomps, model.describeComponents(subcomps))
         print_component_graph(graph, pretty, 1)
     else:
         # The "pretty" code would do the same, but much slower
@@ -257,10 +267,25 @@ def print_roattributes(component, pretty):
         print_roattribute(name, value, pretty)
 
 def print_data_flow(name, df, pretty):
+    try:
+        stats = df.getStatistics()
+    except Exception:  # Not all DataFlows support it
+        logging.debug("Failed to read statistics of %s", name, exc_info=True)
+        stats = None
+
     if pretty:
-        print(u"\t" + name + u" (Data-flow)")
+        if stats:
+            print(u"\t%s (Data-flow)\tpublished: %d, dropped: %d, queue depth: %d, lag: %s" %
+                  (name, stats["published"], stats["dropped"], stats["queue depth"],
+                   units.readable_str(stats["lag"], "s", sig=3)))
+        else:
+            print(u"\t" + name + u" (Data-flow)")
     else:
-        print(u"%s\ttype:data-flow" % (name,))
+        if stats:
+            print(u"%s\ttype:data-flow\tpublished:%d\tdropped:%d\tqueue depth:%d\tlag:%s" %
+                  (name, stats["published"], stats["dropped"], stats["queue depth"], stats["lag"]))
+        else:
+            print(u"%s\ttype:data-flow" % (name,))
 
 def print_data_flows(component, pretty):
     # find all dataflows
@@ -279,14 +304,26 @@ def print_events(component, pretty):
         print_event(name, value, pretty)
 
 
-def print_vattribute(component, name, va, pretty):
+def print_vattribute(component, name, va, pretty, desc=None):
     """
     Print on one line the information about a VigilantAttribute
     component (Component): the component containing the VigilantAttribute
     name (str): the name of the VigilantAttribute
     va (VigilantAttribute): the VigilantAttribute to display
     pretty (bool): whether to display for the user (True) or for a machine (False)
+    desc (None or dict): state of the VA, as returned by model.describeComponents().
+      If None, it is read from the VA.
     """
+    if desc is None:
+        # we cannot discover if it continuous or enumerated, just try and see if it fails
+        desc = {"value": va.value}
+        for attr in ("range", "choices"):
+            try:
+                desc[attr] = getattr(va, attr)
+            except AttributeError:
+                pass
+    value = desc["value"]
+
     if va.unit:
         if pretty:
             unit = u" (unit: %s)" % va.unit
@@ -303,31 +340,30 @@ def print_vattribute(component, name, va, pretty):
     else:
         readonly = u""
 
-    # we cannot discover if it continuous or enumerated, just try and see if it fails
-    try:
-        varange = va.range
+    if "range" in desc:
+        varange = desc["range"]
         if pretty:
             str_range = u" (range: %s → %s)" % (varange[0], varange[1])
         else:
             str_range = u"\trange:%s" % str(varange)
-    except AttributeError:
+    else:
         str_range = u""
 
-    try:
-        vachoices = va.choices # set or dict
+    if "choices" in desc:
+        vachoices = desc["choices"]  # set or dict
         if pretty:
-            if isinstance(va.choices, dict):
+            if isinstance(vachoices, dict):
                 str_choices = u" (choices: %s)" % u", ".join(
                                 u"%s: '%s'" % i for i in vachoices.items())
             else:
                 str_choices = u" (choices: %s)" % u", ".join([str(c) for c in vachoices])
         else:
             str_choices = u"\tchoices:%s" % str(vachoices)
-    except AttributeError:
+    else:
         str_choices = ""
 
     if pretty:
-        val = va.value
+        val = value
         if name in VAS_COMPS:
             try:
                 val = {c.name for c in val}
@@ -346,11 +382,11 @@ def print_vattribute(component, name, va, pretty):
             val_converted = u""
 
         # For position, it's trickier, as the unit is on .axes
-        if (name == "position" and isinstance(va.value, dict) and
+        if (name == "position" and isinstance(value, dict) and
             hasattr(component, "axes") and isinstance(component.axes, dict)
            ):
             pos_deg = {}
-            for an, pos in va.value.items():
+            for an, pos in value.items():
                 try:
                     axis_def = component.axes[an]
                 except KeyError:
@@ -374,14 +410,19 @@ def print_vattribute(component, name, va, pretty):
               (readonly, sval, unit, str_range, str_choices, val_converted))
     else:
         print(u"%s\ttype:%sva\tvalue:%s%s%s%s" %
-              (name, readonly, str(va.value), unit, str_range, str_choices))
+              (name, readonly, str(value), unit, str_range, str_choices))
 
 
-def print_vattributes(component, pretty):
+def print_vattributes(component, pretty, descs=None):
+    """
+    descs (None or dict str -> dict): name of the VA -> state of the VA, as
+      returned by model.describeComponents(). If None, the VAs are read one by one.
+    """
+    descs = descs or {}
     for name, va in model.getVAs(component).items():
         if name in VAS_HIDDEN:
             continue
-        print_vattribute(component, name, va, pretty)
+        print_vattribute(component, name, va, pretty, descs.get(name))
 
 
 def map_metadata_names():
@@ -416,7 +457,11 @@ def print_metadata(component, pretty):
             name = md2name.get(key, "'%s'" % (key,))
             print(u"%s\ttype:metadata\tvalue:%s" % (name, value))
 
-def print_attributes(component, pretty):
+def print_attributes(component, pretty, desc=None):
+    """
+    desc (None or dict): description of the component, as returned by
+      model.describeComponents()
+    """
     if pretty:
         print(u"Component '%s':" % component.name)
         print(u"\trole: %s" % component.role)
@@ -426,7 +471,7 @@ def print_attributes(component, pretty):
         print(u"role\tvalue:%s" % component.role)
         print(u"affects\tvalue:" + u"\t".join(component.affects.value))
     print_roattributes(component, pretty)
-    print_vattributes(component, pretty)
+    print_vattributes(component, pretty, desc and desc["vas"])
     print_data_flows(component, pretty)
     print_events(component, pretty)
     print_metadata(component, pretty)
@@ -472,12 +517,16 @@ def list_properties(comp_name, pretty=True):
     pretty (bool): if True, display with pretty-printing
     """
     if comp_name == "*":
-        for c in model.getComponents():
-            print_attributes(c, pretty)
-            print("")
+        comps = model.getComponents()
     else:
-        component = get_component(comp_name)
-        print_attributes(component, pretty)
+        comps = [get_component(comp_name)]
+
+    # Read the state of all the VAs in one go
+    descs = model.describeComponents(comps)
+    for c in comps:
+        print_attributes(c, pretty, descs.get(c.name))
+        if comp_name == "*":
+            print("")
 
 def set_attr(comp_name, attr_val_str):
     """
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on 17 Oct 2026
+
+Copyright © 2026 Delmic
+
+This file is part of Odemis.
+
+Odemis is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License version 2 as published by the Free Software
+Foundation.
+
+Odemis is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+Odemis. If not, see http://www.gnu.org/licenses/.
+"""
+import logging
+import os
+import unittest
+
+import numpy
+
+from odemis import model
+from odemis.cli import convert
+from odemis.dataio import tiff
+
+logging.getLogger().setLevel(logging.DEBUG)
+
+FN_A = "test_convert_a.ome.tiff"
+FN_B = "test_convert_b.ome.tiff"
+FN_OUT = "test_convert_out.ome.tiff"
+
+
+class TestConvert(unittest.TestCase):
+
+    def setUp(self):
+        md = {model.MD_PIXEL_SIZE: (1e-6, 1e-6), model.MD_POS: (1e-3, -1e-3),
+              model.MD_DIMS: "ZYX"}
+        self.da = model.DataArray(numpy.random.randint(0, 2 ** 12, (4, 512, 600), dtype=numpy.uint16), md)
+        self.db = model.DataArray(numpy.random.randint(0, 2 ** 13, (512, 600), dtype=numpy.uint16),
+                                  {model.MD_PIXEL_SIZE: (1e-6, 1e-6)})
+        tiff.export(FN_A, self.da)
+        tiff.export(FN_B, self.db)
+
+    def tearDown(self):
+        for fn in (FN_A, FN_B, FN_OUT):
+            try:
+                os.remove(fn)
+            except OSError:
+                pass
+
+    def test_minus_shadow(self):
+        """
+        Subtraction of DataArrayShadows gives the same result as with DataArrays
+        """
+        exp = convert.minus([self.da], [self.db])[0]
+        self.assertEqual(exp.dtype, numpy.int32)
+
+        data_a, _ = convert.open_acq(FN_A, shadow=True)
+        data_b, _ = convert.open_acq(FN_B, shadow=True)
+        self.assertIsInstance(data_a[0], model.DataArrayShadow)
+        res = convert.minus(data_a, data_b)[0]
+        self.assertIsInstance(res, model.DataArrayShadow)
+        # The file might have extra dimensions of length 1
+        self.assertEqual(res.shape[-3:], exp.shape)
+        self.assertEqual(res.dtype, exp.dtype)
+        plane = res[(0,) * (res.ndim - 3) + (2,)]
+        numpy.testing.assert_array_equal(plane, exp[2])
+        # The dimensions of the plane are only the ones left
+        self.assertEqual(plane.metadata.get(model.MD_DIMS, "YX"), "YX")
+        self.assertEqual(plane.metadata[model.MD_PIXEL_SIZE], (1e-6, 1e-6))
+        numpy.testing.assert_array_equal(res.getData().reshape(exp.shape), exp)
+
+    def test_convert_minus(self):
+        """
+        Convert a file, with subtraction, to a pyramidal TIFF
+        """
+        ret = convert.main(["convert", "--input", FN_A, "--minus", FN_B,
+                            "--output", FN_OUT, "--pyramid"])
+        self.assertFalse(ret)
+
+        exp = convert.minus([self.da], [self.db])[0]
+        rdata = tiff.open_data(FN_OUT)
+        self.assertTrue(hasattr(rdata.content[0], "maxzoom"))
+        numpy.testing.assert_array_equal(rdata.content[0].getData().reshape(exp.shape), exp)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -26,6 +26,7 @@ import logging
 import os
 
 from ._base import *
+from ._peek import ImageSummary, FileSummary, peek
 from odemis.dataio import tiff
 
 # The interface of a "format manager" is as follows:
@@ -35,10 +36,11 @@ from odemis.dataio import tiff
 #  * export (callable): write model.DataArray into a file
 #  * read_data (callable): read a file into model.DataArray
 #  * read_thumbnail (callable): read the thumbnail(s) of a file
+#  * open_data (callable): open a file, to read the data only when needed
 #  if it doesn't support writing, then is has no .export(), and if it doesn't
 #  support reading, then it has not read_data().
-_iomodules = ["tiff", "stiff", "hdf5", "png", "csv", "catmaid"]
-__all__ = _iomodules + ["get_available_formats", "get_converter", "find_fittest_converter"]
+_iomodules = ["tiff", "stiff", "hdf5", "zarr", "png", "csv", "catmaid"]
+__all__ = _iomodules + ["get_available_formats", "get_converter", "find_fittest_converter", "peek"]
 
 
 def get_available_formats(mode=os.O_RDWR, allowlossy=False):
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+Created on 17 Oct 2026
+
+Copyright © 2026 Delmic
+
+This file is part of Odemis.
+
+Odemis is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License version 2 as published by the Free Software
+Foundation.
+
+Odemis is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+Odemis. If not, see http://www.gnu.org/licenses/.
+"""
+
+# Quick access to the description of the content of an acquisition file (shapes,
+# dtypes, metadata and thumbnails), without reading the pixel data. This is
+# what a file browser needs, for many files at once.
+# The summary is stored in a small "index" file, next to the acquisition file,
+# so that the next times, the acquisition file doesn't even need to be parsed.
+# The index is only used if the size and modification time of the file are
+# still the same as when the index was created.
+
+import json
+import logging
+import numpy
+import os
+
+from odemis import model
+from odemis.util.conversion import JsonExtraEncoder
+
+__all__ = ["ImageSummary", "FileSummary", "peek"]
+
+INDEX_VERSION = 1
+INDEX_EXTENSION = ".index.npz"
+
+
+class ImageSummary(object):
+    """
+    Description of an image of a file, without its data
+    """
+
+    def __init__(self, shape, dtype, metadata):
+        """
+        shape (tuple of int): The shape of the image
+        dtype (numpy.dtype): The data type
+        metadata (dict str->val): The metadata
+        """
+        self.shape = tuple(shape)
+        self.ndim = len(self.shape)
+        self.dtype = numpy.dtype(dtype)
+        self.metadata = metadata
+
+    def __repr__(self):
+        return "%s(%s, %s)" % (self.__class__.__name__, self.shape, self.dtype)
+
+
+class FileSummary(object):
+    """
+    Description of the content of an acquisition file
+    """
+
+    def __init__(self, filename, fmt, content, thumbnails):
+        """
+        filename (str): path to the file
+        fmt (str): name of the format of the file
+        content (tuple of ImageSummary): the images in the file (same order as
+          with .open_data())
+        thumbnails (tuple of DataArray): the thumbnails of the file (with data)
+        """
+        self.filename = filename
+        self.format = fmt
+        self.content = content
+        self.thumbnails = thumbnails
+
+
+def _get_index_filename(filename):
+    """
+    return (str): the name of the index file of an acquisition file
+    """
+    dirname, basename = os.path.split(filename)
+    # Hidden file, to not clutter the file browsers
+    return os.path.join(dirname, "." + basename + INDEX_EXTENSION)
+
+
+def encode_metadata(md):
+    """
+    Convert metadata to a JSON-compatible dict. The metadata which cannot be
+    converted is dropped.
+    """
+    ret = {}
+    for k, v in md.items():
+        try:
+            ret[k] = json.loads(json.dumps(v, cls=JsonExtraEncoder))
+        except (TypeError, ValueError):
+            logging.debug("Not storing metadata %s in index, as it cannot be encoded", k)
+    return ret
+
+
+def _decode_value(v):
+    # Sequences in the metadata are (nearly) always tuples
+    if isinstance(v, list):
+        return tuple(_decode_value(i) for i in v)
+    elif isinstance(v, dict):
+        return {k: _decode_value(i) for k, i in v.items()}
+    return v
+
+
+def decode_metadata(md):
+    """
+    Convert metadata encoded with encode_metadata() back to standard metadata
+    """
+    return {k: _decode_value(v) for k, v in md.items()}
+
+
+def _file_signature(filename):
+    """
+    return (int, int): size and modification time (in ns) of the file
+    raise OSError: if the file doesn't exist
+    """
+    st = os.stat(filename)
+    return st.st_size, st.st_mtime_ns
+
+
+def _read_index(filename):
+    """
+    Read the index of an acquisition file, if it exists and is up-to-date
+    return (FileSummary or None): None if there is no (valid) index
+    """
+    try:
+        sig = _file_signature(filename)
+        # allow_pickle=False, so that reading a (malicious) index cannot run code
+        with numpy.load(_get_index_filename(filename), allow_pickle=False) as idx:
+            desc = json.loads(idx["description"].tobytes().decode("utf-8"))
+            if desc["version"] != INDEX_VERSION or tuple(desc["signature"]) != sig:
+                logging.debug("Index of %s is outdated", filename)
+                return None
+
+            content = tuple(ImageSummary(d["shape"], d["dtype"], decode_metadata(d["metadata"]))
+                            for d in desc["content"])
+            thumbnails = tuple(model.DataArray(idx["thumbnail%d" % i], decode_metadata(md))
+                               for i, md in enumerate(desc["thumbnails"]))
+    except FileNotFoundError:
+        return None
+    except Exception as ex:
+        logging.info("Failed to read index of %s: %s", filename, ex)
+        return None
+
+    return FileSummary(filename, desc["format"], content, thumbnails)
+
+
+def _write_index(summary, sig):
+    """
+    Store the summary of a file in its index. If the index cannot be written
+    (eg, the directory is read-only), nothing happens.
+    summary (FileSummary): the description of the file
+    sig (int, int): signature of the file, as returned by _file_signature()
+    """
+    desc = {
+        "version": INDEX_VERSION,
+        "signature": sig,
+        "format": summary.format,
+        "content": [{"shape": s.shape, "dtype": s.dtype.str, "metadata": encode_metadata(s.metadata)}
+                    for s in summary.content],
+        "thumbnails": [encode_metadata(t.metadata) for t in summary.thumbnails],
+    }
+    arrays = {"thumbnail%d" % i: numpy.asarray(t) for i, t in enumerate(summary.thumbnails)}
+    jdesc = json.dumps(desc, cls=JsonExtraEncoder)
+    arrays["description"] = numpy.frombuffer(jdesc.encode("utf-8"), dtype=numpy.uint8)
+
+    idxfn = _get_index_filename(summary.filename)
+    tmpfn = idxfn + ".%d.tmp" % os.getpid()
+    try:
+        with open(tmpfn, "wb") as f:
+            numpy.savez(f, **arrays)
+        # Atomic, so that a concurrent reader never sees a partial index
+        os.replace(tmpfn, idxfn)
+    except OSError as ex:
+        logging.debug("Cannot write index of %s: %s", summary.filename, ex)
+        try:
+            os.remove(tmpfn)
+        except OSError:
+            pass
+
+
+def _summarize(filename, converter):
+    """
+    Read the summary of a file, by opening it with the converter
+    return (FileSummary)
+    """
+    if hasattr(converter, "open_data"):
+        # Only reads the metadata, and the thumbnail
+        acd = converter.open_data(filename)
+        content = tuple(ImageSummary(d.shape, d.dtype, d.metadata.copy()) for d in acd.content)
+        thumbnails = tuple(t.getData() for t in acd.thumbnails)
+    else:
+        data = converter.read_data(filename)
+        content = tuple(ImageSummary(d.shape, d.dtype, d.metadata.copy()) for d in data)
+        try:
+            thumbnails = tuple(converter.read_thumbnail(filename))
+        except Exception:
+            logging.debug("Failed to read the thumbnail of %s", filename, exc_info=True)
+            thumbnails = ()
+
+    return FileSummary(filename, converter.FORMAT, content, thumbnails)
+
+
+def peek(filename, use_index=True):
+    """
+    Read the description of the content of an acquisition file, without
+    reading the pixel data (apart from the thumbnails).
+    filename (str): path to the file
+    use_index (bool): if True, the summary is read from the index file, when
+      it's up-to-date, and otherwise the index is (re)created. In the index, the
+      metadata is stored as JSON, so its values are approximated: sequences
+      are returned as tuples, and the values which cannot be stored are dropped.
+    return (FileSummary): the description of the file
+    raise IOError: if the file cannot be read
+    raise NotImplementedError: if the format of the file cannot be read
+    """
+    # Local import, to avoid circular import
+    from odemis.dataio import find_fittest_converter
+
+    if use_index:
+        summary = _read_index(filename)
+        if summary is not None:
+            return summary
+
+    converter = find_fittest_converter(filename, default=None, mode=os.O_RDONLY)
+    if converter is None:
+        raise NotImplementedError("No converter found for file %s" % (filename,))
+
+    # Read the signature before the file, so that if it's modified meanwhile,
+    # the index will be outdated.
+    sig = _file_signature(filename)
+    summary = _summarize(filename, converter)
+    if use_index:
+        _write_index(summary, sig)
+
+    return summary
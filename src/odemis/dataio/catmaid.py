@@ -20,12 +20,19 @@ Public License for more details.
 You should have received a copy of the GNU General Public License along with Odemis. If not,
 see http://www.gnu.org/licenses/.
 """
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import configparser
+import hashlib
+import json
 import logging
 import math
 import numpy
+import os
 import re
 import requests
+import threading
+import time
 from urllib.parse import urlparse, parse_qs
 
 from PIL import Image
@@ -77,6 +84,15 @@ SUPPORTED_CONTENT_TYPES = {
 
 KEY_PATH = "~/.local/share/odemis/catmaid.key"
 
+# The tiles downloaded are kept on disk, so that they don't need to be fetched
+# again when zooming back or reopening the stack. Set to None to disable.
+CACHE_DIR = os.path.expanduser("~/.cache/odemis/catmaid")
+CACHE_MAX_SIZE = 1024 * 2 ** 20  # bytes
+# After this time, the server is asked whether the tile has changed (using the ETag)
+CACHE_MAX_AGE = 3600  # s
+# Maximum number of tiles fetched simultaneously by getTiles()
+MAX_CONCURRENT_REQUESTS = 8
+
 # Tile Source Types
 FILE_BASED = 1
 REQUEST_QUERY = 2
@@ -167,13 +183,67 @@ class DataArrayShadowPyramidalCatmaid(DataArrayShadow):
         DataArrayShadow.__init__(self, shape, dtype, metadata, maxzoom=maxzoom, tile_shape=tile_shape)
 
         self._base_url = base_url
-        self._session = requests.Session()
+        # One session per thread, as tiles can be fetched from multiple threads
+        # simultaneously. Each session keeps its connection to the server open.
+        self._sessions = threading.local()
         _, username, password = read_config_file(self._base_url, username=True, password=True)
         self._auth = (username, password)
         self._stack_info = stack_info
         file_extension = self._stack_info["mirrors"][0]["file_extension"]
         self._file_extension = file_extension[1:] if file_extension.startswith(".") else file_extension
 
+        self._cache = None
+        if CACHE_DIR:
+            try:
+                self._cache = TileDiskCache(CACHE_DIR, CACHE_MAX_SIZE)
+            except OSError as ex:
+                logging.warning("Failed to use tile cache in %s: %s", CACHE_DIR, ex)
+        self._executor = None  # ThreadPoolExecutor, created when first needed
+
+    def _getSession(self):
+        """
+        return (requests.Session): the session for the current thread
+        """
+        try:
+            return self._sessions.session
+        except AttributeError:
+            session = requests.Session()
+            self._sessions.session = session
+            return session
+
+    def _fetchTile(self, tile_url):
+        """
+        Get the image of a tile, from the cache if it's there and still valid,
+          or otherwise from the server.
+        tile_url (str): the URL of the tile. It's also used as key for the cache,
+          as it contains the stack, zoom level, depth, row and column.
+        return (numpy array): the image
+        raise HTTPError: if the server failed to provide the tile
+        """
+        headers = {}
+        cached = self._cache.get(tile_url) if self._cache else None
+        if cached:
+            content, info = cached
+            if time.time() - info["time"] < CACHE_MAX_AGE:
+                return content_to_array(content, info["content_type"])
+            # Too old => check it hasn't changed
+            if info.get("etag"):
+                headers["If-None-Match"] = info["etag"]
+
+        response = self._getSession().get(tile_url, auth=self._auth, headers=headers)
+        if cached and response.status_code == 304:  # Not modified
+            info["time"] = time.time()
+            self._cache.put(tile_url, content, info)
+            return content_to_array(content, info["content_type"])
+
+        image = response_to_array(response)
+        if self._cache:
+            info = {"etag": response.headers.get("ETag"),
+                    "content_type": response.headers["Content-Type"],
+                    "time": time.time()}
+            self._cache.put(tile_url, response.content, info)
+        return image
+
     def getTile(self, x, y, zoom, depth=0):
         """
         Fetches one tile
@@ -198,7 +268,7 @@ class DataArrayShadowPyramidalCatmaid(DataArrayShadow):
             tile_height=tile_height,
         )
         try:
-            image = response_to_array(self._session.get(tile_url, auth=self._auth))
+            image = self._fetchTile(tile_url)
         except HTTPError as e:
             if e.response.status_code == 401:
                 raise AuthenticationError("Authentication failed while getting tiles at {}".format(tile_url))
@@ -217,6 +287,20 @@ class DataArrayShadowPyramidalCatmaid(DataArrayShadow):
 
         return tile
 
+    def getTiles(self, tiles, depth=0):
+        """
+        Fetches multiple tiles. The tiles are fetched concurrently, reusing the
+          connections to the server.
+        tiles (iterable of (0<=int, 0<=int, 0<=int)): X index, Y index and zoom
+          level of each tile (as for getTile())
+        depth (0<=int): The Z index of the stack.
+        return (list of DataArray): the tiles, in the same order as requested
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS)
+        futures = [self._executor.submit(self.getTile, x, y, zoom, depth) for x, y, zoom in tiles]
+        return [f.result() for f in futures]
+
     def getData(self):
         """Abstract method of DataArrayShadow"""
         raise NotImplementedError()
@@ -282,10 +366,18 @@ def response_to_array(response):
        image (numpy array): the requested image from the response.
     """
     response.raise_for_status()
-    content_type = response.headers['Content-Type']
+    return content_to_array(response.content, response.headers['Content-Type'])
+
 
+def content_to_array(content, content_type):
+    """
+    content (bytes): the encoded image, as received from the server.
+    content_type (str): the MIME type of the image.
+    return:
+       image (numpy array): the decoded image.
+    """
     if content_type in SUPPORTED_CONTENT_TYPES:
-        buffer = BytesIO(response.content)  # opening directly from raw response doesn't work for JPEGs
+        buffer = BytesIO(content)  # opening directly from raw response doesn't work for JPEGs
         raw_img = Image.open(buffer).convert('L')
         return numpy.array(raw_img)
     else:
@@ -293,6 +385,131 @@ def response_to_array(response):
             content_type.upper().split('/')[1]))
 
 
+class TileDiskCache(object):
+    """
+    Cache of the tiles (as encoded by the server), stored on disk, so that they
+    are still available after reopening the stack. When the total size is above
+    the limit, the least recently used tiles are discarded.
+    Each tile is stored in a file named after the hash of its key, along with a
+    small JSON file containing information about it (eg, ETag).
+    It's thread-safe.
+    """
+
+    def __init__(self, directory, max_size):
+        """
+        directory (str): where to store the tiles. It's created if it doesn't exist.
+        max_size (0<=int): maximum total size of the tiles, in bytes
+        raise OSError: if the directory cannot be created
+        """
+        os.makedirs(directory, exist_ok=True)
+        self._directory = directory
+        self.max_size = max_size
+        self._lock = threading.Lock()
+
+        # Find the tiles already present, from the oldest used to the most recently used
+        tiles = []
+        for fn in os.listdir(directory):
+            name, ext = os.path.splitext(fn)
+            if ext != ".tile":
+                continue
+            try:
+                st = os.stat(os.path.join(directory, fn))
+            except OSError:
+                continue
+            tiles.append((st.st_mtime, name, st.st_size))
+        tiles.sort()
+        self._entries = OrderedDict((name, size) for _, name, size in tiles)  # name -> size
+        self._size = sum(self._entries.values())
+        with self._lock:
+            self._evict()
+
+    @property
+    def size(self):
+        """
+        (0<=int): the total size of the tiles currently in the cache, in bytes
+        """
+        return self._size
+
+    def _path(self, name, ext):
+        return os.path.join(self._directory, name + ext)
+
+    def get(self, key):
+        """
+        key (str): identifier of the tile
+        return (None or (bytes, dict)): the content of the tile, and its
+          information (as passed to put()). None if the tile is not in the cache.
+        """
+        name = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        with self._lock:
+            if name not in self._entries:
+                return None
+            self._entries.move_to_end(name)
+
+            try:
+                with open(self._path(name, ".json"), "r") as f:
+                    info = json.load(f)
+                with open(self._path(name, ".tile"), "rb") as f:
+                    content = f.read()
+                # Keep track of the usage, for the next time the cache is opened
+                os.utime(self._path(name, ".tile"))
+            except (OSError, ValueError) as ex:
+                logging.warning("Failed to read tile %s from the cache: %s", key, ex)
+                self._remove(name)
+                return None
+
+        return content, info
+
+    def put(self, key, content, info):
+        """
+        Store (or update) a tile
+        key (str): identifier of the tile
+        content (bytes): the tile
+        info (dict str -> value): extra information about the tile, which can be
+          stored as JSON
+        """
+        name = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        with self._lock:
+            try:
+                # Write to temporary files first, so that a tile is never partially written
+                for ext, mode, data in ((".tile", "wb", content), (".json", "w", None)):
+                    tmp_path = self._path(name, ext + ".tmp")
+                    with open(tmp_path, mode) as f:
+                        if data is None:
+                            json.dump(info, f)
+                        else:
+                            f.write(data)
+                    os.replace(tmp_path, self._path(name, ext))
+            except OSError as ex:
+                logging.warning("Failed to store tile %s in the cache: %s", key, ex)
+                self._remove(name)
+                return
+
+            self._size -= self._entries.pop(name, 0)
+            self._entries[name] = len(content)
+            self._size += len(content)
+            self._evict()
+
+    def _remove(self, name):
+        """
+        Delete a tile. Must be called with the lock acquired.
+        """
+        self._size -= self._entries.pop(name, 0)
+        for ext in (".tile", ".json"):
+            try:
+                os.remove(self._path(name, ext))
+            except OSError:
+                pass
+
+    def _evict(self):
+        """
+        Delete the least recently used tiles, until the total size is within the
+          limit. Must be called with the lock acquired.
+        """
+        while self._size > self.max_size and self._entries:
+            name = next(iter(self._entries))
+            self._remove(name)
+
+
 STACK_URL = "{base_url}/{project_id}/stack/{stack_id}/info"
 
 
@@ -33,14 +33,14 @@ from numpy.polynomial import polynomial
 import odemis
 from odemis import model
 from odemis.util import fluo, img, spectrum
-from odemis.util.conversion import JsonExtraEncoder
+from odemis.util.conversion import JsonExtraEncoder, get_tile_md_pos
 
 # User-friendly name
 FORMAT = "HDF5"
 # list of file-name extensions possible, the first one is the default when saving a file
 EXTENSIONS = [u".h5", u".hdf5"]
 LOSSY = False
-CAN_SAVE_PYRAMID = False
+CAN_SAVE_PYRAMID = True
 
 # We are trying to follow the same format as SVI, as defined here:
 # http://www.svi.nl/HDF5
@@ -139,16 +139,32 @@ def _create_image_dataset(group, dataset_name, image, **kwargs):
     """
     assert(len(image.shape) >= 2)
     image_dataset = group.create_dataset(dataset_name, data=image, **kwargs)
+    if image.ndim == 3 and (image.shape[-3] == 3 or image.shape[-1] == 3):
+        irange = None
+    else:
+        irange = [image.min(), image.max()]
+    _set_image_attrs(image_dataset, irange)
+
+    return image_dataset
+
 
+def _set_image_attrs(image_dataset, irange):
+    """
+    Set the attributes of a dataset to follow the HDF5 image specification
+    image_dataset (HDF Dataset): dataset containing the image
+    irange (None or list of 2 numbers): minimum and maximum values of the
+      image, only used for greyscale images
+    """
+    shape = image_dataset.shape
     # numpy.string_ is to force fixed-length string (necessary for compatibility)
     # FIXME: needs to be NULLTERM, not NULLPAD... but h5py doesn't allow to distinguish
     image_dataset.attrs["CLASS"] = numpy.string_("IMAGE")
     # Colour image?
-    if image.ndim == 3 and (image.shape[-3] == 3 or image.shape[-1] == 3):
+    if len(shape) == 3 and (shape[-3] == 3 or shape[-1] == 3):
         # TODO: check dtype is int?
         image_dataset.attrs["IMAGE_SUBCLASS"] = numpy.string_("IMAGE_TRUECOLOR")
         image_dataset.attrs["IMAGE_COLORMODEL"] = numpy.string_("RGB")
-        if image.shape[-3] == 3:
+        if shape[-3] == 3:
             # Stored as [pixel components][height][width]
             image_dataset.attrs["INTERLACE_MODE"] = numpy.string_("INTERLACE_PLANE")
         else: # This is the numpy standard
@@ -157,13 +173,11 @@ def _create_image_dataset(group, dataset_name, image, **kwargs):
     else:
         image_dataset.attrs["IMAGE_SUBCLASS"] = numpy.string_("IMAGE_GRAYSCALE")
         image_dataset.attrs["IMAGE_WHITE_IS_ZERO"] = numpy.array(0, dtype="uint8")
-        image_dataset.attrs["IMAGE_MINMAXRANGE"] = [image.min(), image.max()]
+        image_dataset.attrs["IMAGE_MINMAXRANGE"] = irange
 
     image_dataset.attrs["DISPLAY_ORIGIN"] = numpy.string_("UL") # not rotated
     image_dataset.attrs["IMAGE_VERSION"] = numpy.string_("1.2")
 
-    return image_dataset
-
 
 def _read_image_dataset(dataset):
     """
@@ -174,6 +188,18 @@ def _read_image_dataset(dataset):
      IOError: if it doesn't conform to the standard
      NotImplementedError: if the image uses so fancy standard features
     """
+    md = _read_image_dataset_md(dataset)
+    return model.DataArray(dataset[...], md)
+
+
+def _read_image_dataset_md(dataset):
+    """
+    Check a dataset respects the HDF5 image specification, without reading the data.
+    returns (dict): the metadata of the image, which is just MD_DIMS if it's RGB.
+    raises
+     IOError: if it doesn't conform to the standard
+     NotImplementedError: if the image uses so fancy standard features
+    """
     # check basic format
     if len(dataset.shape) < 2:
         raise IOError("Image has a shape of %s" % (dataset.shape,))
@@ -184,7 +210,7 @@ def _read_image_dataset(dataset):
     # conversion is almost entirely different depending on subclass
     subclass = dataset.attrs.get("IMAGE_SUBCLASS", b"IMAGE_GRAYSCALE")
 
-    image = model.DataArray(dataset[...])
+    md = {}
     if subclass == b"IMAGE_GRAYSCALE":
         pass
     elif subclass == b"IMAGE_TRUECOLOR":
@@ -203,9 +229,9 @@ def _read_image_dataset(dataset):
 
         if il_mode == b"INTERLACE_PLANE":
             # colour is first dim
-            image.metadata[model.MD_DIMS] = "CYX"
+            md[model.MD_DIMS] = "CYX"
         elif il_mode == b"INTERLACE_PIXEL":
-            image.metadata[model.MD_DIMS] = "YXC"
+            md[model.MD_DIMS] = "YXC"
         else:
             raise NotImplementedError("Unable to handle images of subclass '%s'" % subclass)
 
@@ -217,7 +243,7 @@ def _read_image_dataset(dataset):
     if dorig != b"UL":
         logging.warning("Image rotation %s not handled", dorig)
 
-    return image
+    return md
 
 
 def _add_image_info(group, dataset, image):
@@ -1229,13 +1255,15 @@ def _add_svi_info(group):
     gi["URL"] = "www.delmic.com"
 
 
-def _add_acquistion_svi(group, data, mds, **kwargs):
+def _add_acquistion_svi(group, data, mds, pyramid=False, **kwargs):
     """
     Adds the acquisition data according to the sub-format by SVI
     group (HDF Group): the group that will contain the metadata (named "PhysicalData")
     data (DataArray): image with (global) metadata, all the images must
       have the same shape.
     mds (None or list of dict): metadata for each C of the image (if different)
+    pyramid (bool): if True and the data is a 2D image, also store the
+      lower resolution levels
     """
     gi = group.create_group("ImageData")
 
@@ -1244,12 +1272,63 @@ def _add_acquistion_svi(group, data, mds, **kwargs):
     _h5py_enum_commit(group, b"StateEnumeration", _dtstate)
 
     # TODO: use scaleoffset to store the number of bits used (MD_BPP)
-    ids = _create_image_dataset(gi, "Image", data, **kwargs)
+    if pyramid and _can_pyramid(data):
+        ids = _create_image_dataset(gi, "Image", data, chunks=_get_tile_chunks(data.shape), **kwargs)
+        _add_pyramid_levels(gi, data, **kwargs)
+    else:
+        ids = _create_image_dataset(gi, "Image", data, **kwargs)
     _add_image_info(gi, ids, data)
     _add_image_metadata(group, data, mds)
     _add_svi_info(group)
 
 
+def _can_pyramid(image):
+    """
+    image (DataArray or h5py.Dataset): image as stored in the file (ie, CTZYX)
+    return (bool): True if the image is 2D (ie, all the other dimensions are 1),
+      and so it can be stored with lower resolution levels
+    """
+    return len(image.shape) == 5 and numpy.prod(image.shape[:-2]) == 1
+
+
+def _get_tile_chunks(shape):
+    """
+    shape (tuple of int): shape of a 2D image, stored as CTZYX
+    return (tuple of int): chunk shape corresponding to a tile
+    """
+    return (1, 1, 1) + tuple(min(s, img.PYRAMID_TILE_SIZE) for s in shape[-2:])
+
+
+def _add_pyramid_levels(group, image, **kwargs):
+    """
+    Store the lower resolution levels of an image, each being half the size
+    of the previous level, as long as the previous level is larger than a tile.
+    They are named ImageZoom1, ImageZoom2...
+    group (HDF Group): the "ImageData" group
+    image (DataArray): a 2D image, stored as CTZYX
+    kwargs: passed to create_dataset()
+    """
+    level = image[0, 0, 0]
+    z = 1
+    while all(s >= img.PYRAMID_TILE_SIZE for s in level.shape):
+        level = img.halveImage(level)
+        group.create_dataset("ImageZoom%d" % z, data=level[numpy.newaxis, numpy.newaxis, numpy.newaxis],
+                             chunks=_get_tile_chunks(level.shape), **kwargs)
+        z += 1
+
+
+def _get_pyramid_levels(group):
+    """
+    group (HDF Group): the "ImageData" group
+    return (list of h5py.Dataset): the image at full resolution, followed by the
+      lower resolution levels, if any
+    """
+    levels = [group["Image"]]
+    while isinstance(group.get("ImageZoom%d" % len(levels)), h5py.Dataset):
+        levels.append(group["ImageZoom%d" % len(levels)])
+    return levels
+
+
 def _findImageGroups(das):
     """
     Find groups of images which should be considered part of the same acquisition
@@ -1426,175 +1505,309 @@ def _updateRGBMD(da):
     da.metadata[model.MD_DIMS] = dims
 
 
-def _thumbFromHDF5(filename):
+def _mergeCorrectionMetadata(da):
     """
-    Read thumbnails from an HDF5 file.
-    Expects to find them as IMAGE in Preview/Image.
-    return (list of model.DataArray)
+    Create a new DataArray with metadata updated to with the correction metadata
+    merged.
+    da (DataArray): the original data
+    return (DataArray): new DataArray (view) with the updated metadata
     """
-    f = h5py.File(filename, "r")
-
-    thumbs = []
-    # look for the Preview directory
-    try:
-        grp = f["Preview"]
-    except KeyError:
-        # no thumbnail
-        return thumbs
-
-    # scan for images
-    for name, ds in grp.items():
-        # an image? (== has the attribute CLASS: IMAGE)
-        if isinstance(ds, h5py.Dataset) and ds.attrs.get("CLASS") == b"IMAGE":
-            try:
-                da = _read_image_dataset(ds)
-            except Exception:
-                logging.info("Skipping image '%s' which couldn't be read.", name)
-                continue
-
-            if name == "Image":
-                try:
-                    da.metadata = _read_image_info(grp)
-                except Exception:
-                    logging.debug("Failed to parse metadata of acquisition '%s'", name)
-                    continue
-
-            thumbs.append(da)
-
-    return thumbs
+    md = da.metadata.copy() # to avoid modifying the original one
+    img.mergeMetadata(md)
+    return model.DataArray(da, md) # create a view
 
 
-def _dataFromSVIHDF5(f):
+def _saveAsHDF5(filename, ldata, thumbnail, compressed=True, pyramid=False):
     """
-    Read microscopy data from an HDF5 file using the SVI convention.
-    Expects to find them as IMAGE in XXX/ImageData/Image + XXX/PhysicalData.
-    f (h5py.File): the root of the file
-    return (list of model.DataArray)
+    Saves a list of DataArray as a HDF5 (SVI) file.
+    filename (string): name of the file to save
+    ldata (list of DataArray): list of 2D (up to 5D) data of int or float.
+     Should have at least one array.
+    thumbnail (None or DataArray): see export
+    compressed (boolean): whether the file is compressed or not.
+    pyramid (boolean): whether the 2D images are saved with lower resolution levels
     """
-    data = []
-
-    for obj in f.values():
-        # find all the expected and interesting objects
-        try:
-            svidata = obj["SVIData"]
-            imagedata = obj["ImageData"]
-            image = imagedata["Image"]
-            physicaldata = obj["PhysicalData"]
-        except KeyError:
-            continue  # not conforming => try next object
+    with AcquisitionWriter(filename, thumbnail, compressed, pyramid) as writer:
+        # merge correction metadata (as we cannot save them separatly in OME-TIFF)
+        ldata = [_mergeCorrectionMetadata(da) for da in ldata]
 
-        # Read the raw data
-        try:
-            da = _read_image_dataset(image)
-        except Exception:
-            logging.exception("Failed to read data of acquisition '%s'", obj.name)
+        # list ndarray/list of list of metadata (one per channel)
+        acq, mds = _groupImages(ldata)
+        for da, md in zip(acq, mds):
+            writer.append(da, md)
 
-        # TODO: read more metadata
-        try:
-            da.metadata.update(_read_image_info(imagedata))
-        except Exception:
-            logging.exception("Failed to parse metadata of acquisition '%s'", obj.name)
 
-        das = _parse_physical_data(physicaldata, da)
-        data.extend(das)
-    return data
+# Target size of a chunk of the images written progressively. The default
+# chunk cache of HDF5 is 1 MiB, but the writer uses a larger one, so that a
+# whole row of chunks fits in it, and each chunk is only compressed once.
+CHUNK_SIZE = 2 ** 20  # bytes
+CHUNK_CACHE_SIZE = 64 * 2 ** 20  # bytes
 
 
-def _dataFromHDF5(filename):
+def _get_svi_shape(shape, md):
     """
-    Read microscopy data from an HDF5 file.
-    filename (string): path of the file to read
-    return (list of model.DataArray)
+    Compute the shape of a data, once stored in a file as CTZYX or CAZYX
+    shape (tuple of int): shape of the data
+    md (dict): metadata of the data (MD_DIMS and MD_THETA_LIST are used)
+    return:
+      dims (str): the dimensions of the data
+      svi_shape (tuple of 5 int): the shape in the file
+      svi_dims (str): the dimensions in the file (CTZYX or CAZYX)
+    raise ValueError: if the data dimensions cannot be stored without reordering
     """
-    f = h5py.File(filename, "r")
-
-    # if follows SVI convention => use the special function
-    # If it has at least one directory like XXX/SVIData => it follows SVI conventions
-    for obj in f.values():
-        if (isinstance(obj, h5py.Group) and
-            isinstance(obj.get("SVIData"), h5py.Group)):
-            return _dataFromSVIHDF5(f)
-
-    data = []
-    # go rough: return any dataset with numbers (and more than one element)
-
-    def addIfWorthy(name, obj):
-        try:
-            if not isinstance(obj, h5py.Dataset):
-                return
-            if not obj.dtype.kind in "biufc":
-                return
-            if numpy.prod(obj.shape) <= 1:
-                return
-            # TODO: if it's an image, open it as an image
-            # TODO: try to get some metadata?
-            da = model.DataArray(obj[...])
-        except Exception:
-            logging.info("Skipping '%s' as it doesn't seem a correct data", name)
-        data.append(da)
+    if model.MD_THETA_LIST in md:
+        svi_dims = "CAZYX"
+    else:
+        svi_dims = "CTZYX"
+    dims = md.get(model.MD_DIMS, svi_dims[-len(shape):])
+    if len(dims) != len(shape) or "".join(d for d in svi_dims if d in dims) != dims:
+        raise ValueError("Cannot store data of dimensions %s with shape %s, "
+                         "should be ordered as %s" % (dims, shape, svi_dims))
 
-    f.visititems(addIfWorthy)
-    return data
+    svi_shape = tuple(shape[dims.index(d)] if d in dims else 1 for d in svi_dims)
+    return dims, svi_shape, svi_dims
 
 
-def _mergeCorrectionMetadata(da):
+def _guess_chunks(shape, itemsize):
     """
-    Create a new DataArray with metadata updated to with the correction metadata
-    merged.
-    da (DataArray): the original data
-    return (DataArray): new DataArray (view) with the updated metadata
+    Pick a chunk shape for a dataset, of about CHUNK_SIZE
+    shape (tuple of int): (initial) shape of the dataset. A 0 indicates that
+      the dimension will grow later on.
+    itemsize (int): number of bytes per element
+    return (tuple of int): shape of a chunk
     """
-    md = da.metadata.copy() # to avoid modifying the original one
-    img.mergeMetadata(md)
-    return model.DataArray(da, md) # create a view
+    chunks = [max(1, s) for s in shape]
+    while numpy.prod(chunks) * itemsize > CHUNK_SIZE and max(chunks) > 1:
+        # Halve the longest dimension
+        i = chunks.index(max(chunks))
+        chunks[i] = (chunks[i] + 1) // 2
+    return tuple(chunks)
 
 
-def _saveAsHDF5(filename, ldata, thumbnail, compressed=True):
+class StreamedImage(object):
     """
-    Saves a list of DataArray as a HDF5 (SVI) file.
-    filename (string): name of the file to save
-    ldata (list of DataArray): list of 2D (up to 5D) data of int or float.
-     Should have at least one array.
-    thumbnail (None or DataArray): see export
-    compressed (boolean): whether the file is compressed or not.
+    Image written progressively to an HDF5 file, see AcquisitionWriter.create_image().
+    The data can be written block by block (eg, pixel by pixel, or row by row),
+    in any order. The parts of the image never written are 0.
+    The metadata can be updated until the image is finalised.
     """
-    # h5py will extend the current file by default, so we want to make sure
-    # there is no file at all.
-    try:
-        os.remove(filename)
-    except OSError:
-        pass
-    f = h5py.File(filename, "w") # w will fail if file exists
-    if compressed:
-        # szip is not free for commercial usage and lzf doesn't seem to be
-        # well supported yet
-        compression = "gzip"
-    else:
-        compression = None
 
-    if thumbnail is not None:
-        thumbnail = _mergeCorrectionMetadata(thumbnail)
-        # Save the image as-is in a special group "Preview"
-        prevg = f.create_group("Preview")
-        _updateRGBMD(thumbnail) # ensure RGB info is there if needed
-        ids = _create_image_dataset(prevg, "Image", thumbnail, compression=compression)
-        _add_image_info(prevg, ids, thumbnail)
+    def __init__(self, group, shape, dtype, metadata, compression=None):
+        """
+        group (HDF Group): the (empty) group of the acquisition
+        shape (tuple of int): initial shape of the image. It can have 0's, in
+          which case these dimensions will be extended when writing.
+        dtype (numpy.dtype): type of the data
+        metadata (dict): metadata of the image. MD_DIMS indicates the dimensions,
+          which must be ordered like CTZYX (or CAZYX).
+        compression (None or str): compression filter of the dataset
+        """
+        self.metadata = metadata
+        self._dims, svi_shape, self._svi_dims = _get_svi_shape(shape, metadata)
+        dtype = numpy.dtype(dtype)
+
+        self._group = group
+        gi = group.create_group("ImageData")
+        self._dataset = gi.create_dataset("Image", shape=svi_shape, dtype=dtype,
+                                          maxshape=(None,) * len(svi_shape),
+                                          chunks=_guess_chunks(svi_shape, dtype.itemsize),
+                                          compression=compression)
+        self._range = None  # min/max of all the data written
+        self.finalized = False
+
+    @property
+    def shape(self):
+        """
+        (tuple of int): current shape of the image
+        """
+        return tuple(self._dataset.shape[self._svi_dims.index(d)] for d in self._dims)
+
+    @property
+    def dtype(self):
+        return self._dataset.dtype
+
+    def _update_range(self, block):
+        block = numpy.asarray(block)
+        if block.size == 0:
+            return
+        bmin, bmax = block.min(), block.max()
+        if self._range is None:
+            self._range = [bmin, bmax]
+        else:
+            self._range = [min(self._range[0], bmin), max(self._range[1], bmax)]
+
+    def __setitem__(self, key, block):
+        """
+        Write data, with the same indexing as numpy arrays, limited to integers
+        and slices (eg, im[:, 0, 0, y, x] = spectrum). The image is not extended.
+        """
+        if self.finalized:
+            raise IOError("Image already finalised")
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) > len(self._dims) or any(k is Ellipsis for k in key):
+            raise IndexError("Unsupported index %s" % (key,))
+        key += (slice(None),) * (len(self._dims) - len(key))
+
+        # The dimensions not present in the image are fixed to 0
+        svi_key = tuple(key[self._dims.index(d)] if d in self._dims else 0
+                        for d in self._svi_dims)
+        self._dataset[svi_key] = block
+        self._update_range(block)
+
+    def write(self, block, offset):
+        """
+        Write a block of data (eg, a pixel, a row or a tile), extending the image
+        if it goes beyond the current shape.
+        block (numpy.ndarray): data to write, with the same dimensions as the image
+        offset (tuple of int): position in the image of the first element of the block
+        """
+        if block.ndim != len(self._dims) or len(offset) != len(self._dims):
+            raise ValueError("Block of shape %s at %s doesn't match the dimensions %s" %
+                             (block.shape, offset, self._dims))
+
+        shape = self.shape
+        new_shape = tuple(max(s, o + bs) for s, o, bs in zip(shape, offset, block.shape))
+        if new_shape != shape:
+            self._dataset.resize(tuple(new_shape[self._dims.index(d)] if d in self._dims else 1
+                                       for d in self._svi_dims))
+
+        self[tuple(slice(o, o + bs) for o, bs in zip(offset, block.shape))] = block
+
+    def append(self, block, axis=0):
+        """
+        Write a block of data just after the end of the image along a dimension
+        block (numpy.ndarray): data to write, with the same dimensions as the image
+        axis (int): dimension along which the image is extended
+        """
+        offset = [0] * len(self._dims)
+        offset[axis] = self.shape[axis]
+        self.write(block, offset)
+
+    def finalize(self):
+        """
+        Store the metadata. Afterwards, no more data can be written.
+        It's fine to call it multiple times.
+        """
+        if self.finalized:
+            return
+
+        md = self.metadata.copy()
+        img.mergeMetadata(md)
+        md[model.MD_DIMS] = self._svi_dims
+        # The metadata helpers only need to know the shape of the image
+        shadow = model.DataArray(numpy.broadcast_to(numpy.zeros((), self.dtype),
+                                                    self._dataset.shape), md)
+
+        _h5py_enum_commit(self._group, b"StateEnumeration", _dtstate)
+        _set_image_attrs(self._dataset, self._range or [0, 0])
+        _add_image_info(self._group["ImageData"], self._dataset, shadow)
+        _add_image_metadata(self._group, shadow, None)
+        _add_svi_info(self._group)
+        self.finalized = True
+
+
+class AcquisitionWriter(object):
+    """
+    Writes an HDF5 file incrementally, one acquisition after another, so that
+    large data doesn't need to be fully in memory. The images can be passed
+    either as a whole (with append()), or progressively (with create_image()),
+    for instance while they are being acquired.
+    Contrarily to export(), it doesn't merge the images of different channels
+    into a single acquisition.
+    Can be used as a context manager, which closes the file at the end.
+    """
 
-    # merge correction metadata (as we cannot save them separatly in OME-TIFF)
-    ldata = [_mergeCorrectionMetadata(da) for da in ldata]
+    def __init__(self, filename, thumbnail=None, compressed=True, pyramid=False):
+        """
+        filename (str): name of the file to create. If it exists, it's overwritten.
+        thumbnail (None or DataArray): see export()
+        compressed (boolean): whether the data is compressed
+        pyramid (boolean): whether the 2D images passed to append() are saved
+          with lower resolution levels (see export()).
+        """
+        # h5py will extend the current file by default, so we want to make sure
+        # there is no file at all.
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+        self._file = h5py.File(filename, "w", rdcc_nbytes=CHUNK_CACHE_SIZE)  # w will fail if file exists
+        if compressed:
+            # szip is not free for commercial usage and lzf doesn't seem to be
+            # well supported yet
+            self._compression = "gzip"
+        else:
+            self._compression = None
+        self._pyramid = pyramid
+        self._nacq = 0  # number of acquisitions created so far
+        self._images = []  # StreamedImages created
+
+        if thumbnail is not None:
+            thumbnail = _mergeCorrectionMetadata(thumbnail)
+            # Save the image as-is in a special group "Preview"
+            prevg = self._file.create_group("Preview")
+            _updateRGBMD(thumbnail)  # ensure RGB info is there if needed
+            ids = _create_image_dataset(prevg, "Image", thumbnail, compression=self._compression)
+            _add_image_info(prevg, ids, thumbnail)
+
+    def _create_group(self):
+        ga = self._file.create_group("Acquisition%d" % self._nacq)
+        self._nacq += 1
+        return ga
+
+    def append(self, data, mds=None):
+        """
+        Add a whole image as a new acquisition.
+        data (DataArray): 2D (up to 5D) data of int or float
+        mds (None or list of dict): metadata for each C of the image (if different)
+        """
+        data = _adjustDimensions(_mergeCorrectionMetadata(data))
+        ga = self._create_group()
+        _add_acquistion_svi(ga, data, mds, pyramid=self._pyramid, compression=self._compression)
+
+    def create_image(self, shape, dtype, metadata):
+        """
+        Add a new acquisition, to be written progressively.
+        shape (tuple of int): initial shape of the image, see StreamedImage.
+          It must have at least 2 dimensions.
+        dtype (numpy.dtype): type of the data
+        metadata (dict): metadata of the image. It can be updated up to the
+          moment the image is finalised.
+        return (StreamedImage): the image to write to. It's finalised, at the
+          latest, when the writer is closed.
+        raise ValueError: if the dimensions are not ordered CTZYX (or CAZYX)
+        """
+        if len(shape) < 2:
+            raise ValueError("Image must have at least 2 dimensions, got %s" % (shape,))
+        _get_svi_shape(shape, metadata)  # Check the dimensions before creating the group
+        im = StreamedImage(self._create_group(), shape, dtype, metadata, self._compression)
+        self._images.append(im)
+        return im
+
+    def close(self):
+        """
+        Finalise all the images and close the file.
+        It's fine to call it multiple times.
+        """
+        if self._file is None:
+            return
+        try:
+            for im in self._images:
+                im.finalize()
+        finally:
+            self._file.close()
+            self._file = None
+            self._images = []
 
-    # list ndarray/list of list of metadata (one per channel)
-    acq, mds = _groupImages(ldata)
-    for i, da in enumerate(acq):
-        ga = f.create_group("Acquisition%d" % i)
-        _add_acquistion_svi(ga, da, mds[i], compression=compression)
+    def __enter__(self):
+        return self
 
-    f.close()
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
 
-# TODO: allow to append data to a file, or any other way to allow saving large
-# data without having everything in memory simultaneously.
-def export(filename, data, thumbnail=None):
+def export(filename, data, thumbnail=None, pyramid=False):
     '''
     Write an HDF5 file with the given image and metadata
     filename (str): filename of the file to create (including path)
@@ -1608,13 +1821,16 @@ def export(filename, data, thumbnail=None):
       (reasonable) size. Must be either 2D array (greyscale) or 3D with last
       dimension of length 3 (RGB). If the exporter doesn't support it, it will
       be dropped silently.
+    pyramid (boolean): if True, the 2D images are also saved with lower
+      resolution levels, tiled, so that they can be displayed tile by tile
+      (see open_data()).
     '''
     # TODO: add an argument to not do any clever data aggregation?
     if not isinstance(data, (list, tuple)):
         # TODO should probably not enforce it: respect duck typing
         assert(isinstance(data, model.DataArray))
         data = [data]
-    _saveAsHDF5(filename, data, thumbnail)
+    _saveAsHDF5(filename, data, thumbnail, pyramid=pyramid)
 
 
 def read_data(filename):
@@ -1630,11 +1846,8 @@ def read_data(filename):
     raises:
         IOError in case the file format is not as expected.
     """
-    # TODO: support filename to be a File or Stream (but it seems very difficult
-    # to do it without looking at the .filename attribute)
-    # see http://pytables.github.io/cookbook/inmemory_hdf5_files.html
-
-    return _dataFromHDF5(filename)
+    acd = open_data(filename)
+    return [das.getData() for das in acd.content]
 
 
 def read_thumbnail(filename):
@@ -1647,9 +1860,263 @@ def read_thumbnail(filename):
     raises:
         IOError in case the file format is not as expected.
     """
-    # TODO: support filename to be a File or Stream
+    acd = open_data(filename)
+    return [das.getData() for das in acd.thumbnails]
+
+
+def open_data(filename):
+    """
+    Opens an HDF5 file, and return an AcquisitionData instance. The data is
+    only read when requested.
+    filename (string): path to the file
+    return (AcquisitionData): an opened file
+    """
+    # TODO: support filename to be a File or Stream (but it seems very difficult
+    # to do it without looking at the .filename attribute)
+    # see http://pytables.github.io/cookbook/inmemory_hdf5_files.html
+    return AcquisitionDataHDF5(filename)
+
+
+class DataArrayShadowHDF5(model.DataArrayShadow):
+    """
+    This class implements the read of an image in an HDF5 file, only when
+    the data is requested.
+    Note: h5py serialises all the accesses to the files, so there is no need
+    for an extra lock.
+    """
+
+    def __init__(self, dataset, shape, dtype, metadata=None, index=None):
+        """
+        dataset (h5py.Dataset): the dataset containing the image
+        shape (tuple of int): The shape of the corresponding DataArray
+        dtype (numpy.dtype): The data type
+        metadata (dict str->val): The metadata
+        index (None or int): if the image is only one channel of the dataset,
+          the index of that channel (along the first dimension)
+        """
+        self._dataset = dataset
+        self._index = index
+        model.DataArrayShadow.__init__(self, shape, dtype, metadata)
+
+    def _read(self, key):
+        """
+        Read part of the image
+        key (tuple of int or slice): the part to read, in the dimensions of the image
+        return (numpy.ndarray)
+        """
+        if self._index is not None:
+            key = (self._index,) + key
+        return self._dataset[key]
+
+    def getData(self):
+        """
+        Fetches the whole data (at full resolution) of image.
+        return DataArray: the data, with its metadata
+        """
+        return model.DataArray(self._read(()), self.metadata.copy())
+
+    def __getitem__(self, key):
+        """
+        Fetches only part of the data, without reading the rest of the image.
+        key (int, slice, or tuple of int and slice): same as for indexing a numpy array
+        return DataArray: the part of the data, with the metadata of the image
+        """
+        if not isinstance(key, tuple):
+            key = (key,)
+        return model.DataArray(self._read(key), self.metadata.copy())
+
+
+class DataArrayShadowPyramidalHDF5(DataArrayShadowHDF5):
+    """
+    This class implements the read of a 2D image with lower resolution levels
+    in an HDF5 file (as saved by export(pyramid=True)), tile by tile.
+    The image is presented as YX, although the datasets are CTZYX.
+    """
+
+    def __init__(self, levels, metadata=None):
+        """
+        levels (list of h5py.Dataset): the image at full resolution, followed
+          by each of the reduced images. All the datasets have a shape 111YX,
+          and are chunked with the same chunk shape in XY.
+        metadata (dict str->val): The metadata
+        """
+        self._levels = levels
+        self._dataset = levels[0]
+        self._index = None
+        md = dict(metadata) if metadata else {}
+        md[model.MD_DIMS] = "YX"
+        tile_shape = self._dataset.chunks[:-3:-1]  # X, Y
+        model.DataArrayShadow.__init__(self, self._dataset.shape[-2:], self._dataset.dtype, md,
+                                       len(levels) - 1, tile_shape)
+
+    def _read(self, key):
+        return self._dataset[(0, 0, 0) + key]
+
+    def getTile(self, x, y, zoom):
+        """
+        Fetches one tile
+        x (0<=int): X index of the tile.
+        y (0<=int): Y index of the tile
+        zoom (0<=int): zoom level to use. The total shape of the image is shape / 2**zoom.
+            The number of tiles available in an image is ceil((shape//zoom)/tile_shape)
+        return (DataArray): the tile. The shape is the tile_shape, or smaller on the borders.
+        raise ValueError: if the zoom level doesn't exist
+        raise IndexError: if the tile is outside of the image
+        """
+        if not 0 <= zoom <= self.maxzoom:
+            raise ValueError("Invalid Z value %d" % (zoom,))
+        level = self._levels[zoom]
+
+        xp = x * self.tile_shape[0]
+        yp = y * self.tile_shape[1]
+        if not (0 <= xp < level.shape[-1] and 0 <= yp < level.shape[-2]):
+            raise IndexError("Tile %d, %d is outside of the image at zoom %d" % (x, y, zoom))
+
+        tile = level[0, 0, 0, yp:yp + self.tile_shape[1], xp:xp + self.tile_shape[0]]
+        tile = model.DataArray(tile, self.metadata.copy())
+        orig_pixel_size = self.metadata.get(model.MD_PIXEL_SIZE, (1, 1))
+        tile.metadata[model.MD_PIXEL_SIZE] = tuple(ps * 2 ** zoom for ps in orig_pixel_size)
+        tile.metadata[model.MD_POS] = get_tile_md_pos((x, y), self.tile_shape, tile, self)
+        return tile
+
+
+class AcquisitionDataHDF5(model.AcquisitionData):
+    """
+    Implements AcquisitionData for HDF5 files
+    """
+
+    def __init__(self, filename):
+        """
+        filename (string): The name of the HDF5 file
+        """
+        # The file stays open as long as the DataArrayShadows are used
+        f = h5py.File(filename, "r")
+
+        # if follows SVI convention => use the special function
+        # If it has at least one directory like XXX/SVIData => it follows SVI conventions
+        for obj in f.values():
+            if (isinstance(obj, h5py.Group) and
+                isinstance(obj.get("SVIData"), h5py.Group)):
+                data = self._getSVIDataArrayShadows(f)
+                break
+        else:
+            data = self._getAllDataArrayShadows(f)
+
+        thumbnails = self._getThumbnailShadows(f)
+        model.AcquisitionData.__init__(self, tuple(data), tuple(thumbnails))
+
+    @staticmethod
+    def _getThumbnailShadows(f):
+        """
+        Find the thumbnails, expected as IMAGE in Preview/Image.
+        f (h5py.File): the root of the file
+        return (list of DataArrayShadowHDF5)
+        """
+        thumbs = []
+        # look for the Preview directory
+        try:
+            grp = f["Preview"]
+        except KeyError:
+            # no thumbnail
+            return thumbs
+
+        # scan for images
+        for name, ds in grp.items():
+            # an image? (== has the attribute CLASS: IMAGE)
+            if isinstance(ds, h5py.Dataset) and ds.attrs.get("CLASS") == b"IMAGE":
+                try:
+                    md = _read_image_dataset_md(ds)
+                except Exception:
+                    logging.info("Skipping image '%s' which couldn't be read.", name)
+                    continue
+
+                if name == "Image":
+                    try:
+                        md = _read_image_info(grp)
+                    except Exception:
+                        logging.debug("Failed to parse metadata of acquisition '%s'", name)
+                        continue
+
+                thumbs.append(DataArrayShadowHDF5(ds, ds.shape, ds.dtype, md))
+
+        return thumbs
+
+    @staticmethod
+    def _getSVIDataArrayShadows(f):
+        """
+        Find the microscopy data of an HDF5 file using the SVI convention.
+        Expects to find them as IMAGE in XXX/ImageData/Image + XXX/PhysicalData.
+        f (h5py.File): the root of the file
+        return (list of DataArrayShadowHDF5)
+        """
+        data = []
+
+        for obj in f.values():
+            # find all the expected and interesting objects
+            try:
+                svidata = obj["SVIData"]
+                imagedata = obj["ImageData"]
+                image = imagedata["Image"]
+                physicaldata = obj["PhysicalData"]
+            except KeyError:
+                continue  # not conforming => try next object
+
+            try:
+                md = _read_image_dataset_md(image)
+            except Exception:
+                logging.exception("Failed to read data of acquisition '%s'", obj.name)
+                continue
+
+            # TODO: read more metadata
+            try:
+                md.update(_read_image_info(imagedata))
+            except Exception:
+                logging.exception("Failed to parse metadata of acquisition '%s'", obj.name)
+
+            # The metadata parsing only needs the shape of the data => pass it
+            # a DataArray without actual data.
+            shadow = model.DataArray(numpy.broadcast_to(numpy.zeros((), image.dtype), image.shape), md)
+            das = _parse_physical_data(physicaldata, shadow)
+
+            levels = _get_pyramid_levels(imagedata)
+            if len(das) == 1 and len(levels) > 1 and _can_pyramid(image):
+                data.append(DataArrayShadowPyramidalHDF5(levels, das[0].metadata))
+            elif len(das) == 1:
+                data.append(DataArrayShadowHDF5(image, image.shape, image.dtype, das[0].metadata))
+            else:  # One DataArray per channel
+                for i, d in enumerate(das):
+                    data.append(DataArrayShadowHDF5(image, d.shape, image.dtype, d.metadata, index=i))
+
+        return data
+
+    @staticmethod
+    def _getAllDataArrayShadows(f):
+        """
+        Find all the datasets with numbers (and more than one element), for
+        files not following the SVI convention.
+        f (h5py.File): the root of the file
+        return (list of DataArrayShadowHDF5)
+        """
+        data = []
+
+        def addIfWorthy(name, obj):
+            try:
+                if not isinstance(obj, h5py.Dataset):
+                    return
+                if not obj.dtype.kind in "biufc":
+                    return
+                if numpy.prod(obj.shape) <= 1:
+                    return
+                # TODO: if it's an image, open it as an image
+                # TODO: try to get some metadata?
+                das = DataArrayShadowHDF5(obj, obj.shape, obj.dtype)
+            except Exception:
+                logging.info("Skipping '%s' as it doesn't seem a correct data", name)
+                return
+            data.append(das)
 
-    return _thumbFromHDF5(filename)
+        f.visititems(addIfWorthy)
+        return data
 
 
 def convert_to_str(s: Union[bytes, str]) -> str:
@@ -26,6 +26,7 @@ FORMAT = "Serialized TIFF"
 # list of file-name extensions possible, the first one is the default when saving a file
 EXTENSIONS = [u".0.ome.tiff"]
 CAN_SAVE_PYRAMID = True
+CAN_SAVE_SHADOW = True
 LOSSY = False
 
 # An almost identical OME-XML metadata block is inserted into the first IFD of
@@ -42,7 +43,7 @@ def export(filename, data, thumbnail=None, compressed=True, pyramid=False):
     filename (unicode): filename of the file to create (including path)
     data (list of model.DataArray, or model.DataArray): the data to export.
        Metadata is taken directly from the DA object. If it's a list, a multiple
-       files distribution is created.
+       files distribution is created. DataArrayShadows are also accepted.
     thumbnail (None or numpy.array): Image used as thumbnail for the first file.
       Can be of any (reasonable) size. Must be either 2D array (greyscale) or 3D
       with last dimension of length 3 (RGB). If the exporter doesn't support it,
@@ -20,14 +20,214 @@ PURPOSE. See the GNU General Public License for more details.
 You should have received a copy of the GNU General Public License along with
 Odemis. If not, see http://www.gnu.org/licenses/.
 """
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 
 import numpy
+from PIL import Image
 from requests import ConnectionError
 
-from odemis.dataio import AuthenticationError
+from odemis.dataio import AuthenticationError, catmaid
 from odemis.dataio.catmaid import open_data
 
+logging.getLogger().setLevel(logging.DEBUG)
+
+TILE_SIZE = 64
+
+
+class CatmaidStandInHandler(BaseHTTPRequestHandler):
+    """
+    Minimal Catmaid server, with one stack of file based tiles, and ETag support.
+    The content of each tile is a constant value: the sum of its column, row,
+    zoom and depth, plus server.version.
+    """
+
+    def log_message(self, format, *args):
+        logging.debug("Catmaid stand-in: " + format, *args)
+
+    def do_GET(self):
+        server = self.server
+        if self.path == "/1/stack/1/info":
+            stack_info = {
+                "dimension": {"x": 4 * TILE_SIZE, "y": 2 * TILE_SIZE, "z": 3},
+                "resolution": {"x": 4.0, "y": 4.0, "z": 40.0},
+                "num_zoom_levels": 2,
+                "mirrors": [{
+                    "tile_width": TILE_SIZE,
+                    "tile_height": TILE_SIZE,
+                    "tile_source_type": catmaid.FILE_BASED,
+                    "file_extension": "png",
+                    "image_base": "http://localhost:%d/tiles/" % server.server_port,
+                }],
+            }
+            self._send(200, "application/json", json.dumps(stack_info).encode("ascii"))
+            return
+
+        # /tiles/{depth}/{row}_{col}_{zoom}.png
+        try:
+            depth, name = self.path[len("/tiles/"):].split("/")
+            row, col, zoom = (int(v) for v in name[:-len(".png")].split("_"))
+            depth = int(depth)
+        except ValueError:
+            self._send(404, "text/plain", b"Not found")
+            return
+
+        with server.lock:
+            server.requests.append(self.path)
+            value = col + row + zoom + depth + server.version
+        etag = '"%d"' % value
+        if self.headers.get("If-None-Match") == etag:
+            with server.lock:
+                server.not_modified += 1
+            self._send(304, None, b"", etag)
+            return
+
+        buf = BytesIO()
+        Image.fromarray(numpy.full((TILE_SIZE, TILE_SIZE), value, dtype=numpy.uint8)).save(buf, "PNG")
+        self._send(200, "image/png", buf.getvalue(), etag)
+
+    def _send(self, code, content_type, content, etag=None):
+        self.send_response(code)
+        if content_type:
+            self.send_header("Content-Type", content_type)
+        if etag:
+            self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+class TestCatmaidCache(unittest.TestCase):
+    """
+    Test the tile cache, using a local stand-in of a Catmaid server
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("localhost", 0), CatmaidStandInHandler)
+        cls.server.lock = threading.Lock()
+        cls.server_thread = threading.Thread(target=cls.server.serve_forever)
+        cls.server_thread.daemon = True
+        cls.server_thread.start()
+        cls.url = "catmaid://localhost:%d/?pid=1&sid0=1" % cls.server.server_port
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.server.requests = []
+        self.server.not_modified = 0
+        self.server.version = 0
+        self._orig_cache = catmaid.CACHE_DIR, catmaid.CACHE_MAX_SIZE, catmaid.CACHE_MAX_AGE
+        self.cache_dir = tempfile.mkdtemp()
+        catmaid.CACHE_DIR = self.cache_dir
+
+    def tearDown(self):
+        catmaid.CACHE_DIR, catmaid.CACHE_MAX_SIZE, catmaid.CACHE_MAX_AGE = self._orig_cache
+        shutil.rmtree(self.cache_dir)
+
+    def test_cache(self):
+        """
+        Tiles are only fetched once, even after reopening the stack
+        """
+        das = open_data(self.url).content[0]
+        tile = das.getTile(1, 0, 0, depth=2)
+        self.assertEqual(tile.shape, (TILE_SIZE, TILE_SIZE))
+        self.assertEqual(tile[0, 0], 3)
+        self.assertEqual(len(self.server.requests), 1)
+
+        tile = das.getTile(1, 0, 0, depth=2)
+        self.assertEqual(tile[0, 0], 3)
+        self.assertEqual(len(self.server.requests), 1)
+
+        das = open_data(self.url).content[0]
+        tile = das.getTile(1, 0, 0, depth=2)
+        self.assertEqual(tile[0, 0], 3)
+        self.assertEqual(len(self.server.requests), 1)
+
+        # Different depth => different tile
+        tile = das.getTile(1, 0, 0, depth=1)
+        self.assertEqual(tile[0, 0], 2)
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_revalidation(self):
+        """
+        Tiles too old are checked with the ETag, and only fetched again if modified
+        """
+        catmaid.CACHE_MAX_AGE = 0
+        das = open_data(self.url).content[0]
+        tile = das.getTile(2, 1, 1)
+        self.assertEqual(tile[0, 0], 4)
+
+        tile = das.getTile(2, 1, 1)
+        self.assertEqual(tile[0, 0], 4)
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(self.server.not_modified, 1)
+
+        # Tile modified on the server
+        self.server.version = 10
+        tile = das.getTile(2, 1, 1)
+        self.assertEqual(tile[0, 0], 14)
+        self.assertEqual(self.server.not_modified, 1)
+
+    def test_eviction(self):
+        """
+        The least recently used tiles are discarded when the cache is full
+        """
+        das = open_data(self.url).content[0]
+        das.getTile(0, 0, 0)
+        tile_size = das._cache.size
+        self.assertGreater(tile_size, 0)
+
+        # Reopen with a cache only big enough for 3 tiles (of (almost) the same size)
+        catmaid.CACHE_MAX_SIZE = int(tile_size * 3.5)
+        das = open_data(self.url).content[0]
+        for i in range(4):
+            das.getTile(i, 0, 0, depth=i)  # The first one is already in the cache
+            time.sleep(0.01)  # To be sure the access times are different
+        self.assertLessEqual(das._cache.size, catmaid.CACHE_MAX_SIZE)
+        self.assertEqual(len(self.server.requests), 4)
+
+        # The first tile has been evicted, but not the last one
+        das.getTile(3, 0, 0, depth=3)
+        self.assertEqual(len(self.server.requests), 4)
+        das.getTile(0, 0, 0)
+        self.assertEqual(len(self.server.requests), 5)
+
+        # The cache is still bounded when reopened
+        das = open_data(self.url).content[0]
+        self.assertLessEqual(das._cache.size, catmaid.CACHE_MAX_SIZE)
+
+    def test_get_tiles(self):
+        """
+        Multiple tiles can be fetched at once
+        """
+        das = open_data(self.url).content[0]
+        indices = [(x, y, 0) for x in range(4) for y in range(2)]
+        tiles = das.getTiles(indices, depth=1)
+        self.assertEqual(len(tiles), len(indices))
+        for (x, y, z), tile in zip(indices, tiles):
+            self.assertEqual(tile[0, 0], x + y + 1)
+        self.assertEqual(len(self.server.requests), len(indices))
+
+    def test_no_cache(self):
+        catmaid.CACHE_DIR = None
+        das = open_data(self.url).content[0]
+        das.getTile(0, 0, 0)
+        das.getTile(0, 0, 0)
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
 
 # FIXME if we start using catmaid, make sure the test cases are independent of external servers.
 @unittest.skip("Skip unittests as the external servers are often down, and we do not use catmaid yet.")
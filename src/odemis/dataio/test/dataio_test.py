@@ -14,13 +14,19 @@ Odemis is distributed in the hope that it will be useful, but WITHOUT ANY WARRAN
 
 You should have received a copy of the GNU General Public License along with Odemis. If not, see http://www.gnu.org/licenses/.
 '''
+import logging
+import numpy
 import os
 import re
+import shutil
+import tempfile
+import time
 import unittest
 import warnings
 from unittest.case import skip
 
-from odemis import dataio
+from odemis import dataio, model
+from odemis.dataio import hdf5, tiff
 from odemis.dataio import (find_fittest_converter, get_available_formats,
                            get_converter)
 
@@ -48,7 +54,7 @@ class TestDataIO(unittest.TestCase):
 
         # including lossy formats
         all_fmts = get_available_formats(os.O_RDWR, allowlossy=True)
-        self.assertEqual(len(dataio.__all__), len(all_fmts) + 3)
+        self.assertEqual(len(dataio.__all__), len(all_fmts) + 4)
 
     def test_get_converter(self):
         fmts = get_available_formats()
@@ -107,5 +113,93 @@ class TestDataIO(unittest.TestCase):
                    "For '%s', expected format %s but got %s" % (args[0], fmt_exp, fmt_mng.FORMAT))
 
 
+class TestPeek(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def _create_file(self, fn, exporter):
+        md = {model.MD_PIXEL_SIZE: (1e-6, 2e-6), model.MD_POS: (1e-3, -1e-3),
+              model.MD_ACQ_DATE: time.time(), model.MD_DESCRIPTION: "test",
+              model.MD_EXP_TIME: 0.1, model.MD_DIMS: "ZYX"}
+        data = [model.DataArray(numpy.zeros((3, 256, 300), dtype=numpy.uint16), md),
+                model.DataArray(numpy.ones((200, 250), dtype=numpy.float32),
+                                {model.MD_DESCRIPTION: "second"})]
+        thumb = model.DataArray(numpy.zeros((50, 60, 3), dtype=numpy.uint8))
+        fn = os.path.join(self.dirname, fn)
+        exporter.export(fn, data, thumb)
+        return fn
+
+    def test_peek(self):
+        for fn, exporter in (("test.ome.tiff", tiff), ("test.h5", hdf5)):
+            fn = self._create_file(fn, exporter)
+            acd = exporter.open_data(fn)
+
+            for i in range(2):  # First without index, and then with the index
+                summary = dataio.peek(fn)
+                self.assertEqual(summary.format, exporter.FORMAT)
+                self.assertEqual(len(summary.content), len(acd.content))
+                for s, d in zip(summary.content, acd.content):
+                    self.assertEqual(s.shape, d.shape)
+                    self.assertEqual(s.dtype, d.dtype)
+                    self.assertEqual(s.metadata[model.MD_DESCRIPTION], d.metadata[model.MD_DESCRIPTION])
+                    self.assertEqual(s.metadata.get(model.MD_PIXEL_SIZE), d.metadata.get(model.MD_PIXEL_SIZE))
+                self.assertEqual(len(summary.thumbnails), 1)
+                numpy.testing.assert_array_equal(summary.thumbnails[0], acd.thumbnails[0].getData())
+                self.assertTrue(os.path.exists(dataio._peek._get_index_filename(fn)))
+
+    def test_outdated_index(self):
+        fn = self._create_file("test.ome.tiff", tiff)
+        summary = dataio.peek(fn)
+        self.assertEqual(len(summary.content), 2)
+
+        # Overwrite the file => the index is not used
+        data = model.DataArray(numpy.zeros((20, 30), dtype=numpy.uint8))
+        tiff.export(fn, data)
+        summary = dataio.peek(fn)
+        self.assertEqual(len(summary.content), 1)
+        self.assertEqual(summary.content[0].shape, (20, 30))
+
+        # Without index
+        os.remove(dataio._peek._get_index_filename(fn))
+        summary = dataio.peek(fn, use_index=False)
+        self.assertEqual(summary.content[0].dtype, numpy.uint8)
+        self.assertFalse(os.path.exists(dataio._peek._get_index_filename(fn)))
+
+        with self.assertRaises(IOError):
+            dataio.peek(os.path.join(self.dirname, "non-existing.h5"))
+
+    def test_peek_speed(self):
+        """
+        Compare the time to open a directory of many files, and to peek them
+        (with and without the index)
+        """
+        nfiles = 200
+        fns = [self._create_file("test%d.ome.tiff" % i, tiff) for i in range(nfiles)]
+
+        tstart = time.time()
+        for fn in fns:
+            acd = tiff.open_data(fn)
+            [t.getData() for t in acd.thumbnails]
+        dur_open = time.time() - tstart
+
+        tstart = time.time()
+        for fn in fns:
+            dataio.peek(fn)
+        dur_peek_noidx = time.time() - tstart
+
+        tstart = time.time()
+        for fn in fns:
+            dataio.peek(fn)
+        dur_peek = time.time() - tstart
+
+        logging.info("Opened %d files in %g s, peeked them in %g s the first time, and %g s with index",
+                     nfiles, dur_open, dur_peek_noidx, dur_peek)
+        self.assertLess(dur_peek, dur_open)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -1430,6 +1430,237 @@ class TestHDF5IO(unittest.TestCase):
         self.assertEqual(im.shape, tshape)
         self.assertEqual(im[0, 0].tolist(), [0, 255, 0])
 
+    def testOpenData(self):
+        """
+        Check the data is only read when needed, and can be read by parts
+        """
+        shape = (50, 1, 1, 40, 30)  # CTZYX
+        cube = model.DataArray(numpy.random.randint(0, 4096, shape).astype(numpy.uint16),
+                               {model.MD_DESCRIPTION: "Spectrum",
+                                model.MD_PIXEL_SIZE: (1e-6, 1e-6),
+                                model.MD_POS: (1e-3, -30e-3),
+                                model.MD_WL_LIST: [500e-9 + i * 1e-9 for i in range(shape[0])]})
+        # Two fluo images of the same shape, which are grouped in one acquisition
+        fluos = []
+        for i in range(2):
+            md = {model.MD_DESCRIPTION: "Fluo %d" % i,
+                  model.MD_PIXEL_SIZE: (1e-6, 1e-6),
+                  model.MD_POS: (1e-3, -30e-3),
+                  model.MD_IN_WL: (500e-9 + i * 100e-9, 520e-9 + i * 100e-9),
+                  model.MD_OUT_WL: (600e-9 + i * 100e-9, 620e-9 + i * 100e-9)}
+            fluos.append(model.DataArray(numpy.full((40, 30), i + 1, dtype=numpy.uint16), md))
+
+        hdf5.export(FILENAME, [cube] + fluos)
+
+        acd = hdf5.open_data(FILENAME)
+        self.assertEqual(len(acd.content), 3)
+        rcube = acd.content[0]
+        self.assertIsInstance(rcube, model.DataArrayShadow)
+        self.assertFalse(hasattr(rcube, "maxzoom"))
+        self.assertEqual(rcube.shape, shape)
+        self.assertEqual(rcube.dtype, cube.dtype)
+        self.assertEqual(rcube.metadata[model.MD_DESCRIPTION], "Spectrum")
+
+        # Only read the spectrum of one pixel
+        spec = rcube[:, 0, 0, 10, 5]
+        self.assertEqual(spec.metadata[model.MD_DESCRIPTION], "Spectrum")
+        numpy.testing.assert_array_equal(spec, cube[:, 0, 0, 10, 5])
+        numpy.testing.assert_array_equal(rcube.getData(), cube)
+
+        # Each channel is a separate DataArrayShadow
+        for i, das in enumerate(acd.content[1:]):
+            self.assertEqual(das.shape, (1, 1, 40, 30))
+            self.assertEqual(das.metadata[model.MD_DESCRIPTION], "Fluo %d" % i)
+            self.assertEqual(das[0, 0, 1, 1], i + 1)
+            numpy.testing.assert_array_equal(das.getData()[0, 0], fluos[i])
+
+        # Same as reading everything at once
+        rdata = hdf5.read_data(FILENAME)
+        self.assertEqual(len(rdata), len(acd.content))
+        for da, das in zip(rdata, acd.content):
+            self.assertEqual(da.shape, das.shape)
+            self.assertEqual(da.metadata, das.metadata)
+
+    def testExportPyramid(self):
+        """
+        Check a 2D image saved with pyramid can be read tile by tile
+        """
+        size = (1100, 600)  # X, Y
+        data = model.DataArray(numpy.random.randint(0, 4096, size[::-1]).astype(numpy.uint16),
+                               {model.MD_DESCRIPTION: "SEM",
+                                model.MD_PIXEL_SIZE: (1e-6, 1e-6),
+                                model.MD_POS: (1e-3, -30e-3)})
+        hdf5.export(FILENAME, data, pyramid=True)
+
+        acd = hdf5.open_data(FILENAME)
+        self.assertEqual(len(acd.content), 1)
+        das = acd.content[0]
+        self.assertEqual(das.shape, size[::-1])
+        self.assertEqual(das.tile_shape, (256, 256))
+        # Same number of levels as a pyramidal TIFF
+        self.assertEqual(das.maxzoom, 2)
+        numpy.testing.assert_array_equal(das.getData(), data)
+
+        tile = das.getTile(1, 1, 0)
+        self.assertEqual(tile.shape, (256, 256))
+        numpy.testing.assert_array_equal(tile, data[256:512, 256:512])
+        self.assertEqual(tile.metadata[model.MD_PIXEL_SIZE], (1e-6, 1e-6))
+
+        # Last tile of the lowest resolution is on the border
+        level2 = img.halveImage(img.halveImage(data))
+        tile = das.getTile(1, 0, 2)
+        self.assertEqual(tile.shape, (150, 275 - 256))
+        numpy.testing.assert_array_equal(tile, level2[:, 256:])
+        self.assertEqual(tile.metadata[model.MD_PIXEL_SIZE], (4e-6, 4e-6))
+
+        with self.assertRaises(ValueError):
+            das.getTile(0, 0, 3)
+        with self.assertRaises(IndexError):
+            das.getTile(2, 0, 2)
+
+
+class TestHDF5Writer(unittest.TestCase):
+    """
+    Test the progressive writing of a file, with AcquisitionWriter
+    """
+
+    def tearDown(self):
+        try:
+            os.remove(FILENAME)
+        except Exception:
+            pass
+
+    def _get_spec_md(self, nc):
+        return {model.MD_HW_NAME: "fake spec",
+                model.MD_DESCRIPTION: "Spectrum",
+                model.MD_ACQ_DATE: time.time(),
+                model.MD_PIXEL_SIZE: (1e-6, 1e-6),  # m/px
+                model.MD_POS: (1e-3, -30e-3),  # m
+                model.MD_EXP_TIME: 1.2,  # s
+                model.MD_WL_LIST: [500e-9 + i * 1e-9 for i in range(nc)],
+                model.MD_DIMS: "CTZYX",
+                }
+
+    def testPixelByPixel(self):
+        """
+        Write a spectrum cube pixel by pixel, as the sync streams do
+        """
+        shape = (64, 1, 1, 20, 30)  # CTZYX
+        cube = numpy.random.randint(0, 4096, shape).astype(numpy.uint16)
+        md = self._get_spec_md(shape[0])
+        sem = model.DataArray(numpy.ones(shape[-2:], dtype=numpy.uint16),
+                              {model.MD_DESCRIPTION: "SEM",
+                               model.MD_PIXEL_SIZE: (1e-6, 1e-6),
+                               model.MD_POS: (1e-3, -30e-3)})
+        thumbnail = model.DataArray(numpy.zeros((20, 30, 3), dtype=numpy.uint8))
+
+        with hdf5.AcquisitionWriter(FILENAME, thumbnail) as writer:
+            writer.append(sem)
+            sim = writer.create_image(shape, cube.dtype, md)
+            self.assertEqual(sim.shape, shape)
+            for y, x in numpy.ndindex(*shape[-2:]):
+                sim[:, 0, 0, y, x] = cube[:, 0, 0, y, x]
+            # Metadata can be updated until the end
+            sim.metadata[model.MD_DESCRIPTION] = "Spectrum updated"
+            sim.finalize()
+            with self.assertRaises(IOError):
+                sim[:, 0, 0, 0, 0] = cube[:, 0, 0, 0, 0]
+
+        rdata = hdf5.read_data(FILENAME)
+        self.assertEqual(len(rdata), 2)
+        rsem, rcube = rdata
+        numpy.testing.assert_array_equal(rsem[0, 0, 0], sem)
+        numpy.testing.assert_array_equal(rcube, cube)
+        self.assertEqual(rcube.metadata[model.MD_DESCRIPTION], "Spectrum updated")
+        self.assertEqual(rcube.metadata[model.MD_POS], md[model.MD_POS])
+        self.assertEqual(rcube.metadata[model.MD_PIXEL_SIZE], md[model.MD_PIXEL_SIZE])
+        numpy.testing.assert_allclose(rcube.metadata[model.MD_WL_LIST], md[model.MD_WL_LIST])
+        self.assertEqual(len(hdf5.read_thumbnail(FILENAME)), 1)
+
+        # The data is chunked, and has the standard image attributes
+        with h5py.File(FILENAME, "r") as f:
+            im = f["Acquisition1/ImageData/Image"]
+            self.assertIsNotNone(im.chunks)
+            self.assertEqual(im.attrs["IMAGE_SUBCLASS"], b"IMAGE_GRAYSCALE")
+            self.assertEqual(list(im.attrs["IMAGE_MINMAXRANGE"]), [cube.min(), cube.max()])
+
+    def testAppendRows(self):
+        """
+        Write an image of unknown length, row by row
+        """
+        nc, width = 16, 40
+        md = self._get_spec_md(nc)
+        md[model.MD_DIMS] = "CYX"
+        rows = [numpy.full((nc, 1, width), i, dtype=numpy.float32) for i in range(25)]
+        with hdf5.AcquisitionWriter(FILENAME, compressed=False) as writer:
+            sim = writer.create_image((nc, 0, width), numpy.float32, md)
+            for r in rows:
+                sim.append(r, axis=1)
+            self.assertEqual(sim.shape, (nc, len(rows), width))
+            # Overwriting a block in the middle doesn't change the shape
+            sim.write(numpy.full((nc, 2, 2), -1, dtype=numpy.float32), (0, 3, 5))
+            self.assertEqual(sim.shape, (nc, len(rows), width))
+            # Not finalised explicitly => done when closing the writer
+
+        rdata = hdf5.read_data(FILENAME)
+        self.assertEqual(len(rdata), 1)
+        rim = rdata[0]
+        self.assertEqual(rim.shape, (nc, 1, 1, len(rows), width))
+        self.assertEqual(rim[0, 0, 0, 10, 0], 10)
+        self.assertEqual(rim[0, 0, 0, 4, 6], -1)
+        self.assertEqual(rim[0, 0, 0, 4, 7], 4)
+
+    def testBadDims(self):
+        with hdf5.AcquisitionWriter(FILENAME) as writer:
+            with self.assertRaises(ValueError):
+                writer.create_image((30, 20, 3), numpy.uint8, {model.MD_DIMS: "YXC"})
+            with self.assertRaises(ValueError):
+                writer.create_image((20, 30), numpy.uint8, {model.MD_DIMS: "CYX"})
+            with self.assertRaises(ValueError):
+                writer.create_image((30,), numpy.uint8, {})
+
+    def testMemory(self):
+        """
+        Compare the peak of memory used to save a large spectrum cube, with
+        export() and by writing it progressively.
+        """
+        import tracemalloc
+        shape = (512, 1, 1, 64, 128)  # 64 MiB
+        dtype = numpy.uint16
+        md = self._get_spec_md(shape[0])
+
+        tracemalloc.start()
+        try:
+            tstart = time.time()
+            cube = model.DataArray(numpy.zeros(shape, dtype), md)
+            for y in range(shape[-2]):
+                cube[:, 0, 0, y, :] = y
+            hdf5.export(FILENAME, cube)
+            dur_export = time.time() - tstart
+            del cube
+            peak_export = tracemalloc.get_traced_memory()[1]
+
+            tracemalloc.stop()  # reset the peak
+            tracemalloc.start()
+            tstart = time.time()
+            with hdf5.AcquisitionWriter(FILENAME) as writer:
+                sim = writer.create_image(shape, dtype, md)
+                for y in range(shape[-2]):
+                    row = numpy.full(shape[:3] + (1, shape[-1]), y, dtype)
+                    sim.write(row, (0, 0, 0, y, 0))
+            dur_writer = time.time() - tstart
+            peak_writer = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+        logging.info("Saving %d MiB cube: export() peak = %d MiB in %g s, writer peak = %d MiB in %g s",
+                     numpy.prod(shape) * 2 / 2 ** 20, peak_export / 2 ** 20, dur_export,
+                     peak_writer / 2 ** 20, dur_writer)
+        self.assertLess(peak_writer, peak_export / 4)
+
+        rdata = hdf5.read_data(FILENAME)
+        self.assertEqual(rdata[0][0, 0, 0, 10, 0], 10)
+
 
 if __name__ == "__main__":
     # import sys;sys.argv = ['', 'Test.testName']
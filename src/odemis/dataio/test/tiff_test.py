@@ -2211,6 +2211,55 @@ class TestTiffIO(unittest.TestCase):
             # the image is not tiled
             rdata.content[0].getTile(0, 0, 0)
 
+    def testAcquisitionDataTIFFZStack(self):
+        """
+        Checks the tiles of a pyramidal Z stack (ie, multiple pixelData) can be read
+        """
+        size = (3, 600, 700)  # ZYX
+        md = {
+            model.MD_DIMS: "ZYX",
+            model.MD_POS: (2e-6, 10e-6, 3e-6),
+            model.MD_PIXEL_SIZE: (1e-6, 1e-6, 2e-6),
+        }
+        arr = numpy.arange(numpy.prod(size), dtype=numpy.uint16).reshape(size)
+        data = model.DataArray(arr, metadata=md)
+        tiff.export(FILENAME, data, pyramid=True)
+
+        rdata = tiff.open_data(FILENAME)
+        self.assertEqual(len(rdata.content), 1)
+        das = rdata.content[0]
+        self.assertEqual(das.shape[-3:], size)
+        self.assertEqual(das.maxzoom, 1)
+        hdim = das.shape[:-2]
+
+        # Full resolution: each plane of the tile is read
+        tile = das.getTile(1, 1, 0)
+        self.assertEqual(tile.shape, hdim + (256, 256))
+        numpy.testing.assert_array_equal(tile.reshape(size[0], 256, 256),
+                                         arr[:, 256:512, 256:512])
+        self.assertEqual(tile.metadata[model.MD_PIXEL_SIZE], (1e-6, 1e-6, 2e-6))
+        self.assertEqual(len(tile.metadata[model.MD_POS]), 3)
+        self.assertAlmostEqual(tile.metadata[model.MD_POS][2], 3e-6)
+
+        # Border tile, at a lower resolution
+        tile = das.getTile(1, 1, 1)
+        self.assertEqual(tile.shape, hdim + (300 - 256, 350 - 256))
+        self.assertEqual(tile.metadata[model.MD_PIXEL_SIZE], (2e-6, 2e-6, 2e-6))
+
+        # Selecting a plane gives a 2D pyramidal image
+        das_z1 = das[(0,) * (len(hdim) - 1) + (1,)]
+        self.assertEqual(das_z1.shape, size[1:])
+        self.assertEqual(das_z1.maxzoom, 1)
+        tile = das_z1.getTile(2, 0, 0)
+        numpy.testing.assert_array_equal(tile, arr[1, 0:256, 512:700])
+        numpy.testing.assert_array_equal(das_z1.getData(), arr[1])
+
+        # Arbitrary selection => read the data
+        numpy.testing.assert_array_equal(das[..., 10:20, 5],
+                                         arr.reshape(das.shape)[..., 10:20, 5])
+        # An index after a whole dimension is not a plane selection
+        numpy.testing.assert_array_equal(das[:, 1], arr.reshape(das.shape)[:, 1])
+
     def testWriteImageJMultiZStackSeries(self):
         """
         Checks the xml information of FM images from multiple channels in Z and time series, such that is compatible
@@ -2555,6 +2604,162 @@ class TestTiffIO(unittest.TestCase):
         # the size of this tile is also the size of the image
         self.assertEqual(tiles[0][0].shape, (156, 187))
 
+    def testPyramidWriteSpeed(self):
+        """
+        Compare the time to write a large pyramidal image, with the previous
+        (serial) way, and check the image is identical
+        """
+        size = (8000, 6000)
+        arr = numpy.random.randint(0, 200, size[::-1], dtype=numpy.uint16)
+        arr += numpy.arange(size[0], dtype=numpy.uint16)  # some structure, to compress
+        data = model.DataArray(arr, metadata={model.MD_DIMS: "YX",
+                                              model.MD_PIXEL_SIZE: (1e-6, 1e-6)})
+        # The pixel size is needed to read the tiles
+        tags = tiff._convertToTiffTag(data.metadata)
+
+        # Previous implementation: serial compression, and each zoom level
+        # computed from the full image
+        tstart = time.time()
+        f = libtiff.TIFF.open(FILENAME, mode="w")
+        for key, val in tags.items():
+            f.SetField(key, val)
+        resized_shapes = tiff._genResizedShapes(data)
+        f.SetField(T.TIFFTAG_SUBIFD, [0] * len(resized_shapes))
+        f.write_tiles(data, tiff.TILE_SIZE, tiff.TILE_SIZE, "lzw", False)
+        for shape in resized_shapes:
+            subim = img.rescale_hq(data, shape)
+            f.SetField(T.TIFFTAG_SUBFILETYPE, T.FILETYPE_REDUCEDIMAGE)
+            f.write_tiles(subim, tiff.TILE_SIZE, tiff.TILE_SIZE, "lzw", False)
+        f.close()
+        dur_serial = time.time() - tstart
+        size_serial = os.path.getsize(FILENAME)
+
+        tstart = time.time()
+        f = libtiff.TIFF.open(FILENAME, mode="w")
+        for key, val in tags.items():
+            f.SetField(key, val)
+        tiff.write_image(f, data, compression="lzw", pyramid=True)
+        f.close()
+        dur_parallel = time.time() - tstart
+        size_parallel = os.path.getsize(FILENAME)
+
+        # The speed-up depends on the number of CPUs (and their load), so it's
+        # only reported
+        logging.info("Wrote pyramidal image in %g s (%d MB) serially, and %g s (%d MB) "
+                     "in parallel with %d workers",
+                     dur_serial, size_serial // 2 ** 20, dur_parallel, size_parallel // 2 ** 20,
+                     tiff.MAX_TILE_WORKERS)
+
+        rdata = tiff.open_data(FILENAME)
+        self.assertEqual(rdata.content[0].maxzoom, len(resized_shapes))
+        numpy.testing.assert_array_equal(rdata.content[0].getData(), arr)
+        tile = rdata.content[0].getTile(3, 2, 0)
+        numpy.testing.assert_array_equal(tile, arr[512:768, 768:1024])
+        # The border tiles are not padded
+        tile = rdata.content[0].getTile(31, 23, 0)
+        numpy.testing.assert_array_equal(tile, arr[5888:, 7936:])
+        # The zoom levels are close to the image rescaled from the full image
+        tile = rdata.content[0].getTile(0, 0, 2)
+        exp = img.rescale_hq(data, (size[1] // 4, size[0] // 4))[:256, :256]
+        numpy.testing.assert_allclose(tile, exp, atol=2)
+
+    def testReadRaw(self):
+        """
+        Check uncompressed images are directly read from the file, and the
+        read data is the same as the one written
+        """
+        if tiff._TIFFGetStrileOffset is None:
+            self.skipTest("libtiff doesn't support TIFFGetStrileOffset")
+
+        size = (4000, 3000)
+        arr = numpy.random.randint(0, 2 ** 12, size[::-1], dtype=numpy.uint16)
+        rgb = numpy.random.randint(0, 255, (300, 200, 3), dtype=numpy.uint8)
+        ldata = [model.DataArray(arr, metadata={model.MD_DIMS: "YX",
+                                                model.MD_PIXEL_SIZE: (1e-6, 1e-6)}),
+                 model.DataArray(rgb, metadata={model.MD_DIMS: "YXC"})]
+        tiff.export(FILENAME, ldata, compressed=False)
+
+        f = libtiff.TIFF.open(FILENAME)
+        tstart = time.time()
+        im = tiff._readRawImage(f)
+        dur_raw = time.time() - tstart
+        self.assertIsNotNone(im)
+        numpy.testing.assert_array_equal(im, arr)
+
+        # Compare with the standard read by libtiff
+        tstart = time.time()
+        im = f.read_image()
+        dur_read = time.time() - tstart
+        f.close()
+        numpy.testing.assert_array_equal(im, arr)
+        logging.info("Image read in %g s directly, and %g s by libtiff", dur_raw, dur_read)
+
+        rdata = tiff.open_data(FILENAME)
+        im = rdata.content[0].getData()
+        numpy.testing.assert_array_equal(im, arr)
+        im_rgb = rdata.content[1].getData()
+        numpy.testing.assert_array_equal(im_rgb, rgb)
+
+        # Modifying the data doesn't change the file
+        im[0, 0] = 2 ** 13
+        numpy.testing.assert_array_equal(tiff.read_data(FILENAME)[0], arr)
+
+        # Rewriting the file doesn't affect the data already read
+        tiff.export(FILENAME, ldata[::-1], compressed=False)
+        numpy.testing.assert_array_equal(im[1:], arr[1:])
+        numpy.testing.assert_array_equal(im_rgb, rgb)
+
+        # Compressed images are read by libtiff
+        tiff.export(FILENAME, ldata, compressed=True)
+        f = libtiff.TIFF.open(FILENAME)
+        self.assertIsNone(tiff._readRawImage(f))
+        f.close()
+        rdata = tiff.open_data(FILENAME)
+        numpy.testing.assert_array_equal(rdata.content[0].getData(), arr)
+
+        # The tiles of uncompressed pyramidal images are also read directly
+        tiff.export(FILENAME, ldata[0], compressed=False, pyramid=True)
+        f = libtiff.TIFF.open(FILENAME)
+        tile = tiff._readRawTile(f, 768, 512)
+        f.close()
+        self.assertIsNotNone(tile)
+        numpy.testing.assert_array_equal(tile, arr[512:768, 768:1024])
+        rdata = tiff.open_data(FILENAME)
+        tile = rdata.content[0].getTile(3, 2, 0)
+        numpy.testing.assert_array_equal(tile, arr[512:768, 768:1024])
+        # The border tiles are not padded
+        tile = rdata.content[0].getTile(15, 11, 0)
+        numpy.testing.assert_array_equal(tile, arr[2816:, 3840:])
+        tile = rdata.content[0].getTile(0, 0, 1)
+        self.assertEqual(tile.shape, (256, 256))
+
+    def testExportShadow(self):
+        """
+        Check DataArrayShadows can be exported, and give the same file as
+        exporting the DataArrays
+        """
+        fn_copy = "test_copy" + tiff.EXTENSIONS[0]
+        self.addCleanup(os.remove, fn_copy)
+        md = {model.MD_PIXEL_SIZE: (1e-6, 1e-6), model.MD_POS: (1e-3, -1e-3),
+              model.MD_DESCRIPTION: "test"}
+        zstack = numpy.random.randint(0, 2 ** 12, (5, 1, 4, 512, 600), dtype=numpy.uint16)
+        rgb = numpy.random.randint(0, 255, (300, 200, 3), dtype=numpy.uint8)
+        ldata = [model.DataArray(zstack, md),
+                 model.DataArray(rgb, {model.MD_DIMS: "YXC"})]
+        tiff.export(FILENAME, ldata)
+
+        for pyramid in (False, True):
+            rdata = tiff.open_data(FILENAME)
+            self.assertIsInstance(rdata.content[0], model.DataArrayShadow)
+            tiff.export(fn_copy, list(rdata.content), pyramid=pyramid)
+
+            cdata = tiff.read_data(fn_copy)
+            self.assertEqual(len(cdata), len(ldata))
+            for orig, copy in zip(ldata, cdata):
+                numpy.testing.assert_array_equal(copy, orig)
+            self.assertEqual(cdata[0].metadata[model.MD_POS], md[model.MD_POS])
+            self.assertEqual(cdata[0].metadata[model.MD_DESCRIPTION], md[model.MD_DESCRIPTION])
+
     def test_convert_thermo_fisher_to_odemis_metadata(self):
 
         # open example image
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on 17 Oct 2026
+
+Copyright © 2026 Delmic
+
+This file is part of Odemis.
+
+Odemis is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License version 2 as published by the Free Software
+Foundation.
+
+Odemis is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+Odemis. If not, see http://www.gnu.org/licenses/.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import numpy
+from odemis import dataio, model
+from odemis.dataio import zarr
+from odemis.util import img
+import os
+import shutil
+import time
+import unittest
+
+logging.getLogger().setLevel(logging.DEBUG)
+
+FILENAME = u"test" + zarr.EXTENSIONS[0]
+
+
+class TestZarrIO(unittest.TestCase):
+
+    def tearDown(self):
+        shutil.rmtree(FILENAME, ignore_errors=True)
+
+    def testExportRead(self):
+        """
+        Checks that we can write and read back images of different types
+        """
+        md = {model.MD_PIXEL_SIZE: (1e-6, 2e-6), model.MD_POS: (1e-3, -30e-3),
+              model.MD_DESCRIPTION: "test", model.MD_EXP_TIME: 1.2,
+              model.MD_ACQ_DATE: time.time()}
+        ldata = [
+            model.DataArray(numpy.random.randint(0, 4096, (300, 600), dtype=numpy.uint16), md),
+            model.DataArray(numpy.random.random((3, 513, 100)).astype(numpy.float32),
+                            {model.MD_DIMS: "ZYX", model.MD_DESCRIPTION: "Z stack"}),
+            model.DataArray(numpy.random.randint(0, 255, (100, 120, 3), dtype=numpy.uint8),
+                            {model.MD_DIMS: "YXC"}),
+        ]
+        thumbnail = model.DataArray(numpy.zeros((30, 40, 3), dtype=numpy.uint8))
+
+        for compressed in (True, False):
+            zarr.export(FILENAME, ldata, thumbnail, compressed=compressed)
+            self.assertIs(dataio.find_fittest_converter(FILENAME, mode=os.O_RDONLY), zarr)
+
+            rdata = zarr.read_data(FILENAME)
+            self.assertEqual(len(rdata), len(ldata))
+            for r, d in zip(rdata, ldata):
+                self.assertEqual(r.dtype, d.dtype)
+                numpy.testing.assert_array_equal(r, d)
+            self.assertEqual(rdata[0].metadata[model.MD_PIXEL_SIZE], md[model.MD_PIXEL_SIZE])
+            self.assertEqual(rdata[0].metadata[model.MD_POS], md[model.MD_POS])
+            self.assertEqual(rdata[0].metadata[model.MD_DESCRIPTION], md[model.MD_DESCRIPTION])
+            self.assertEqual(rdata[1].metadata[model.MD_DIMS], "ZYX")
+
+            rthumbs = zarr.read_thumbnail(FILENAME)
+            self.assertEqual(len(rthumbs), 1)
+            numpy.testing.assert_array_equal(rthumbs[0], thumbnail)
+
+        # Partial reads
+        acd = zarr.open_data(FILENAME)
+        numpy.testing.assert_array_equal(acd.content[1][1], ldata[1][1])
+        numpy.testing.assert_array_equal(acd.content[0][100:200, 260:500], ldata[0][100:200, 260:500])
+
+    def testOverwrite(self):
+        """
+        Check an existing Zarr store or empty directory is overwritten, but
+        not any other directory
+        """
+        data = model.DataArray(numpy.zeros((20, 30), dtype=numpy.uint16))
+        zarr.export(FILENAME, data)
+        zarr.export(FILENAME, data + 1)
+        numpy.testing.assert_array_equal(zarr.read_data(FILENAME)[0], data + 1)
+
+        shutil.rmtree(FILENAME)
+        os.mkdir(FILENAME)
+        zarr.export(FILENAME, data)
+        numpy.testing.assert_array_equal(zarr.read_data(FILENAME)[0], data)
+
+        shutil.rmtree(FILENAME)
+        os.mkdir(FILENAME)
+        other = os.path.join(FILENAME, "important.txt")
+        with open(other, "w") as f:
+            f.write("do not delete")
+        with self.assertRaises(IOError):
+            zarr.export(FILENAME, data)
+        self.assertTrue(os.path.exists(other))
+
+    def testPyramid(self):
+        """
+        Checks the tiles of the lower resolution levels
+        """
+        size = (5, 1000, 1200)  # ZYX
+        md = {model.MD_PIXEL_SIZE: (1e-6, 1e-6), model.MD_POS: (1e-3, -30e-3),
+              model.MD_DIMS: "ZYX"}
+        arr = numpy.random.randint(0, 4096, size, dtype=numpy.uint16)
+        zarr.export(FILENAME, model.DataArray(arr, md), pyramid=True)
+
+        acd = zarr.open_data(FILENAME)
+        das = acd.content[0]
+        self.assertEqual(das.maxzoom, 2)
+        self.assertEqual(das.tile_shape, (zarr.TILE_SIZE, zarr.TILE_SIZE))
+
+        tile = das.getTile(1, 2, 0)
+        numpy.testing.assert_array_equal(tile, arr[:, 512:768, 256:512])
+        # Border tile
+        tile = das.getTile(4, 3, 0)
+        numpy.testing.assert_array_equal(tile, arr[:, 768:, 1024:])
+        self.assertEqual(tile.metadata[model.MD_PIXEL_SIZE], (1e-6, 1e-6))
+
+        tile = das.getTile(0, 0, 1)
+        exp = numpy.stack([img.halveImage(a) for a in arr])[:, :256, :256]
+        numpy.testing.assert_array_equal(tile, exp)
+        self.assertEqual(tile.metadata[model.MD_PIXEL_SIZE], (2e-6, 2e-6))
+
+        tile = das.getTile(1, 0, 2)
+        exp = numpy.stack([img.halveImage(img.halveImage(a)) for a in arr])[:, :, 256:]
+        numpy.testing.assert_array_equal(tile, exp)
+
+    def testConcurrentTiles(self):
+        """
+        Write overlapping tiles of a large image from multiple threads
+        """
+        shape = (3000, 4000)
+        full = numpy.random.randint(0, 4096, shape, dtype=numpy.uint16)
+        md = {model.MD_PIXEL_SIZE: (1e-6, 1e-6), model.MD_DIMS: "YX"}
+        tshape = (700, 900)
+        step = (600, 800)  # => some overlap between tiles
+        positions = [(y, x) for y in range(0, shape[0] - tshape[0] + 1, step[0])
+                     for x in range(0, shape[1] - tshape[1] + 1, step[1])]
+
+        def write_tiles(im, executor=None):
+            def write_tile(pos):
+                y, x = pos
+                im.write(full[y:y + tshape[0], x:x + tshape[1]], pos)
+            if executor:
+                list(executor.map(write_tile, positions))
+            else:
+                for p in positions:
+                    write_tile(p)
+
+        # Serially
+        tstart = time.time()
+        with zarr.AcquisitionWriter(FILENAME) as writer:
+            im = writer.create_image(shape, full.dtype, md)
+            write_tiles(im)
+        dur_serial = time.time() - tstart
+        shutil.rmtree(FILENAME)
+
+        # Concurrently, as if acquired by multiple detectors
+        tstart = time.time()
+        with zarr.AcquisitionWriter(FILENAME, pyramid=True) as writer:
+            im = writer.create_image(shape, full.dtype, md)
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                write_tiles(im, executor)
+        dur_concurrent = time.time() - tstart
+        logging.info("Wrote %d tiles in %g s serially, and %g s concurrently (+ pyramid)",
+                     len(positions), dur_serial, dur_concurrent)
+
+        rdata = zarr.open_data(FILENAME)
+        das = rdata.content[0]
+        covered = (slice(0, positions[-1][0] + tshape[0]), slice(0, positions[-1][1] + tshape[1]))
+        numpy.testing.assert_array_equal(das.getData()[covered], full[covered])
+        # Never written => 0
+        self.assertEqual(das[shape[0] - 1, shape[1] - 1], 0)
+        self.assertEqual(das.maxzoom, 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
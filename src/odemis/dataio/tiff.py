@@ -20,6 +20,8 @@ You should have received a copy of the GNU General Public License along with
 Odemis. If not, see http://www.gnu.org/licenses/.
 '''
 import calendar
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import configparser
 from datetime import datetime
 import json
@@ -39,6 +41,7 @@ import sys
 import threading
 import time
 import uuid
+import zlib
 
 import libtiff.libtiff_ctypes as T  # for the constant names
 import xml.etree.ElementTree as ET
@@ -64,7 +67,15 @@ EXTENSIONS = [u".ome.tiff", u".ome.tif", u".tiff", u".tif"]
 STIFF_SPLIT = ".0."  # pattern to replace with the "stiff" multiple file
 
 CAN_SAVE_PYRAMID = True # indicates the support for pyramidal export
+CAN_SAVE_SHADOW = True  # indicates export() accepts DataArrayShadows (read while writing)
 TILE_SIZE = 256 # Tile size of pyramidal images
+# Tiles of pyramidal images are compressed with deflate, in parallel.
+# Level 1 is the fastest, and still compresses more than LZW on typical images.
+TILE_DEFLATE_LEVEL = 1
+MAX_TILE_WORKERS = os.cpu_count() or 1
+# Number of planes read in advance when exporting DataArrayShadows. That's also
+# the maximum number of extra planes kept in memory.
+MAX_PREFETCH_PLANES = 2
 LOSSY = False
 
 # We try to make it as much as possible looking like a normal (multi-page) TIFF,
@@ -103,6 +114,19 @@ T.tifftags[TIFFTAG_ZEISS_MD_2] = ((T.ctypes.c_uint32, T.ctypes.c_char), lambda d
 # So we have to explicitly change the format to indicate it'll be variable (and GetField will work fine)
 T.tifftags[TIFFTAG_TESCAN_MD] = ((T.ctypes.c_uint32, T.ctypes.c_char), lambda d: d[1][:d[0]])
 
+# Functions to get the position of the strips/tiles in the file, needed to
+# directly read the uncompressed images. Only available from libtiff 4.1.
+try:
+    _TIFFGetStrileOffset = T.libtiff.TIFFGetStrileOffset
+    _TIFFGetStrileOffset.restype = T.ctypes.c_uint64
+    _TIFFGetStrileOffset.argtypes = [T.TIFF, T.ctypes.c_uint32]
+    _TIFFGetStrileByteCount = T.libtiff.TIFFGetStrileByteCount
+    _TIFFGetStrileByteCount.restype = T.ctypes.c_uint64
+    _TIFFGetStrileByteCount.argtypes = [T.TIFF, T.ctypes.c_uint32]
+except AttributeError:
+    logging.info("libtiff doesn't support TIFFGetStrileOffset, uncompressed images will not be read directly")
+    _TIFFGetStrileOffset = None
+
 # suppress warnings and errors from libtiff (written to stderr by default)
 # T.suppress_errors() # deliberately commented out
 T.suppress_warnings()
@@ -291,6 +315,122 @@ def _readTiffTag(tfile):
     return md
 
 
+def _getRawDType(tfile):
+    """
+    Check whether the pixel data of the current image can be directly read from
+    the file, based on its format.
+    tfile (tiff handle): Handle of the TIFF file
+    return (None or numpy.dtype): the dtype of the pixels, with the byte order of
+      the file, or None if the data cannot be read directly (eg, it's compressed)
+    """
+    if _TIFFGetStrileOffset is None:
+        return None
+    if _GetFieldDefault(tfile, T.TIFFTAG_COMPRESSION, T.COMPRESSION_NONE) != T.COMPRESSION_NONE:
+        return None
+    bits = tfile.GetField(T.TIFFTAG_BITSPERSAMPLE)
+    if bits is None or bits % 8 != 0:
+        return None
+    typ = tfile.get_numpy_type(bits, tfile.GetField(T.TIFFTAG_SAMPLEFORMAT))
+    if typ is None:
+        return None
+    dtype = numpy.dtype(typ)
+    if tfile.IsByteSwapped():
+        dtype = dtype.newbyteorder("S")
+    return dtype
+
+
+def _readRaw(filename, dtype, offset, shape):
+    """
+    Read a block of uncompressed pixel data from a file
+    filename (str): path to the file
+    dtype (numpy.dtype): type of the pixels, with the byte order of the file
+    offset (int): position of the first byte of the data in the file
+    shape (tuple of int): shape of the data
+    return (numpy.array): the data, independent from the file
+    """
+    with open(filename, "rb") as f:
+        data = numpy.fromfile(f, dtype=dtype, count=int(numpy.prod(shape)), offset=offset)
+    return data.reshape(shape)
+
+
+def _readRawImage(tfile):
+    """
+    Read the pixel data of the current image in one go, if it's stored
+    uncompressed, in strips, one after another. It avoids going through libtiff,
+    which reads (and copies) the data strip by strip.
+    Note: the data is copied, and not memory mapped, as the file could be
+    rewritten while the image is still in use (which would crash the program).
+    tfile (tiff handle): Handle of the TIFF file
+    return (None or numpy.array): the image, in the same shape as
+      tfile.read_image(). None if the image cannot be read directly.
+    """
+    if tfile.IsTiled():
+        return None
+    dtype = _getRawDType(tfile)
+    if dtype is None:
+        return None
+
+    width = tfile.GetField(T.TIFFTAG_IMAGEWIDTH)
+    height = tfile.GetField(T.TIFFTAG_IMAGELENGTH)
+    spp = _GetFieldDefault(tfile, T.TIFFTAG_SAMPLESPERPIXEL, 1)
+    if spp == 1:
+        shape = (height, width)
+    elif _GetFieldDefault(tfile, T.TIFFTAG_PLANARCONFIG, T.PLANARCONFIG_CONTIG) == T.PLANARCONFIG_CONTIG:
+        shape = (height, width, spp)
+    else:
+        shape = (spp, height, width)
+
+    # Check the strips are one after another
+    offset = _TIFFGetStrileOffset(tfile, 0)
+    end = offset
+    for i in range(tfile.NumberOfStrips()):
+        if _TIFFGetStrileOffset(tfile, i) != end:
+            return None
+        end += _TIFFGetStrileByteCount(tfile, i)
+    if end - offset < numpy.prod(shape) * dtype.itemsize or offset == 0:
+        return None
+
+    return _readRaw(tfile.FileName(), dtype, offset, shape)
+
+
+def _readRawTile(tfile, x, y):
+    """
+    Read directly one tile of the current image, if it's stored uncompressed.
+    tfile (tiff handle): Handle of the TIFF file
+    x, y (int): position of a pixel in the tile
+    return (None or numpy.array): the tile, in the same shape as
+      tfile.read_one_tile(), or None if the tile cannot be read directly.
+    """
+    dtype = _getRawDType(tfile)
+    if dtype is None:
+        return None
+
+    spp = _GetFieldDefault(tfile, T.TIFFTAG_SAMPLESPERPIXEL, 1)
+    if spp > 1 and (_GetFieldDefault(tfile, T.TIFFTAG_PLANARCONFIG, T.PLANARCONFIG_CONTIG)
+                    != T.PLANARCONFIG_CONTIG):
+        return None  # One tile per sample => not worthy
+    if _GetFieldDefault(tfile, T.TIFFTAG_IMAGEDEPTH, 1) != 1:
+        return None
+    tw = tfile.GetField(T.TIFFTAG_TILEWIDTH)
+    th = tfile.GetField(T.TIFFTAG_TILELENGTH)
+    width = tfile.GetField(T.TIFFTAG_IMAGEWIDTH)
+    height = tfile.GetField(T.TIFFTAG_IMAGELENGTH)
+    if not (0 <= x < width and 0 <= y < height):
+        return None  # Let libtiff report the error
+
+    index = T.libtiff.TIFFComputeTile(tfile, x, y, 0, 0)
+    index = getattr(index, "value", index)
+    shape = (th, tw) if spp == 1 else (th, tw, spp)
+    offset = _TIFFGetStrileOffset(tfile, index)
+    if offset == 0 or _TIFFGetStrileByteCount(tfile, index) < numpy.prod(shape) * dtype.itemsize:
+        return None
+
+    tile = _readRaw(tfile.FileName(), dtype, offset, shape)
+    # The tiles on the border are padded in the file
+    xt, yt = x - x % tw, y - y % th
+    return tile[:min(th, height - yt), :min(tw, width - xt)]
+
+
 def _isThumbnail(tfile):
     """
     Detects whether the current image of a file is a thumbnail or not
@@ -1754,15 +1894,50 @@ def _createPointROI(rois, name, p, shp_attrib=None):
     return rid
 
 
+class _DataArrayShadowMD(DataArrayShadow):
+    """
+    DataArrayShadow with different metadata, but giving access to the same data
+    as another DataArrayShadow.
+    """
+
+    def __init__(self, das, metadata):
+        """
+        das (DataArrayShadow): the original data
+        metadata (dict str->val): the metadata to use instead of the original one
+        """
+        DataArrayShadow.__init__(self, das.shape, das.dtype, metadata)
+        self._das = das
+        if hasattr(das, "maxzoom"):
+            self.maxzoom = das.maxzoom
+            self.tile_shape = das.tile_shape
+
+    def getData(self):
+        return model.DataArray(self._das.getData(), self.metadata.copy())
+
+    def __getitem__(self, key):
+        # Raises TypeError if the original data doesn't support it
+        return self._das[key]
+
+    def __getattr__(self, name):
+        # Only called for the attributes not found, such as getTile()
+        if name == "_das":  # Not yet set
+            raise AttributeError(name)
+        return getattr(self._das, name)
+
+
 def _mergeCorrectionMetadata(da):
     """
     Create a new DataArray with metadata updated to with the correction metadata
     merged.
-    da (DataArray): the original data
-    return (DataArray): new DataArray (view) with the updated metadata
+    da (DataArray or DataArrayShadow): the original data
+    return (DataArray or DataArrayShadow): new DataArray (view) or DataArrayShadow
+      with the updated metadata
     """
     md = da.metadata.copy() # to avoid modifying the original one
     img.mergeMetadata(md)
+    if isinstance(da, DataArrayShadow):
+        # The data will only be read when writing it
+        return _DataArrayShadowMD(da, md)
     return model.DataArray(da, md) # create a view
 
 
@@ -1905,69 +2080,126 @@ def _saveAsMultiTiffLT(filename, ldata, thumbnail, compressed=True, multiple_fil
     if ometxt:
         f.SetField(T.TIFFTAG_IMAGEDESCRIPTION, imagej_description.encode('ascii') + ometxt)
 
+    # List all the planes (2D or RGB images) to write, in order
+    planes = []  # data, index in data, write_rgb
     for fifd, das in sorted_groups:
         if len(das) == 0:
             continue  # Something is wrong
         elif len(das) == 1:
             data = das[0]
             # Just normal output
-            tags = _convertToTiffTag(data.metadata)
             # if metadata indicates YXC format just handle it as RGB
             if data.metadata.get(model.MD_DIMS) == 'YXC' and data.shape[-1] in (3, 4):
-                write_rgb = True
-                hdim = data.shape[:-3]
+                planes.extend((data, i, True) for i in numpy.ndindex(*data.shape[:-3]))
             # TODO: handle RGB for C at any position before and after XY, but iif TZ=11
             # for data > 2D: write as a sequence of 2D images or RGB images
             elif data.ndim == 5 and data.shape[0] == 3:  # RGB
-                # Write an RGB image, instead of 3 images along C
-                write_rgb = True
-                hdim = data.shape[1:3]
-                # CTZYX -> TZCYX
-                data = numpy.moveaxis(data, 0, 2)  # move C axis near YX
+                # Write an RGB image (as CYX), instead of 3 images along C
+                planes.extend((data, (slice(None),) + i, True)
+                              for i in numpy.ndindex(*data.shape[1:3]))
             elif data.ndim == 5:
-                write_rgb = False
                 # CTZYX -> TZCYX  (for ImageJ compatible ordering)
-                data = numpy.moveaxis(data, 0, 2)
-                hdim = data.shape[:-2]
+                planes.extend((data, (c, t, z), False)
+                              for t, z, c in numpy.ndindex(*data.shape[1:3], data.shape[0]))
             else:  # YX
-                write_rgb = False
-                hdim = data.shape[:-2]
-
-            for i in numpy.ndindex(*hdim):
-                # Save metadata (before the image)
-                for key, val in tags.items():
-                    try:
-                        f.SetField(key, val)
-                    except Exception:
-                        logging.exception("Failed to store tag %s with value '%s'", key, val)
-                if data.dtype in [numpy.int64, numpy.uint64]:
-                    c = None  # libtiff doesn't support compression on these types
-                else:
-                    c = compression
-                write_image(f, data[i], write_rgb=write_rgb, compression=c, pyramid=pyramid)
+                planes.extend((data, i, False) for i in numpy.ndindex(*data.shape[:-2]))
 
         else:
             # len(das) > 1 => list of DataArrays to represent the C dimension
             # the shape of all das are same: 1TZYX, or ZYX, or TZYX
             # len(das) is to be used as C
-
-            write_rgb = False
             hdim = das[0].shape[:-2]  # 1TZ or TZ or Z
-
             for i in numpy.ndindex(*hdim):
                 for data in das:  # for ImageJ compatible ordering
-                    tags = _convertToTiffTag(data.metadata)
-                    # Save metadata (before the image)
-                    for key, val in tags.items():
-                        try:
-                            f.SetField(key, val)
-                        except Exception:
-                            logging.exception("Failed to store tag %s with value '%s'", key, val)
-                    if data.dtype in [numpy.int64, numpy.uint64]:
-                        c = None  # libtiff doesn't support compression on these types
-                    else:
-                        c = compression
-                    write_image(f, data[i], write_rgb=write_rgb, compression=c, pyramid=pyramid)
+                    planes.append((data, i, False))
+
+    # The planes are read (if the data is DataArrayShadows) in advance, in
+    # separate threads, while the previous planes are being written.
+    with ThreadPoolExecutor(max_workers=MAX_PREFETCH_PLANES) as executor:
+        for (data, i, write_rgb), plane in zip(planes, _readPlanes(planes, executor)):
+            tags = _convertToTiffTag(data.metadata)
+            # Save metadata (before the image)
+            for key, val in tags.items():
+                try:
+                    f.SetField(key, val)
+                except Exception:
+                    logging.exception("Failed to store tag %s with value '%s'", key, val)
+            if data.dtype in [numpy.int64, numpy.uint64]:
+                c = None  # libtiff doesn't support compression on these types
+            else:
+                c = compression
+            plane = model.DataArray(plane, _getPlaneMetadata(data, i))
+            write_image(f, plane, write_rgb=write_rgb, compression=c, pyramid=pyramid)
+
+
+def _getPlaneMetadata(data, index):
+    """
+    Compute the metadata of one plane of the data, so that it describes only the
+    dimensions of the plane.
+    data (DataArray or DataArrayShadow): the whole data
+    index (tuple of int, first one can be a slice): the position of the plane
+      along the high dimensions, as for _readPlane()
+    return (dict str->val): the metadata of the plane. MD_DIMS only contains the
+      dimensions of the plane, and MD_PIXEL_SIZE and MD_POS have no Z if the
+      plane has no Z dimension.
+    """
+    md = data.metadata.copy()
+    dims = md.get(model.MD_DIMS)
+    if dims is None or len(dims) != data.ndim:
+        dims = "CTZYX"[-data.ndim:]
+    # The dimensions selected by an int are removed
+    dims = "".join(d for n, d in enumerate(dims)
+                   if n >= len(index) or not isinstance(index[n], int))
+    md[model.MD_DIMS] = dims
+    if "Z" not in dims:
+        for k in (model.MD_PIXEL_SIZE, model.MD_POS):
+            if k in md and len(md[k]) > 2:
+                md[k] = md[k][:2]
+    return md
+
+
+def _readPlane(data, index):
+    """
+    Read one plane of the data
+    data (DataArray or DataArrayShadow): the whole data
+    index (tuple of int, first one can be a slice): the position of the plane
+      along the high dimensions. If the first element is a slice, all the
+      planes along that dimension are read.
+    return (numpy.ndarray): the plane
+    """
+    if isinstance(data, numpy.ndarray):
+        return data[index]
+    if not index:
+        return data.getData()
+    if isinstance(index[0], slice):
+        return numpy.stack([_readPlane(data, (c,) + index[1:])
+                            for c in range(data.shape[0])[index[0]]])
+
+    try:
+        plane = data[index]
+    except TypeError:  # This DataArrayShadow doesn't support partial reading
+        return data.getData()[index]
+    if isinstance(plane, DataArrayShadow):
+        plane = plane.getData()
+    return plane
+
+
+def _readPlanes(planes, executor):
+    """
+    Read planes, a few of them in advance
+    planes (list of (DataArray or DataArrayShadow, tuple, bool)): the data,
+      index of the plane, and whether it's RGB
+    executor (Executor): to run the reads
+    yield (numpy.ndarray): each plane, in order
+    """
+    # Limit the number of planes in memory, as each can be very large
+    pending = deque()
+    for data, i, _ in planes:
+        pending.append(executor.submit(_readPlane, data, i))
+        if len(pending) > MAX_PREFETCH_PLANES:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
 
 
 def extract_imagej_metadata(ldata) -> str:
@@ -2019,6 +2251,126 @@ def _genResizedShapes(data):
     return resized_shapes
 
 
+def _compress_tile(arr, x, y, predictor):
+    """
+    Extract one tile of an image, and compress it as a TIFF deflate tile
+    arr (numpy.ndarray of shape YX or YXC): the image (or one plane of it)
+    x, y (int): position of the top-left pixel of the tile
+    predictor (bool): if True, apply the horizontal differencing predictor
+    return (bytes): the compressed tile
+    """
+    # Tiles on the border are padded with 0's (in native byte order, as libtiff expects)
+    tile = numpy.zeros((TILE_SIZE, TILE_SIZE) + arr.shape[2:], dtype=arr.dtype.newbyteorder("="))
+    sub = arr[y:y + TILE_SIZE, x:x + TILE_SIZE]
+    tile[:sub.shape[0], :sub.shape[1]] = sub
+    if predictor:
+        # Difference with the previous pixel of the same sample, with wrap-around
+        tile[:, 1:] = tile[:, 1:] - tile[:, :-1]
+    return zlib.compress(tile.tobytes(), TILE_DEFLATE_LEVEL)
+
+
+def _write_tiles_parallel(f, arr, executor, write_rgb=False):
+    """
+    Write a tiled image, compressed with deflate. Compared to f.write_tiles(),
+    the tiles are compressed concurrently, and only written (in order) by the
+    calling thread.
+    f (libtiff file handle): Handle of a TIFF file
+    arr (numpy.ndarray of shape YX, YXC (RGB) or CYX (RGB)): image to write
+    executor (Executor): to run the compression of the tiles
+    write_rgb (boolean): True if the image is RGB
+    return (bool): True if the image was written, False if this type of image
+      is not supported (and nothing was written)
+    """
+    if arr.dtype.kind in "ui":
+        sample_format = T.SAMPLEFORMAT_UINT if arr.dtype.kind == "u" else T.SAMPLEFORMAT_INT
+        predictor = True
+    elif arr.dtype.kind == "f":
+        sample_format = T.SAMPLEFORMAT_IEEEFP
+        predictor = False
+    else:
+        return False
+
+    if arr.ndim == 2:
+        height, width = arr.shape
+        depth = 1
+        planes = [arr]
+    elif arr.ndim == 3 and write_rgb:
+        if arr.shape[2] in (3, 4):
+            height, width, depth = arr.shape
+            planes = [arr]
+        else:
+            depth, height, width = arr.shape
+            planes = [arr[i] for i in range(depth)]
+    else:
+        return False
+
+    f.SetField(T.TIFFTAG_COMPRESSION, T.COMPRESSION_ADOBE_DEFLATE)
+    if predictor:
+        f.SetField(T.TIFFTAG_PREDICTOR, T.PREDICTOR_HORIZONTAL)
+    f.SetField(T.TIFFTAG_BITSPERSAMPLE, arr.itemsize * 8)
+    f.SetField(T.TIFFTAG_SAMPLEFORMAT, sample_format)
+    f.SetField(T.TIFFTAG_ORIENTATION, T.ORIENTATION_TOPLEFT)
+    f.SetField(T.TIFFTAG_TILEWIDTH, TILE_SIZE)
+    f.SetField(T.TIFFTAG_TILELENGTH, TILE_SIZE)
+    f.SetField(T.TIFFTAG_IMAGEWIDTH, width)
+    f.SetField(T.TIFFTAG_IMAGELENGTH, height)
+    if arr.ndim == 2:
+        f.SetField(T.TIFFTAG_PHOTOMETRIC, T.PHOTOMETRIC_MINISBLACK)
+        f.SetField(T.TIFFTAG_PLANARCONFIG, T.PLANARCONFIG_CONTIG)
+    else:
+        f.SetField(T.TIFFTAG_PHOTOMETRIC, T.PHOTOMETRIC_RGB)
+        f.SetField(T.TIFFTAG_SAMPLESPERPIXEL, depth)
+        if len(planes) > 1:
+            f.SetField(T.TIFFTAG_PLANARCONFIG, T.PLANARCONFIG_SEPARATE)
+        else:
+            f.SetField(T.TIFFTAG_PLANARCONFIG, T.PLANARCONFIG_CONTIG)
+        if depth == 4:  # RGBA
+            f.SetField(T.TIFFTAG_EXTRASAMPLES, [T.EXTRASAMPLE_UNASSALPHA], count=1)
+        elif depth > 4:
+            f.SetField(T.TIFFTAG_EXTRASAMPLES, [T.EXTRASAMPLE_UNSPECIFIED] * (depth - 3),
+                       count=(depth - 3))
+
+    # The tiles are numbered row by row, and then plane by plane
+    def write_tile(index, future):
+        buf = future.result()
+        # The function returns a ctypes object (tmsize_t), not an int
+        r = T.libtiff.TIFFWriteRawTile(f, index, buf, len(buf))
+        if getattr(r, "value", r) == -1:
+            raise IOError("Failed to write tile %d of TIFF image" % (index,))
+
+    # Only keep a few tiles in memory (uncompressed or compressed), as the
+    # image can be very large.
+    max_pending = 4 * MAX_TILE_WORKERS
+    pending = deque()
+    index = 0
+    for p in planes:
+        for y in range(0, height, TILE_SIZE):
+            for x in range(0, width, TILE_SIZE):
+                pending.append((index, executor.submit(_compress_tile, p, x, y, predictor)))
+                index += 1
+                if len(pending) >= max_pending:
+                    write_tile(*pending.popleft())
+    while pending:
+        write_tile(*pending.popleft())
+
+    f.WriteDirectory()
+    return True
+
+
+def _write_tiles(f, arr, compression, write_rgb, executor):
+    """
+    Write a tiled image, using parallel compression when possible
+    f (libtiff file handle): Handle of a TIFF file
+    arr (DataArray): image to write
+    compression (None or str): compression type, as accepted by f.write_tiles()
+    write_rgb (boolean): True if the image is RGB
+    executor (Executor): to run the compression of the tiles
+    """
+    if compression is not None and _write_tiles_parallel(f, arr, executor, write_rgb):
+        return
+    f.write_tiles(arr, TILE_SIZE, TILE_SIZE, compression, write_rgb)
+
+
 def write_image(f, arr, compression=None, write_rgb=False, pyramid=False):
     """
     f (libtiff file handle): Handle of a TIFF file
@@ -2026,16 +2378,21 @@ def write_image(f, arr, compression=None, write_rgb=False, pyramid=False):
     compression (boolean): Compression type to be used on the TIFF file
     write_rgb (boolean): True if the image is RGB, False if the image is grayscale
     pyramid (boolean): whether the file should be saved in the pyramid format or not.
-      In this format, each image is saved along with different zoom levels
+      In this format, each image is saved along with different zoom levels.
+      If compressed, the tiles are compressed with deflate (instead of the
+      requested compression), using multiple threads.
     """
     # if not pyramid, just save the image in the TIFF file, and return
     if not pyramid:
         f.write_image(arr, compression=compression, write_rgb=write_rgb)
         return
 
-    # TODO: for pyramidal images, we should follow the OME-TIFF 6 format
+    # The zoom levels follow the OME-TIFF 6 sub-resolution layout:
     # https://docs.openmicroscopy.org/ome-model/6.0.1/ome-tiff/specification.html#sub-resolutions
-    # (It should be very similar to the current implementation)
+    # Each plane is a full resolution IFD, with its reduced images (halved in
+    # X & Y each time) stored in its SubIFDs, in decreasing size, and flagged as
+    # "reduced image". All planes have the same number of sub-resolutions, and
+    # they are all tiled.
 
     # generate the sizes of the zoom levels to be generated and saved
     resized_shapes = _genResizedShapes(arr)
@@ -2046,17 +2403,21 @@ def write_image(f, arr, compression=None, write_rgb=False, pyramid=False):
         # when this tag is present.
         f.SetField(T.TIFFTAG_SUBIFD, [0] * len(resized_shapes))
 
-    # write the original image
-    f.write_tiles(arr, TILE_SIZE, TILE_SIZE, compression, write_rgb)
-    # generate the rescaled images and write the tiled image
-    for resized_shape in resized_shapes:
-        # rescale the image
-        subim = img.rescale_hq(arr, resized_shape)
+    with ThreadPoolExecutor(max_workers=MAX_TILE_WORKERS) as executor:
+        # write the original image
+        _write_tiles(f, arr, compression, write_rgb, executor)
+        # generate the rescaled images and write the tiled image. Each zoom
+        # level is computed from the previous one (which is much smaller than
+        # the original image), and dropped as soon as the next one is computed.
+        subim = arr
+        for resized_shape in resized_shapes:
+            # rescale the image
+            subim = img.rescale_hq(subim, resized_shape)
 
-        # Before writting the actual data, we set the special metadata
-        f.SetField(T.TIFFTAG_SUBFILETYPE, T.FILETYPE_REDUCEDIMAGE)
-        # write the tiled image to the TIFF file
-        f.write_tiles(subim, TILE_SIZE, TILE_SIZE, compression, write_rgb)
+            # Before writting the actual data, we set the special metadata
+            f.SetField(T.TIFFTAG_SUBFILETYPE, T.FILETYPE_REDUCEDIMAGE)
+            # write the tiled image to the TIFF file
+            _write_tiles(f, subim, compression, write_rgb, executor)
 
 
 def export(filename, data, thumbnail=None, compressed=True, multiple_files=False, pyramid=False):
@@ -2069,6 +2430,8 @@ def export(filename, data, thumbnail=None, compressed=True, multiple_files=False
        Time, Z, Y, X. However, all the first dimensions of size 1 can be omitted
        (ex: an array of 111YX can be given just as YX, but RGB images are 311YX,
        so must always be 5 dimensions).
+       DataArrayShadows are also accepted, in which case the data is read
+       plane by plane, while writing, so that it doesn't need to fit in memory.
     thumbnail (None or numpy.array): Image used as thumbnail
       for the file. Can be of any (reasonable) size. Must be either 2D array
       (greyscale) or 3D with last dimension of length 3 (RGB). If the exporter
@@ -2153,11 +2516,14 @@ class DataArrayShadowTIFF(DataArrayShadow):
         depending if the image is pyramidal or not.
         """
         if isinstance(tiff_info, list):
-            tiff_handle = tiff_info[0]['handle']
+            tiff_info0 = tiff_info[0]
         else:
-            tiff_handle = tiff_info['handle']
-        num_tcols = tiff_handle.GetField(T.TIFFTAG_TILEWIDTH)
-        num_trows = tiff_handle.GetField(T.TIFFTAG_TILELENGTH)
+            tiff_info0 = tiff_info
+        tiff_handle = tiff_info0['handle']
+        with tiff_info0['lock']:
+            tiff_handle.SetDirectory(tiff_info0['dir_index'])
+            num_tcols = tiff_handle.GetField(T.TIFFTAG_TILEWIDTH)
+            num_trows = tiff_handle.GetField(T.TIFFTAG_TILELENGTH)
         if num_tcols and num_trows:
             subcls = DataArrayShadowPyramidalTIFF
         else:
@@ -2195,6 +2561,55 @@ class DataArrayShadowTIFF(DataArrayShadow):
             image = self._readImage(self.tiff_info)
             return model.DataArray(image, metadata=self.metadata.copy())
 
+    def __getitem__(self, key):
+        """
+        Selects part of the data. When only selecting whole planes of the
+        higher dimensions (ie, one IFD per plane), a DataArrayShadow on these
+        planes is returned, so that the (pixel) data is still only read when needed.
+        Otherwise, the whole data is read, and the selection is returned.
+        key (int, slice, or tuple of int and slice): same as for indexing a numpy array
+        return (DataArrayShadow or DataArray): the selected part of the data
+        """
+        if not isinstance(key, tuple):
+            key = (key,)
+
+        # Split the key into the integer indices at the beginning (on the
+        # higher dimensions), and the rest, which must select everything.
+        nhdim = 0
+        if isinstance(self.tiff_info, list):
+            nhdim = len(self.tiff_info[0]['hdim_index'])
+        idx = []
+        whole = False  # True once a whole dimension is selected
+        for k in key:
+            if isinstance(k, (int, numpy.integer)) and len(idx) < nhdim and not whole:
+                idx.append(int(k))
+            elif isinstance(k, slice) and k == slice(None):
+                whole = True
+            else:
+                return self.getData()[key]
+
+        idx = tuple(i + s if i < 0 else i for i, s in zip(idx, self.shape))
+        if not idx:
+            return self
+        if not all(0 <= i < s for i, s in zip(idx, self.shape)):
+            raise IndexError("Index %s out of bounds for shape %s" % (key, self.shape))
+
+        # Keep only the planes selected, with their index relative to the selection
+        tiff_info = []
+        for ti in self.tiff_info:
+            if ti['hdim_index'][:len(idx)] == idx:
+                ti = dict(ti)
+                ti['hdim_index'] = ti['hdim_index'][len(idx):]
+                tiff_info.append(ti)
+        if len(tiff_info) == 1:
+            tiff_info = tiff_info[0]
+            del tiff_info['hdim_index']
+
+        md = self.metadata.copy()
+        if model.MD_DIMS in md:
+            md[model.MD_DIMS] = md[model.MD_DIMS][len(idx):]
+        return DataArrayShadowTIFF(tiff_info, self.shape[len(idx):], self.dtype, md)
+
     def _readImage(self, tiff_info):
         """
         Reads the image of a given directory
@@ -2207,7 +2622,10 @@ class DataArrayShadowTIFF(DataArrayShadow):
         """
         with tiff_info['lock']:
             tiff_info['handle'].SetDirectory(tiff_info['dir_index'])
-            image = tiff_info['handle'].read_image()
+            # If possible, directly read the data from the file, without libtiff
+            image = _readRawImage(tiff_info['handle'])
+            if image is None:
+                image = tiff_info['handle'].read_image()
         return image
 
     def _readAndMergeImages(self):
@@ -2254,15 +2672,15 @@ class DataArrayShadowPyramidalTIFF(DataArrayShadowTIFF):
             tiff_info0 = tiff_info
         tiff_file = tiff_info0['handle']
 
-        num_tcols = tiff_file.GetField(T.TIFFTAG_TILEWIDTH)
-        num_trows = tiff_file.GetField(T.TIFFTAG_TILELENGTH)
-        if num_tcols is None or num_trows is None:
-            raise ValueError("The image is not tiled")
-
         with tiff_info0['lock']:
             tiff_file.SetDirectory(tiff_info0['dir_index'])
+            num_tcols = tiff_file.GetField(T.TIFFTAG_TILEWIDTH)
+            num_trows = tiff_file.GetField(T.TIFFTAG_TILELENGTH)
             sub_ifds = tiff_file.GetField(T.TIFFTAG_SUBIFD)
 
+        if num_tcols is None or num_trows is None:
+            raise ValueError("The image is not tiled")
+
         # add the number of subdirectories, and the main image
         if sub_ifds:
             maxzoom = len(sub_ifds)
@@ -2281,43 +2699,93 @@ class DataArrayShadowPyramidalTIFF(DataArrayShadowTIFF):
         zoom (0<=int): zoom level to use. The total shape of the image is shape / 2**zoom.
             The number of tiles available in an image is ceil((shape//zoom)/tile_shape)
         return (DataArray): the shape of the DataArray is typically of shape
+          tile_shape (or smaller on the borders). If the data has multiple
+          pixelData (eg, a Z stack), the tile contains all of them, so its shape
+          is the higher dimensions of the data + the tile shape.
         '''
         # get information about how to retrieve the actual pixels from the TIFF file
         tiff_info = self.tiff_info
         if isinstance(tiff_info, list):
-            # TODO Implement the reading of the subdata when tiff_info is a list.
-            # It is the case when the DataArray has multiple pixelData (eg, when data has more than 2D).
-            raise NotImplementedError("DataArray has multiple pixelData")
+            # Read the same tile in each pixelData, and merge them like getData()
+            tile = None
+            for tiff_info_item in tiff_info:
+                plane = self._readTile(tiff_info_item, x, y, zoom)
+                if tile is None:
+                    hdim = self.shape[:len(tiff_info_item['hdim_index'])]
+                    tile = numpy.empty(hdim + plane.shape, dtype=plane.dtype)
+                tile[tiff_info_item['hdim_index']] = plane
+        else:
+            tile = self._readTile(tiff_info, x, y, zoom)
 
-        with tiff_info['lock']:
-            tiff_file = tiff_info['handle']
-            tiff_file.SetDirectory(tiff_info['dir_index'])
+        orig_pixel_size = self.metadata.get(model.MD_PIXEL_SIZE, (1, 1))
+        # calculate the pixel size of the tile for the zoom level (only X and Y are reduced)
+        tile_pixel_size = (tuple(ps * 2 ** zoom for ps in orig_pixel_size[:2]) +
+                           tuple(orig_pixel_size[2:]))
 
-            if zoom != 0:
-                # get an array of offsets, one for each subimage
-                sub_ifds = tiff_file.GetField(T.TIFFTAG_SUBIFD)
-                if not sub_ifds:
-                    raise ValueError("Image does not have zoom levels")
+        tile = model.DataArray(tile, self.metadata.copy())
+        tile.metadata[model.MD_PIXEL_SIZE] = tile_pixel_size
+        # calculate the center of the tile
+        tile.metadata[model.MD_POS] = get_tile_md_pos((x, y), self.tile_shape, tile, self)
 
-                if not (0 <= zoom <= len(sub_ifds)):
-                    raise ValueError("Invalid Z value %d" % (zoom,))
+        return tile
 
-                # set the offset of the subimage. Z=0 is the main image
-                tiff_file.SetSubDirectory(sub_ifds[zoom - 1])
+    def _readTile(self, tiff_info, x, y, zoom):
+        """
+        Reads one tile of a given directory. The zoom levels are read from the
+        SubIFDs of the directory, as in the OME-TIFF 6 sub-resolution layout.
+        tiff_info (dictionary): Information about the source tiff file and directory from which
+            the tile should be read. (cf _readImage())
+        x (0<=int): X index of the tile.
+        y (0<=int): Y index of the tile
+        zoom (0<=int): zoom level to use.
+        return (numpy.array): The tile
+        """
+        thread_handles = tiff_info.get('thread_handles')
+        if thread_handles is None:
+            # Only one handle on the file => all the threads have to share it
+            with tiff_info['lock']:
+                return self._readTileFromHandle(tiff_info['handle'], tiff_info['dir_index'], x, y, zoom)
+
+        # Each thread has its own handle on the file, so the tiles can be read
+        # in parallel, without lock.
+        try:
+            tiff_file = thread_handles.handle
+        except AttributeError:
+            with tiff_info['lock']:
+                filename = tiff_info['handle'].FileName()
+            tiff_file = TIFF.open(filename, mode='r')
+            thread_handles.handle = tiff_file
+        return self._readTileFromHandle(tiff_file, tiff_info['dir_index'], x, y, zoom)
+
+    def _readTileFromHandle(self, tiff_file, dir_index, x, y, zoom):
+        """
+        Reads one tile, using the given handle. The caller must ensure the handle
+          is not used concurrently.
+        tiff_file (tiff handle): Handle of the tiff file
+        dir_index (int): Index of the directory of the (full resolution) image
+        x (0<=int): X index of the tile.
+        y (0<=int): Y index of the tile
+        zoom (0<=int): zoom level to use.
+        return (numpy.array): The tile
+        """
+        tiff_file.SetDirectory(dir_index)
+        if zoom != 0:
+            # get an array of offsets, one for each subimage
+            sub_ifds = tiff_file.GetField(T.TIFFTAG_SUBIFD)
+            if not sub_ifds:
+                raise ValueError("Image does not have zoom levels")
 
-            orig_pixel_size = self.metadata.get(model.MD_PIXEL_SIZE, (1, 1))
+            if not (0 <= zoom <= len(sub_ifds)):
+                raise ValueError("Invalid Z value %d" % (zoom,))
 
-            # calculate the pixel size of the tile for the zoom level
-            tile_pixel_size = tuple(ps * 2 ** zoom for ps in orig_pixel_size)
+            # set the offset of the subimage. Z=0 is the main image
+            tiff_file.SetSubDirectory(sub_ifds[zoom - 1])
 
-            xp = x * self.tile_shape[0]
-            yp = y * self.tile_shape[1]
+        xp = x * self.tile_shape[0]
+        yp = y * self.tile_shape[1]
+        tile = _readRawTile(tiff_file, xp, yp)
+        if tile is None:
             tile = tiff_file.read_one_tile(xp, yp)
-            tile = model.DataArray(tile, self.metadata.copy())
-            tile.metadata[model.MD_PIXEL_SIZE] = tile_pixel_size
-            # calculate the center of the tile
-            tile.metadata[model.MD_POS] = get_tile_md_pos((x, y), self.tile_shape, tile, self)
-
         return tile
 
 
@@ -2363,9 +2831,11 @@ class AcquisitionDataTIFF(AcquisitionData):
         """
         data = []
         thumbnails = []
+        # Handles on the same file, for reading tiles concurrently from different threads
+        thread_handles = threading.local()
         # iterates all the directories of the TIFF file
         for dir_index in self._iterDirectories(tfile):
-            das, is_thumb = self._createDataArrayShadows(tfile, dir_index, lock)
+            das, is_thumb = self._createDataArrayShadows(tfile, dir_index, lock, thread_handles)
             if is_thumb:
                 data.append(None)
                 thumbnails.append(das)
@@ -2543,12 +3013,14 @@ class AcquisitionDataTIFF(AcquisitionData):
         raise LookupError("No OME XML data found")
 
     @staticmethod
-    def _createDataArrayShadows(tfile, dir_index, lock):
+    def _createDataArrayShadows(tfile, dir_index, lock, thread_handles=None):
         """
         Create the DataArrayShadow from the TIFF metadata for the current directory
         tfile (tiff handle): Handle for the TIFF file
         dir_index (int): Index of the directory in the TIFF file
         lock (threading.Lock): The lock that controls the access to the TIFF file
+        thread_handles (None or threading.local): where to store the handles
+          on the same file, specific to each thread, to read the tiles
         return:
             das (DataArrayShadows): DataArrayShadows representing the image
             is_thumbnail (bool): True if the image is a thumbnail
@@ -2577,6 +3049,8 @@ class AcquisitionDataTIFF(AcquisitionData):
         # in case the DataArray has multiple pixelData (eg, when data has more than 2D).
         # Add also the lock of the TIFF file
         tiff_info = {'handle': tfile, 'dir_index': dir_index, 'lock': lock}
+        if thread_handles is not None:
+            tiff_info['thread_handles'] = thread_handles
         das = DataArrayShadowTIFF(tiff_info, shape, typ, md)
 
         return das, _isThumbnail(tfile)
@@ -2716,8 +3190,6 @@ class AcquisitionDataTIFF(AcquisitionData):
         if len(tiff_info_list) == 1:
             # Optimisation: if there is actually only one (because it's split
             # over C), make it a simple DAS.
-            # That's especially useful for now, as Pyramidal DAS don't support
-            # high dimensions yet.
             tiff_info_list = tiff_info_list[0]
             del tiff_info_list['hdim_index']
             tshape = fim.shape
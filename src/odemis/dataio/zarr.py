@@ -0,0 +1,770 @@
+# -*- coding: utf-8 -*-
+"""
+Created on 17 Oct 2026
+
+Copyright © 2026 Delmic
+
+This file is part of Odemis.
+
+Odemis is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License version 2 as published by the Free Software
+Foundation.
+
+Odemis is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+Odemis. If not, see http://www.gnu.org/licenses/.
+"""
+
+# Chunked directory store, following the Zarr v2 layout, so that the files can
+# also be read by the standard Zarr libraries. Each chunk is a separate
+# (compressed) file, so different parts of an image can be written
+# concurrently, from different threads, and read back independently.
+#
+# The layout of an acquisition is:
+#  + name.zarr/
+#    . .zgroup, .zattrs     # list of the images and thumbnails
+#    + image0/              # one group per image
+#      . .zgroup, .zattrs   # OME-NGFF "multiscales" description + Odemis metadata
+#      + 0/                 # full resolution array
+#        . .zarray          # shape, chunks, dtype, compressor
+#        . 0.0.0 ...        # the chunks, named after their index
+#      + 1/ ...             # (optional) lower resolution levels, halved in X & Y
+#    + thumbnail0/ ...      # same as images, without lower resolution levels
+#
+# The images keep their own shape and dimensions (as MD_DIMS). Y and X must be
+# the last dimensions, possibly followed by C (for RGB images). The chunks are
+# TILE_SIZE x TILE_SIZE along Y & X, and contain a single plane of the other
+# dimensions (apart from C in RGB images).
+
+from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict
+import itertools
+import json
+import math
+import numpy
+import os
+import shutil
+import threading
+import zlib
+
+from odemis import model
+from odemis.dataio._peek import encode_metadata, decode_metadata
+from odemis.util import img
+from odemis.util.conversion import get_tile_md_pos
+
+try:
+    import lz4.block
+except ImportError:
+    lz4 = None
+
+FORMAT = "Zarr"
+# list of file-name extensions possible, the first one is the default when saving a file
+EXTENSIONS = [u".zarr"]
+LOSSY = False
+CAN_SAVE_PYRAMID = True
+
+TILE_SIZE = 256  # Size of the chunks along X & Y, which are also the tiles of the pyramid
+ZLIB_LEVEL = 1  # Fastest, and still compresses well typical images
+MAX_CHUNK_WORKERS = os.cpu_count() or 1
+ODEMIS_ATTRS_VERSION = 1
+
+
+def _write_json(fn, obj):
+    with open(fn, "w") as f:
+        json.dump(obj, f, indent=1)
+
+
+def _read_json(fn):
+    with open(fn, "r") as f:
+        return json.load(f)
+
+
+def _get_compressor(compressed):
+    """
+    compressed (bool): whether the data should be compressed
+    return (None or dict): Zarr description of the compressor
+    """
+    if not compressed:
+        return None
+    # LZ4 is much faster, but not always available
+    if lz4 is not None:
+        return {"id": "lz4", "acceleration": 1}
+    return {"id": "zlib", "level": ZLIB_LEVEL}
+
+
+def _get_chunks(shape, dims):
+    """
+    Find the shape of the chunks of an image
+    shape (tuple of int): shape of the image
+    dims (str): dimensions of the image, as in MD_DIMS
+    return (tuple of int): shape of the chunks
+    raise ValueError: if the dimensions are not supported
+    """
+    if len(dims) != len(shape):
+        raise ValueError("Dimensions %s don't match shape %s" % (dims, shape))
+    if dims.endswith("YXC"):
+        return (1,) * (len(shape) - 3) + (TILE_SIZE, TILE_SIZE, shape[-1])
+    elif dims.endswith("YX"):
+        return (1,) * (len(shape) - 2) + (TILE_SIZE, TILE_SIZE)
+    else:
+        raise ValueError("Dimensions %s not supported, they must end with YX or YXC" % (dims,))
+
+
+class ChunkedArray(object):
+    """
+    An N-dimensional array stored in a directory, as one file per chunk.
+    The chunks can be written concurrently from multiple threads (but not from
+    multiple processes).
+    """
+
+    def __init__(self, path, shape=None, dtype=None, chunks=None, compressor=None):
+        """
+        path (str): directory of the array
+        shape (None or tuple of int): shape of the array, to create a new array.
+          If None, an existing array is opened, and the other arguments are ignored.
+        dtype (numpy.dtype): type of the data
+        chunks (tuple of int): shape of each chunk
+        compressor (None or dict): compressor of the chunks, as returned by
+          _get_compressor()
+        raise IOError: if the array cannot be opened
+        """
+        self.path = path
+        if shape is None:
+            zarray = _read_json(os.path.join(path, ".zarray"))
+            if zarray.get("zarr_format") != 2 or zarray.get("order", "C") != "C" or zarray.get("filters"):
+                raise IOError("Unsupported array format in %s" % (path,))
+            shape = zarray["shape"]
+            dtype = zarray["dtype"]
+            chunks = zarray["chunks"]
+            compressor = zarray["compressor"]
+            self._sep = zarray.get("dimension_separator", ".")
+            fill_value = zarray.get("fill_value") or 0
+        else:
+            self._sep = "."
+            fill_value = 0
+            os.makedirs(path)
+            _write_json(os.path.join(path, ".zarray"), {
+                "zarr_format": 2,
+                "shape": list(shape),
+                "chunks": list(chunks),
+                "dtype": numpy.dtype(dtype).str,
+                "compressor": compressor,
+                "fill_value": fill_value,
+                "order": "C",
+                "filters": None,
+                "dimension_separator": self._sep,
+            })
+
+        self.shape = tuple(shape)
+        self.ndim = len(self.shape)
+        self.dtype = numpy.dtype(dtype)
+        self.chunks = tuple(chunks)
+        self._fill_value = fill_value
+        self._compressor = compressor
+        if compressor is not None and compressor["id"] not in ("zlib", "lz4"):
+            raise IOError("Unsupported compressor %s in %s" % (compressor["id"], path))
+        if compressor is not None and compressor["id"] == "lz4" and lz4 is None:
+            raise IOError("Python lz4 module needed to read %s" % (path,))
+
+        # One lock per chunk, to avoid partially writing the same chunk concurrently
+        self._chunk_locks = defaultdict(threading.Lock)
+        self._locks_lock = threading.Lock()
+
+    @property
+    def nchunks(self):
+        """
+        (tuple of int): number of chunks along each dimension
+        """
+        return tuple(int(math.ceil(s / c)) for s, c in zip(self.shape, self.chunks))
+
+    def _chunk_filename(self, idx):
+        return os.path.join(self.path, self._sep.join(str(i) for i in idx))
+
+    def _encode(self, chunk):
+        # The data is stored with the byte order declared in .zarray
+        buf = numpy.ascontiguousarray(chunk, dtype=self.dtype).tobytes()
+        if self._compressor is None:
+            return buf
+        elif self._compressor["id"] == "lz4":
+            # Same format as numcodecs: uncompressed size (int32 LE) + LZ4 block
+            return lz4.block.compress(buf, acceleration=self._compressor.get("acceleration", 1),
+                                      store_size=True)
+        else:
+            return zlib.compress(buf, self._compressor.get("level", ZLIB_LEVEL))
+
+    def _decode(self, buf):
+        if self._compressor is None:
+            pass
+        elif self._compressor["id"] == "lz4":
+            buf = lz4.block.decompress(buf)
+        else:
+            buf = zlib.decompress(buf)
+        return numpy.frombuffer(buf, dtype=self.dtype).reshape(self.chunks)
+
+    def read_chunk(self, idx):
+        """
+        Read one chunk
+        idx (tuple of int): index of the chunk
+        return (numpy.ndarray of shape .chunks): the chunk. The parts outside of
+          the array are undefined. It's read-only.
+        """
+        try:
+            with open(self._chunk_filename(idx), "rb") as f:
+                buf = f.read()
+        except FileNotFoundError:
+            # Never written
+            return numpy.full(self.chunks, self._fill_value, dtype=self.dtype)
+        return self._decode(buf)
+
+    def write_chunk(self, idx, chunk):
+        """
+        Write one chunk
+        idx (tuple of int): index of the chunk
+        chunk (numpy.ndarray): the data. It can be smaller than .chunks (on the
+          borders of the array), in which case it's padded.
+        """
+        if chunk.shape != self.chunks:
+            full = numpy.full(self.chunks, self._fill_value, dtype=self.dtype)
+            full[tuple(slice(0, s) for s in chunk.shape)] = chunk
+            chunk = full
+        buf = self._encode(chunk)
+        fn = self._chunk_filename(idx)
+        # Atomic replacement, so that the chunk can be read at any time
+        tmpfn = "%s.%d.tmp" % (fn, threading.get_ident())
+        with open(tmpfn, "wb") as f:
+            f.write(buf)
+        os.replace(tmpfn, fn)
+
+    def _normalize_key(self, key):
+        """
+        Convert a key (as for numpy) to a range for each dimension
+        return (list of (int, int)), (list of bool): the range (start, stop)
+          along each dimension, and whether the dimension is kept in the result
+        """
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) > self.ndim or any(k is Ellipsis for k in key):
+            raise IndexError("Unsupported index %s" % (key,))
+        key += (slice(None),) * (self.ndim - len(key))
+
+        ranges, keep = [], []
+        for k, s in zip(key, self.shape):
+            if isinstance(k, slice):
+                start, stop, step = k.indices(s)
+                if step != 1:
+                    raise IndexError("Only slices with step 1 are supported, got %s" % (k,))
+                ranges.append((start, max(start, stop)))
+                keep.append(True)
+            else:
+                k = int(k)
+                if k < 0:
+                    k += s
+                if not 0 <= k < s:
+                    raise IndexError("Index %d out of range for dimension of size %d" % (k, s))
+                ranges.append((k, k + 1))
+                keep.append(False)
+        return ranges, keep
+
+    def _iter_chunks(self, ranges):
+        """
+        Iterate over the chunks containing a region
+        ranges (list of (int, int)): the region
+        yield (tuple of int), (tuple of slice), (tuple of slice): index of the
+          chunk, the part of the chunk in the region, and the position of
+          this part in the region.
+        """
+        cranges = [range(start // c, (stop + c - 1) // c) for (start, stop), c in zip(ranges, self.chunks)]
+        for idx in itertools.product(*cranges):
+            in_chunk, in_region = [], []
+            for i, (start, stop), c in zip(idx, ranges, self.chunks):
+                cstart = max(start, i * c)
+                cstop = min(stop, (i + 1) * c)
+                in_chunk.append(slice(cstart - i * c, cstop - i * c))
+                in_region.append(slice(cstart - start, cstop - start))
+            yield idx, tuple(in_chunk), tuple(in_region)
+
+    def __getitem__(self, key):
+        """
+        Read part of the array, reading only the chunks needed.
+        key (int, slice, or tuple of int and slice): same as for indexing a
+          numpy array (but slices must have a step of 1)
+        return (numpy.ndarray)
+        """
+        ranges, keep = self._normalize_key(key)
+        out = numpy.empty([stop - start for start, stop in ranges], dtype=self.dtype)
+        for idx, in_chunk, in_region in self._iter_chunks(ranges):
+            out[in_region] = self.read_chunk(idx)[in_chunk]
+        return out.reshape([s for s, k in zip(out.shape, keep) if k])
+
+    def write(self, block, offset, executor=None):
+        """
+        Write a block of data (eg, a tile), at any position. The chunks only
+        partially covered are merged with the data already written.
+        It's fine to call it concurrently from multiple threads.
+        block (numpy.ndarray): data to write, with the same number of dimensions
+          as the array
+        offset (tuple of int): position in the array of the first element of the block
+        executor (None or Executor): if provided, used to write the chunks in parallel
+        raise ValueError: if the block doesn't fit in the array
+        """
+        if block.ndim != self.ndim or len(offset) != self.ndim:
+            raise ValueError("Block of shape %s at %s doesn't match the array of shape %s" %
+                             (block.shape, offset, self.shape))
+        if any(o < 0 or o + b > s for o, b, s in zip(offset, block.shape, self.shape)):
+            raise ValueError("Block of shape %s at %s doesn't fit in the array of shape %s" %
+                             (block.shape, offset, self.shape))
+
+        ranges = [(o, o + b) for o, b in zip(offset, block.shape)]
+        chunks = list(self._iter_chunks(ranges))
+        if executor is not None and len(chunks) > 1:
+            fs = [executor.submit(self._write_part, block, *c) for c in chunks]
+            for f in fs:
+                f.result()
+        else:
+            for c in chunks:
+                self._write_part(block, *c)
+
+    def _write_part(self, block, idx, in_chunk, in_region):
+        """
+        Write part of a block into a chunk
+        """
+        # The part of the chunk which is inside the array
+        valid = tuple(slice(0, min(c, s - i * c)) for i, c, s in zip(idx, self.chunks, self.shape))
+        full = all(ic.start == 0 and ic.stop == v.stop for ic, v in zip(in_chunk, valid))
+
+        # Even a full chunk must wait for the partial writes of the same chunk
+        # to be over, otherwise they'd overwrite it with the old data.
+        with self._locks_lock:
+            lock = self._chunk_locks[idx]
+        with lock:
+            if full:
+                self.write_chunk(idx, block[in_region])
+            else:
+                chunk = self.read_chunk(idx).copy()
+                chunk[in_chunk] = block[in_region]
+                self.write_chunk(idx, chunk)
+
+
+def _get_level_shapes(shape, dims):
+    """
+    Compute the shape of each level of the pyramid of an image. The levels are
+    halved along X & Y, as long as the previous level is at least a tile.
+    shape (tuple of int): shape of the image at full resolution
+    dims (str): dimensions of the image
+    return (list of tuple of int): shape of each level, starting with the full
+      resolution
+    """
+    iy, ix = dims.index("Y"), dims.index("X")
+    shapes = [tuple(shape)]
+    while shapes[-1][iy] >= TILE_SIZE and shapes[-1][ix] >= TILE_SIZE:
+        z = len(shapes)
+        shapes.append(tuple(s // 2 ** z if d in "XY" else s for s, d in zip(shape, dims)))
+    return shapes
+
+
+class StreamedImage(object):
+    """
+    Image written progressively to a Zarr store, see AcquisitionWriter.create_image().
+    The data can be written block by block (eg, tile by tile), in any order,
+    and concurrently from multiple threads. The parts of the image never
+    written are 0.
+    The metadata can be updated until the image is finalised.
+    """
+
+    def __init__(self, path, shape, dtype, metadata, compressor=None, pyramid=False, executor=None):
+        """
+        path (str): directory of the image group (must not exist)
+        shape (tuple of int): shape of the image
+        dtype (numpy.dtype): type of the data
+        metadata (dict): metadata of the image. MD_DIMS indicates the dimensions,
+          which must end with YX or YXC.
+        compressor (None or dict): compressor of the chunks
+        pyramid (bool): whether to also save lower resolution levels of the image
+        executor (None or Executor): to write the chunks in parallel
+        raise ValueError: if the dimensions are not supported
+        """
+        self.metadata = metadata
+        self._dims = metadata.get(model.MD_DIMS, "CTZYX"[-len(shape):])
+        chunks = _get_chunks(shape, self._dims)
+
+        self._path = path
+        os.makedirs(path)
+        _write_json(os.path.join(path, ".zgroup"), {"zarr_format": 2})
+        self._array = ChunkedArray(os.path.join(path, "0"), shape, dtype, chunks, compressor)
+        self._compressor = compressor
+        self._pyramid = pyramid
+        self._executor = executor
+        self.finalized = False
+
+    @property
+    def shape(self):
+        return self._array.shape
+
+    @property
+    def dtype(self):
+        return self._array.dtype
+
+    def write(self, block, offset):
+        """
+        Write a block of data (eg, a tile), at any position.
+        block (numpy.ndarray): data to write, with the same dimensions as the image
+        offset (tuple of int): position in the image of the first element of the block
+        """
+        if self.finalized:
+            raise IOError("Image already finalised")
+        self._array.write(numpy.asarray(block), offset, self._executor)
+
+    def __setitem__(self, key, block):
+        """
+        Write data, with the same indexing as numpy arrays, limited to integers
+        and slices with step 1 (eg, im[0, y:y + 256, x:x + 256] = tile).
+        """
+        ranges, keep = self._array._normalize_key(key)
+        shape = [stop - start for start, stop in ranges]
+        block = numpy.broadcast_to(block, [s for s, k in zip(shape, keep) if k]).reshape(shape)
+        self.write(block, [start for start, stop in ranges])
+
+    def _write_level_chunk(self, src, dst, idx):
+        """
+        Compute one chunk of a lower resolution level, from the previous level
+        src (ChunkedArray): the previous level
+        dst (ChunkedArray): the level to compute
+        idx (tuple of int): index of the chunk in dst
+        """
+        iy, ix = self._dims.index("Y"), self._dims.index("X")
+        key = []
+        for d, (i, c, s) in enumerate(zip(idx, dst.chunks, dst.shape)):
+            if d in (iy, ix):
+                # Twice the size, from the previous level
+                key.append(slice(2 * i * c, 2 * min((i + 1) * c, s)))
+            elif d < iy:  # One plane
+                key.append(i)
+            else:  # C of RGB image
+                key.append(slice(None))
+        # The region is YX or YXC
+        chunk = img.halveImage(src[tuple(key)])
+        dst.write_chunk(idx, chunk.reshape((1,) * iy + chunk.shape))
+
+    def _write_levels(self):
+        """
+        Compute and write the lower resolution levels of the pyramid
+        return (int): the number of levels written
+        """
+        shapes = _get_level_shapes(self.shape, self._dims)
+        src = self._array
+        for z, shape in enumerate(shapes[1:], 1):
+            dst = ChunkedArray(os.path.join(self._path, "%d" % z), shape, self.dtype,
+                               self._array.chunks, self._compressor)
+            idxs = list(itertools.product(*(range(n) for n in dst.nchunks)))
+            if self._executor is not None:
+                fs = [self._executor.submit(self._write_level_chunk, src, dst, idx) for idx in idxs]
+                for f in fs:
+                    f.result()
+            else:
+                for idx in idxs:
+                    self._write_level_chunk(src, dst, idx)
+            src = dst
+        return len(shapes) - 1
+
+    def finalize(self):
+        """
+        Compute the pyramid (if requested), and store the metadata. Afterwards,
+        no more data can be written.
+        It's fine to call it multiple times.
+        """
+        if self.finalized:
+            return
+
+        nlevels = self._write_levels() if self._pyramid else 0
+
+        md = self.metadata.copy()
+        img.mergeMetadata(md)
+        md[model.MD_DIMS] = self._dims
+        # OME-NGFF description, for compatibility with other software
+        axes = [{"name": d.lower(), "type": "space" if d in "XYZ" else ("time" if d == "T" else "channel")}
+                for d in self._dims]
+        datasets = [{"path": "%d" % z,
+                     "coordinateTransformations": [{"type": "scale",
+                                                    "scale": [2 ** z if d in "XY" else 1 for d in self._dims]}]}
+                    for z in range(nlevels + 1)]
+        _write_json(os.path.join(self._path, ".zattrs"), {
+            "multiscales": [{"version": "0.4", "axes": axes, "datasets": datasets}],
+            "odemis": {"version": ODEMIS_ATTRS_VERSION, "metadata": encode_metadata(md)},
+        })
+        self.finalized = True
+
+
+class AcquisitionWriter(object):
+    """
+    Writes a Zarr store incrementally, one image after another, or several
+    images at the same time, tile by tile (eg, while acquiring them).
+    Can be used as a context manager, which closes the store at the end.
+    """
+
+    def __init__(self, filename, thumbnail=None, compressed=True, pyramid=False):
+        """
+        filename (str): name of the directory to create. If it exists, it's
+          overwritten, but only if it's empty or a Zarr store.
+        thumbnail (None or DataArray): see export()
+        compressed (boolean): whether the data is compressed
+        pyramid (boolean): whether the images are saved with lower resolution levels
+        raise IOError: if filename is an existing directory which is not a Zarr store
+        """
+        if os.path.isdir(filename):
+            if os.path.exists(os.path.join(filename, ".zgroup")):
+                shutil.rmtree(filename)
+            elif os.listdir(filename):
+                # Don't delete a directory which might be anything (eg, the home directory)
+                raise IOError("%s is a directory which is not a Zarr store, refusing to overwrite it" %
+                              (filename,))
+        elif os.path.exists(filename):
+            os.remove(filename)
+        os.makedirs(filename, exist_ok=True)
+        # Mark it as a Zarr store straight away, so that it can be overwritten
+        # even if the writer is not closed properly.
+        _write_json(os.path.join(filename, ".zgroup"), {"zarr_format": 2})
+        self._filename = filename
+        self._compressor = _get_compressor(compressed)
+        self._pyramid = pyramid
+        self._executor = ThreadPoolExecutor(max_workers=MAX_CHUNK_WORKERS)
+        self._images = []  # StreamedImages created
+        self._thumbnails = []
+        self._lock = threading.Lock()
+
+        if thumbnail is not None:
+            md = thumbnail.metadata.copy()
+            if model.MD_DIMS not in md:
+                md[model.MD_DIMS] = "YXC" if thumbnail.ndim == 3 else "YX"
+            im = StreamedImage(os.path.join(filename, "thumbnail0"), thumbnail.shape, thumbnail.dtype,
+                               md, self._compressor, executor=self._executor)
+            im.write(thumbnail, (0,) * thumbnail.ndim)
+            im.finalize()
+            self._thumbnails.append("thumbnail0")
+
+    def create_image(self, shape, dtype, metadata):
+        """
+        Add a new image, to be written progressively.
+        shape (tuple of int): shape of the image. It must have at least 2 dimensions.
+        dtype (numpy.dtype): type of the data
+        metadata (dict): metadata of the image. It can be updated up to the
+          moment the image is finalised.
+        return (StreamedImage): the image to write to. It's finalised, at the
+          latest, when the writer is closed.
+        raise ValueError: if the dimensions don't end with YX or YXC
+        """
+        with self._lock:
+            name = "image%d" % len(self._images)
+            im = StreamedImage(os.path.join(self._filename, name), shape, dtype, metadata,
+                               self._compressor, self._pyramid, self._executor)
+            self._images.append(im)
+        return im
+
+    def append(self, data):
+        """
+        Add a whole image
+        data (DataArray): the image
+        """
+        im = self.create_image(data.shape, data.dtype, data.metadata.copy())
+        im.write(data, (0,) * data.ndim)
+        im.finalize()
+
+    def close(self):
+        """
+        Finalise all the images and close the store.
+        It's fine to call it multiple times.
+        """
+        if self._executor is None:
+            return
+        try:
+            for im in self._images:
+                im.finalize()
+            _write_json(os.path.join(self._filename, ".zgroup"), {"zarr_format": 2})
+            _write_json(os.path.join(self._filename, ".zattrs"), {
+                "odemis": {"version": ODEMIS_ATTRS_VERSION,
+                           "images": ["image%d" % i for i in range(len(self._images))],
+                           "thumbnails": self._thumbnails}
+            })
+        finally:
+            self._executor.shutdown()
+            self._executor = None
+            self._images = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def export(filename, data, thumbnail=None, compressed=True, pyramid=False):
+    '''
+    Write a Zarr store with the given image and metadata
+    filename (unicode): filename of the directory to create (including path)
+    data (list of model.DataArray, or model.DataArray): the data to export.
+       Metadata is taken directly from the DA object. If it's a list, multiple
+       images are stored. The dimensions (MD_DIMS) must end with YX or YXC.
+    thumbnail (None or numpy.array): Image used as thumbnail for the file.
+      Must be either 2D array (greyscale) or 3D with last dimension of length 3 (RGB).
+    compressed (boolean): whether the data is compressed or not.
+    pyramid (boolean): whether the images are also saved at lower resolutions,
+      to allow to display them quickly, tile by tile.
+    '''
+    if not isinstance(data, list):
+        data = [data]
+
+    with AcquisitionWriter(filename, thumbnail, compressed, pyramid) as writer:
+        for da in data:
+            writer.append(da)
+
+
+def read_data(filename):
+    """
+    Read a Zarr store and return its content (skipping the thumbnail).
+    filename (unicode): filename of the directory to read
+    return (list of model.DataArray): the data to import (with the metadata
+     as .metadata). It might be empty.
+    raise IOError in case the file format is not as expected.
+    """
+    acd = open_data(filename)
+    return [acd.content[n].getData() for n in range(len(acd.content))]
+
+
+def read_thumbnail(filename):
+    """
+    Read the thumbnail data of a given Zarr store.
+    filename (unicode): filename of the directory to read
+    return (list of model.DataArray): the thumbnails attached to the file. If
+     the file contains no thumbnail, an empty list is returned.
+    raise IOError in case the file format is not as expected.
+    """
+    acd = open_data(filename)
+    return [acd.thumbnails[n].getData() for n in range(len(acd.thumbnails))]
+
+
+def open_data(filename):
+    """
+    Opens a Zarr store. The data is only read when requested.
+    filename (string): path to the directory
+    return (AcquisitionData): an opened file
+    raise IOError in case the file format is not as expected.
+    """
+    return AcquisitionDataZarr(filename)
+
+
+class DataArrayShadowZarr(model.DataArrayShadow):
+    """
+    This class implements the read of an image in a Zarr store, only when
+    the data is requested.
+    """
+
+    def __init__(self, levels, metadata):
+        """
+        levels (list of ChunkedArray): the image at each resolution, starting
+          with the full resolution
+        metadata (dict str->val): The metadata
+        """
+        self._levels = levels
+        array = levels[0]
+        model.DataArrayShadow.__init__(self, array.shape, array.dtype, metadata)
+
+    def getData(self):
+        """
+        Fetches the whole data (at full resolution) of image.
+        return DataArray: the data, with its metadata
+        """
+        return model.DataArray(self._levels[0][()], self.metadata.copy())
+
+    def __getitem__(self, key):
+        """
+        Fetches only part of the data, reading only the chunks needed.
+        key (int, slice, or tuple of int and slice): same as for indexing a
+          numpy array (but slices must have a step of 1)
+        return DataArray: the part of the data, with the metadata of the image
+        """
+        return model.DataArray(self._levels[0][key], self.metadata.copy())
+
+
+class DataArrayShadowPyramidalZarr(DataArrayShadowZarr):
+    """
+    This class implements the read of an image with lower resolution levels
+    in a Zarr store, tile by tile.
+    """
+
+    def __init__(self, levels, metadata):
+        self._levels = levels
+        array = levels[0]
+        dims = metadata[model.MD_DIMS]
+        iy, ix = dims.index("Y"), dims.index("X")
+        tile_shape = (array.chunks[ix], array.chunks[iy])
+        model.DataArrayShadow.__init__(self, array.shape, array.dtype, metadata,
+                                       len(levels) - 1, tile_shape)
+
+    def getTile(self, x, y, zoom):
+        '''
+        Fetches one tile
+        x (0<=int): X index of the tile.
+        y (0<=int): Y index of the tile
+        zoom (0<=int): zoom level to use. The total shape of the image is shape / 2**zoom.
+            The number of tiles available in an image is ceil((shape//zoom)/tile_shape)
+        return (DataArray): the shape of the DataArray is typically of shape
+          tile_shape (or smaller on the borders). If the image has more dimensions
+          (eg, a Z stack), the tile contains all of them.
+        '''
+        dims = self.metadata[model.MD_DIMS]
+        tw, th = self.tile_shape
+        key = tuple(slice(y * th, (y + 1) * th) if d == "Y" else
+                    slice(x * tw, (x + 1) * tw) if d == "X" else
+                    slice(None) for d in dims)
+        tile = model.DataArray(self._levels[zoom][key], self.metadata.copy())
+
+        orig_pixel_size = self.metadata.get(model.MD_PIXEL_SIZE, (1, 1))
+        # calculate the pixel size of the tile for the zoom level (only X and Y are reduced)
+        tile.metadata[model.MD_PIXEL_SIZE] = (tuple(ps * 2 ** zoom for ps in orig_pixel_size[:2]) +
+                                              tuple(orig_pixel_size[2:]))
+        # calculate the center of the tile
+        tile.metadata[model.MD_POS] = get_tile_md_pos((x, y), self.tile_shape, tile, self)
+
+        return tile
+
+
+class AcquisitionDataZarr(model.AcquisitionData):
+    """
+    Implements AcquisitionData for Zarr stores
+    """
+
+    def __init__(self, filename):
+        """
+        filename (string): The name of the directory
+        raise IOError in case the file format is not as expected.
+        """
+        try:
+            attrs = _read_json(os.path.join(filename, ".zattrs"))["odemis"]
+        except (OSError, ValueError, KeyError) as ex:
+            raise IOError("Failed to open %s as Zarr store: %s" % (filename, ex))
+
+        content = [self._openImage(os.path.join(filename, n)) for n in attrs.get("images", [])]
+        thumbnails = [self._openImage(os.path.join(filename, n)) for n in attrs.get("thumbnails", [])]
+        model.AcquisitionData.__init__(self, tuple(content), tuple(thumbnails))
+
+    @staticmethod
+    def _openImage(path):
+        """
+        Open one image group
+        return (DataArrayShadowZarr)
+        """
+        try:
+            attrs = _read_json(os.path.join(path, ".zattrs"))
+            md = decode_metadata(attrs["odemis"]["metadata"])
+            datasets = attrs["multiscales"][0]["datasets"]
+        except (OSError, ValueError, KeyError, IndexError) as ex:
+            raise IOError("Failed to open image %s: %s" % (path, ex))
+
+        levels = [ChunkedArray(os.path.join(path, d["path"])) for d in datasets]
+        md.setdefault(model.MD_DIMS, "CTZYX"[-levels[0].ndim:])
+        if len(levels) > 1:
+            return DataArrayShadowPyramidalZarr(levels, md)
+        else:
+            return DataArrayShadowZarr(levels, md)
@@ -254,7 +254,7 @@ class GenericComponent(model.Actuator):
     HwComponent) and a subclass GenericActuator(GenericComponent, Actuator), fix the diamond inheritance issues in
     the model, and use a new() method in GenericComponent() to generate a GenericActuator if there are axes.
     """
-    def __init__(self, name, role, vas=None, axes=None, **kwargs):
+    def __init__(self, name, role, vas=None, axes=None, init_delay=0, **kwargs):
         """
         Only VA's specified in vas are created. Their type is determined based on the supplied initial value, and the
         presence of range or choices in.
@@ -274,8 +274,14 @@ class GenericComponent(model.Actuator):
             "range" (float, float): optional, min/max of the axis, defaults to (-0.1, 0.1)
             "choices" (dict): optional, alternative to ranges, these are the choices of the axis
             "speed" (float, float): optional, allowable range of speeds, defaults to (0., 10.)
+        init_delay (0 <= float): time (in s) spent initialising, to simulate slow
+          hardware (eg, a camera cooling down, or a stage referencing).
 
         """
+        if init_delay:
+            logging.debug("Simulating initialisation of %s for %g s", name, init_delay)
+            time.sleep(init_delay)
+
         # Create desired VA's
         if vas:
             for vaname, vaprop in vas.items():
@@ -141,11 +141,23 @@ class Component(ComponentBase):
         Equivalent to __getstate__() of the proxy version
         """
         proxy_state = Pyro4.core.pyroObjectSerializer(self)[2]
+        vas = _vattributes.dump_vigilant_attributes(self)
         return (proxy_state, self.parent,
                 _core.dump_roattributes(self),
                 _dataflow.dump_dataflows(self),
-                _vattributes.dump_vigilant_attributes(self),
-                _dataflow.dump_events(self))
+                vas,
+                _dataflow.dump_events(self),
+                _vattributes.attach_multiplexer(self, vas))
+
+    def _describe(self):
+        """
+        Used by the Container to describe all its components in one call.
+        return (dict str -> value): "component" -> the component itself (which
+          is serialized as a proxy), "vas" -> the state of the VAs (see
+          describe_vigilant_attributes())
+        """
+        return {"component": self,
+                "vas": _vattributes.describe_vigilant_attributes(self)}
 
     def __str__(self):
         try:
@@ -211,6 +223,7 @@ class ComponentProxy(ComponentBase, Pyro4.Proxy):
         """
         Pyro4.Proxy.__init__(self, uri)
         self._parent = None
+        self._va_mux_address = None
 
     # like a roattribute, but set via __setstate__
     @property
@@ -225,6 +238,7 @@ class ComponentProxy(ComponentBase, Pyro4.Proxy):
                 _dataflow.dump_dataflows(self),
                 _vattributes.dump_vigilant_attributes(self),
                 _dataflow.dump_events(self),
+                self._va_mux_address,
                 )
 
     def __setstate__(self, state):
@@ -234,14 +248,21 @@ class ComponentProxy(ComponentBase, Pyro4.Proxy):
         roattributes (dict string -> value)
         dataflows (dict string -> dataflow)
         vas (dict string -> VA)
+        events (dict string -> Event)
+        mux_address (str or None): address of the multiplexer of the VA updates
         """
-        proxy_state, parent, roattributes, dataflows, vas, events = state
+        proxy_state, parent, roattributes, dataflows, vas, events, mux_address = state
         self._parent = parent
+        self._va_mux_address = mux_address
         Pyro4.Proxy.__setstate__(self, proxy_state)
         _core.load_roattributes(self, roattributes)
         _dataflow.load_dataflows(self, dataflows)
         _vattributes.load_vigilant_attributes(self, vas)
         _dataflow.load_events(self, events)
+        if mux_address:
+            for name, va in vas.items():
+                if isinstance(va, _vattributes.VigilantAttributeProxy):
+                    va._set_batch_channel(mux_address, name)
 
     def __setattr__(self, name, value):
         # Detect that the user is trying to replace a VigilantAttribute, which is
@@ -24,6 +24,7 @@ import multiprocessing
 import os
 import threading
 from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import quote
 
 import Pyro4
@@ -71,6 +72,9 @@ def getMicroscope():
     """
     global _microscope # cached at the module level
     if _microscope is None:
+        # The containers might have been restarted since the previous connection
+        with _container_proxies_lock:
+            _container_proxies.clear()
         backend = getContainer(BACKEND_NAME, validate=False)
 
         # Force a short timeout, because if the backend is not reachable very
@@ -122,6 +126,73 @@ def getComponents():
     # return _getChildren(microscope)
 
 
+def describeComponents(comps=None):
+    """
+    Get the description of many components at once. It contacts each container
+    only once (in parallel), instead of every VA of every component separately.
+    It's meant for clients which need the state of all the VAs of many
+    components, such as odemis-cli --list-prop. It doesn't make the connection
+    to the components (eg, getMicroscope() or getComponents()) faster, and the
+    components returned are the usual proxies.
+    comps (iterable of Component or None): the components to describe. If None,
+      all the components managed by the backend are described.
+    return (dict str -> dict): name of the component -> description. It
+      contains "component" (the Component), and "vas" (dict str -> dict): name
+      of the VA -> "value", and if available "range" and "choices".
+      The VAs with a getter are not included, and should be read separately.
+      Components which cannot be described (eg, because they are in a container
+      which doesn't support it) are not included.
+    """
+    if comps is None:
+        comps = getComponents()
+
+    # Group the components per container
+    names = set()
+    locations = set()
+    descs = {}
+    for c in comps:
+        names.add(c.name)
+        if isinstance(c, Pyro4.core.Proxy):
+            locations.add(c._pyroUri.location)
+        else:  # Local component
+            descs[c.name] = c._describe()
+
+    def describe_container(location):
+        try:
+            return _getContainerProxy(location).describe()
+        except Exception:
+            logging.info("Failed to describe container %s", location, exc_info=True)
+            return {}
+
+    if locations:
+        with ThreadPoolExecutor(max_workers=len(locations)) as executor:
+            for cdescs in executor.map(describe_container, locations):
+                descs.update(cdescs)
+
+    # Containers also return the components which were not requested
+    return {n: d for n, d in descs.items() if n in names}
+
+
+# location -> Proxy to the container, created when first needed
+_container_proxies = {}
+_container_proxies_lock = threading.Lock()
+
+
+def _getContainerProxy(location):
+    """
+    location (str): location of a Pyro daemon (as in Pyro4.URI.location)
+    return (Proxy): proxy to the container, reused for all the calls from this process
+    """
+    with _container_proxies_lock:
+        try:
+            return _container_proxies[location]
+        except KeyError:
+            container = Pyro4.Proxy("PYRO:Pyro.Daemon@" + location)
+            container._pyroTimeout = CALL_TIMEOUT
+            _container_proxies[location] = container
+            return container
+
+
 def _getChildren(root):
     """
     Return the set of components which are referenced from the given component
@@ -286,6 +357,12 @@ class ContainerObject(Pyro4.core.DaemonObject):
         """
         return self.getObject(self.daemon.rootId)
 
+    def describe(self):
+        """
+        returns the description of all the components in the container
+        """
+        return self.daemon.describe()
+
 
 # Basically a wrapper around the Pyro Daemon
 class Container(Pyro4.core.Daemon):
@@ -370,6 +447,24 @@ class Container(Pyro4.core.Daemon):
             raise
         return comp
 
+    def describe(self):
+        """
+        Describe all the components handled by the container, so that a client
+        can get their state in a single call.
+        returns (dict str -> dict): name of the component -> description (see
+          Component._describe())
+        """
+        descs = {}
+        for obj in list(self.objectsById.values()):
+            describe = getattr(obj, "_describe", None)
+            if describe is None:  # Not a component
+                continue
+            try:
+                descs[obj.name] = describe()
+            except Exception:
+                logging.exception("Failed to describe object %s", obj)
+        return descs
+
     def setRoot(self, component):
         """
         sets the root object. It has to be one of the component handled by the
@@ -25,9 +25,11 @@ Odemis. If not, see http://www.gnu.org/licenses/.
 # losslessly and with metadata attached (see _metadata for the conventional ones).
 
 import Pyro4
+import collections
 import logging
 import numpy
-from odemis.model import _metadata, _vattributes
+from odemis.model import _mdcodec, _metadata, _shm, _vattributes
+from Pyro4.core import oneway
 from odemis.util import inspect_getmembers
 from odemis.util.weak import WeakMethod, WeakRefLostError
 import os
@@ -38,6 +40,26 @@ import zmq
 
 from . import _core
 
+# Number of arrays kept in the shared memory ring buffer of a DataFlow. An array
+# received via shared memory is dropped if that many newer arrays are published
+# before the subscriber has read it.
+SHM_RING_SLOTS = 8
+# Prefix of the name of the shared memory segments of the DataFlows
+SHM_PREFIX = "odemis-df-"
+
+# Minimum time (in s) between two reports of the statistics of a subscription
+# to the DataFlow.
+STATS_REPORT_PERIOD = 1
+
+
+def remove_stale_shm_segments():
+    """
+    Remove the shared memory segments left over by DataFlows of processes which
+    have died. To be called when starting the back-end.
+    return (int): number of segments removed
+    """
+    return _shm.remove_stale_segments(SHM_PREFIX)
+
 
 class DataArray(numpy.ndarray):
     """
@@ -204,17 +226,27 @@ class DataFlow(DataFlowBase):
         DataFlowBase.__init__(self)
         # different from ._listeners for notify() to do different things
         self._remote_listeners = set()  # any unique string works
+        self._shm_listeners = set()  # remote listeners which receive the data via shared memory
         self._sync_lock = threading.RLock()  # To ensure only one sync change at a time
         self._was_synchronized = False
 
         self._global_name = None  # to be filled when registered
         self._ctx = None
         self.pipe = None
+        self._shm_pipe = None  # To send the location of the arrays in the shared memory
+        self._shm_ring = None  # SharedMemoryRing, created on the first shared memory subscription
+        # One encoder per pipe, as each of them is a separate stream of messages
+        self._md_encoder = _mdcodec.MetadataEncoder()
+        self._shm_md_encoder = _mdcodec.MetadataEncoder()
 
         self._max_discard = max_discard
         self._max_discard_orig = max_discard  # Used when switching between synchronized and not
         self._max_discard_last_update = None  # Value when last updated (when there are no remote listeners)
 
+        # For the statistics
+        self._published = 0  # Number of arrays notified since the creation
+        self._remote_stats = {}  # remote listener name -> dict str -> number, as reported by the subscriber
+
     def _getproxystate(self):
         """
         Equivalent to __getstate__() of the proxy version
@@ -238,6 +270,40 @@ class DataFlow(DataFlowBase):
     def _set_max_discard(self, value):
         self.max_discard = value
 
+    @oneway
+    def _report_statistics(self, listener, stats):
+        """
+        Called regularly by the remote subscribers to report how well they
+        manage to receive the data.
+        listener (str): name of the remote listener
+        stats (dict str -> number): see getStatistics()
+        """
+        # Only accept reports from current subscribers (it might come late)
+        if listener in self._remote_listeners or listener in self._shm_listeners:
+            self._remote_stats[listener] = stats
+
+    def getStatistics(self):
+        """
+        Report how well the data is passed to the subscribers.
+        return (dict str -> value):
+          "published" (int): number of arrays notified since the creation of the DataFlow
+          "dropped" (int): number of arrays discarded by the current remote subscribers
+          "queue depth" (int): largest number of arrays waiting to be notified
+            by a remote subscriber (over the last report period)
+          "lag" (float): longest time (in s) between the publication of an
+            array and its notification by a remote subscriber
+          "subscribers" (dict str -> dict): for each remote subscriber, its own
+            "received", "dropped", "queue depth" and "lag".
+        """
+        remote_stats = dict(self._remote_stats)
+        return {
+            "published": self._published,
+            "dropped": sum(st["dropped"] for st in remote_stats.values()),
+            "queue depth": max((st["queue depth"] for st in remote_stats.values()), default=0),
+            "lag": max((st["lag"] for st in remote_stats.values()), default=0),
+            "subscribers": remote_stats,
+        }
+
     def _update_pipe_hwm(self):
         """
         updates the high water mark option of OMQ pipe according to max_discard
@@ -321,6 +387,13 @@ class DataFlow(DataFlowBase):
         logging.debug("server is registered to send to " + "ipc://" + self._global_name)
         self.pipe.bind("ipc://" + self._global_name)
 
+        # Second pipe for the subscribers using the shared memory: they receive
+        # a different message, which only contains the location of the data.
+        self._shm_pipe = self._ctx.socket(zmq.PUB)
+        self._shm_pipe.linger = 1
+        self._shm_pipe.sndhwm = 200
+        self._shm_pipe.bind("ipc://" + self._global_name + ".shm")
+
     def _unregister(self):
         """
         unregister the dataflow from the daemon and clean up the 0MQ bindings
@@ -331,11 +404,16 @@ class DataFlow(DataFlowBase):
         if self._ctx:
             self.pipe.close()
             self.pipe = None
+            self._shm_pipe.close()
+            self._shm_pipe = None
             self._ctx.term()
             self._ctx = None
+        if self._shm_ring:
+            self._shm_ring.close()
+            self._shm_ring = None
 
     def _count_listeners(self):
-        return len(self._listeners) + len(self._remote_listeners)
+        return len(self._listeners) + len(self._remote_listeners) + len(self._shm_listeners)
 
     def get(self, asap=True):
         """
@@ -375,6 +453,8 @@ class DataFlow(DataFlowBase):
             # add string to listeners if listener is string
             if isinstance(listener, str):
                 self._remote_listeners.add(listener)
+                # The new listener needs to receive the complete metadata
+                self._md_encoder.reset()
             else:
                 assert callable(listener)
                 self._listeners.add(WeakMethod(listener))
@@ -397,12 +477,45 @@ class DataFlow(DataFlowBase):
                                   self._count_listeners(), self._global_name)
                     raise
 
+    def _subscribe_shm(self, listener):
+        """
+        Subscribe a remote listener which will receive the data via shared memory.
+        Only to be called by the DataFlowProxy.
+        listener (str): unique name of the remote listener
+        return (bool): True if subscribed, False if shared memory is not
+          available, in which case the listener should use the standard subscription.
+        """
+        if not _shm.is_shm_available():
+            logging.info("Shared memory not available, refusing shared memory subscription on %s",
+                         self._global_name)
+            return False
+
+        with self._lock:
+            if self._shm_ring is None:
+                self._shm_ring = _shm.SharedMemoryRing(SHM_PREFIX + self._global_name.rsplit("@", 1)[-1],
+                                                       SHM_RING_SLOTS)
+            count_before = self._count_listeners()
+            self._shm_listeners.add(listener)
+            self._shm_md_encoder.reset()
+            logging.debug("Listener %r subscribed via shared memory, now %d subscribers on %s" % (
+                          listener, self._count_listeners(), self._global_name))
+            if count_before == 0:
+                try:
+                    self.start_generate()
+                except Exception as ex:
+                    logging.error("Subscribing listener %r to the dataflow failed. %s", listener, ex)
+                    self._shm_listeners.discard(listener)
+                    raise
+        return True
+
     def unsubscribe(self, listener):
         with self._lock:
             count_before = self._count_listeners()
             if isinstance(listener, str):
                 # remove string from listeners
                 self._remote_listeners.discard(listener)
+                self._shm_listeners.discard(listener)
+                self._remote_stats.pop(listener, None)
             else:
                 self._listeners.discard(WeakMethod(listener))
 
@@ -416,6 +529,9 @@ class DataFlow(DataFlowBase):
                 self._update_pipe_hwm()
 
     def notify(self, data):
+        self._published += 1
+        pub_time = time.time()
+
         # publish the data remotely
         if self.pipe and len(self._remote_listeners) > 0:
             # TODO: is there any way to know how many recipients of the pipe?
@@ -426,8 +542,8 @@ class DataFlow(DataFlowBase):
             # is gone (if there is a way to associate it)
 
             # TODO thread-safe for self.pipe ?
-            dformat = {"dtype": str(data.dtype), "shape": data.shape, "metadata": data.metadata}
-            self.pipe.send_pyobj(dformat, zmq.SNDMORE)
+            header = self._md_encoder.encode(data.metadata, (str(data.dtype), data.shape, pub_time))
+            self.pipe.send(header, zmq.SNDMORE)
             try:
                 if not data.flags["C_CONTIGUOUS"]:
                     # if not in C order, it will be received incorrectly
@@ -442,6 +558,13 @@ class DataFlow(DataFlowBase):
                 data = numpy.require(data, requirements=["C_CONTIGUOUS"])
                 self.pipe.send(memoryview(data), copy=False)
 
+        if self._shm_pipe and self._shm_listeners:
+            # Copy the data once into the shared memory, and only send its location
+            shm_name, offset, seq = self._shm_ring.write(data)
+            header = self._shm_md_encoder.encode(data.metadata,
+                                                 (str(data.dtype), data.shape, pub_time, shm_name, offset, seq))
+            self._shm_pipe.send(header)
+
         # publish locally
         DataFlowBase.notify(self, data)
 
@@ -469,6 +592,15 @@ class DataFlowProxy(DataFlowBase, Pyro4.Proxy):
         self._ctx = None
         self._commands = None
         self._thread = None
+        # If True, the next subscriptions will ask to receive the data via
+        # shared memory. The DataArrays not read before SHM_RING_SLOTS newer
+        # DataArrays have been published are dropped.
+        self.use_shm = False
+        # Maximum number of DataArrays waiting to be notified when the listeners
+        # are too slow. If more arrive, the oldest ones are discarded (unless
+        # max_discard is 0). Read when subscribing.
+        self.queue_size = 1
+        self._pyroOneway.add("_report_statistics")
 
     @property
     def max_discard(self):
@@ -495,6 +627,9 @@ class DataFlowProxy(DataFlowBase, Pyro4.Proxy):
         self._ctx = None
         self._commands = None
         self._thread = None
+        self.use_shm = False
+        self.queue_size = 1
+        self._pyroOneway.add("_report_statistics")
 
     # .get() is a direct remote call
 
@@ -514,6 +649,22 @@ class DataFlowProxy(DataFlowBase, Pyro4.Proxy):
         # start the remote subscription
         if not self._thread:
             self._create_thread()
+
+        if self.use_shm:
+            # Listen first, so that no data is lost, and then request the subscription
+            self._commands.send(b"SUBSHM")
+            self._commands.recv()  # synchronise
+            try:
+                if Pyro4.Proxy.__getattr__(self, "_subscribe_shm")(self._proxy_name):
+                    return
+            except Exception as ex:
+                logging.error("Subscribing to the dataflow failed. %s", ex)
+                self._commands.send(b"UNSUB")  # asynchronous (necessary to not deadlock)
+                raise
+            logging.info("Dataflow %s cannot use shared memory, falling back to standard transport",
+                         self._global_name)
+            self._commands.send(b"UNSUB")
+
         self._commands.send(b"SUB")
         self._commands.recv()  # synchronise
 
@@ -526,6 +677,13 @@ class DataFlowProxy(DataFlowBase, Pyro4.Proxy):
             self._commands.send(b"UNSUB")  # asynchronous (necessary to not deadlock)
             raise
 
+    def _send_statistics(self, stats):
+        """
+        Report the statistics of the subscription to the remote DataFlow
+        stats (dict str -> number)
+        """
+        Pyro4.Proxy.__getattr__(self, "_report_statistics")(self._proxy_name, stats)
+
     def stop_generate(self):
         # stop the remote subscription
         Pyro4.Proxy.__getattr__(self, "unsubscribe")(self._proxy_name)
@@ -578,10 +736,171 @@ class SubscribeProxyThread(threading.Thread):
         self._data = zmq_ctx.socket(zmq.SUB)
         # Don't automatically discard messages on 0MQ as it's hard to change live (based on max_discard)
         # and also as we receive 3 messages per DataArray that would be very unreliable.
-        # Instead, we will discard the DataArray in the thread itself (based on the max_discard).
+        # Instead, this thread always receives all the messages as soon as they
+        # arrive, and the DataArrays are discarded (oldest first) from the queue
+        # of the notifier thread (based on the max_discard and queue_size).
         self._data.rcvhwm = 0
         self._data.connect("ipc://" + uri)
 
+        # create a zmq subscription to receive the location of the data in shared memory
+        self._shm_data = zmq_ctx.socket(zmq.SUB)
+        self._shm_data.rcvhwm = 0
+        self._shm_data.connect("ipc://" + uri + ".shm")
+        self._shm_reader = _shm.SharedMemoryReader()
+        self._md_decoder = _mdcodec.MetadataDecoder()
+        self._shm_md_decoder = _mdcodec.MetadataDecoder()
+
+        # Arrays received, waiting to be notified by the notifier thread.
+        # Each element is a tuple: metadata, dtype, shape, publication time, and
+        # the 0MQ frame containing the data or the location in the shared memory.
+        self._queue = collections.deque()
+        self._queue_cv = threading.Condition()
+        self._stopping = False
+        # Maximum number of messages discarded in a row, and maximum number of
+        # arrays waiting in the queue, when discarding is allowed.
+        # Read from the DataFlow(Proxy) when the subscription is started.
+        self._max_discard = 0
+        self._queue_size = 1
+        self._discarded = 0  # Number of messages discarded in a row
+        # Statistics of the subscription, regularly reported to the DataFlow
+        self._received = 0
+        self._dropped = 0
+        self._dropped_logged = 0
+        self._max_depth = 0  # queue depth since last report
+        self._last_lag = 0  # s, between the publication and the notification of the last array
+        self._last_report = 0
+
+        self._notifier = threading.Thread(target=self._notify_loop, name="notifier for dataflow " + uri)
+        self._notifier.daemon = True
+
+    def _decode_header(self, decoder, header):
+        """
+        decoder (MetadataDecoder): the decoder of the pipe which received the header
+        header (bytes): the encoded header of the array
+        return (dict, tuple) or None: metadata and array format, or None if it
+          cannot be decoded (yet)
+        """
+        try:
+            ret = decoder.decode(header)
+        except ValueError:
+            logging.exception("Failed to decode array header received on %s", self.uri)
+            return None
+        if ret is None:
+            logging.debug("Skipping array on %s, waiting for complete metadata", self.uri)
+        return ret
+
+    def _enqueue(self, item):
+        """
+        Pass an array to the notifier thread. If too many arrays are already
+        waiting, the oldest ones are dropped.
+        item (tuple): see ._queue
+        """
+        with self._queue_cv:
+            self._received += 1
+            if self._max_discard > 0:
+                while (len(self._queue) >= self._queue_size
+                       and self._discarded < self._max_discard):
+                    self._queue.popleft()
+                    self._discarded += 1
+                    self._dropped += 1
+            self._queue.append(item)
+            self._max_depth = max(self._max_depth, len(self._queue))
+            self._queue_cv.notify()
+
+    def _clear_queue(self):
+        with self._queue_cv:
+            self._queue.clear()
+            self._discarded = 0
+
+    def _stop_notifier(self):
+        with self._queue_cv:
+            self._stopping = True
+            self._queue.clear()
+            self._queue_cv.notify()
+
+    def _build_array(self, item):
+        """
+        item (tuple): see ._queue
+        return (DataArray or None): the array, or None if it's not available anymore
+        """
+        md, dtype, shape, pub_time, source = item
+        if isinstance(source, tuple):  # location in the shared memory
+            shm_name, offset, seq = source
+            try:
+                array = self._shm_reader.read(shm_name, offset, seq, dtype, shape)
+            except OSError as ex:
+                # Typically, the segment has been replaced by a bigger one in-between
+                logging.warning("Dataflow %s failed to read array in shared memory: %s", self.uri, ex)
+                return None
+            if array is None:
+                logging.warning("Dataflow %s dropped array %d, overwritten in shared memory before being read",
+                                self.uri, seq)
+                return None
+        else:
+            # TODO: any need to use zmq.utils.rebuffer.array_from_buffer()?
+            if len(source):
+                array = numpy.frombuffer(source, dtype=dtype)
+            else:  # frombuffer doesn't support zero length array
+                array = numpy.empty((0,), dtype=dtype)
+            array.shape = shape
+        return DataArray(array, metadata=md)
+
+    def _report_statistics(self):
+        """
+        Send the statistics of the subscription to the DataFlow, and log the
+        dropped arrays (at most once per STATS_REPORT_PERIOD, to avoid log flooding).
+        """
+        now = time.time()
+        if now < self._last_report + STATS_REPORT_PERIOD:
+            return
+        self._last_report = now
+
+        with self._queue_cv:
+            stats = {"received": self._received,
+                     "dropped": self._dropped,
+                     "queue depth": self._max_depth,
+                     "lag": self._last_lag}
+            self._max_depth = len(self._queue)
+
+        if self._dropped > self._dropped_logged:
+            logging.warning("Dataflow %s dropped %d arrays", self.uri, self._dropped - self._dropped_logged)
+            self._dropped_logged = self._dropped
+
+        try:
+            self.weak_df._send_statistics(stats)
+        except ReferenceError:
+            raise
+        except Exception as ex:
+            logging.debug("Failed to report statistics of dataflow %s: %s", self.uri, ex)
+
+    def _notify_loop(self):
+        """
+        Pass the arrays received to the DataFlowProxy, in a separate thread, so
+        that the messages keep being received (and possibly discarded) while
+        the listeners are busy.
+        """
+        try:
+            while True:
+                with self._queue_cv:
+                    while not self._queue and not self._stopping:
+                        self._queue_cv.wait()
+                    if self._stopping:
+                        return
+                    item = self._queue.popleft()
+                    self._discarded = 0
+
+                darray = self._build_array(item)
+                if darray is not None:
+                    self.weak_df.notify(darray)
+                    self._last_lag = time.time() - item[3]
+                self._report_statistics()
+        except ReferenceError:  # The DataFlow(Proxy) is gone
+            if logging:
+                logging.debug("Dataflow proxy %s is gone, stopping the notifier thread", self.uri)
+        except Exception:
+            if logging:
+                logging.exception("Ending notifier thread due to exception")
+
     def run(self):
         """
         Process messages for commands and data
@@ -590,27 +909,35 @@ class SubscribeProxyThread(threading.Thread):
         # Which means: logging might be None, and zmq might not be working
         # normally (apparently zmq.POLLIN == None during this time).
         try:
+            self._notifier.start()
             poller = zmq.Poller()
             poller.register(self._commands, zmq.POLLIN)
             poller.register(self._data, zmq.POLLIN)
+            poller.register(self._shm_data, zmq.POLLIN)
 
-            # Maximum number of messages discarded in a row.
-            # Read from the remote DataFlow when the subscription is started.
-            max_discard = 0
-            discarded = 0  # Number of messages discarded in a row
+            subscribed = None  # The socket currently subscribed to
             while True:
                 socks = dict(poller.poll())
 
                 # process commands
                 if self._commands in socks:
                     message = self._commands.recv()
-                    if message == b"SUB":
-                        self._data.setsockopt(zmq.SUBSCRIBE, b'')
-                        max_discard = self.weak_df.max_discard
-                        logging.debug("Subscribed to remote dataflow %s, with max_discard = %s", self.uri, max_discard)
+                    if message in (b"SUB", b"SUBSHM"):
+                        subscribed = self._shm_data if message == b"SUBSHM" else self._data
+                        subscribed.setsockopt(zmq.SUBSCRIBE, b'')
+                        with self._queue_cv:
+                            self._max_discard = self.weak_df.max_discard
+                            self._queue_size = max(1, self.weak_df.queue_size)
+                        logging.debug("Subscribed to remote dataflow %s, with max_discard = %s, queue size = %s, shared memory = %s",
+                                      self.uri, self._max_discard, self._queue_size, subscribed is self._shm_data)
                         self._commands.send(b"SUBD")
                     elif message == b"UNSUB":
-                        self._data.setsockopt(zmq.UNSUBSCRIBE, b'')
+                        if subscribed is not None:
+                            subscribed.setsockopt(zmq.UNSUBSCRIBE, b'')
+                            subscribed = None
+                        # Don't deliver the arrays received before unsubscribing
+                        # on the next subscription
+                        self._clear_queue()
                         if logging:
                             logging.debug("Unsubscribed from remote dataflow %s", self.uri)
                         # no confirmation (async)
@@ -622,30 +949,22 @@ class SubscribeProxyThread(threading.Thread):
                 # receive data
                 if self._data in socks:
                     # TODO: be more resilient if wrong data is received (can block forever)
-                    array_format = self._data.recv_pyobj()
+                    header = self._data.recv()
                     array_buf = self._data.recv(copy=False)
                     # logging.debug("Received new DataArray over ZMQ for %s", self.uri)
-                    # more fresh data already?
-                    if (discarded < max_discard
-                        and self._data.getsockopt(zmq.EVENTS) & zmq.POLLIN
-                       ):
-                        discarded += 1
-                        # logging.debug("Discarding object received as a newer one is available")
-                        continue
-                    # Don't log here, because if we are discarding message it's because we are running
-                    # out of time, and logging is slow.
-                    # TODO: only log the accumulated number every second, to avoid log flooding
-                    if discarded:
-                        logging.warning("Dataflow %s dropped %d arrays", self.uri, discarded)
-                    discarded = 0
-                    # TODO: any need to use zmq.utils.rebuffer.array_from_buffer()?
-                    if len(array_buf):
-                        array = numpy.frombuffer(array_buf, dtype=array_format["dtype"])
-                    else:  # frombuffer doesn't support zero length array
-                        array = numpy.empty((0,), dtype=array_format["dtype"])
-                    array.shape = array_format["shape"]
-                    darray = DataArray(array, metadata=array_format["metadata"])
-                    self.weak_df.notify(darray)
+                    # Always decode the header, even if the array is discarded,
+                    # as the metadata of the next one is relative to it.
+                    array_format = self._decode_header(self._md_decoder, header)
+                    if array_format is not None:
+                        md, (dtype, shape, pub_time) = array_format
+                        self._enqueue((md, dtype, shape, pub_time, array_buf))
+
+                # receive location of data in shared memory
+                if self._shm_data in socks:
+                    array_format = self._decode_header(self._shm_md_decoder, self._shm_data.recv())
+                    if array_format is not None:
+                        md, (dtype, shape, pub_time, shm_name, offset, seq) = array_format
+                        self._enqueue((md, dtype, shape, pub_time, (shm_name, offset, seq)))
 
         except ReferenceError:  # The DataFlow(Proxy) is gone
             # => stop this thread too
@@ -655,12 +974,14 @@ class SubscribeProxyThread(threading.Thread):
             if logging:
                 logging.exception("Ending ZMQ thread due to exception")
         finally:
+            self._stop_notifier()
             try:
                 self._commands.close()
             except Exception:
                 print("Exception closing ZMQ commands connection")
             try:
                 self._data.close()
+                self._shm_data.close()
             except Exception:
                 print("Exception closing ZMQ data connection")
 
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""
+Created on 17 Oct 2026
+
+Copyright © 2026 Delmic
+
+This file is part of Odemis.
+
+Odemis is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License version 2 as published by the Free Software
+Foundation.
+
+Odemis is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+Odemis. If not, see http://www.gnu.org/licenses/.
+"""
+
+# Codec for the headers of the DataArrays sent over 0MQ by the DataFlows.
+# The content is pickled (which is the fastest way to serialize Python objects).
+# When the metadata is large, it's sent as a delta compared to the metadata of
+# the previous message: only the keys which have changed (or been removed) are
+# sent. Typically, a time correlator sends every histogram with the same
+# MD_TIME_LIST, an array larger than the histogram itself. Only the immutable
+# values and the numpy arrays (as a copy) are kept between messages, the other
+# ones are sent every time. With small metadata, pickling everything is faster
+# than finding the changes, so every message contains all the metadata.
+# Every message is a pickled tuple, starting with:
+#  * version (int)
+#  * flags (int): FLAG_KEYFRAME if all the metadata is sent, FLAG_REFERENCE
+#    if the next messages might be a delta compared to this one.
+#  * sequence number (int)
+# A delta message can only be decoded if the previous message has been decoded.
+# Otherwise, the receiver has to wait for the next key frame.
+
+import pickle
+import time
+
+import numpy
+
+VERSION = 3
+FLAG_KEYFRAME = 0x01
+FLAG_REFERENCE = 0x02
+
+# Minimum size (in bytes) of the pickled metadata to send it as delta. Below,
+# finding the changes takes longer than pickling everything.
+DELTA_MIN_SIZE = 1024
+
+_IMMUTABLE_TYPES = (type(None), bool, int, float, str, bytes)
+
+
+def _is_immutable(v):
+    """
+    return (bool): True if the value cannot be modified in-place
+    """
+    t = type(v)
+    if t in _IMMUTABLE_TYPES:
+        return True
+    return t is tuple and all(type(i) in _IMMUTABLE_TYPES for i in v)
+
+
+def _keep_values(md):
+    """
+    Select the values which can be kept to be compared with the next messages
+    md (dict): the metadata
+    return (dict): the values to keep. The numpy arrays are copied, as the
+      original ones might be modified in-place.
+    """
+    kept = {}
+    for k, v in md.items():
+        if type(v) is numpy.ndarray:
+            kept[k] = v.copy()
+        elif _is_immutable(v):
+            kept[k] = v
+    return kept
+
+
+def _is_same(v, pv):
+    """
+    Check whether a value is the same as the (kept) value of the previous message
+    return (bool)
+    """
+    if v is pv:
+        return True
+    if type(v) is not type(pv):
+        return False
+    if type(v) is numpy.ndarray:
+        return v.dtype == pv.dtype and v.shape == pv.shape and numpy.array_equal(v, pv)
+    try:
+        if v != pv:
+            return False
+    except ValueError:  # Typically, tuple of numpy arrays
+        return False
+    # (1, 2) == (1.0, 2.0), but the receiver should get the right type
+    return type(v) is not tuple or all(type(i) is type(pi) for i, pi in zip(v, pv))
+
+
+class MetadataEncoder(object):
+    """
+    Encodes the metadata of a series of messages. If the metadata is large,
+    only the keys which have changed since the previous message are sent.
+    """
+
+    def __init__(self, keyframe_interval=100, keyframe_period=1, delta_min_size=DELTA_MIN_SIZE):
+        """
+        keyframe_interval (int > 0): maximum number of messages between two
+          messages containing all the metadata.
+        keyframe_period (float > 0): maximum time (in s) between two messages
+          containing all the metadata.
+        This ensures that a receiver which missed a message can decode the
+        messages again after a short while.
+        delta_min_size (int >= 0): minimum size (in bytes) of the pickled
+          metadata to send the next messages as delta.
+        """
+        self._keyframe_interval = keyframe_interval
+        self._keyframe_period = keyframe_period
+        self._delta_min_size = delta_min_size
+        self._seq = 0
+        self._since_keyframe = keyframe_interval  # To force a key frame on the first message
+        self._last_keyframe = 0  # time of the last key frame
+        # Whether the metadata of the last key frame was large. Assumed at first,
+        # so that deltas can be sent from the second message.
+        self._large = True
+        # key -> kept value of the previous message, or None if the next
+        # message must be a key frame
+        self._prev = None
+
+    def reset(self):
+        """
+        Force the next message to contain all the metadata. Should be called
+        whenever a new receiver starts listening.
+        """
+        self._since_keyframe = self._keyframe_interval
+
+    def encode(self, md, extra=None):
+        """
+        Encode one message
+        md (dict): the metadata
+        extra (object or None): value which is sent as-is (not delta-encoded), for
+          instance the shape and dtype of the array.
+        return (bytes): the binary message
+        """
+        self._seq = (self._seq + 1) & 0xffffffff
+        if (self._prev is None
+            or self._since_keyframe >= self._keyframe_interval
+            or time.time() > self._last_keyframe + self._keyframe_period
+           ):
+            return self._encode_keyframe(md, extra)
+
+        self._since_keyframe += 1
+        prev = self._prev
+        changed = {}
+        for k, v in md.items():
+            pv = prev.get(k, prev)  # prev is never a value => works as "missing"
+            if pv is not prev and _is_same(v, pv):
+                continue
+            changed[k] = v
+            if pv is not prev:
+                del prev[k]
+        prev.update(_keep_values(changed))
+
+        removed = [k for k in prev if k not in md]
+        for k in removed:
+            del prev[k]
+
+        return pickle.dumps((VERSION, FLAG_REFERENCE, self._seq, extra, changed, removed),
+                            pickle.HIGHEST_PROTOCOL)
+
+    def _encode_keyframe(self, md, extra):
+        # The size of the metadata is only known once pickled, so whether the
+        # next messages are relative to this one is decided from the size of
+        # the previous key frame.
+        reference = self._large
+        flags = FLAG_KEYFRAME | FLAG_REFERENCE if reference else FLAG_KEYFRAME
+        msg = pickle.dumps((VERSION, flags, self._seq, extra, md, ()), pickle.HIGHEST_PROTOCOL)
+        self._large = len(msg) >= self._delta_min_size
+        if reference and self._large:
+            self._since_keyframe = 0
+            self._last_keyframe = time.time()
+            self._prev = _keep_values(md)
+        else:
+            self._prev = None
+        return msg
+
+
+class MetadataDecoder(object):
+    """
+    Decodes the messages created by a MetadataEncoder. All the messages must be
+    passed, in order (even the ones which are not going to be used).
+    """
+
+    def __init__(self):
+        self._seq = None  # sequence number of the last message decoded
+        self._md = None  # key -> kept value, of the last reference message
+
+    def decode(self, msg):
+        """
+        Decode one message
+        msg (bytes or buffer): the binary message
+        return (dict, object) or None: the metadata (a new dict, which can be
+          modified), and the extra value. None if the message is a delta of a
+          message which hasn't been received.
+        raise ValueError: if the message is not valid or not compatible
+        """
+        try:
+            version, flags, seq, extra, changed, removed = pickle.loads(msg)
+        except Exception as ex:
+            raise ValueError("Failed to decode metadata: %s" % (ex,))
+        if version != VERSION:
+            raise ValueError("Unsupported metadata codec version %s" % (version,))
+
+        if flags & FLAG_KEYFRAME:
+            # The metadata is complete, and freshly unpickled => can be returned as-is
+            if flags & FLAG_REFERENCE:
+                self._md = _keep_values(changed)
+            else:
+                self._md = None
+            self._seq = seq
+            return changed, extra
+
+        if self._md is None or self._seq is None or seq != (self._seq + 1) & 0xffffffff:
+            # Missed a message => wait for the next key frame
+            self._seq = None
+            return None
+
+        prev = self._md
+        for k in removed:
+            prev.pop(k, None)
+        md = prev.copy()
+        for k, v in md.items():
+            if type(v) is numpy.ndarray:
+                md[k] = v.copy()  # So that the receiver can modify it
+        md.update(changed)
+        for k in changed:
+            # If the encoder doesn't keep this value, it will be sent again
+            prev.pop(k, None)
+        prev.update(_keep_values(changed))
+
+        self._seq = seq
+        return md, extra
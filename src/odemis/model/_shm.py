@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""
+Created on 17 Oct 2026
+
+Copyright © 2026 Delmic
+
+This file is part of Odemis.
+
+Odemis is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License version 2 as published by the Free Software
+Foundation.
+
+Odemis is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+Odemis. If not, see http://www.gnu.org/licenses/.
+"""
+
+# Shared-memory ring buffer, used by the DataFlows to pass large arrays to
+# subscribers in other processes without copying them through the kernel.
+# The publisher writes each array in the next slot of a memory segment located
+# in /dev/shm, and only sends the location of the slot (+ the metadata) over 0MQ.
+# The subscribers map the same segment (read-only) and copy the array out of
+# the slot.
+# Each slot starts with a small header containing the sequence number of the
+# array written. The subscriber checks it before and after copying the array
+# (as a seqlock), to detect that a slot has been overwritten (because it was
+# reading too slowly) and drop the array instead of passing on corrupted data.
+# As the segments are only removed by the publisher, the ones of a process
+# which has died are removed by remove_stale_segments().
+
+import itertools
+import logging
+import mmap
+import numpy
+import os
+import re
+import threading
+
+SHM_DIRECTORY = "/dev/shm"
+SLOT_HEADER_SIZE = 64  # bytes, to keep the data aligned on a cache line
+_SEQ_DTYPE = numpy.dtype("<u8")
+
+_segment_counter = itertools.count()
+
+
+def is_shm_available():
+    """
+    return (bool): True if shared memory segments can be created on this system
+    """
+    return os.path.isdir(SHM_DIRECTORY) and os.access(SHM_DIRECTORY, os.W_OK)
+
+
+def remove_stale_segments(prefix):
+    """
+    Remove the shared memory segments left over by processes which are not
+    running anymore (typically, because they crashed).
+    prefix (str): prefix of the segment names to look for
+    return (int): number of segments removed
+    """
+    prefix = prefix.replace("/", "_")
+    name_re = re.compile(re.escape(prefix) + r".*-(\d+)-\d+$")
+    try:
+        names = os.listdir(SHM_DIRECTORY)
+    except OSError:
+        return 0
+
+    removed = 0
+    for name in names:
+        m = name_re.match(name)
+        if not m:
+            continue
+        pid = int(m.group(1))
+        try:
+            os.kill(pid, 0)
+            continue  # Still running
+        except ProcessLookupError:
+            pass
+        except PermissionError:
+            continue  # Running, as another user
+        try:
+            os.unlink(os.path.join(SHM_DIRECTORY, name))
+            removed += 1
+            logging.info("Removed stale shared memory segment %s", name)
+        except OSError as ex:
+            logging.warning("Failed to remove stale shared memory segment %s: %s", name, ex)
+    return removed
+
+
+def _round_up(size, alignment=mmap.PAGESIZE):
+    return -(-size // alignment) * alignment
+
+
+class SharedMemoryRing(object):
+    """
+    Ring buffer of fixed size slots in a shared memory segment, written by the
+    publisher.
+    The segment is allocated on the first write, and re-allocated (with a new
+    name) whenever an array doesn't fit in a slot. As the old segment is only
+    unlinked, the subscribers which still have it mapped can keep using it.
+    """
+
+    def __init__(self, prefix, nslots=8):
+        """
+        prefix (str): prefix of the segment name, should be unique for the publisher
+        nslots (int > 0): number of slots in the ring. A slot is only overwritten
+          after nslots newer arrays have been written.
+        """
+        if nslots < 1:
+            raise ValueError("nslots must be at least 1, got %s" % (nslots,))
+        # The name of a file in /dev/shm cannot contain "/"
+        self._prefix = prefix.replace("/", "_")
+        self._nslots = nslots
+        self._slot_size = 0  # bytes, including the header
+        self._name = None
+        self._mmap = None
+        self._seq = 0  # sequence number of the last array written (0 = nothing written)
+        self._lock = threading.Lock()
+
+    @property
+    def name(self):
+        return self._name
+
+    def _allocate(self, nbytes):
+        """
+        Create a new segment with slots large enough to contain nbytes
+        """
+        self._free()
+        slot_size = _round_up(SLOT_HEADER_SIZE + nbytes, 64)
+        name = "%s-%d-%d" % (self._prefix, os.getpid(), next(_segment_counter))
+        path = os.path.join(SHM_DIRECTORY, name)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o660)
+        try:
+            os.ftruncate(fd, slot_size * self._nslots)
+            self._mmap = mmap.mmap(fd, slot_size * self._nslots, access=mmap.ACCESS_WRITE)
+        except Exception:
+            os.unlink(path)
+            raise
+        finally:
+            os.close(fd)
+
+        self._name = name
+        self._slot_size = slot_size
+        logging.debug("Allocated shared memory segment %s of %d x %d bytes",
+                      name, self._nslots, slot_size)
+
+    def _free(self):
+        if self._name is None:
+            return
+        try:
+            os.unlink(os.path.join(SHM_DIRECTORY, self._name))
+        except OSError:
+            logging.warning("Failed to unlink shared memory segment %s", self._name)
+        try:
+            self._mmap.close()
+        except BufferError:
+            # Some arrays still refer to it => it'll be unmapped when they are gone
+            pass
+        self._name = None
+        self._mmap = None
+        self._slot_size = 0
+
+    def write(self, data):
+        """
+        Copy an array into the next slot of the ring.
+        data (numpy.ndarray): the array to write. It doesn't need to be contiguous.
+        return (str, int, int): name of the segment, offset of the data in the
+          segment, and sequence number of the array.
+        """
+        with self._lock:
+            if SLOT_HEADER_SIZE + data.nbytes > self._slot_size:
+                self._allocate(data.nbytes)
+
+            self._seq += 1
+            slot_offset = (self._seq % self._nslots) * self._slot_size
+            seq = numpy.ndarray((1,), dtype=_SEQ_DTYPE, buffer=self._mmap, offset=slot_offset)
+            # Mark the slot as being written, so that a reader of the previous
+            # array in this slot never gets the partially overwritten data.
+            seq[0] = 0
+            dst = numpy.ndarray(data.shape, dtype=data.dtype, buffer=self._mmap,
+                                offset=slot_offset + SLOT_HEADER_SIZE)
+            dst[...] = data  # Handles strides
+            seq[0] = self._seq
+
+            return self._name, slot_offset, self._seq
+
+    def close(self):
+        """
+        Release the segment. The ring can still be used afterwards (a new
+        segment will be allocated).
+        """
+        with self._lock:
+            self._free()
+
+    def __del__(self):
+        try:
+            self._free()
+        except Exception:
+            pass
+
+
+class SharedMemoryReader(object):
+    """
+    Subscriber side of the SharedMemoryRing: maps the segments (read-only) and
+    copies the arrays out of the slots.
+    """
+
+    def __init__(self):
+        self._name = None
+        self._mmap = None
+
+    def _open(self, name):
+        path = os.path.join(SHM_DIRECTORY, name)
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            self._mmap = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+        # The previous mmap is not closed explicitly, as some arrays might
+        # still be using it. It's unmapped when the last of them is gone.
+        self._name = name
+
+    def read(self, name, offset, seq, dtype, shape):
+        """
+        Copy an array out of a slot.
+        name (str): name of the segment
+        offset (int): offset of the slot in the segment
+        seq (int): sequence number of the expected array
+        dtype (numpy.dtype): the type of the array
+        shape (tuple of int): the shape of the array
+        return (numpy.ndarray or None): copy of the array, or None if the slot
+          has already been (or is being) overwritten by a newer array.
+        raise OSError: if the segment cannot be opened
+        """
+        if name != self._name:
+            self._open(name)
+
+        slot_seq = numpy.ndarray((1,), dtype=_SEQ_DTYPE, buffer=self._mmap, offset=offset)
+        if int(slot_seq[0]) != seq:
+            return None
+
+        src = numpy.ndarray(shape, dtype=dtype, buffer=self._mmap,
+                            offset=offset + SLOT_HEADER_SIZE)
+        array = src.copy()
+
+        # The publisher could have started writing a new array in the slot
+        # while copying. There is no point retrying: the data is gone.
+        if int(slot_seq[0]) != seq:
+            return None
+        return array
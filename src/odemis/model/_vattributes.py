@@ -22,6 +22,7 @@ Odemis. If not, see http://www.gnu.org/licenses/.
 
 import Pyro4
 from Pyro4.core import oneway
+import collections
 from collections.abc import Iterable, Set
 import logging
 import numbers
@@ -29,8 +30,10 @@ import numpy
 from odemis.util.weak import WeakMethod, WeakRefLostError
 import os
 import threading
+import time
 import types
 import sys
+import weakref
 import zmq
 from scipy.spatial import distance
 
@@ -38,6 +41,12 @@ from . import _core
 from odemis.util import inspect_getmembers
 
 
+# Default minimum time (in s) between two messages of the VA updates of a
+# component. The updates happening during that time are coalesced into a
+# single message. A component can override it with a ._va_batch_window attribute.
+VA_BATCH_WINDOW = 0.005
+
+
 class NotSettableError(AttributeError):
     pass
 
@@ -137,6 +146,10 @@ class VigilantAttribute(VigilantAttributeBase):
 
         # different from ._listeners for notify() to do different things
         self._remote_listeners = set() # any unique string works
+        # Remote listeners receiving the updates via the multiplexer of a
+        # component: listener (str) -> address of the multiplexer
+        self._batched_listeners = {}
+        self._muxes = {}  # address -> VAMultiplexer, name of the VA in the multiplexer
 
         self._global_name = None # to be filled when registered
         self._ctx = None
@@ -287,6 +300,8 @@ class VigilantAttribute(VigilantAttributeBase):
             if self._remote_listeners:
                 logging.info("Unregistering %s while still %d remote listeners", self, len(self._remote_listeners))
                 self._remote_listeners.clear()
+            self._batched_listeners.clear()
+            self._muxes.clear()
 
             if self.pipe:
                 self.pipe.close()
@@ -323,17 +338,48 @@ class VigilantAttribute(VigilantAttributeBase):
         if isinstance(listener, str):
             # remove string from listeners
             self._remote_listeners.discard(listener)
+            self._batched_listeners.pop(listener, None)
         else:
             VigilantAttributeBase.unsubscribe(self, listener)
 
+    def _attach_multiplexer(self, mux, name):
+        """
+        Allow the remote listeners to receive the updates via the multiplexer
+        of a component.
+        mux (VAMultiplexer): the multiplexer
+        name (str): the name of this VA in the multiplexer
+        """
+        self._muxes[mux.address] = (mux, name)
+
+    def _subscribe_batched(self, listener, address):
+        """
+        Subscribe a remote listener which receives the updates via the
+        multiplexer of a component. Only to be called by the VigilantAttributeProxy.
+        listener (str): unique name of the remote listener
+        address (str): address of the multiplexer
+        return (bool): True if subscribed, False if the multiplexer is not
+          available, in which case the listener should use the standard subscription.
+        """
+        if address not in self._muxes:
+            return False
+        self._batched_listeners[listener] = address
+        return True
+
     def notify(self, v):
         if self.debug:
-            logging.debug("Notifying %d local and %d remote subscribers for v = %s",
-                          len(self._listeners), len(self._remote_listeners), v)
+            logging.debug("Notifying %d local and %d (+%d batched) remote subscribers for v = %s",
+                          len(self._listeners), len(self._remote_listeners),
+                          len(self._batched_listeners), v)
 
         # publish the data remotely
         if self._remote_listeners:
             self.pipe.send_pyobj(v)
+        if self._batched_listeners:
+            # If every value must be received, don't let the multiplexer coalesce them
+            coalesce = self.max_discard > 0
+            for address in set(self._batched_listeners.values()):
+                mux, name = self._muxes[address]
+                mux.post(name, v, coalesce)
 
         # publish locally
         VigilantAttributeBase.notify(self, v)
@@ -360,6 +406,8 @@ class VigilantAttributeProxy(VigilantAttributeBase, Pyro4.Proxy):
         self._ctx = None
         self._commands = None
         self._thread = None
+        self._batch_channel = None  # address of the multiplexer, name of the VA in it
+        self._demux = None
 
     def __getattr__(self, name):
         # Behaviour of .range and .choices remote attributes:
@@ -428,6 +476,17 @@ class VigilantAttributeProxy(VigilantAttributeBase, Pyro4.Proxy):
         self._ctx = None
         self._commands = None
         self._thread = None
+        self._batch_channel = None
+        self._demux = None
+
+    def _set_batch_channel(self, address, name):
+        """
+        Indicate that the updates of the VA can be received via the multiplexer
+        of its component. Only to be called by the ComponentProxy.
+        address (str): address of the multiplexer of the component
+        name (str): name of the VA in the multiplexer
+        """
+        self._batch_channel = (address, name)
 
     def _create_thread(self):
         logging.debug("Creating thread for VA %s", self._global_name)
@@ -450,6 +509,9 @@ class VigilantAttributeProxy(VigilantAttributeBase, Pyro4.Proxy):
         """
         start the remote subscription
         """
+        if self._batch_channel and self._start_listening_batched():
+            return
+
         if not self._thread:
             self._create_thread()
         self._commands.send(b"SUB")
@@ -464,17 +526,46 @@ class VigilantAttributeProxy(VigilantAttributeBase, Pyro4.Proxy):
         if len(self._listeners) == 0:
             self._stop_listening()
 
+    def _start_listening_batched(self):
+        """
+        start the remote subscription via the multiplexer of the component
+        return (bool): True if it worked, False if the standard subscription
+          should be used instead.
+        """
+        address, name = self._batch_channel
+        self._demux = _get_demultiplexer(address)
+        self._demux.register(name, self.notify)
+        try:
+            if Pyro4.Proxy.__getattr__(self, "_subscribe_batched")(self._proxy_name, address):
+                return True
+        except Exception:
+            logging.debug("Failed to subscribe to VA %s via multiplexer", self._global_name, exc_info=True)
+
+        # Probably an old server, or the VA is not part of the component anymore
+        self._demux.unregister(name, self.notify)
+        self._demux = None
+        self._batch_channel = None
+        return False
+
     def _stop_listening(self):
         """
         stop the remote subscription
         """
         Pyro4.Proxy.__getattr__(self, "unsubscribe")(self._proxy_name)
+        if self._demux:
+            self._demux.unregister(self._batch_channel[1], self.notify)
+            self._demux = None
         if self._commands:
             self._commands.send(b"UNSUB")
 
     def __del__(self):
         # end the thread (but it will stop as soon as it notices we are gone anyway)
         try:
+            if self._demux and len(self._listeners):
+                logging.warning("Stopping subscription while there are still subscribers "
+                                "because VA '%s' is going out of context",
+                                self._global_name)
+                Pyro4.Proxy.__getattr__(self, "unsubscribe")(self._proxy_name)
             if self._thread:
                 if self._thread.is_alive():
                     if len(self._listeners):
@@ -564,10 +655,243 @@ class SubscribeProxyThread(threading.Thread):
                     return
 
 
+class VAMultiplexer(object):
+    """
+    Publishes the updates of all the VAs of a component on a single 0MQ channel.
+    All the updates happening within a short time window are sent together as
+    one message, and if a VA changes several times during that window, only its
+    latest value is sent (unless the VA must not discard any value).
+    The first update after a quiet period is sent immediately, so that isolated
+    changes are not delayed.
+    """
+
+    def __init__(self, address, window=VA_BATCH_WINDOW):
+        """
+        address (str): unique name of the channel (used as ipc:// address)
+        window (0 <= float): minimum time (in s) between two messages
+        """
+        self.address = address
+        self.window = window
+        self._ctx = zmq.Context(1)
+        self._pipe = self._ctx.socket(zmq.PUB)
+        self._pipe.linger = 1  # don't keep messages more than 1s after close
+        self._pipe.bind("ipc://" + address)
+
+        self._lock = threading.Lock()
+        self._pending = collections.OrderedDict()  # name -> list of values
+        self._pending_ev = threading.Event()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="VA multiplexer " + address)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def post(self, name, value, coalesce=True):
+        """
+        Schedule the sending of a new value of a VA.
+        name (str): name of the VA
+        value: the new value
+        coalesce (bool): if True, replaces the value of the VA not yet sent (if any).
+          Otherwise, all the values are sent.
+        """
+        with self._lock:
+            if coalesce:
+                self._pending.pop(name, None)
+                self._pending[name] = [value]
+            else:
+                self._pending.setdefault(name, []).append(value)
+            self._pending_ev.set()
+
+    def _run(self):
+        try:
+            while True:
+                self._pending_ev.wait()
+                with self._lock:
+                    if self._closed:
+                        return
+                    updates = [(n, v) for n, vals in self._pending.items() for v in vals]
+                    self._pending.clear()
+                    self._pending_ev.clear()
+                self._pipe.send_pyobj(updates)
+                # Accumulate the next updates during the window
+                if self.window:
+                    time.sleep(self.window)
+        except Exception:
+            logging.exception("VA multiplexer %s failed", self.address)
+        finally:
+            self._pipe.close()
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self._pending_ev.set()
+        if self._thread is not threading.current_thread():
+            self._thread.join(5)
+            self._ctx.term()
+
+
+_mux_lock = threading.Lock()
+
+
+def attach_multiplexer(self, vas):
+    """
+    Create (if needed) the multiplexer of the VAs of a component, and attach
+    the given VAs to it.
+    self (Component): the object (instance of a class). It must already be
+                      registered to a Pyro daemon.
+    vas (dict string -> VigilantAttributeBase): attribute name -> VA
+    return (str): address of the multiplexer
+    """
+    with _mux_lock:
+        mux = getattr(self, "_va_mux", None)
+        if mux is None:
+            uri = self._pyroDaemon.uriFor(self)
+            address = uri.sockname + "@" + uri.object + ".vas"
+            window = getattr(self, "_va_batch_window", VA_BATCH_WINDOW)
+            mux = VAMultiplexer(address, window)
+            self._va_mux = mux
+
+    for name, va in vas.items():
+        if isinstance(va, VigilantAttribute):
+            va._attach_multiplexer(mux, name)
+    return mux.address
+
+
+class VADemultiplexer(object):
+    """
+    Receives the updates published by the VAMultiplexer of a component, and
+    dispatches them to the VigilantAttributeProxys. Only one per component and
+    per process, shared by all the proxies of the VAs of the component.
+    """
+
+    def __init__(self, address):
+        """
+        address (str): address of the multiplexer
+        """
+        self.address = address
+        self._lock = threading.Lock()
+        self._notifiers = {}  # name -> set of WeakMethod
+
+        self._ctx = zmq.Context(1)
+        self._commands = self._ctx.socket(zmq.PAIR)
+        self._commands.bind("inproc://" + address)
+        self._thread = DemultiplexerThread(self, address, self._ctx)
+        self._thread.start()
+        self._commands.send(b"SUB")
+        self._commands.recv()  # synchronise
+
+    def register(self, name, notifier):
+        """
+        name (str): name of the VA
+        notifier (callable): method to call when a new value arrives. Only a
+          weak reference is kept.
+        """
+        with self._lock:
+            self._notifiers.setdefault(name, set()).add(WeakMethod(notifier))
+
+    def unregister(self, name, notifier):
+        with self._lock:
+            notifiers = self._notifiers.get(name)
+            if notifiers is None:
+                return
+            notifiers.discard(WeakMethod(notifier))
+            if not notifiers:
+                del self._notifiers[name]
+
+    def dispatch(self, updates):
+        """
+        updates (list of (str, value)): name of the VA -> new value
+        """
+        for name, value in updates:
+            with self._lock:
+                notifiers = tuple(self._notifiers.get(name, ()))
+            for n in notifiers:
+                try:
+                    n(value)
+                except WeakRefLostError:
+                    with self._lock:
+                        self._notifiers.get(name, set()).discard(n)
+                except Exception:
+                    logging.exception("Failed to notify update of VA %s", name)
+
+    def __del__(self):
+        try:
+            self._commands.send(b"STOP")
+            self._commands.close()
+        except Exception:
+            pass
+
+
+class DemultiplexerThread(threading.Thread):
+    def __init__(self, demux, address, zmq_ctx):
+        """
+        demux (VADemultiplexer): the demultiplexer to pass the updates to. Only
+          a weak reference is kept, and the thread stops when it's gone.
+        address (str): address of the multiplexer
+        zmq_ctx (0MQ context): available 0MQ context to use
+        """
+        threading.Thread.__init__(self, name="zmq for VAs " + address)
+        self.daemon = True
+        self.w_demux = weakref.ref(demux)
+
+        self._commands = zmq_ctx.socket(zmq.PAIR)
+        self._commands.connect("inproc://" + address)
+        self.data = zmq_ctx.socket(zmq.SUB)
+        self.data.connect("ipc://" + address)
+
+    def run(self):
+        poller = zmq.Poller()
+        poller.register(self._commands, zmq.POLLIN)
+        poller.register(self.data, zmq.POLLIN)
+        try:
+            while True:
+                socks = dict(poller.poll())
+
+                if socks.get(self._commands) == zmq.POLLIN:
+                    message = self._commands.recv()
+                    if message == b"SUB":
+                        self.data.setsockopt(zmq.SUBSCRIBE, b'')
+                        self._commands.send(b"SUBD")
+                    elif message == b"STOP":
+                        return
+
+                if socks.get(self.data) == zmq.POLLIN:
+                    updates = self.data.recv_pyobj()
+                    demux = self.w_demux()
+                    if demux is None:
+                        return
+                    demux.dispatch(updates)
+                    del demux
+        finally:
+            self._commands.close()
+            self.data.close()
+
+
+_demuxes = weakref.WeakValueDictionary()  # address -> VADemultiplexer
+_demux_lock = threading.Lock()
+
+
+def _get_demultiplexer(address):
+    """
+    return (VADemultiplexer): the demultiplexer for the given address, shared
+      in the whole process.
+    """
+    with _demux_lock:
+        demux = _demuxes.get(address)
+        if demux is None:
+            demux = VADemultiplexer(address)
+            _demuxes[address] = demux
+        return demux
+
+
 def unregister_vigilant_attributes(self):
     for _, value in inspect_getmembers(self, lambda x: isinstance(x, VigilantAttribute)):
         value._unregister()
 
+    mux = getattr(self, "_va_mux", None)
+    if mux is not None:
+        mux.close()
+        self._va_mux = None
+
 
 def dump_vigilant_attributes(self):
     """
@@ -588,6 +912,34 @@ def dump_vigilant_attributes(self):
     return vas
 
 
+def describe_vigilant_attributes(self):
+    """
+    return the current state of all the VAs of an object (component), so that
+    it can be displayed without contacting each VA separately.
+    The VAs with a getter are not described, as reading their value typically
+    requires to contact the hardware, which can be slow.
+    self (Component): the object (instance of a class).
+    return (dict string -> dict): attribute name -> description of the VA, which
+      contains "value", and also "range" and "choices" if the VA has them.
+    """
+    descs = {}
+    for name, va in dump_vigilant_attributes(self).items():
+        if getattr(va, "_getter", None):
+            continue
+        try:
+            desc = {"value": va.value}
+            for attr in ("range", "choices"):
+                try:
+                    desc[attr] = getattr(va, attr)
+                except AttributeError:
+                    pass
+        except Exception:
+            logging.warning("Failed to read VA %s of %s", name, self, exc_info=True)
+            continue
+        descs[name] = desc
+    return descs
+
+
 def load_vigilant_attributes(self, vas):
     """
     duplicate the given VAs into the instance.
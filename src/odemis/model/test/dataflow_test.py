@@ -212,6 +212,7 @@ class TestDataFlow(unittest.TestCase):
 
         self.assertEqual(im.shape, self.size)
         self.assertIn("a", im.metadata)
+        self.assertGreaterEqual(self.df.getStatistics()["published"], 2)
 
         for i in range(number):
             # end early if it's already finished
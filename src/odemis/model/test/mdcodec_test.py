@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on 17 Oct 2026
+
+Copyright © 2026 Delmic
+
+This file is part of Odemis.
+
+Odemis is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License version 2 as published by the Free Software
+Foundation.
+
+Odemis is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+Odemis. If not, see http://www.gnu.org/licenses/.
+"""
+
+import logging
+import pickle
+import time
+import unittest
+
+import numpy
+
+from odemis import model
+from odemis.model import _mdcodec
+
+logging.getLogger().setLevel(logging.DEBUG)
+
+
+def _get_md(i):
+    return {
+        model.MD_ACQ_DATE: time.time(),
+        model.MD_EXP_TIME: 0.001,
+        model.MD_PIXEL_SIZE: (1e-6, 1e-6),
+        model.MD_POS: (1e-3, -2e-3),
+        model.MD_BINNING: (1, 1),
+        model.MD_HW_NAME: "Time correlator",
+        model.MD_DIMS: "T",
+        model.MD_DESCRIPTION: "Histogram %d" % (i // 10,),
+        model.MD_ROTATION: 0.0,
+        model.MD_TIME_LIST: None,
+        "Custom key": [1, 2, 3],
+    }
+
+
+class TestMetadataCodec(unittest.TestCase):
+
+    def test_delta(self):
+        enc = _mdcodec.MetadataEncoder(delta_min_size=0)
+        dec = _mdcodec.MetadataDecoder()
+        md = _get_md(0)
+        msg_full = enc.encode(md, ("uint16", (1024,)))
+        rmd, extra = dec.decode(msg_full)
+        self.assertEqual(rmd, md)
+        self.assertEqual(extra, ("uint16", (1024,)))
+
+        # Only the date changes => much smaller message
+        md[model.MD_ACQ_DATE] += 1
+        msg_delta = enc.encode(md, ("uint16", (1024,)))
+        self.assertLess(len(msg_delta), len(msg_full) / 3)
+        rmd, extra = dec.decode(msg_delta)
+        self.assertEqual(rmd, md)
+
+        # Remove a key, add another one, modify a list in-place
+        del md[model.MD_ROTATION]
+        md[model.MD_GAIN] = 2
+        md["Custom key"].append(4)
+        rmd, extra = dec.decode(enc.encode(md))
+        self.assertEqual(rmd, md)
+        self.assertIsNone(extra)
+
+        # Modifying the received metadata doesn't affect the next ones
+        rmd["Custom key"].append(5)
+        rmd[model.MD_GAIN] = 3
+        rmd, extra = dec.decode(enc.encode(md))
+        self.assertEqual(rmd, md)
+
+    def test_missed_message(self):
+        enc = _mdcodec.MetadataEncoder(keyframe_interval=5, keyframe_period=1000, delta_min_size=0)
+        dec = _mdcodec.MetadataDecoder()
+        md = _get_md(0)
+
+        # Starting on a delta message
+        enc.encode(md)
+        self.assertIsNone(dec.decode(enc.encode(md)))
+
+        for i in range(20):
+            md = _get_md(i)
+            msg = enc.encode(md)
+            if i == 7:
+                continue  # missed message
+            ret = dec.decode(msg)
+            if i < 4 or i in (8, 9):
+                # Can only decode again on the next key frame
+                self.assertIsNone(ret)
+            else:
+                self.assertEqual(ret[0], md)
+
+        # A reset forces a key frame
+        enc.reset()
+        dec = _mdcodec.MetadataDecoder()
+        self.assertEqual(dec.decode(enc.encode(md))[0], md)
+
+    def test_small(self):
+        """
+        Small metadata is always sent completely
+        """
+        enc = _mdcodec.MetadataEncoder()
+        dec = _mdcodec.MetadataDecoder()
+        md = {model.MD_EXP_TIME: 0.001, model.MD_ACQ_DATE: time.time()}
+        msg_full = enc.encode(md)
+        md[model.MD_ACQ_DATE] += 1
+        msg = enc.encode(md)
+        self.assertEqual(len(msg), len(msg_full))
+        # So missing a message doesn't matter
+        rmd, extra = dec.decode(msg)
+        self.assertEqual(rmd, md)
+
+    def test_types(self):
+        """
+        The values are received with the same type, and the mutable ones are
+        independent from the ones of the previous messages
+        """
+        enc = _mdcodec.MetadataEncoder(delta_min_size=0)
+        dec = _mdcodec.MetadataDecoder()
+        md = {model.MD_POS: (1, 2), model.MD_WL_LIST: [1e-9, 2e-9],
+              model.MD_BASELINE: numpy.float32(2), "Custom key": {1, 2},
+              model.MD_TIME_LIST: numpy.arange(10) * 1e-9}
+        for i in range(3):
+            rmd, extra = dec.decode(enc.encode(md))
+            self.assertEqual(rmd.keys(), md.keys())
+            for k, v in md.items():
+                self.assertIs(type(rmd[k]), type(v))
+                if isinstance(v, numpy.ndarray):
+                    numpy.testing.assert_array_equal(rmd[k], v)
+                else:
+                    self.assertEqual(rmd[k], v)
+            rmd[model.MD_WL_LIST].append(3e-9)
+            rmd[model.MD_TIME_LIST][0] = 1
+            # Same value, but different type
+            md[model.MD_POS] = (1.0, 2.0)
+            # Array modified in-place
+            md[model.MD_TIME_LIST][1] = i
+
+    def _measure_speed(self, mds, data):
+        """
+        return (float, int, float, int): number of messages per second and size
+          of a message, with the pickle format (as used before), and with the codec
+        """
+        tstart = time.time()
+        for md in mds:
+            msg = pickle.dumps({"dtype": str(data.dtype), "shape": data.shape, "metadata": md},
+                               pickle.DEFAULT_PROTOCOL)
+            pickle.loads(msg)
+        rate_pickle = len(mds) / (time.time() - tstart)
+        len_pickle = len(msg)
+
+        enc = _mdcodec.MetadataEncoder()
+        dec = _mdcodec.MetadataDecoder()
+        tstart = time.time()
+        for md in mds:
+            msg = enc.encode(md, (str(data.dtype), data.shape))
+            dec.decode(msg)
+        rate_codec = len(mds) / (time.time() - tstart)
+        len_codec = len(msg)
+        return rate_pickle, len_pickle, rate_codec, len_codec
+
+    def test_speed(self):
+        """
+        Compare the number of messages per second which can be encoded/decoded,
+        with the pickle format (as used before). The rates depend on the load
+        of the computer, so they are only reported.
+        """
+        n = 5000
+        data = numpy.zeros(64, dtype=numpy.uint32)
+
+        # Small metadata => same as pickle (+ the header)
+        mds = [_get_md(i) for i in range(n)]
+        rate_pickle, len_pickle, rate_codec, len_codec = self._measure_speed(mds, data)
+        logging.info("Small metadata: pickle: %d msg/s (%d bytes), codec: %d msg/s (%d bytes)",
+                     rate_pickle, len_pickle, rate_codec, len_codec)
+
+        # Large metadata, mostly unchanged => delta is faster and smaller
+        wl = tuple(float(w) for w in numpy.linspace(400e-9, 800e-9, 1000))
+        mds = [dict(_get_md(i), **{model.MD_WL_LIST: wl}) for i in range(n)]
+        rate_pickle, len_pickle, rate_codec, len_codec = self._measure_speed(mds, data)
+        logging.info("Large metadata: pickle: %d msg/s (%d bytes), codec: %d msg/s (%d bytes)",
+                     rate_pickle, len_pickle, rate_codec, len_codec)
+        self.assertLess(len_codec, len_pickle)
+
+        # Time correlator: the time list (the same for every histogram) is
+        # larger than the data
+        data = numpy.zeros(65536, dtype=numpy.uint32)
+        base_md = _get_md(0)
+        base_md[model.MD_TIME_LIST] = numpy.arange(data.shape[0]) * 4e-12
+        mds = []
+        for i in range(n // 10):
+            md = base_md.copy()  # As the drivers do
+            md[model.MD_ACQ_DATE] = time.time()
+            mds.append(md)
+        rate_pickle, len_pickle, rate_codec, len_codec = self._measure_speed(mds, data)
+        logging.info("Time list: pickle: %d msg/s (%d bytes), codec: %d msg/s (%d bytes)",
+                     rate_pickle, len_pickle, rate_codec, len_codec)
+        self.assertLess(len_codec, len_pickle / 100)
+
+
+if __name__ == "__main__":
+    unittest.main()
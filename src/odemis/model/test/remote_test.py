@@ -34,7 +34,7 @@ import numpy
 import Pyro4
 
 from odemis import model
-from odemis.model import VigilantAttributeBase, isasync, oneway, roattribute
+from odemis.model import VigilantAttributeBase, _shm, isasync, oneway, roattribute
 from odemis.util import executeAsyncTask, mock, timeout, testing
 
 logging.basicConfig(format="%(asctime)s  %(levelname)-7s %(module)-15s: %(message)s")
@@ -99,6 +99,31 @@ class ContainerTest(unittest.TestCase):
         # we are not terminating the children, but this should be caught by the container
         container.terminate()
 
+    def test_describe(self):
+        container, comp = model.createInNewContainer("testdesc", MyComponent, {"name": "MyComp"})
+        comp2 = container.instantiate(FatherComponent, {"name": "Father", "children_num": 2})
+
+        descs = model.describeComponents([comp])
+        self.assertEqual(set(descs.keys()), {"MyComp"})
+        desc = descs["MyComp"]
+        self.assertEqual(desc["component"].name, "MyComp")
+        self.assertEqual(desc["vas"]["prop"]["value"], comp.prop.value)
+        self.assertNotIn("range", desc["vas"]["prop"])
+        self.assertEqual(desc["vas"]["cont"]["range"], comp.cont.range)
+        self.assertEqual(desc["vas"]["enum"]["choices"], comp.enum.choices)
+        # The VAs with a getter are not read
+        self.assertNotIn("hwval", desc["vas"])
+
+        # All the components of the container are described in a single call
+        descs = container.describe()
+        self.assertEqual(set(descs.keys()), {"MyComp", "Father", "child0", "child1"})
+        children = descs["Father"]["vas"]["children"]["value"]
+        self.assertEqual({c.name for c in children}, {"child0", "child1"})
+
+        comp2.terminate()
+        comp.terminate()
+        container.terminate()
+
     def test_timeout(self):
         if Pyro4.config.COMMTIMEOUT == 0 or Pyro4.config.COMMTIMEOUT > 20:
             self.skipTest("Timeout too long (%d s) to test." % Pyro4.config.COMMTIMEOUT)
@@ -623,6 +648,99 @@ class RemoteTest(unittest.TestCase):
         dfs.synchronizedOn(None)
         self.assertEqual(dfs.get_event_type(), None)
 
+    def test_dataflow_shm(self):
+        """
+        Check receiving data via shared memory
+        """
+        self.count = 0
+        self.expected_shape = (2048, 2048)
+        self.data_arrays_sent = 0
+        df = self.comp.data
+        df.reset()
+
+        df.use_shm = True
+        self.last_data = None
+        df.subscribe(self.receive_data_keep)
+        time.sleep(0.5)
+        df.unsubscribe(self.receive_data_keep)
+        count_end = self.count
+        print("received %d arrays over %d" % (self.count, self.data_arrays_sent))
+
+        time.sleep(0.1)
+        self.assertEqual(count_end, self.count)
+        self.assertGreaterEqual(count_end, 1)
+
+        # The data is copied out of the shared memory, so it stays valid
+        self.assertIsInstance(self.last_data, model.DataArray)
+        self.assertTrue(self.last_data.flags.writeable)
+        idx = int(self.last_data[0, 0])
+        self.assertEqual(self.last_data[idx % 2048, 1], 255)
+
+        # Stridden arrays are also supported
+        self.count = 0
+        self.expected_shape = (2048, 2045)
+        self.comp.cut.value = 3
+        df.subscribe(self.receive_data)
+        time.sleep(0.5)
+        df.unsubscribe(self.receive_data)
+        self.comp.cut.value = 0
+        self.assertGreaterEqual(self.count, 1)
+
+    def test_dataflow_shm_speed(self):
+        """
+        Compare the throughput of the standard and the shared memory transports
+        """
+        df = self.comp.data
+        df.setPeriod(0)
+        self.expected_shape = (2048, 2048)
+        fps = {}
+        for use_shm in (False, True):
+            self.count = 0
+            self.data_arrays_sent = 0
+            df.reset()
+            df.use_shm = use_shm
+            df.subscribe(self.receive_data)
+            time.sleep(2)
+            df.unsubscribe(self.receive_data)
+            fps[use_shm] = self.count / 2
+            self.assertGreaterEqual(self.count, 1)
+        df.setPeriod(0.05)
+        logging.info("Received %g fps via 0MQ, %g fps via shared memory", fps[False], fps[True])
+
+    def test_dataflow_slow_subscriber(self):
+        """
+        Check that a slow subscriber only receives the latest data, and that
+        it's reported in the statistics
+        """
+        df = self.comp.data
+        df.setPeriod(0.005)
+        df.reset()
+        self.received_idx = []
+        df.subscribe(self.receive_data_slow)
+        time.sleep(2.5)  # more than the report period
+        df.unsubscribe(self.receive_data_slow)
+        df.setPeriod(0.05)
+
+        stats = df.getStatistics()
+        logging.info("Received %d arrays, with statistics %s", len(self.received_idx), stats)
+        self.assertGreaterEqual(len(self.received_idx), 5)
+        # Some arrays have been skipped, but always delivered in order
+        self.assertGreater(self.received_idx[-1] - self.received_idx[0], len(self.received_idx))
+        self.assertEqual(self.received_idx, sorted(self.received_idx))
+        self.assertGreater(stats["published"], len(self.received_idx))
+        # The subscriber is gone, so no more statistics about it
+        self.assertEqual(stats["subscribers"], {})
+
+    def receive_data_slow(self, dataflow, data):
+        self.received_idx.append(int(data[0][0]))
+        if len(self.received_idx) == 15:
+            # Check the statistics while still subscribed
+            stats = dataflow.getStatistics()
+            self.assertLessEqual(stats["queue depth"], 2)
+            if stats["subscribers"]:
+                self.assertGreater(stats["dropped"], 0)
+        time.sleep(0.1)
+
 #    @unittest.skip("simple")
     def test_dataflow_stridden(self):
         # test that stridden array can be passed (even if less efficient)
@@ -669,6 +787,10 @@ class RemoteTest(unittest.TestCase):
             self.data_arrays_sent = data[0][0]
             self.assertGreaterEqual(self.data_arrays_sent, self.count)
 
+    def receive_data_keep(self, dataflow, data):
+        self.receive_data(dataflow, data)
+        self.last_data = data
+
     def receive_data_auto_unsub(self, dataflow, data):
         """
         callback for df
@@ -762,6 +884,37 @@ class RemoteTest(unittest.TestCase):
         except TypeError:
             pass # as it should be
 
+    def test_va_batched(self):
+        """
+        Check that the rapid updates of VAs of the same component are coalesced
+        """
+        prop = self.comp.prop
+        cont = self.comp.cont
+        self.assertIsNotNone(prop._batch_channel)
+
+        self.called = 0
+        self.last_value = None
+        prop.subscribe(self.receive_va_update)
+        self.cont_values = []
+        cont.subscribe(self.receive_cont_update)
+        time.sleep(0.01)  # It can take some time to subscribe
+
+        n = 1000
+        self.comp.change_props_many(n)
+        time.sleep(0.2)  # give time to receive notifications
+        prop.unsubscribe(self.receive_va_update)
+        cont.unsubscribe(self.receive_cont_update)
+
+        # The last value is always received, but much less updates than changes
+        logging.info("Received %d updates for %d changes", self.called, n)
+        self.assertEqual(self.last_value, n)
+        self.assertGreaterEqual(self.called, 1)
+        self.assertLess(self.called, n)
+        self.assertEqual(self.cont_values[-1], (n % 3) + 0.5)
+
+    def receive_cont_update(self, value):
+        self.cont_values.append(value)
+
     def receive_va_update(self, value):
         logging.debug("Update va to %s", value)
         self.called += 1
@@ -851,6 +1004,61 @@ def ServerLoop(socket_name):
     daemon.close()
 
 
+class SharedMemoryTest(unittest.TestCase):
+    """
+    Test the shared memory ring buffer used by the DataFlows
+    """
+
+    def test_shm_ring_overwrite(self):
+        """
+        Check an array overwritten in the shared memory ring is dropped
+        """
+        if not _shm.is_shm_available():
+            self.skipTest("Shared memory not available")
+        ring = _shm.SharedMemoryRing("odemis-test-ring", nslots=2)
+        reader = _shm.SharedMemoryReader()
+        try:
+            arrays = [numpy.full((10, 20), i, dtype=numpy.uint16) for i in range(3)]
+            locs = [ring.write(a) for a in arrays]
+            # The first slot has been reused for the third array
+            name, offset, seq = locs[0]
+            self.assertIsNone(reader.read(name, offset, seq, numpy.uint16, (10, 20)))
+            for a, (name, offset, seq) in zip(arrays[1:], locs[1:]):
+                r = reader.read(name, offset, seq, numpy.uint16, (10, 20))
+                numpy.testing.assert_array_equal(r, a)
+            # The array read is independent from the slot
+            ring.write(arrays[0])
+            ring.write(arrays[0])
+            numpy.testing.assert_array_equal(r, arrays[2])
+        finally:
+            ring.close()
+
+    def test_shm_remove_stale(self):
+        """
+        Check the segments of dead processes are removed, and the others kept
+        """
+        if not _shm.is_shm_available():
+            self.skipTest("Shared memory not available")
+        # Find a PID which is not used
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0)
+        os.waitpid(pid, 0)
+
+        stale = os.path.join(_shm.SHM_DIRECTORY, "odemis-test-stale-obj-%d-0" % (pid,))
+        alive = os.path.join(_shm.SHM_DIRECTORY, "odemis-test-stale-obj-%d-0" % (os.getpid(),))
+        for p in (stale, alive):
+            open(p, "w").close()
+        try:
+            self.assertEqual(_shm.remove_stale_segments("odemis-test-stale-"), 1)
+            self.assertFalse(os.path.exists(stale))
+            self.assertTrue(os.path.exists(alive))
+        finally:
+            for p in (stale, alive):
+                if os.path.exists(p):
+                    os.remove(p)
+
+
 class MyError(Exception):
     pass
 
@@ -905,6 +1113,10 @@ class MyComponent(model.Component):
         self.enum = model.StringEnumerated("a", {"a", "c", "bfds"})
         self.cut = model.IntVA(0, setter=self._setCut)
         self.listval = model.ListVA([2, 65])
+        self.hwval = model.FloatVA(1.5, getter=self._getHwVal, readonly=True)
+
+    def _getHwVal(self):
+        return 1.5
 
     def _setCut(self, value):
         self.data.cut = value
@@ -934,6 +1146,14 @@ class MyComponent(model.Component):
         """
         self.prop.value = value
 
+    def change_props_many(self, n):
+        """
+        Update quickly the VAs prop and cont, n times each
+        """
+        for i in range(1, n + 1):
+            self.prop.value = i
+            self.cont.value = (i % 3) + 0.5
+
     @isasync
     def do_long(self, duration=5):
         """
@@ -1048,6 +1268,7 @@ class FakeDataFlow(model.DataFlow):
         self._thread = None
         self.count = 0
         self.cut = 0 # to test non stride arrays
+        self.period = 0.05  # s, time between two arrays generated
         self._startAcquire = sae
 
     def _create_one(self, shape, bpp, index):
@@ -1072,6 +1293,9 @@ class FakeDataFlow(model.DataFlow):
         if bpp is not None:
             self.bpp = bpp
 
+    def setPeriod(self, period):
+        self.period = period
+
     def get(self):
         array = self._create_one(self.shape, self.bpp, 0)
         if len(array):
@@ -1105,7 +1329,7 @@ class FakeDataFlow(model.DataFlow):
                 array[0][0] = self.count
 #            print "generating array %d" % self.count
             self.notify(array)
-            time.sleep(0.05) # wait a bit see if the subscribers still want data
+            time.sleep(self.period) # wait a bit see if the subscribers still want data
 
 
 class SynchronizableDataFlow(model.DataFlow):
@@ -47,6 +47,8 @@ from odemis.util.driver import (BACKEND_DEAD, BACKEND_RUNNING,
                                 get_backend_status)
 
 DEFAULT_SETTINGS_FILE = "/etc/odemis-settings.yaml"
+# Maximum number of components instantiated simultaneously
+MAX_PARALLEL_INIT = 8
 
 status_to_xtcode = {BACKEND_RUNNING: 0,
                     BACKEND_DEAD: 1,
@@ -62,7 +64,8 @@ class BackendContainer(model.Container):
     """
 
     def __init__(self, model_file, settings_file, create_sub_containers=False,
-                 dry_run=False, strict_children: bool = False, name=model.BACKEND_NAME):
+                 dry_run=False, strict_children: bool = False, name=model.BACKEND_NAME,
+                 max_parallel_init=MAX_PARALLEL_INIT):
         """
         inst_file (file): opened file that contains the yaml
         settings_file (file): opened file that contains the persistent data
@@ -73,6 +76,8 @@ class BackendContainer(model.Container):
           model without actually any driver contacting the hardware.
         strict_children: If True, make the microscope file syntax check stricter, and explicitly
         distinguish between children and dependencies.
+        max_parallel_init (int > 0): maximum number of components which are
+          instantiated simultaneously. 1 instantiates them one at a time.
         """
         model.Container.__init__(self, name)
 
@@ -82,7 +87,10 @@ class BackendContainer(model.Container):
         self._inst_thread = None # thread running the component instantiation
         self._must_stop = threading.Event()
         self._dry_run = dry_run
-        # TODO: have an argument to ask for disabling parallel start? same as create_sub_containers?
+        self._max_parallel_init = max_parallel_init
+        # Protects the read-modify-write of .ghosts and .alive of the microscope,
+        # and the persistent data, as components are instantiated in parallel
+        self._comps_lock = threading.RLock()
 
         # parse the instantiation file
         logging.debug("model instantiation file is: %s", self._model.name)
@@ -191,7 +199,11 @@ class BackendContainer(model.Container):
     def _instantiate_all(self):
         """
         Thread continuously monitoring the components that need to be instantiated
+        The components are instantiated in parallel, as soon as all the components
+        they depend on are instantiated.
         """
+        executor = None
+        starting = {}  # str -> Future returning set of HwComponents: the components being instantiated
         try:
             # Hack warning: there is a bug in python when using lock (eg, logging)
             # and simultaneously using threads and process: is a thread acquires
@@ -201,49 +213,67 @@ class BackendContainer(model.Container):
             # threads have started (and logging nothing) before creating new processes.
             time.sleep(1)
 
+            # For the same reason, create all the containers (processes) before
+            # the components are instantiated in parallel.
+            tstart = time.time()
+            self._instantiator.create_all_containers()
+            executor = futures.ThreadPoolExecutor(max_workers=self._max_parallel_init,
+                                                  thread_name_prefix="Component instantiator")
+
             mic = self._instantiator.microscope
             failed = set() # set of str: name of components that failed recently
             while not self._must_stop.is_set():
-                # Try to start simultaneously all the components that are
-                # independent from each other
-                nexts = set()
-                while not nexts:
-                    instantiated = set(c.name for c in mic.alive.value) | {mic.name}
-                    nexts = self._instantiator.get_instantiables(instantiated)
-                    # If still some non-failed component, immediately try again,
-                    # otherwise give some time for things to get fixed or broken
-                    nexts -= failed
-                    if not nexts:
-                        if self._dry_run:
-                            return # everything instantiated, good enough
+                # Start simultaneously all the components that are independent
+                # from each other, and from the ones currently starting
+                instantiated = set(c.name for c in mic.alive.value) | {mic.name}
+                nexts = self._instantiator.get_instantiables(instantiated)
+                nexts -= failed | set(starting.keys())
+                if nexts:
+                    logging.debug("Trying to instantiate comps: %s", ", ".join(nexts))
+                for n in nexts:
+                    if self._instantiator.needs_new_container(n):
+                        # The container failed to be created beforehand. Only
+                        # try again when no other component is being instantiated.
+                        if starting:
+                            continue
+                        try:
+                            self._instantiator.create_container(n)
+                        except Exception:
+                            logging.exception("Failed to create container for component %s", n)
+                            failed.add(n)
+                            continue
+                    with self._comps_lock:
+                        ghosts = mic.ghosts.value.copy()
+                        if n not in ghosts:
+                            logging.warning("going to instantiate %s but not a ghost", n)
+                        ghosts[n] = ST_STARTING
+                        mic.ghosts.value = ghosts
+                    starting[n] = executor.submit(self._instantiate_component, n)
 
-                        if self._must_stop.wait(10):
-                            return
-                        failed = set() # not recent anymore
+                if not starting:
+                    if not mic.ghosts.value and tstart is not None:
+                        self._log_init_durations(time.time() - tstart)
+                        tstart = None
 
-                logging.debug("Trying to instantiate comps: %s", ", ".join(nexts))
+                    # If still some non-failed component, immediately try again,
+                    # otherwise give some time for things to get fixed or broken
+                    if self._dry_run:
+                        return # everything instantiated, good enough
 
-                for n in nexts:
-                    ghosts = mic.ghosts.value.copy()
-                    if n not in ghosts:
-                        logging.warning("going to instantiate %s but not a ghost", n)
-                    # TODO: run each of them in a future, so that they start
-                    # in parallel, and (bonus) when the future is done, check
-                    # immediately which component can be started. The only
-                    # difficulty is to ensure non-concurrent access to .ghosts
-                    # and .alive .
+                    if self._must_stop.wait(10):
+                        return
+                    failed = set() # not recent anymore
+                    continue
+
+                # As soon as one component is ready, check which components can
+                # now be instantiated
+                futures.wait(starting.values(), return_when=futures.FIRST_COMPLETED)
+                for n, f in list(starting.items()):
+                    if not f.done():
+                        continue
+                    del starting[n]
                     try:
-                        ghosts[n] = ST_STARTING
-                        mic.ghosts.value = ghosts
-                        newcmps = self._instantiate_component(n)
-                        if self._must_stop.is_set():
-                            # in case the termination was too late to stop these new component
-                            for c in newcmps:
-                                try:
-                                    c.terminate()
-                                except Exception:
-                                    logging.warning("Failed to terminate component '%s'", c.name, exc_info=True)
-                            break
+                        newcmps = f.result()
                     except ValueError:
                         if self._dry_run:
                             raise
@@ -254,16 +284,52 @@ class BackendContainer(model.Container):
                         return
                     if not newcmps:
                         failed.add(n)
+                    elif self._must_stop.is_set():
+                        # in case the termination was too late to stop these new component
+                        self._terminate_new_components(newcmps)
 
         except Exception:
             logging.exception("Instantiator thread failed")
             raise
         finally:
+            # Wait for the components still being instantiated, and stop them
+            # (as the instantiation is over)
+            for n, f in starting.items():
+                try:
+                    newcmps = f.result()
+                except Exception:
+                    continue  # Already reported
+                self._terminate_new_components(newcmps)
+            if executor:
+                executor.shutdown(wait=False)
             logging.debug("Instantiator thread finished")
 
+    def _terminate_new_components(self, comps):
+        """
+        Stop components which have been instantiated after the instantiation was stopped
+        comps (set of HwComponent): the components to terminate
+        """
+        for c in comps:
+            try:
+                c.terminate()
+            except Exception:
+                logging.warning("Failed to terminate component '%s'", c.name, exc_info=True)
+
+    def _log_init_durations(self, total):
+        """
+        Report how long it took to instantiate each component
+        total (float): time (s) it took to instantiate all the components
+        """
+        durations = self._instantiator.init_durations
+        logging.info("All components instantiated in %g s (sum of instantiation times: %g s)",
+                     total, sum(durations.values()))
+        for n, d in sorted(durations.items(), key=lambda i: i[1], reverse=True):
+            logging.info("  %s: %g s", n, d)
+
     def _instantiate_component(self, name):
         """
         Instantiate a component and handle the outcome
+        Can be called simultaneously from several threads.
         return (set of HwComponent): all the components instantiated, so it is an
           empty set if the component failed to instantiate (due to HwError)
         raise ValueError: if the component failed so badly to instantiate that
@@ -272,15 +338,16 @@ class BackendContainer(model.Container):
         # TODO: use the AST from the microscope (instead of the original one
         # in _instantiator) to allow modifying it online?
         mic = self._instantiator.microscope
-        ghosts = mic.ghosts.value.copy()
         try:
             comp = self._instantiator.instantiate_component(name)
         except model.HwError as exp:
             # HwError means: hardware problem, try again later
             logging.warning("Failed to start component %s due to device error: %s",
                             name, exp)
-            ghosts[name] = exp
-            mic.ghosts.value = ghosts
+            with self._comps_lock:
+                ghosts = mic.ghosts.value.copy()
+                ghosts[name] = exp
+                mic.ghosts.value = ghosts
             return set()
         except Exception as exp:
             # Anything else means: microscope file or driver is borked => give up
@@ -307,19 +374,21 @@ class BackendContainer(model.Container):
                 logging.warning("Component %s instantiated extra unexpected components %s",
                                 name, new_names - exp_names)
 
-            mic.alive.value = mic.alive.value | new_cmps
-            # update ghosts by removing all the new components
-            dchildren = self._instantiator.get_children_names(name)
-            for n in dchildren:
-                del ghosts[n]
+            with self._comps_lock:
+                mic.alive.value = mic.alive.value | new_cmps
+                # update ghosts by removing all the new components
+                ghosts = mic.ghosts.value.copy()
+                dchildren = self._instantiator.get_children_names(name)
+                for n in dchildren:
+                    del ghosts[n]
 
-            mic.ghosts.value = ghosts
+                mic.ghosts.value = ghosts
 
-            for c in new_cmps:
-                prop_names, _ = self._instantiator.get_persistent(c.name)
-                for prop_name in prop_names:
-                    self._observe_persistent_va(c, prop_name)
-            self._update_persistent_metadata()
+                for c in new_cmps:
+                    prop_names, _ = self._instantiator.get_persistent(c.name)
+                    for prop_name in prop_names:
+                        self._observe_persistent_va(c, prop_name)
+                self._update_persistent_metadata()
 
             return new_cmps
 
@@ -580,6 +649,9 @@ class BackendRunner(object):
             logging.error("Failed to create back-end directory " + model.BASE_DIRECTORY)
             raise
 
+        # A back-end which crashed cannot have removed its shared memory segments
+        model.remove_stale_shm_segments()
+
         # create the root container
         try:
             # create daemon for containing the backend container
@@ -29,6 +29,8 @@ import itertools
 import logging
 import os
 import re
+import threading
+import time
 import yaml
 
 from odemis import model
@@ -259,7 +261,12 @@ class Instantiator(object):
         self._microscope_ast = None # the definition of the Microscope
         self.components = set() # all the components created
         self.sub_containers = {}  # container's name -> container: all the sub-containers created for the components
+        self._idle_containers = set()  # names of the sub-containers not (yet) running their component
         self._comp_container = {}  # comp name -> container: the container that runs the given component
+        self.init_durations = {}  # comp name -> float: time (s) it took to instantiate the component
+        # Protects .components, ._comp_container and .sub_containers, as
+        # components can be instantiated from several threads simultaneously
+        self._lock = threading.RLock()
         self.create_sub_containers = create_sub_containers # flag for creating sub-containers
         self.dry_run = dry_run # flag for instantiating mock version of the components
         self.strict_children = strict_children  # Flag to indicate
@@ -650,6 +657,47 @@ class Instantiator(object):
         # Multiple dependencies -> just use the root container then
         return self.root_container
 
+    def needs_new_container(self, name):
+        """
+        Check whether a new container (process) must be created before
+        instantiating a component
+        name (str): name of a component which could be instantiated
+        return (bool): True if create_container() must be called first
+        """
+        with self._lock:
+            return (self.create_sub_containers and name not in self._idle_containers
+                    and self._get_container(name) is None)
+
+    def create_container(self, name):
+        """
+        Create the container (process) in which a component will be instantiated.
+        Creating a process while other threads are running is risky (the locks
+        held by these threads are copied locked), so this should only be called
+        when no component is being instantiated.
+        name (str): name of the component, which is also the name of the container
+        """
+        cont = model.createNewContainer(name, validate=False)
+        with self._lock:
+            self.sub_containers[name] = cont
+            self._idle_containers.add(name)
+
+    def create_all_containers(self):
+        """
+        Create the containers of all the components which run in their own
+        container. To be called before instantiating any component.
+        Failures are only logged, as the container will be created again
+        when instantiating the component.
+        """
+        for name, attrs in self.ast.items():
+            if "class" not in attrs or attrs["class"] == "Microscope":
+                continue
+            if not self.needs_new_container(name):
+                continue
+            try:
+                self.create_container(name)
+            except Exception:
+                logging.exception("Failed to create container for component %s", name)
+
     def _instantiate_comp(self, name):
         """
         Instantiate a component
@@ -694,22 +742,38 @@ class Instantiator(object):
         try:
             cont = self._get_container(name)
             if cont is None:
-                # new container has the same name as the component
-                cont, comp = model.createInNewContainer(name, class_comp, args)
-                self.sub_containers[name] = cont
+                # The container has the same name as the component. It should
+                # have been created beforehand, when instantiating components
+                # from several threads (see create_container()).
+                if self.needs_new_container(name):
+                    self.create_container(name)
+                with self._lock:
+                    cont = self.sub_containers[name]
+                    self._idle_containers.discard(name)
+                try:
+                    comp = model.createInContainer(cont, class_comp, args)
+                except Exception:
+                    # Keep the container for the next try, to not have to create
+                    # a new process (which cannot be done safely while
+                    # other components are instantiated).
+                    with self._lock:
+                        self._idle_containers.add(name)
+                    raise
             else:
                 logging.debug("Creating %s in container %s", name, cont)
                 comp = model.createInContainer(cont, class_comp, args)
-            self._comp_container[name] = cont
         except Exception:
             logging.error("Error while instantiating component %s.", name)
             raise
 
-        self.components.add(comp)
-        # Add all the children, which were created by delegation, to our list of components.
-        self.components |= comp.children.value
-        for child in comp.children.value:
-            self._comp_container[child.name] = cont
+        children = comp.children.value
+        with self._lock:
+            self._comp_container[name] = cont
+            self.components.add(comp)
+            # Add all the children, which were created by delegation, to our list of components.
+            self.components |= children
+            for child in children:
+                self._comp_container[child.name] = cont
 
         return comp
 
@@ -721,7 +785,9 @@ class Instantiator(object):
         Raises:
              LookupError: if no component is found
         """
-        for comp in self.components:
+        with self._lock:
+            comps = list(self.components)
+        for comp in comps:
             if comp.name == name:
                 return comp
         raise LookupError("No component named '%s' found" % name)
@@ -911,11 +977,14 @@ class Instantiator(object):
             ValueError: if the component has already been instantiated
             KeyError: if component should be created by delegation
         """
-        for c in self.components:
-            if c.name == name:
+        with self._lock:
+            if any(c.name == name for c in self.components):
                 raise ValueError("Trying to instantiate again component %s" % name)
 
+        tstart = time.time()
         comp = self._instantiate_comp(name)
+        self.init_durations[name] = time.time() - tstart
+        logging.info("Component %s instantiated in %g s", name, self.init_durations[name])
 
         # Post-instantiation changes
         newcmps = self.get_children(comp) # that includes comp itself
@@ -926,6 +995,34 @@ class Instantiator(object):
 
         return comp
 
+    def get_dependencies(self, name):
+        """
+        Find the components which must be instantiated before the given component
+        can be instantiated. In other words, the edges of the dependency graph
+        (a DAG) of the model.
+        name (str): name of a component which is instantiated explicitly (ie, has a class)
+        return (set of str): names of the components it depends on, including the
+          dependencies of the children it creates by delegation, and the power suppliers.
+        """
+        attrs = self.ast[name]
+        deps = set(attrs.get("dependencies", {}).values())
+        # the power supplier is just some special dependency
+        if "power_supplier" in attrs:
+            deps.add(attrs["power_supplier"])
+
+        for child in attrs.get("children", {}).values():
+            child_attrs = self.ast[child]
+            if child_attrs.get("creator") != name:
+                # support legacy code: old style dependencies
+                deps.add(child)
+                continue
+            # All the children should also have their dependencies instantiated
+            deps.update(child_attrs.get("dependencies", {}).values())
+            if "power_supplier" in child_attrs:
+                deps.add(child_attrs["power_supplier"])
+
+        return deps
+
     def get_instantiables(self, instantiated=None):
         """
         Find the components that are currently not yet instantiated, but
@@ -934,47 +1031,23 @@ class Instantiator(object):
         instantiated (None or set of str): the names of the components already
           instantiated. If it's None, it will use the list of all the components
           ever instantiated.
-        return (set of str): names of all the components that are instantiable
+        return (set of str): names of all the components that are instantiable.
+          As they do not depend on each other, they can be instantiated simultaneously.
         """
         comps = set()
         if instantiated is None:
-            instantiated = set(c.name for c in self.components)
+            with self._lock:
+                instantiated = set(c.name for c in self.components)
         for n, attrs in self.ast.items():
             if n in instantiated: # should not be already instantiated
                 continue
             if "class" not in attrs: # created by delegation
                 continue
-            if "power_supplier" in attrs:
-                psuname = attrs["power_supplier"]
-                if psuname not in instantiated:
-                    logging.debug("Component %s is not instantiable yet (needs %s)", n, psuname)
-                    continue
-
-            # All the children should also have their dependencies instantiated
-            all_children_instantiable = True
-            for child in attrs.get("children", {}).values():
-                child_attrs = self.ast[child]
-                if child_attrs.get("creator") != n:  # Old style dependencies => skip
-                    continue
-                deps = list(child_attrs.get("dependencies", {}).values())
-                if "power_supplier" in child_attrs:  # the power supplier is just some special dependency
-                    deps.append(child_attrs["power_supplier"])
-                for name in deps:
-                    if name not in instantiated:
-                        logging.debug("Component %s is not instantiable yet (%s needs %s)", n, child, name)
-                        all_children_instantiable = False
-                        break
-            if not all_children_instantiable:
-                continue
 
-            # All its dependencies should be instantiated
-            deps = list(attrs.get("dependencies", {}).values())
-            # support legacy code
-            deps += [c for c in attrs.get("children", {}).values() if self.ast[c].get("creator") != n]
-            for name in deps:
-                if name not in instantiated:
-                    logging.debug("Component %s is not instantiable yet", n)
-                    break
+            missing = self.get_dependencies(n) - instantiated
+            if missing:
+                logging.debug("Component %s is not instantiable yet (needs %s)",
+                              n, ", ".join(sorted(missing)))
             else:
                 comps.add(n)
 
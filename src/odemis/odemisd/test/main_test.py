@@ -208,6 +208,38 @@ class TestCommandLine(unittest.TestCase):
         os.remove("test.log")
         os.remove("testdaemon.log")
 
+    @timeout(40)
+    def test_parallel_init(self):
+        """
+        Check that the components which don't depend on each other are
+        instantiated in parallel
+        """
+        filename = os.path.join(FILE_PATH, "parallel-init-sim.odm.yaml")
+        ncomps, init_delay = 4, 3  # As in the microscope file
+        tstart = time.time()
+        cmdline = "--log-level=2 --log-target=testdaemon.log --daemonize %s" % filename
+        ret = subprocess.call(ODEMISD_CMD + cmdline.split())
+        self.assertEqual(ret, 0, "trying to run '%s'" % cmdline)
+
+        ret = self._wait_backend_starts(ncomps * init_delay + 10)
+        dur = time.time() - tstart
+        self.assertEqual(ret, 0, "backend status check returned %d" % (ret,))
+        logging.info("Backend with %d components taking %g s to initialise started in %g s",
+                     ncomps, init_delay, dur)
+        # Sequentially, it would take at least ncomps * init_delay
+        self.assertLess(dur, (ncomps - 1) * init_delay)
+
+        comps = model.getComponents()
+        self.assertEqual(len(comps), ncomps + 2)  # + microscope + wrapper
+
+        cmdline = "odemisd --log-level=2 --log-target=test.log --kill"
+        ret = main.main(cmdline.split())
+        self.assertEqual(ret, 0, "trying to run '%s'" % cmdline)
+        time.sleep(5)  # give some time to stop
+
+        os.remove("test.log")
+        os.remove("testdaemon.log")
+
     @timeout(10)
     def test_error_instantiate(self):
         """Test config files which should fail on instantiation"""
@@ -25,7 +25,7 @@ import os
 import unittest
 
 import yaml
-from odemis.odemisd.modelgen import ParseError, SafeLoader
+from odemis.odemisd.modelgen import Instantiator, ParseError, SafeLoader
 
 TEST_FILES_PATH = os.path.dirname(__file__)
 
@@ -206,5 +206,24 @@ class SafeLoaderExtensionsTest(unittest.TestCase):
         # Compare with expected results
         self.assertEqual(self.expected_full_result, data_found)
 
+
+class InstantiatorTest(unittest.TestCase):
+
+    def test_dependencies(self):
+        """
+        Check the dependency graph allows to instantiate independent components together
+        """
+        with open(os.path.join(TEST_FILES_PATH, "parallel-init-sim.odm.yaml")) as f:
+            inst = Instantiator(f)
+
+        self.assertEqual(inst.get_dependencies("Slow Camera"), set())
+        self.assertEqual(inst.get_dependencies("Stage Wrapper"), {"Slow Stage"})
+
+        slow_comps = {"Slow Camera", "Slow Stage", "Slow Focus", "Slow Filter"}
+        self.assertEqual(inst.get_instantiables({"Slow Microscope"}), slow_comps)
+        self.assertEqual(inst.get_instantiables({"Slow Microscope", "Slow Stage"}),
+                         slow_comps - {"Slow Stage"} | {"Stage Wrapper"})
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -24,6 +24,7 @@ Odemis. If not, see http://www.gnu.org/licenses/.
 # Various helper functions that have a generic usefulness
 # Warning: do not put anything that has dependencies on non default python modules
 
+import collections
 import inspect
 import itertools
 import logging
@@ -732,6 +733,82 @@ class RepeatingTimer(threading.Thread):
         self._must_stop.set()
 
 
+def _sizeof(v):
+    """
+    return (int): size in bytes of the data of an array, or of the object itself
+    """
+    try:
+        return v.nbytes
+    except AttributeError:
+        return sys.getsizeof(v)
+
+
+class LRUCache(object):
+    """
+    Dict-like cache, which discards the least recently used entries as soon as
+    the total size of the values is above a limit.
+    It is thread-safe.
+    """
+    def __init__(self, max_size, sizeof=_sizeof):
+        """
+        max_size (0<=int): maximum total size of the values, in the unit
+          returned by sizeof (by default, in bytes)
+        sizeof (callable: value -> 0<=int): returns the size of a value.
+          By default, for arrays, the size of their data.
+        """
+        self.max_size = max_size
+        self._sizeof = sizeof
+        self._entries = collections.OrderedDict()  # key -> (value, size)
+        self._size = 0
+        self._lock = threading.Lock()
+
+    @property
+    def size(self):
+        """
+        (0<=int): the total size of the values currently in the cache
+        """
+        return self._size
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __getitem__(self, key):
+        with self._lock:
+            value, _ = self._entries[key]
+            self._entries.move_to_end(key)
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        size = self._sizeof(value)
+        with self._lock:
+            if key in self._entries:
+                self._size -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self._size += size
+            # Discard the oldest entries (but always keep the latest one)
+            while self._size > self.max_size and len(self._entries) > 1:
+                _, (_, osize) = self._entries.popitem(last=False)
+                self._size -= osize
+
+    def __delitem__(self, key):
+        with self._lock:
+            self._size -= self._entries.pop(key)[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+
 def executeAsyncTask(future, fn, args=(), kwargs=None):
     """
     Execute a task in a separate thread. To follow the state of execution,
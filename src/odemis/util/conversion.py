@@ -326,11 +326,12 @@ def get_tile_md_pos(i, tile_size, tileda, origda):
     """
     md = origda.metadata
     tile_md = tileda.metadata
-    md_pos = numpy.asarray(md.get(model.MD_POS, (0.0, 0.0)))
+    md_pos = md.get(model.MD_POS, (0.0, 0.0))
     if model.MD_PIXEL_SIZE not in md or model.MD_PIXEL_SIZE not in tile_md:
         raise ValueError("MD_PIXEL_SIZE must be set")
-    orig_ps = numpy.asarray(md[model.MD_PIXEL_SIZE])
-    tile_ps = numpy.asarray(tile_md[model.MD_PIXEL_SIZE])
+    # Only X & Y are affected by the tiling (Z is kept as-is, for Z stacks)
+    orig_ps = numpy.asarray(md[model.MD_PIXEL_SIZE][:2])
+    tile_ps = numpy.asarray(tile_md[model.MD_PIXEL_SIZE][:2])
 
     dims = md.get(model.MD_DIMS, "CTZYX"[-origda.ndim::])
     img_shape = [origda.shape[dims.index('X')], origda.shape[dims.index('Y')]]
@@ -361,8 +362,8 @@ def get_tile_md_pos(i, tile_size, tileda, origda):
     new_tile_pos_rel = tmat @ tile_rel_to_img_center_pixels
     new_tile_pos_rel = numpy.ravel(new_tile_pos_rel)
     # calculate the final position of the tile, in world coordinates
-    tile_pos_world_final = md_pos + new_tile_pos_rel
-    return tuple(tile_pos_world_final)
+    tile_pos_world_final = numpy.asarray(md_pos[:2]) + new_tile_pos_rel
+    return tuple(tile_pos_world_final) + tuple(md_pos[2:])
 
 
 def get_img_transformation_md(mat, timage, src_img):
@@ -22,9 +22,15 @@ Odemis. If not, see http://www.gnu.org/licenses/.
 
 # various functions to convert and modify images (as DataArray)
 
+import functools
+import heapq
+import itertools
 import logging
 import math
+import numbers
 import numpy
+import threading
+import time
 from odemis import model
 import scipy.ndimage
 import cv2
@@ -32,7 +38,7 @@ import copy
 from odemis.model import DataArray
 from odemis.model import MD_DWELL_TIME, MD_EXP_TIME, TINT_FIT_TO_RGB, TINT_RGB_AS_IS
 from odemis.util import get_best_dtype_for_acc, transform
-from odemis.util.conversion import get_img_transformation_matrix, rgb_to_frgb
+from odemis.util.conversion import get_img_transformation_matrix, rgb_to_frgb, get_tile_md_pos
 from typing import Tuple
 
 import matplotlib.colors as colors
@@ -135,9 +141,84 @@ def md_format_to_tint(user_tint):
         raise TypeError("Invalid tint metadata type %s" % (user_tint,))
 
 
+# Maximum error on the ratio of values below any given value, accepted when
+# computing the histogram of live images (which are updated several times per
+# second). With 0.2%, an image is reduced to ~1 million values.
+HISTOGRAM_LIVE_MAX_ERROR = 0.002
+# Probability that the error is actually above the maximum error requested
+_HIST_SAMPLE_FAILURE = 0.001
+
+
+def getHistogramSampleSize(max_error):
+    """
+    Compute the number of values needed to estimate the distribution of the
+    values of an image, with a given maximum error.
+    It's based on the Dvoretzky-Kiefer-Wolfowitz inequality, which bounds the
+    difference between the cumulative distribution of a sample and the
+    cumulative distribution of the whole population. So the ratio of values
+    below any intensity (as used by findOptimalRange()) is known within
+    max_error, independently of the size of the image.
+    max_error (0<float<1): maximum error on the ratio of values
+    return (int): number of values to sample
+    """
+    if not 0 < max_error < 1:
+        raise ValueError("max_error should be between 0 and 1, got %s" % (max_error,))
+    return int(math.ceil(math.log(2 / _HIST_SAMPLE_FAILURE) / (2 * max_error ** 2)))
+
+
+@functools.lru_cache(maxsize=4)
+def _getSampleIndices(size, n):
+    """
+    Pick random positions in a (flattened) image, to estimate its histogram
+    size (int): number of values in the image
+    n (int): number of positions
+    return (numpy.ndarray of int): the positions, sorted (for faster access).
+      It's always the same for the same arguments. Do not modify it.
+    """
+    # The positions only have to be independent from the content of the image,
+    # so use a fixed seed. This also ensures that the same positions are used
+    # for images of the same shape, which allows to integrate the subsets.
+    rng = numpy.random.default_rng(size)
+    idx = rng.integers(0, size, n)
+    idx.sort()
+    idx.flags.writeable = False
+    return idx
+
+
+def subsampleForHistogram(data, max_error):
+    """
+    Pick a random subset of the values of an image, large enough to compute
+    its histogram within a given error.
+    The values are picked (with replacement) at uniformly random positions,
+    as required by the Dvoretzky-Kiefer-Wolfowitz inequality (see
+    getHistogramSampleSize()). The positions only depend on the size of the
+    image, so the same ones are used for every image of the same size.
+    data (numpy.ndarray): the image
+    max_error (0<=float<1): maximum error on the ratio of values below any
+      intensity. 0 means no error, so the whole data is returned.
+    return (numpy.ndarray): the data itself, or a copy of a subset of it (as
+      a 1D array).
+    """
+    if max_error == 0:
+        return data
+    n = getHistogramSampleSize(max_error)
+    if data.size < 2 * n:
+        return data
+
+    idx = _getSampleIndices(data.size, n)
+    data = data.view(numpy.ndarray)
+    if data.flags.c_contiguous:
+        return data.reshape(-1)[idx]
+    else:
+        return data.flat[idx]
+
+
 def findOptimalRange(hist, edges, outliers=0):
     """
     Find the intensity range fitting best an image based on the histogram.
+    The histogram can be computed on a subset of the image, for instance with
+    histogram(data, max_error=...) or a RunningHistogram, as only the ratio
+    of values in each bin is used.
     hist (ndarray 1D of 0<=int): histogram
     edges (tuple of 2 numbers): the values corresponding to the first and last
       bin of the histogram. To get an index, use edges = (0, len(hist)).
@@ -194,15 +275,20 @@ def findOptimalRange(hist, edges, outliers=0):
     return rng
 
 
-def getOutliers(data, outliers=0):
+def getOutliers(data, outliers=0, max_error=0):
     """
     Finds the minimum and maximum values when discarding a given percentage of outliers.
     :param data: (DataArray) The data containing the image.
     :param outliers: (0<float<0.5) Ratio of outliers to discard (on each side).
                       0 discards no value, 0.5 discards every value (and so returns the median).
+    :param max_error: (0<=float<1) Maximum error accepted on the ratio of outliers,
+                      to only look at a subset of the data. See histogram().
     :return: (tuple of 2 values) The range (min and max value).
     """
-    hist, edges = histogram(data)
+    if outliers == 0:
+        # The extreme values are needed => look at all the data
+        max_error = 0
+    hist, edges = histogram(data, max_error=max_error)
 
     return findOptimalRange(hist, edges, outliers)
 
@@ -241,34 +327,134 @@ def compactHistogram(hist, length):
     chist = hist.reshape(-1, bin_size)
     return numpy.sum(chist, 1)
 
-# TODO: compute histogram faster. There are several ways:
-# * x=numpy.bincount(a.flat, minlength=depth) => fast (~0.03s for
-#   a 2048x2048 array) but only works on flat array with uint8 and uint16 and
-#   creates 2**16 bins if uint16 (so need to do a reshape and sum on top of it)
+# Computing the histogram:
+# * numpy.bincount(a.flat, minlength=depth) => fast (~0.03s for a 2048x2048
+#   array) but only works with non-negative ints, and creates one bin per value.
 # * numpy.histogram(a, bins=256, range=(0,depth)) => slow (~0.09s for a
 #   2048x2048 array) but works exactly as needed directly in every case.
-# * see weave? (~ 0.01s for 2048x2048 array of uint16) eg:
-#  timeit.timeit("counts=numpy.zeros((2**16), dtype=numpy.uint32);
-#  weave.inline( code, ['counts', 'idxa'])", "import numpy;from scipy import weave; code=r\"for (int i=0; i<Nidxa[0]; i++) { COUNTS1( IDXA1(i)>>8)++; }\"; idxa=numpy.ones((2048*2048), dtype=numpy.uint16)+15", number=100)
-# * see cython?
+# So for ints, as long as there are not too many different values, the values
+# are first counted with bincount, and then the counts are grouped into the
+# bins of numpy.histogram(). Grouping the counts costs about as much per value
+# as numpy.histogram() per pixel, so it's only worthy if there are much fewer
+# different values than pixels.
 # for comparison, a.min() + a.max() are 0.01s for 2048x2048 array
 
+# Maximum number of different values, for ints bigger than 16 bits, to count
+# them with numpy.bincount(). Above, numpy.histogram() is used.
+MAX_BINCOUNT_VALUES = 2 ** 20
+# Maximum ratio of different values per pixel to count them with
+# numpy.bincount() when they have to be grouped into bins
+MAX_GROUPED_VALUES_RATIO = 1 / 8
+# numpy.histogram() computes the bins with float64, which cannot represent
+# exactly the ints above this value. So it's used directly in such case.
+MAX_EXACT_FLOAT_INT = 2 ** 53
+
+
+def _histogramInt(data, irange, vrange=None):
+    """
+    Compute the histogram of integer data by counting every value with
+    numpy.bincount(), which is several times faster than numpy.histogram().
+    data (numpy.ndarray of int): the data, not empty
+    irange (tuple of 2 ints): min/max values of the histogram
+    vrange (None or tuple of 2 ints): min/max values of the data, if already known
+    return (None or ndarray 1D of 0<=int): the histogram, with exactly the same
+      bins as numpy.histogram(data, bins=min(8192, irange[1] - irange[0] + 1), range=irange).
+      None if it cannot be computed this way (because there are too many
+      different values, or the values are too large to be exactly represented
+      by a float).
+    """
+    if not all(isinstance(v, numbers.Integral) for v in irange) or irange[0] > irange[1]:
+        return None
+    a, b = int(irange[0]), int(irange[1])
+    if max(abs(a), abs(b)) > MAX_EXACT_FLOAT_INT:
+        return None
+    length = min(8192, b - a + 1)
+    if length == b - a + 1:
+        max_values = data.size * 4
+    else:  # Values grouped into bins
+        max_values = int(data.size * MAX_GROUPED_VALUES_RATIO)
+    orig_dtype = data.dtype
+    data = data.view(numpy.ndarray).reshape(-1)
+
+    # Compute counts, so that counts[i] is the number of values equal to
+    # offset + i, for every value between lo and hi.
+    if data.itemsize <= 2:
+        # Small enough to count every possible value
+        idt = numpy.iinfo(orig_dtype)
+        if data.size * 4 < idt.max - idt.min + 1:
+            return None  # So few values that counting them would be slower
+        if min(b, idt.max) - max(a, idt.min) + 1 > max_values:
+            return None
+        if orig_dtype.kind == "i":
+            # Convert to unsigned (ie, value - idt.min), by flipping the sign bit
+            udt = numpy.dtype("u%d" % data.itemsize)
+            data = numpy.bitwise_xor(data.view(udt), udt.type(-idt.min))
+        counts = numpy.bincount(data, minlength=idt.max - idt.min + 1)
+        offset = idt.min
+        lo, hi = max(a, idt.min), min(b, idt.max)
+    else:
+        if vrange is None:
+            vrange = (int(data.min()), int(data.max()))
+        lo, hi = max(a, vrange[0]), min(b, vrange[1])
+        if hi - lo + 1 > min(MAX_BINCOUNT_VALUES, max_values):
+            return None
+
+        if lo > hi:
+            counts = numpy.empty(0, dtype=numpy.intp)  # No value in the range
+            offset = lo
+        elif vrange[0] >= 0 and vrange[1] < MAX_BINCOUNT_VALUES and orig_dtype != numpy.uint64:
+            # Small positive values: they can be counted directly
+            counts = numpy.bincount(data, minlength=hi + 1)
+            offset = 0
+        else:
+            # Shift the values so that lo is at 1, and put all the values
+            # outside of the range in the first and last bins (discarded).
+            # The computation wraps around on 64 bits, which still gives the
+            # right result for the values within the range, even for uint64.
+            shift = (lo - 1 + 2 ** 63) % 2 ** 64 - 2 ** 63
+            shifted = numpy.subtract(data, shift, dtype=numpy.int64, casting="unsafe")
+            numpy.clip(shifted, 0, hi - lo + 2, out=shifted)
+            counts = numpy.bincount(shifted, minlength=hi - lo + 3)[1:-1]
+            offset = lo
+
+    hist = numpy.zeros(length, dtype=numpy.intp)
+    if lo > hi:
+        return hist
+    counts = counts[lo - offset:hi - offset + 1]
+    if length == b - a + 1:
+        # One bin per value
+        hist[lo - a:hi - a + 1] = counts
+    else:
+        # Let numpy.histogram() group the values, so that the bins are exactly
+        # the same. It's fast, as every value is only passed once.
+        values = numpy.arange(lo, hi + 1, dtype=orig_dtype)
+        whist, _ = numpy.histogram(values, bins=length, range=irange, weights=counts)
+        hist[:] = whist
+    return hist
+
 
-def histogram(data, irange=None):
+def histogram(data, irange=None, max_error=0):
     """
     Compute the histogram of the given image.
     data (numpy.ndarray of numbers): greyscale image
     irange (None or tuple of 2 unsigned int): min/max values to be found
       in the data. None => auto (min, max will be detected from the data)
+    max_error (0<=float<1): maximum error accepted on the ratio of values below
+      any intensity. If > 0, only a random subset of the data is counted
+      (see subsampleForHistogram()), which is much faster on large images. 0 => all the values are counted.
     return hist, edges:
      hist (ndarray 1D of 0<=int): number of pixels with the given value
       Note that the length of the returned histogram is not fixed. If irange
       is defined and data is integer, the length is always equal to
       irange[1] - irange[0] + 1.
+      If max_error > 0, the sum of the histogram is the number of values
+      sampled, instead of the size of the data.
      edges (tuple of numbers): lowest and highest bound of the histogram.
        edges[1] is included in the bin. If irange is defined, it's the same
        values.
     """
+    data = subsampleForHistogram(data, max_error)
+    vrange = None  # min/max of the data, if known
     if irange is None:
         if data.dtype.kind in "biu":
             idt = numpy.iinfo(data.dtype)
@@ -277,34 +463,113 @@ def histogram(data, irange=None):
                 # range is too big to be used as is => look really at the data
                 irange = (int(data.view(numpy.ndarray).min()),
                           int(data.view(numpy.ndarray).max()))
+                vrange = irange
         else:
             # cast to ndarray to ensure a scalar (instead of a DataArray)
             irange = (data.view(numpy.ndarray).min(), data.view(numpy.ndarray).max())
 
     # short-cuts (for the most usual types)
     if data.dtype.kind in "bu" and irange[0] == 0 and data.itemsize <= 2 and len(data) > 0:
-        # TODO: for int (irange[0] < 0), treat as unsigned, and swap the first
-        # and second halves of the histogram.
-        # TODO: for 32 or 64 bits with full range, convert to a view looking
-        # only at the 2 high bytes.
         length = irange[1] - irange[0] + 1
         hist = numpy.bincount(data.flat, minlength=length)
         edges = (0, hist.size - 1)
         if edges[1] > irange[1]:
             logging.warning("Unexpected value %d outside of range %s", edges[1], irange)
     else:
+        hist = None
         if data.dtype.kind in "biu":
             length = min(8192, irange[1] - irange[0] + 1)
+            if data.dtype.kind in "iu" and len(data) > 0:
+                hist = _histogramInt(data, irange, vrange)
         else:
             # For floats, it will automatically find the minimum and maximum
             length = 256
-        hist, all_edges = numpy.histogram(data, bins=length, range=irange)
+
+        if hist is None:
+            hist, all_edges = numpy.histogram(data, bins=length, range=irange)
+        else:
+            all_edges = numpy.histogram_bin_edges(numpy.empty(0, dtype=data.dtype),
+                                                  bins=length, range=irange)
         edges = (max(irange[0], all_edges[0]),
                  min(irange[1], all_edges[-1]))
 
     return hist, edges
 
 
+class RunningHistogram(object):
+    """
+    Histogram of a series of images, updated one image at a time.
+    The bins are allocated on the first image, and then reused for every update.
+    Only a subset of each image is counted if a maximum error is given, so
+    that the cost of an update doesn't depend on the size of the images.
+    """
+
+    def __init__(self, irange, max_error=0):
+        """
+        irange (tuple of 2 numbers): min/max values of the histogram. Values
+          outside of this range are not counted (same as histogram()).
+        max_error (0<=float<1): maximum error accepted on the ratio of values
+          below any intensity, for each image added. See histogram().
+        """
+        self._irange = tuple(irange)
+        self.max_error = max_error
+        self._hist = None  # ndarray of int64, allocated on first use
+        self.edges = None  # tuple of 2 numbers, once an image has been added
+
+    @property
+    def hist(self):
+        """
+        (ndarray 1D of 0<=int): the histogram of all the images added since the
+          last reset. It's empty if no image has been added yet. The array is
+          updated in-place, so copy it if it must be kept.
+        """
+        if self._hist is None:
+            return numpy.empty(0, dtype=numpy.int64)
+        return self._hist
+
+    def reset(self):
+        """
+        Forget all the images added. The bins are kept allocated.
+        """
+        if self._hist is not None:
+            self._hist[...] = 0
+
+    def add(self, data):
+        """
+        Count the values of a new image in the histogram.
+        data (numpy.ndarray of numbers): greyscale image
+        """
+        hist, edges = histogram(data, self._irange, self.max_error)
+        if self._hist is None:
+            length = hist.size
+            if all(isinstance(v, numbers.Integral) for v in self._irange):
+                # With integers, the histogram can be longer than the range
+                length = min(length, self._irange[1] - self._irange[0] + 1)
+                edges = (edges[0], min(edges[1], self._irange[1]))
+            self._hist = numpy.zeros(length, dtype=numpy.int64)
+            self.edges = edges
+
+        if hist.size > self._hist.size:
+            # Can happen with integers above irange: count them in the last bin
+            logging.debug("Adding %d values above the histogram range",
+                          hist[self._hist.size:].sum())
+            self._hist[-1] += hist[self._hist.size:].sum()
+            hist = hist[:self._hist.size]
+        self._hist[:hist.size] += hist
+
+    def getRange(self, outliers=0):
+        """
+        Find the intensity range fitting best the images added, directly from
+          the histogram. See findOptimalRange().
+        outliers (0<=float<0.5): ratio of outliers to discard (on both side)
+        return (tuple of 2 values): the range (min and max values)
+        raise ValueError: if no image has been added yet
+        """
+        if self._hist is None:
+            raise ValueError("No image added to the histogram yet")
+        return findOptimalRange(self._hist, self.edges, outliers)
+
+
 def guessDRange(data):
     """
     Guess the data range of the data given.
@@ -348,10 +613,105 @@ def isClipping(data, drange=None):
 
 # TODO: try to do cumulative histogram value mapping (=histogram equalization)?
 # => might improve the greys, but might be "too" clever
-def DataArray2RGB(data, irange=None, tint=(255, 255, 255)):
+# Number of pixels processed at once when converting to RGB via computation
+# (instead of a LUT), so that the intermediary buffers stay in the CPU cache.
+RGB_BLOCK_SIZE = 65536
+
+
+@functools.lru_cache(maxsize=16)
+def _getTintLUT(tint, nchannels):
+    """
+    Compute the colour of each of the 256 grey levels, for a given tint.
+    tint (3-tuple of 0 <= int < 256): RGB colour of the white
+    nchannels (3 or 4): 3 for RGB, 4 for BGRA (with alpha = 255)
+    return (numpy.ndarray of shape 256, nchannels, of uint8): grey level -> colour
+    """
+    grey = numpy.arange(256, dtype=numpy.uint8)
+    lut = numpy.empty((256, nchannels), dtype=numpy.uint8)
+    if nchannels == 3:
+        chans = ((0, tint[0]), (1, tint[1]), (2, tint[2]))
+    else:  # BGRA
+        chans = ((2, tint[0]), (1, tint[1]), (0, tint[2]))
+        lut[:, 3] = 255
+    for c, t in chans:
+        if t == 255:
+            lut[:, c] = grey
+        else:
+            # Same as multiplying an array of uint8 by a float, as DataArray2RGB used to do
+            numpy.multiply(grey, t / 255, out=lut[:, c], casting="unsafe")
+    lut.flags.writeable = False
+    return lut
+
+
+@functools.lru_cache(maxsize=16)
+def _getIntLUT(dtype, irange, tint, nchannels):
+    """
+    Compute the colour of every possible value of an integer type.
+    dtype (str): the type of the data, of 8 or 16 bits
+    irange (int, int): min/max values mapped to black/white. min < max.
+    tint (3-tuple of 0 <= int < 256): RGB colour of the white
+    nchannels (3 or 4): 3 for RGB, 4 for BGRA (with alpha = 255)
+    return (numpy.ndarray of shape 2**bits, nchannels, of uint8): value -> colour.
+      For signed types, the index is the value viewed as unsigned type.
+    """
+    dtype = numpy.dtype(dtype)
+    idt = numpy.iinfo(dtype)
+    values = numpy.arange(idt.min, idt.max + 1, dtype=numpy.int64)
+    grey = numpy.empty(values.shape, dtype=numpy.uint8)
+    numpy.clip(values, irange[0], irange[1], out=values)
+    values -= irange[0]
+    numpy.multiply(values, 255.99 / (irange[1] - irange[0]), out=grey, casting="unsafe")
+
+    lut = _getTintLUT(tint, nchannels)[grey]
+    if dtype.kind == "i":
+        # The value -1 is stored at the index 2**bits - 1 (ie, when seen as unsigned)
+        lut = numpy.roll(lut, idt.min, axis=0)
+    lut.flags.writeable = False
+    return lut
+
+
+def _grey2RGB(data, irange, tint, out):
     """
-    :param data: (numpy.ndarray of unsigned int) 2D image greyscale (unsigned
-        float might work as well)
+    Convert data to RGB (or BGRA) by computing the value of each pixel. The
+    data is processed a few rows at a time, so that the intermediary buffers
+    stay small.
+    data (numpy.ndarray of int or float): greyscale data
+    irange (numpy.ndarray of 2 values): min/max values mapped to black/white. min < max.
+    tint (3-tuple of 0 <= int < 256): RGB colour of the white
+    out (numpy.ndarray of shape data.shape + (3 or 4,), of uint8): where the result is written
+    """
+    if data.size == 0:
+        return
+    if data.ndim == 0:
+        data = data.reshape(1)
+        out = out.reshape(1, out.shape[-1])
+
+    lut = _getTintLUT(tint, out.shape[-1])
+    # use .tolist() to force conversion to "safe" Python type, which avoid overflows
+    r0 = irange[0].tolist()
+    b = 255.99 / (irange[1].tolist() - r0)
+
+    # float32 is precise enough for float32 data, and faster
+    ftype = numpy.float32 if data.dtype == numpy.float32 else numpy.float64
+    step = max(1, RGB_BLOCK_SIZE // max(1, data[0].size))
+    bshape = (min(step, data.shape[0]),) + data.shape[1:]
+    fbuf = numpy.empty(bshape, dtype=ftype)
+    gbuf = numpy.empty(bshape, dtype=numpy.uint8)
+    for i in range(0, data.shape[0], step):
+        block = data[i:i + step]
+        n = block.shape[0]
+        fb, gb = fbuf[:n], gbuf[:n]
+        # Clip, shift and scale, all in the same buffer
+        numpy.clip(block, irange[0], irange[1], out=fb, casting="unsafe")
+        numpy.subtract(fb, r0, out=fb)
+        numpy.multiply(fb, b, out=gb, casting="unsafe")
+        numpy.take(lut, gb, axis=0, out=out[i:i + n], mode="clip")
+
+
+def DataArray2RGB(data, irange=None, tint=(255, 255, 255), out=None):
+    """
+    :param data: (numpy.ndarray of int or float) greyscale image, typically
+        2D (YX), but any shape is accepted.
     :param irange: (None or tuple of 2 values) min/max intensities mapped
         to black/white
         None => auto (min, max are from the data);
@@ -361,16 +721,25 @@ def DataArray2RGB(data, irange=None, tint=(255, 255, 255)):
         - (3-tuple of 0 < int <256) RGB colour of the final image (each
         pixel is multiplied by the value. Default is white.
         - colors.Colormap Object
-    :return: (numpy.ndarray of 3*shape of uint8) converted image in RGB with the
-        same dimension
+    :param out: (None or numpy.ndarray of uint8) array where to write the result.
+        It must be C-contiguous, with the shape data.shape + (3,) for RGB, or
+        data.shape + (4,) for BGRA (as used for display, with alpha = 255).
+        If None, a new RGB array is allocated.
+    :return: (numpy.ndarray of shape + (3 or 4,) of uint8) converted image in RGB
+        (or BGRA), with the same dimensions. If out is provided, it is returned.
     """
-    # TODO: handle signed values
-    assert(data.ndim == 2) # => 2D with greyscale
-
     # Discard the DataArray aspect and just get the raw array, to be sure we
     # don't get a DataArray as result of the numpy operations
     data = data.view(numpy.ndarray)
 
+    if out is None:
+        # 0 copy (1 malloc)
+        out = numpy.empty(data.shape + (3,), dtype=numpy.uint8, order='C')
+    elif (out.shape[:-1] != data.shape or out.shape[-1] not in (3, 4) or
+          out.dtype != numpy.uint8 or not out.flags.c_contiguous):
+        raise ValueError("out must be a contiguous array of uint8 of shape %s + (3 or 4,), got %s %s" %
+                         (data.shape, out.dtype, out.shape))
+
     # fit it to 8 bits and update brightness and contrast at the same time
     if irange is None:
         irange = (numpy.nanmin(data), numpy.nanmax(data))
@@ -378,6 +747,7 @@ def DataArray2RGB(data, irange=None, tint=(255, 255, 255)):
             logging.warning("Trying to convert all-NaN data to RGB")
             data = numpy.nan_to_num(data)
             irange = (0, 1)
+        irange = numpy.array(irange, data.dtype)
     else:
         # ensure irange is the same type as the data. It ensures we don't get
         # crazy values, and also that numpy doesn't get confused in the
@@ -396,95 +766,47 @@ def DataArray2RGB(data, irange=None, tint=(255, 255, 255)):
         # norm = colors.LogNorm(vmin=data.min(), vmax=data.max())
         norm = colors.Normalize(vmin=irange[0], vmax=irange[1], clip=True)
         rgb = tint(norm(data))  # returns an rgba array
-        rgb = rgb[:, :, :3]  # discard alpha channel
-        out = numpy.empty(rgb.shape, dtype=numpy.uint8)
+        if out.shape[-1] == 3:
+            rgb = rgb[..., :3]  # discard alpha channel
+        else:  # BGRA
+            rgb = rgb[..., [2, 1, 0, 3]]
         numpy.multiply(rgb, 255, casting='unsafe', out=out)
         return out
 
-    if data.dtype == numpy.uint8 and irange[0] == 0 and irange[1] == 255:
-        # short-cut when data is already the same type
-        # logging.debug("Applying direct range mapping to RGB")
-        drescaled = data
-        # TODO: also write short-cut for 16 bits by reading only the high byte?
-    else:
-        # If data might go outside of the range, clip first
-        if data.dtype.kind in "iu":
-            # no need to clip if irange is the whole possible range
-            idt = numpy.iinfo(data.dtype)
-            # Ensure B&W if there is only one value allowed
-            if irange[0] >= irange[1]:
-                if irange[0] > idt.min:
-                    irange = (irange[0] - 1, irange[0])
-                else:
-                    irange = (irange[0], irange[0] + 1)
-
-            if img_fast:
-                try:
-                    # only (currently) supports uint16
-                    return img_fast.DataArray2RGB(data, irange, tint)
-                except ValueError as exp:
-                    logging.info("Fast conversion cannot run: %s", exp)
-                except Exception:
-                    logging.exception("Failed to use the fast conversion")
-
-            if irange[0] > idt.min or irange[1] < idt.max:
-                data = data.clip(*irange)
-        else: # floats et al. => always clip
-            # Ensure B&W if there is just one value allowed
-            if irange[0] >= irange[1]:
-                irange = (irange[0] - 1e-9, irange[0])
-            data = data.clip(*irange)
-
-        # use .tolist() to force conversion to "safe" Python type, which avoid overflows
-        range_width = irange[1].tolist() - irange[0].tolist()
-        if data.dtype.kind == "i":
-            # Signed ints are "special" because we cannot use the same type to store the values shifted to 0.
-            dtype_uint = numpy.min_scalar_type(max(255, range_width))
-            dshift = numpy.subtract(data, irange[0], dtype=dtype_uint, casting="unsafe")
-        else:
-            dshift = data - irange[0]
+    tint = tuple(tint)
+    if data.dtype.kind in "iu":
+        idt = numpy.iinfo(data.dtype)
+        # Ensure B&W if there is only one value allowed
+        if irange[0] >= irange[1]:
+            if irange[0] > idt.min:
+                irange = numpy.array((irange[0] - 1, irange[0]), data.dtype)
+            else:
+                irange = numpy.array((irange[0], irange[0] + 1), data.dtype)
 
-        if dshift.dtype == numpy.uint8:
-            drescaled = dshift  # re-use memory for the result
-        else:
-            # TODO: could directly use one channel of the 'rgb' variable?
-            drescaled = numpy.empty(data.shape, dtype=numpy.uint8)
-        # Ideally, it would be 255 / (irange[1] - irange[0]) + 0.5, but to avoid
-        # the addition, we can just use 255.99, and with the rounding down, it's
-        # very similar.
-        b = 255.99 / range_width
-        numpy.multiply(dshift, b, out=drescaled, casting="unsafe")
-
-    # Now duplicate it 3 times to make it RGB (as a simple approximation of
-    # greyscale)
-    # dstack doesn't work because it doesn't generate in C order (uses strides)
-    # apparently this is as fast (or even a bit better):
-
-    # 0 copy (1 malloc)
-    rgb = numpy.empty(data.shape + (3,), dtype=numpy.uint8, order='C')
-
-    # Tint (colouration)
-    if tint == (255, 255, 255):
-        # fast path when no tint
-        # Note: it seems numpy.repeat() is about 30% slower:
-        # rgb = numpy.repeat(drescaled, 3)
-        # rgb.shape = data.shape + (3,)
-        # Using a view to do the copy is also 30% slower:
-        # rgb_inverted = numpy.moveaxis(rgb, 2, 0)
-        # rgb_inverted[:] = drescaled
-        rgb[:, :, 0] = drescaled # 1 copy
-        rgb[:, :, 1] = drescaled # 1 copy
-        rgb[:, :, 2] = drescaled # 1 copy
-    else:
-        rtint, gtint, btint = tint
-        # multiply by a float, cast back to type of out, and put into out array
-        # TODO: multiplying by float(x/255) is the same as multiplying by int(x)
-        #       and >> 8
-        numpy.multiply(drescaled, rtint / 255, out=rgb[:, :, 0], casting="unsafe")
-        numpy.multiply(drescaled, gtint / 255, out=rgb[:, :, 1], casting="unsafe")
-        numpy.multiply(drescaled, btint / 255, out=rgb[:, :, 2], casting="unsafe")
+        if img_fast and out.shape[-1] == 3:
+            try:
+                # only (currently) supports uint16
+                return img_fast.DataArray2RGB(data, irange, tint, out)
+            except ValueError as exp:
+                logging.debug("Fast conversion cannot run: %s", exp)
+            except Exception:
+                logging.exception("Failed to use the fast conversion")
 
-    return rgb
+        if idt.bits <= 16:
+            # Pre-compute the colour for every possible value, and just look
+            # them up (1 pass, no intermediary array).
+            lut = _getIntLUT(data.dtype.str, tuple(irange.tolist()), tint, out.shape[-1])
+            if data.dtype.kind == "i":
+                data = data.view(data.dtype.str.replace("i", "u"))
+            numpy.take(lut, data, axis=0, out=out, mode="clip")
+            return out
+    else: # floats et al. => always clip
+        # Ensure B&W if there is just one value allowed
+        if irange[0] >= irange[1]:
+            irange = numpy.array((irange[0] - 1e-9, irange[0]), data.dtype)
+
+    _grey2RGB(data, irange, tint, out)
+    return out
 
 
 def getColorbar(color_map, width, height, alpha=False):
@@ -641,6 +963,11 @@ def ensureYXC(data):
     return model.DataArray(data, md)
 
 
+# The dtypes that OpenCV can resize
+_CV_RESIZE_DTYPES = {numpy.dtype(t) for t in (numpy.uint8, numpy.uint16, numpy.int16,
+                                              numpy.float32, numpy.float64)}
+
+
 def rescale_hq(data, shape):
     """
     Resize the image to the new given shape (smaller or bigger). It tries to
@@ -661,9 +988,9 @@ def rescale_hq(data, shape):
     else:
         ci = -1
 
-    if data.ndim == 2 or (data.ndim == 3 and ci == 2 and scale[ci] == 1):
+    if (data.dtype in _CV_RESIZE_DTYPES and
+        (data.ndim == 2 or (data.ndim == 3 and ci == 2 and scale[ci] == 1))):
         # TODO: if C is not last dim, reshape (ie, call ensureYXC())
-        # TODO: not all dtypes are supported by OpenCV (eg, uint32)
         # This is a normal spatial image
         if any(s < 1 for s in scale):
             interpolation = cv2.INTER_AREA  # Gives best looking when shrinking
@@ -672,8 +999,8 @@ def rescale_hq(data, shape):
         # If a 3rd dim, OpenCV will apply the resize on each C independently
         out = cv2.resize(data, (shape[1], shape[0]), interpolation=interpolation)
     else:
-        # Weird number of dimensions => default to the less pretty but more
-        # generic scipy version
+        # Weird number of dimensions or dtype not supported by OpenCV => default
+        # to the less pretty but more generic scipy version
         out = numpy.empty(shape, dtype=data.dtype)
         scipy.ndimage.interpolation.zoom(data, zoom=scale, output=out, order=1, prefilter=False)
 
@@ -1069,20 +1396,340 @@ def getBoundingBox(content):
     return rect
 
 
+# Size of the tiles of the pyramidal images created in memory (same as the TIFF files)
+PYRAMID_TILE_SIZE = 256
+# Minimum number of pixels of an image for it to be worthy to display it via
+# a pyramid (instead of projecting the whole image at once)
+PYRAMID_MIN_PIXELS = 4096 * 4096
+
+
+def halveImage(data):
+    """
+    Reduce an image by 2 in X and Y, by averaging each block of 2x2 pixels.
+    If the size is odd, the last row/column is dropped.
+    data (numpy.ndarray of shape YX or YXC): the image
+    return (numpy.ndarray of shape Y//2, X//2(, C)): the reduced image, of the
+      same dtype. Integers are rounded to the closest value.
+    """
+    h, w = data.shape[0] // 2, data.shape[1] // 2
+    data = data.view(numpy.ndarray)
+    out = numpy.empty((h, w) + data.shape[2:], dtype=data.dtype)
+    if data.dtype.kind == "u":
+        acc_dtype = numpy.uint64
+    elif data.dtype.kind in "bi":
+        acc_dtype = numpy.int64
+    else:
+        acc_dtype = numpy.float64
+
+    # Process a few rows at a time, to keep the intermediary arrays small
+    nrows = max(1, RGB_BLOCK_SIZE // max(1, w))
+    for i in range(0, h, nrows):
+        n = min(nrows, h - i)
+        sub = data[2 * i:2 * (i + n)]
+        acc = sub[0::2, 0:2 * w:2].astype(acc_dtype)
+        acc += sub[1::2, 0:2 * w:2]
+        acc += sub[0::2, 1:2 * w:2]
+        acc += sub[1::2, 1:2 * w:2]
+        if acc_dtype is numpy.float64:
+            acc *= 0.25
+        else:
+            acc += 2
+            acc //= 4
+        out[i:i + n] = acc
+
+    return out
+
+
+class DataArrayShadowPyramidalMemory(model.DataArrayShadow):
+    """
+    Pyramidal DataArrayShadow of an image already in memory.
+    It allows to display a large image (eg, a stitched mosaic) tile by tile, at
+    the resolution needed, in the same way as a pyramidal TIFF file, but without
+    having to save it first.
+    The lower resolution levels of the pyramid are computed when first needed,
+    each from the previous level. They are also all computed in advance in a
+    separate thread.
+    """
+
+    def __init__(self, data, tile_shape=(PYRAMID_TILE_SIZE, PYRAMID_TILE_SIZE), background=True):
+        """
+        data (DataArray of shape YX or YXC): the image at full resolution. It
+          should have MD_PIXEL_SIZE. It should not be modified afterwards.
+        tile_shape (0<int, 0<int): the shape of the tiles (X, Y)
+        background (bool): if True, compute all the levels of the pyramid in a
+          separate thread.
+        raise ValueError: if the data is not a 2D image
+        """
+        md = data.metadata.copy()
+        dims = md.get(model.MD_DIMS, "CTZYX"[-data.ndim:])
+        if dims == "YXC" and data.ndim == 3:
+            pass
+        elif data.ndim == 2:
+            dims = "YX"
+        else:
+            raise ValueError("Data must be of shape YX or YXC, but got %s with dims %s" % (data.shape, dims))
+        md[model.MD_DIMS] = dims
+
+        # Same number of levels as the pyramidal TIFF files: keep dividing by 2
+        # as long as the previous level is at least a tile.
+        maxzoom = 0
+        while all(s // 2 ** maxzoom >= ts for s, ts in zip(data.shape[1::-1], tile_shape)):
+            maxzoom += 1
+
+        model.DataArrayShadow.__init__(self, data.shape, data.dtype, md, maxzoom, tile_shape)
+
+        self._levels = [data.view(numpy.ndarray)] + [None] * maxzoom
+        self._levels_lock = threading.Lock()
+        if background and maxzoom > 0:
+            t = threading.Thread(target=self._getLevel, args=(maxzoom,),
+                                 name="Pyramid computation")
+            t.daemon = True
+            t.start()
+
+    def _getLevel(self, zoom):
+        """
+        Get a level of the pyramid, computing it if needed
+        zoom (0<=int<=maxzoom): the level
+        return (numpy.ndarray): the image at the given level
+        """
+        level = self._levels[zoom]
+        if level is not None:
+            return level
+
+        with self._levels_lock:
+            # Compute all the missing levels up to the one requested
+            for z in range(1, zoom + 1):
+                if self._levels[z] is None:
+                    tstart = time.time()
+                    self._levels[z] = halveImage(self._levels[z - 1])
+                    logging.debug("Computed pyramid level %d of shape %s in %g s",
+                                  z, self._levels[z].shape, time.time() - tstart)
+
+        return self._levels[zoom]
+
+    def getData(self):
+        """
+        Fetches the whole data (at full resolution) of image.
+        return DataArray: the data, with its metadata
+        """
+        return model.DataArray(self._levels[0], self.metadata.copy())
+
+    def getTile(self, x, y, zoom):
+        """
+        Fetches one tile
+        x (0<=int): X index of the tile.
+        y (0<=int): Y index of the tile
+        zoom (0<=int): zoom level to use. The total shape of the image is shape / 2**zoom.
+            The number of tiles available in an image is ceil((shape//zoom)/tile_shape)
+        return (DataArray): the tile, read-only. The shape is the tile_shape, or smaller on the borders.
+        raise ValueError: if the zoom level doesn't exist
+        raise IndexError: if the tile is outside of the image
+        """
+        if not 0 <= zoom <= self.maxzoom:
+            raise ValueError("Invalid Z value %d" % (zoom,))
+        level = self._getLevel(zoom)
+
+        xp = x * self.tile_shape[0]
+        yp = y * self.tile_shape[1]
+        if not (0 <= xp < level.shape[1] and 0 <= yp < level.shape[0]):
+            raise IndexError("Tile %d, %d is outside of the image at zoom %d" % (x, y, zoom))
+
+        tile = model.DataArray(level[yp:yp + self.tile_shape[1], xp:xp + self.tile_shape[0]],
+                               self.metadata.copy())
+        # The data is not copied, so make sure it's not modified by accident
+        tile.flags.writeable = False
+        orig_pixel_size = self.metadata.get(model.MD_PIXEL_SIZE, (1, 1))
+        tile.metadata[model.MD_PIXEL_SIZE] = tuple(ps * 2 ** zoom for ps in orig_pixel_size)
+        tile.metadata[model.MD_POS] = get_tile_md_pos((x, y), self.tile_shape, tile, self)
+        return tile
+
+
+def toPyramid(data):
+    """
+    Convert a large image in memory to a DataArrayShadowPyramidalMemory, so that
+      it can be displayed tile by tile.
+    data (DataArray or DataArrayShadow): the image
+    return (DataArray or DataArrayShadow): a DataArrayShadowPyramidalMemory if
+      data is a large enough 2D (or RGB) image with a pixel size, otherwise
+      data itself.
+    """
+    if not isinstance(data, numpy.ndarray) or model.MD_PIXEL_SIZE not in data.metadata:
+        return data
+    dims = data.metadata.get(model.MD_DIMS, "CTZYX"[-data.ndim:])
+    if not (data.ndim == 2 or (data.ndim == 3 and dims == "YXC")):
+        return data
+    if data.shape[0] * data.shape[1] < PYRAMID_MIN_PIXELS:
+        return data
+
+    logging.debug("Converting image of shape %s to a pyramid", data.shape)
+    return DataArrayShadowPyramidalMemory(data)
+
+
+class TileLoader(object):
+    """
+    Reads the tiles of a pyramidal DataArrayShadow in a pool of threads, so
+    that multiple tiles are fetched concurrently (eg, from a file, or from a
+    server). The tiles read are stored in a cache.
+    The tiles requested are read first, followed by the ones to prefetch. On
+    each new request, the tiles of the previous request not yet being read are
+    forgotten.
+    The threads are started when needed, and stop after a while without any
+    tile to read.
+    """
+    IDLE_TIMEOUT = 10  # s, before an unused thread is stopped
+
+    def __init__(self, das, cache, nworkers=4, callback=None):
+        """
+        das (DataArrayShadow): the pyramidal image (ie, with .getTile())
+        cache (dict-like): (x, y, z) -> DataArray, where the tiles read are
+          stored. It should be thread-safe (eg, util.LRUCache).
+        nworkers (0<int): maximum number of tiles read concurrently
+        callback (None or callable (int, int, int) -> None): called with the
+          tile index (x, y, z) after a requested tile (not prefetched) has been
+          read. It's called from a different thread.
+        """
+        self.das = das
+        self._cache = cache
+        self._nworkers = nworkers
+        self._callback = callback
+
+        self._cond = threading.Condition()
+        self._queue = []  # heap of (priority, order, (x, y, z))
+        self._queued = {}  # (x, y, z) -> priority of the tiles to read
+        self._in_progress = set()  # (x, y, z) of the tiles being read
+        self._errors = {}  # (x, y, z) -> Exception, for the tiles which couldn't be read
+        self._order = itertools.count()
+        self._nthreads = 0
+
+    def _push(self, key, priority):
+        """
+        Add a tile to the queue, if it's not already there (with a higher priority)
+        Must be called with the ._cond acquired.
+        """
+        if (key in self._cache or key in self._in_progress or
+            self._queued.get(key, priority + 1) <= priority):
+            return
+        self._queued[key] = priority
+        heapq.heappush(self._queue, (priority, next(self._order), key))
+
+    def _start_workers(self):
+        """
+        Start new threads, if there are more tiles queued than threads.
+        Must be called with the ._cond acquired.
+        """
+        while self._nthreads < min(self._nworkers, len(self._queued)):
+            self._nthreads += 1
+            t = threading.Thread(target=self._run, name="Tile loader")
+            t.daemon = True
+            t.start()
+
+    def request(self, keys, prefetch=()):
+        """
+        Schedule the reading of the tiles which are not yet in the cache. It
+          doesn't wait for the tiles to be read.
+        keys (iterable of (int, int, int)): index (x, y, z) of the tiles needed
+        prefetch (iterable of (int, int, int)): index of the tiles which are
+          likely to be needed soon. They are read after the tiles needed, in order.
+        """
+        with self._cond:
+            # Forget the previous requests
+            self._queue = []
+            self._queued.clear()
+            self._errors.clear()
+            for key in keys:
+                self._push(key, 0)
+            for key in prefetch:
+                self._push(key, 1)
+            self._start_workers()
+            self._cond.notify_all()
+
+    def get(self, x, y, z):
+        """
+        Returns a tile, and waits for it to be read if it's not yet in the cache.
+        The tile is read before all the other tiles queued.
+        x, y, z (0<=int): index and zoom level of the tile
+        return (DataArray): the tile
+        raise Exception: if reading the tile failed (same as .das.getTile())
+        """
+        key = (x, y, z)
+        with self._cond:
+            while True:
+                tile = self._cache.get(key)
+                if tile is not None:
+                    return tile
+                if key in self._errors:
+                    raise self._errors.pop(key)
+                self._push(key, -1)
+                self._start_workers()
+                self._cond.notify_all()
+                self._cond.wait()
+
+    def _run(self):
+        """
+        Main function of each thread: reads the tiles queued, until there are no
+        more for a while.
+        """
+        try:
+            while True:
+                with self._cond:
+                    while not self._queue:
+                        if not self._cond.wait(self.IDLE_TIMEOUT) and not self._queue:
+                            return
+                    priority, _, key = heapq.heappop(self._queue)
+                    if self._queued.get(key) != priority:
+                        continue  # Outdated entry
+                    del self._queued[key]
+                    self._in_progress.add(key)
+
+                try:
+                    tile = self.das.getTile(*key)
+                except Exception as ex:
+                    logging.warning("Failed to read tile %s: %s", key, ex)
+                    with self._cond:
+                        self._errors[key] = ex
+                        self._in_progress.discard(key)
+                        self._cond.notify_all()
+                    continue
+
+                self._cache[key] = tile
+                with self._cond:
+                    self._in_progress.discard(key)
+                    self._cond.notify_all()
+
+                if priority <= 0 and self._callback:
+                    try:
+                        self._callback(*key)
+                    except Exception:
+                        logging.exception("Failed to call back for tile %s", key)
+        finally:
+            with self._cond:
+                self._nthreads -= 1
+                # In case a tile was queued just after deciding to stop
+                self._start_workers()
+
+
 class ImageIntegrator(object):
     """
     Integrate the images one after another. Once the first image is acquired, calculate the best type for fitting
     the image to avoid saturation and overflow. At the end of acquisition, take the average of integrated data if
     the detector is DT_NORMAL and subtract the baseline from the final integrated image.
+    Optionally, a random subset of the integrated image is maintained
+    along, so that its histogram can be computed without looking at the whole image.
     """
-    def __init__(self, steps):
+    def __init__(self, steps, hist_max_error=None):
         """
         steps: (int) the total number of images that need to be integrated
+        hist_max_error: (None or 0<float<1) if not None, maintain the subset of the
+          integrated image needed for getHistogram(), with the given maximum error.
+          See histogram().
         """
         self.steps = steps  # can be changed by the caller, on the fly
         self._step = 0
         self._img = None
         self._best_dtype = None
+        self.hist_max_error = hist_max_error
+        self._sample = None  # subset of the integration in progress
+        self._hist_sample = None  # subset of the last integrated image returned
 
     def append(self, img):
         """
@@ -1095,11 +1742,16 @@ class ImageIntegrator(object):
             img(model.DataArray): the integrated image with the updated metadata
         """
         self._step += 1
+        if self.hist_max_error is not None:
+            # Same positions on every image, as long as the shape stays the same
+            img_sample = subsampleForHistogram(img, self.hist_max_error)
         if self._img is None:
             orig_dtype = img.dtype
             self._best_dtype = get_best_dtype_for_acc(orig_dtype, self.steps)
             integ_img = img
             self._img = integ_img
+            if self.hist_max_error is not None:
+                self._sample = img_sample
 
         else:
             integ_img = self._img
@@ -1107,8 +1759,13 @@ class ImageIntegrator(object):
             if self._step == 2:
                 data = integ_img.astype(self._best_dtype, copy=True)
                 integ_img = model.DataArray(data, integ_img.metadata.copy())
+                if self._sample is not None:
+                    self._sample = self._sample.astype(self._best_dtype, copy=True)
 
             numpy.add(integ_img, img, out=integ_img)
+            if self._sample is not None:
+                # Running update: only the sampled values are accumulated
+                numpy.add(self._sample, img_sample, out=self._sample)
 
             # update the metadata of the integrated image in every integration step
             md = integ_img.metadata
@@ -1123,25 +1780,57 @@ class ImageIntegrator(object):
                     orig_dtype = img.dtype
                     if orig_dtype.kind in "biu":
                         integ_img = numpy.floor_divide(integ_img, self._step, dtype=orig_dtype, casting='unsafe')
+                        if self._sample is not None:
+                            self._sample = numpy.floor_divide(self._sample, self._step, dtype=orig_dtype,
+                                                              casting='unsafe')
                     else:
                         integ_img = numpy.true_divide(integ_img, self._step, dtype=orig_dtype, casting='unsafe')
+                        if self._sample is not None:
+                            self._sample = numpy.true_divide(self._sample, self._step, dtype=orig_dtype,
+                                                             casting='unsafe')
                 elif det_type != model.MD_DT_INTEGRATING:  # not optical either
                     logging.warning("Unknown detector type %s for image integration.", det_type)
                 # The baseline, if exists, should also be subtracted from the integrated image.
                 if model.MD_BASELINE in md:
+                    prev_bl = md[model.MD_BASELINE]
                     integ_img, md = self.subtract_baseline(integ_img, md)
+                    if self._sample is not None:
+                        extra_bl = self._step * prev_bl - md[model.MD_BASELINE]
+                        numpy.subtract(self._sample, extra_bl, out=self._sample, casting="unsafe")
 
                 integ_img = model.DataArray(integ_img, md)
 
             self._img = integ_img
 
+        if self._sample is not None:
+            # Copy, as the sample of the integration in progress is updated in-place
+            self._hist_sample = self._sample.copy()
+
         # reset the ._img and ._step once you reach the integration count
         if self._step >= self.steps:
             self._step = 0
             self._img = None
+            self._sample = None
 
         return integ_img
 
+    def getHistogram(self, irange=None):
+        """
+        Compute the histogram of the last integrated image returned by append(),
+        only based on the subset of the image maintained during the integration.
+        So it's much faster than computing the histogram of the whole image.
+        irange (None or tuple of 2 numbers): min/max values of the histogram.
+          See histogram().
+        return hist, edges: same as histogram()
+        raise ValueError: if hist_max_error is None, or no image has been integrated yet
+        """
+        if self.hist_max_error is None:
+            raise ValueError("Histogram not maintained, as hist_max_error is None")
+        sample = self._hist_sample
+        if sample is None:
+            raise ValueError("No image integrated yet")
+        return histogram(sample, irange)
+
     def add_integration_metadata(self, mda, mdb):
         """
         add mdb to mda, and update mda with the result
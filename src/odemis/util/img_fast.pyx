@@ -95,7 +95,7 @@ def wrapDataArray2RGB(numpy.ndarray[uint16_t, ndim=2] data not None,
     cDataArray2RGB(&data[0,0], data.size, irange[0], irange[1], ctint, &ret[0,0,0])
 
 
-def DataArray2RGB(data, irange, tint=(255, 255, 255)):
+def DataArray2RGB(data, irange, tint=(255, 255, 255), out=None):
     if not data.flags.c_contiguous:
         raise ValueError("Optimised version only works with C-contiguous arrays")
     if data.dtype != numpy.uint16:
@@ -108,7 +108,10 @@ def DataArray2RGB(data, irange, tint=(255, 255, 255)):
     # know how.
     if irange[0] >= irange[1]:
         raise ValueError("irange needs to be a tuple of low/high values")
-    ret = numpy.empty(data.shape + (3,), dtype=numpy.uint8)
-    wrapDataArray2RGB(data, irange, tint, ret)
-    return ret
+    if out is None:
+        out = numpy.empty(data.shape + (3,), dtype=numpy.uint8)
+    elif out.shape != data.shape + (3,) or not out.flags.c_contiguous:
+        raise ValueError("Optimised version only works with C-contiguous RGB output")
+    wrapDataArray2RGB(data, irange, tint, out)
+    return out
 
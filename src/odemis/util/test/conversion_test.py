@@ -316,6 +316,17 @@ class TestConversion(unittest.TestCase):
         tile_md_pos = get_tile_md_pos((1, 1), (TILE_SIZE, TILE_SIZE), tile, origda)
         numpy.testing.assert_almost_equal(tile_md_pos, [0.00065225309200, -0.00051098638647])
 
+        # Z stack: the Z position is kept as-is
+        orig_md[model.MD_POS] = BASE_MD_POS + (3e-6,)
+        orig_md[model.MD_PIXEL_SIZE] = (1e-6, 1e-6, 5e-6)
+        orig_md[model.MD_DIMS] = "ZYX"
+        tile_md[model.MD_PIXEL_SIZE] = (4e-6, 4e-6, 5e-6)
+        tile_md[model.MD_DIMS] = "ZYX"
+        tile = model.DataArray(numpy.zeros((3, TILE_SIZE, TILE_SIZE), numpy.uint8), tile_md)
+        origda = model.DataArray(numpy.zeros((3,) + img_shape, numpy.uint8), orig_md)
+        tile_md_pos = get_tile_md_pos((1, 1), (TILE_SIZE, TILE_SIZE), tile, origda)
+        numpy.testing.assert_almost_equal(tile_md_pos, [0.00065225309200, -0.00051098638647, 3e-6])
+
     def test_json_numpy(self):
 
         # Lots of types which are not supported by default
@@ -41,6 +41,7 @@ logging.getLogger().setLevel(logging.DEBUG)
 CONFIG_PATH = os.path.dirname(odemis.__file__) + "/../../install/linux/usr/share/odemis/"
 SECOM_CONFIG = CONFIG_PATH + "sim/secom-sim.odm.yaml"
 FSLM_CONFIG = CONFIG_PATH + "sim/sparc2-fslm-sim.odm.yaml"
+SPARC2_CONFIG = CONFIG_PATH + "sim/sparc2-sim.odm.yaml"
 
 
 class TestDriver(unittest.TestCase):
@@ -73,6 +74,62 @@ class TestDriver(unittest.TestCase):
         if need_stop:
             testing.stop_backend()
 
+    def test_startup_speed(self):
+        """
+        Measure the time to get a fully connected microscope (as the GUI does at
+        start-up), and the time to get the state of all the VAs of all the
+        components (as odemis-cli --list-prop does), by reading each VA, or via
+        the bulk description. The durations depend on the load of the
+        computer, so they are only reported.
+        """
+        for config in (SECOM_CONFIG, SPARC2_CONFIG):
+            try:
+                testing.start_backend(config)
+            except LookupError:
+                logging.info("A running backend is already found, skipping startup benchmark")
+                return
+            except IOError as exp:
+                logging.error(str(exp))
+                raise
+
+            try:
+                # Connect to the microscope, all the components, and their VAs
+                model._core._microscope = None  # force reset of the microscope for next connection
+                tstart = time.time()
+                model.getMicroscope()
+                comps = model.getComponents()
+                nvas = 0
+                for c in comps:
+                    c._pyroBind()
+                    for va in model.getVAs(c).values():
+                        va._pyroBind()
+                        nvas += 1
+                dur_connect = time.time() - tstart
+
+                # Read the state of all the VAs
+                model._core._microscope = None
+                tstart = time.time()
+                comps = model.getComponents()
+                for c in comps:
+                    for va in model.getVAs(c).values():
+                        va.value
+                dur_va = time.time() - tstart
+
+                model._core._microscope = None
+                tstart = time.time()
+                comps = model.getComponents()
+                descs = model.describeComponents(comps)
+                dur_desc = time.time() - tstart
+
+                logging.info("%s: %d components with %d VAs connected in %g s. "
+                             "State of all VAs read in %g s by reading each VA, "
+                             "and %g s via bulk description",
+                             os.path.basename(config), len(comps), nvas, dur_connect,
+                             dur_va, dur_desc)
+                self.assertEqual(set(descs.keys()), {c.name for c in comps})
+            finally:
+                testing.stop_backend()
+
     def test_memoryUsage(self):
         m = readMemoryUsage()
         self.assertGreater(m, 1)
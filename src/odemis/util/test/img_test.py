@@ -337,6 +337,188 @@ class TestHistogram(unittest.TestCase):
         self.assertEqual(len(chist), 201)
         self.assertEqual(numpy.sum(chist), numpy.sum(hist))
 
+    def assert_same_as_numpy(self, data, irange=None):
+        """
+        Check that histogram() returns exactly the same bins as numpy.histogram()
+        """
+        hist, edges = img.histogram(data, irange)
+        if irange is None:
+            irange = (int(data.min()), int(data.max()))
+            if data.itemsize <= 2:
+                idt = numpy.iinfo(data.dtype)
+                irange = (idt.min, idt.max)
+        length = min(8192, irange[1] - irange[0] + 1)
+        exp_hist, exp_edges = numpy.histogram(data, bins=length, range=irange)
+        numpy.testing.assert_array_equal(hist, exp_hist)
+        self.assertEqual(hist.dtype, exp_hist.dtype)
+        self.assertEqual(edges, (max(irange[0], exp_edges[0]), min(irange[1], exp_edges[-1])))
+
+    def test_int_same_as_numpy(self):
+        """
+        Check the fast path for signed and big ints gives the same result as numpy
+        """
+        size = (512, 300)
+        rng = numpy.random.default_rng(0)
+        for dtype, vrange, iranges in (
+                ("int8", (-128, 127), [None, (-128, 127), (-10, 100)]),
+                ("int16", (-32768, 32767), [None, (-1000, 20000), (0, 4095)]),
+                ("uint16", (0, 65535), [(100, 4000), (1000, 30000)]),
+                ("int32", (-5000, 100000), [None, (-10000, 10000), (0, 2 ** 31 - 1)]),
+                ("uint32", (0, 70000), [None, (0, 2 ** 32 - 1), (15, 5000), (200000, 300000)]),
+                ("int64", (-2 ** 40, -2 ** 40 + 500000), [None, (-2 ** 40, -2 ** 40 + 1000)]),
+                ("uint64", (2 ** 63, 2 ** 63 + 5000), [None, (2 ** 63, 2 ** 63 + 1000)]),
+                ("uint64", (0, 200), [None, (3, 3), (10, 20000)]),
+                ):
+            data = rng.integers(vrange[0], vrange[1], size=size, dtype=dtype, endpoint=True)
+            for irange in iranges:
+                logging.debug("Checking histogram of %s in %s", dtype, irange)
+                self.assert_same_as_numpy(data, irange)
+                # Also non-contiguous
+                self.assert_same_as_numpy(data[::3, ::2], irange)
+
+        # Too many different values to count them: still the same result
+        data = rng.integers(0, 2 ** 32 - 1, size=size, dtype="uint32")
+        self.assert_same_as_numpy(data)
+
+    def test_int_speed(self):
+        """
+        Compare the speed of histogram() with numpy.histogram() on signed and big ints
+        """
+        size = (2048, 2048)
+        rng = numpy.random.default_rng(0)
+        for dtype, vrange, irange in (
+                ("int16", (-2000, 2000), (-32768, 32767)),
+                ("int16", (-2000, 2000), (-2048, 2047)),
+                ("uint16", (100, 4000), (100, 4095)),
+                ("int32", (-100000, 100000), None),
+                ("uint32", (0, 255 * 100), None),  # Typical of an integration of uint8
+                ("int64", (0, 1000), None),
+                ):
+            # Note: with many different values (eg, uint32 over 2**20 values),
+            # numpy.histogram() is used directly, so it's not faster.
+            data = rng.integers(vrange[0], vrange[1], size=size, dtype=dtype, endpoint=True)
+            n = 5
+            tstart = time.time()
+            for i in range(n):
+                img.histogram(data, irange)
+            dur_fast = (time.time() - tstart) / n
+
+            tstart = time.time()
+            for i in range(n):
+                rng_np = irange or (data.min(), data.max())
+                numpy.histogram(data, bins=min(8192, int(rng_np[1]) - int(rng_np[0]) + 1), range=rng_np)
+            dur_np = (time.time() - tstart) / n
+
+            logging.info("Histogram of %s %s took %g ms, vs %g ms with numpy.histogram",
+                         dtype, size, dur_fast * 1e3, dur_np * 1e3)
+            self.assertLess(dur_fast, dur_np)
+
+    def test_subsample(self):
+        """
+        Test histogram() with a maximum error => only a subset of the data is used
+        """
+        max_error = 0.005
+        n = img.getHistogramSampleSize(max_error)
+        rng = numpy.random.default_rng(0)
+        grey_img = rng.normal(2000, 300, size=(2048, 2048)).clip(0, 4095).astype(numpy.uint16)
+        hist, edges = img.histogram(grey_img, (0, 4095))
+        hists, edgess = img.histogram(grey_img, (0, 4095), max_error=max_error)
+        self.assertEqual(edgess, edges)
+        self.assertEqual(hists.shape, hist.shape)
+        self.assertLess(hists.sum(), grey_img.size / 2)
+        self.assertGreaterEqual(hists.sum(), n / 2)
+
+        # The cumulative distributions should be within the error
+        cdf = hist.cumsum() / hist.sum()
+        cdfs = hists.cumsum() / hists.sum()
+        self.assertLessEqual(numpy.abs(cdf - cdfs).max(), max_error)
+
+        # So the auto B/C range is (nearly) the same
+        for outliers in (0.01, 1 / 256):
+            rng_full = img.findOptimalRange(hist, edges, outliers)
+            rng_sampled = img.findOptimalRange(hists, edgess, outliers)
+            self.assertAlmostEqual(rng_full[0], rng_sampled[0], delta=50)
+            self.assertAlmostEqual(rng_full[1], rng_sampled[1], delta=50)
+
+        # Non-contiguous data, and float
+        fimg = grey_img.astype(numpy.float32)[:, ::2]
+        hists, edgess = img.histogram(fimg, max_error=max_error)
+        self.assertLess(hists.sum(), fimg.size / 2)
+        self.assertGreaterEqual(edgess[0], fimg.min())
+        self.assertLessEqual(edgess[1], fimg.max())
+
+        # Small images are not subsampled
+        small_img = grey_img[:64, :64]
+        hists, edgess = img.histogram(small_img, (0, 4095), max_error=max_error)
+        self.assertEqual(hists.sum(), small_img.size)
+
+        with self.assertRaises(ValueError):
+            img.getHistogramSampleSize(1)
+
+    def test_subsample_speed(self):
+        """
+        Compare the speed of computing the histogram of a large image fully and subsampled
+        """
+        grey_img = numpy.random.randint(0, 4096, size=(4096, 4096), dtype=numpy.uint16)
+        n = 10
+        tstart = time.time()
+        for i in range(n):
+            img.histogram(grey_img, (0, 4095))
+        dur_full = (time.time() - tstart) / n
+
+        tstart = time.time()
+        for i in range(n):
+            img.histogram(grey_img, (0, 4095), max_error=img.HISTOGRAM_LIVE_MAX_ERROR)
+        dur_sampled = (time.time() - tstart) / n
+
+        logging.info("Histogram of 4096x4096 px took %g ms, and %g ms subsampled",
+                     dur_full * 1e3, dur_sampled * 1e3)
+        self.assertLess(dur_sampled, dur_full)
+
+    def test_running(self):
+        """
+        Test RunningHistogram
+        """
+        rhist = img.RunningHistogram((0, 255))
+        self.assertEqual(len(rhist.hist), 0)
+        with self.assertRaises(ValueError):
+            rhist.getRange()
+
+        im1 = numpy.zeros((100, 100), dtype=numpy.uint8) + 10
+        im2 = numpy.zeros((100, 100), dtype=numpy.uint8) + 200
+        rhist.add(im1)
+        bins = rhist.hist
+        self.assertEqual(rhist.edges, (0, 255))
+        self.assertEqual(bins[10], im1.size)
+        self.assertEqual(rhist.getRange(), (10, 10))
+
+        rhist.add(im2)
+        self.assertIs(rhist.hist, bins)  # Same array updated
+        self.assertEqual(bins.sum(), im1.size + im2.size)
+        self.assertEqual(rhist.getRange(), (10, 200))
+
+        rhist.reset()
+        self.assertIs(rhist.hist, bins)
+        self.assertEqual(bins.sum(), 0)
+        rhist.add(im2)
+        self.assertEqual(rhist.getRange(), (200, 200))
+
+        # Values above the range end up in the last bin
+        rhist = img.RunningHistogram((0, 99))
+        rhist.add(numpy.arange(200, dtype=numpy.uint16))
+        self.assertEqual(rhist.hist.size, 100)
+        self.assertEqual(rhist.hist.sum(), 200)
+        self.assertEqual(rhist.hist[-1], 101)
+
+        # Subsampled
+        rhist = img.RunningHistogram((0, 4095), max_error=0.01)
+        im = numpy.random.randint(0, 4096, size=(2048, 2048), dtype=numpy.uint16)
+        rhist.add(im)
+        self.assertLess(rhist.hist.sum(), im.size)
+        lo, hi = rhist.getRange(0.1)
+        self.assertAlmostEqual(lo, 0.1 * 4096, delta=0.02 * 4096)
+        self.assertAlmostEqual(hi, 0.9 * 4096, delta=0.02 * 4096)
+
 
 class TestDataArray2RGB(unittest.TestCase):
     @staticmethod
@@ -645,6 +827,72 @@ class TestDataArray2RGB(unittest.TestCase):
         self.assertGreater(hist[-1], 0)
         self.assertEqual(hist[-2], 0)
 
+    def test_out(self):
+        """test writing the result in a given RGB or BGRA array"""
+        shape = (512, 300)
+        tint = (0, 73, 255)
+        for dtype in ("uint8", "int8", "uint16", "int16", "uint32", "int64", "float32", "float64"):
+            data = numpy.arange(shape[0] * shape[1]).reshape(shape).astype(dtype)
+            irange = (data.min(), data.max() // 2)
+            exp = img.DataArray2RGB(data, irange, tint)
+
+            out = numpy.zeros(shape + (3,), dtype=numpy.uint8)
+            ret = img.DataArray2RGB(data, irange, tint, out=out)
+            self.assertIs(ret, out)
+            numpy.testing.assert_array_equal(out, exp)
+
+            out = numpy.zeros(shape + (4,), dtype=numpy.uint8)
+            img.DataArray2RGB(data, irange, tint, out=out)
+            # BGR. ±1, as uint16 RGB might have been converted by the fast (Cython) conversion
+            numpy.testing.assert_allclose(out[..., 2::-1].astype(int), exp, atol=1)
+            self.assertTrue(numpy.all(out[..., 3] == 255))
+
+        with self.assertRaises(ValueError):
+            img.DataArray2RGB(data, irange, tint, out=numpy.zeros(shape + (2,), dtype=numpy.uint8))
+        with self.assertRaises(ValueError):
+            img.DataArray2RGB(data, irange, tint, out=numpy.zeros((3,) + shape, dtype=numpy.uint8))
+
+    def test_lut(self):
+        """test the conversion via a look-up table gives the same result as computing it"""
+        shape = (256, 100)
+        tint = (200, 73, 255)
+        data = numpy.random.randint(-2 ** 15, 2 ** 15, shape).astype(numpy.int16)
+        irange = (-20000, 25000)
+        out_lut = img.DataArray2RGB(data, irange, tint)
+        out_comp = img.DataArray2RGB(data.astype(numpy.int32), irange, tint)
+        numpy.testing.assert_array_equal(out_lut, out_comp)
+
+        # The same look-up table is reused
+        img.DataArray2RGB(data, irange, tint)
+        self.assertGreater(img._getIntLUT.cache_info().hits, 0)
+
+    def test_zyx(self):
+        """test data with more than 2 dimensions"""
+        data = numpy.arange(4 * 20 * 30, dtype=numpy.float32).reshape(4, 20, 30)
+        out = img.DataArray2RGB(data, (0, 2399), (255, 0, 255))
+        self.assertEqual(out.shape, data.shape + (3,))
+        self.assertTrue(numpy.all(out[..., 1] == 0))
+        self.assertEqual(out[0, 0, 0, 0], 0)
+        self.assertEqual(out[-1, -1, -1, 0], 255)
+
+    def test_speed(self):
+        """Benchmark the conversion of large images, for each dtype"""
+        tint = (0, 73, 255)
+        for dtype in ("uint8", "uint16", "int16", "uint32", "float32", "float64"):
+            for size in (1024, 2048, 4096, 8192):
+                data = numpy.random.randint(0, 200, (size, size)).astype(dtype)
+                irange = (10, 180)
+                out = numpy.empty((size, size, 4), dtype=numpy.uint8)
+                n = max(1, 4096 // size)
+                tstart = time.time()
+                for i in range(n):
+                    img.DataArray2RGB(data, irange, tint, out=out)
+                dur = (time.time() - tstart) / n
+                logging.info("Converted %s image of %dx%d px to BGRA in %g s (%g Mpx/s)",
+                             dtype, size, size, dur, size * size / dur / 1e6)
+                self.assertTrue(numpy.all(out[..., 2] == 0))  # R == 0
+                del data, out
+
 
 class TestBin(unittest.TestCase):
 
@@ -820,6 +1068,22 @@ class TestRescaleHQ(unittest.TestCase):
         self.assertEqual(out[15, 30], watermark)
         self.assertEqual(out[30, 60], background)
 
+    def test_int32(self):
+        """
+        Test a dtype not supported by OpenCV (eg, the result of a subtraction)
+        """
+        size = (1024, 512)
+        background = -2 ** 20
+        img32 = numpy.zeros(size, dtype=numpy.int32) + background
+        watermark = 538
+        img32[20:40, 50:70] = watermark
+
+        out = img.rescale_hq(img32, (512, 256))
+        self.assertEqual(out.shape, (512, 256))
+        self.assertEqual(out.dtype, img32.dtype)
+        self.assertEqual(out[15, 30], watermark)
+        self.assertEqual(out[30, 60], background)
+
     def test_smoothness(self):
         size = (100, 100)
         img_in = numpy.zeros(size, dtype="uint8")
@@ -1077,6 +1341,39 @@ class TestImageIntegrator(unittest.TestCase):
 
         numpy.testing.assert_equal(self.integrated_data, (numpy.array([1, 1, 1, 1, 1])))
 
+    def test_histogram(self):
+        """
+        Test the histogram computed from the subset maintained by the integrator
+        """
+        self.img_intor = img.ImageIntegrator(self.integrationCounts)
+        self.img_intor.append(self.data)
+        with self.assertRaises(ValueError):
+            self.img_intor.getHistogram()
+
+        md = self.data.metadata.copy()
+        md[model.MD_DET_TYPE] = model.MD_DT_NORMAL
+        md[model.MD_BASELINE] = 100
+        ims = [model.DataArray(numpy.random.randint(100, 4096, size=(2048, 2048), dtype=numpy.uint16), md)
+               for i in range(self.integrationCounts)]
+        self.img_intor = img.ImageIntegrator(self.integrationCounts, hist_max_error=0.01)
+        for im in ims:
+            integ_img = self.img_intor.append(im)
+            hist, edges = self.img_intor.getHistogram((0, 4095 * self.integrationCounts))
+            self.assertLess(hist.sum(), integ_img.size)
+            hist_full, edges_full = img.histogram(integ_img, (0, 4095 * self.integrationCounts))
+            self.assertEqual(edges, edges_full)
+            cdf = hist_full.cumsum() / hist_full.sum()
+            cdfs = hist.cumsum() / hist.sum()
+            self.assertLessEqual(numpy.abs(cdf - cdfs).max(), 0.01)
+
+        # The last image is the average, with the baseline removed
+        self.assertEqual(integ_img.dtype, numpy.uint16)
+        hist, edges = self.img_intor.getHistogram((0, 4095))
+        lo, hi = img.findOptimalRange(hist, edges, 0.01)
+        lo_full, hi_full = img.getOutliers(integ_img, 0.01)
+        self.assertAlmostEqual(lo, lo_full, delta=40)
+        self.assertAlmostEqual(hi, hi_full, delta=40)
+
 
 class TestMergeTiles(unittest.TestCase):
 
@@ -2120,5 +2417,76 @@ class TestFloodFill(unittest.TestCase):
         filled_array = img.apply_flood_fill(a, (2, 2))
         numpy.testing.assert_array_equal(expected_array, filled_array)
 
+class SlowPyramid(img.DataArrayShadowPyramidalMemory):
+    """
+    Pyramidal image which takes time to read each tile (like over the network)
+    """
+    delay = 0.1  # s
+
+    def getTile(self, x, y, zoom):
+        time.sleep(self.delay)
+        return super().getTile(x, y, zoom)
+
+
+class TestTileLoader(unittest.TestCase):
+
+    def setUp(self):
+        data = model.DataArray(numpy.arange(1024 * 2048, dtype=numpy.uint16).reshape(1024, 2048),
+                               {model.MD_PIXEL_SIZE: (1e-6, 1e-6), model.MD_POS: (0, 0)})
+        self.das = SlowPyramid(data, background=False)
+
+    def test_concurrent(self):
+        """
+        Tiles requested are read in parallel, and the callback is called for each of them
+        """
+        cache = {}
+        loaded = []
+        loader = img.TileLoader(self.das, cache, nworkers=8,
+                                callback=lambda x, y, z: loaded.append((x, y, z)))
+        keys = [(x, y, 0) for x in range(8) for y in range(4)]
+        tstart = time.time()
+        loader.request(keys)
+        tiles = {k: loader.get(*k) for k in keys}
+        dur = time.time() - tstart
+        logging.info("Read %d tiles in %g s", len(keys), dur)
+        self.assertLess(dur, len(keys) * self.das.delay / 2)
+
+        # Check the content of the tiles (slowly), outside of the time measurement
+        for k, tile in tiles.items():
+            numpy.testing.assert_array_equal(tile, self.das.getTile(*k))
+        time.sleep(0.1)  # Callback is called just after the tile is stored
+        self.assertEqual(set(loaded), set(keys))
+
+    def test_prefetch(self):
+        cache = {}
+        loaded = []
+        loader = img.TileLoader(self.das, cache, nworkers=2,
+                                callback=lambda x, y, z: loaded.append((x, y, z)))
+        loader.request([(0, 0, 1)], prefetch=[(1, 0, 1), (0, 0, 2)])
+        loader.get(0, 0, 1)
+        time.sleep(self.das.delay * 3)
+        self.assertIn((1, 0, 1), cache)
+        self.assertIn((0, 0, 2), cache)
+        # No callback for the prefetched tiles
+        self.assertEqual(loaded, [(0, 0, 1)])
+
+        # Already in cache => immediately returned
+        tstart = time.time()
+        loader.get(1, 0, 1)
+        self.assertLess(time.time() - tstart, self.das.delay)
+
+        # A new request cancels the prefetching not yet started
+        loader.request([], prefetch=[(x, 1, 0) for x in range(8)])
+        loader.request([(0, 2, 0)])
+        time.sleep(self.das.delay * 4)
+        self.assertIn((0, 2, 0), cache)
+        self.assertLess(sum((x, 1, 0) in cache for x in range(8)), 4)
+
+    def test_error(self):
+        loader = img.TileLoader(self.das, {})
+        with self.assertRaises(ValueError):
+            loader.get(0, 0, 20)  # Bad zoom level
+
+
 if __name__ == "__main__":
     unittest.main()
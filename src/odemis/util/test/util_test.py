@@ -139,6 +139,48 @@ class TestExectuteTask(unittest.TestCase):
         return -1
 
 
+class LRUCacheTestCase(unittest.TestCase):
+
+    def test_size_limit(self):
+        cache = util.LRUCache(3000)
+        for i in range(3):
+            cache[i] = numpy.zeros(1000, dtype=numpy.uint8)
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(cache.size, 3000)
+
+        # Use the first one => the second one is discarded on the next addition
+        cache[0]
+        cache[3] = numpy.zeros(1000, dtype=numpy.uint8)
+        self.assertEqual(cache.size, 3000)
+        self.assertIn(0, cache)
+        self.assertNotIn(1, cache)
+        self.assertIsNone(cache.get(1))
+        with self.assertRaises(KeyError):
+            cache[1]
+
+        # Replacing a value updates the size
+        cache[3] = numpy.zeros(10, dtype=numpy.uint16)
+        self.assertEqual(cache.size, 2020)
+        del cache[3]
+        self.assertEqual(cache.size, 2000)
+
+        # Too big values are still kept, but alone
+        cache["big"] = numpy.zeros(5000, dtype=numpy.uint8)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.size, 5000)
+
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.size, 0)
+
+    def test_sizeof(self):
+        cache = util.LRUCache(10, sizeof=len)
+        cache["a"] = "12345"
+        cache["b"] = "123456"
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache["b"], "123456")
+
+
 class SortedAccordingTestCase(unittest.TestCase):
 
     def test_simple(self):